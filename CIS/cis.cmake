@@ -130,6 +130,14 @@ ELSE()
 ENDIF()
 
 ADD_LIBRARY(cis
+  CIS/sources/CISCache.cxx
+  CIS/sources/CISJacobian.cxx
+  CIS/sources/CISCodeAnalysis.cxx
+  CIS/sources/CISLookupTables.cxx
+  CIS/sources/CISInterpreter.cxx
+  CIS/sources/CISResultFile.cxx
+  CIS/sources/CISResults.cxx
+  CIS/sources/CISScheduler.cxx
   CIS/sources/CISImplementation.cxx
   CIS/sources/CISSolve.cxx
   ${SUNDIALS_SOURCES}
@@ -161,8 +169,14 @@ ENDIF()
 IF(NOT PTHREADS STREQUAL "PTHREADS-NOTFOUND")
   LIST(APPEND THREADLIBRARY pthreads)
 ENDIF()
+# Older C libraries keep clock_gettime in librt.
+FIND_LIBRARY(RT rt)
+SET(MAYBERT)
+IF(NOT WIN32 AND NOT RT STREQUAL "RT-NOTFOUND")
+  SET(MAYBERT rt)
+ENDIF()
 
-TARGET_LINK_LIBRARIES(cis ccgs malaes cuses cevas cellml ${MAYBEGSL} ${THREADLIBRARY} ${CMAKE_DL_LIBS} ${SYSTEM_SUNDIALS} ${CLANG_LIBRARIES} ${LLVM_LIBRARIES})
+TARGET_LINK_LIBRARIES(cis ccgs malaes cuses cevas cellml ${MAYBEGSL} ${THREADLIBRARY} ${MAYBERT} ${CMAKE_DL_LIBS} ${SYSTEM_SUNDIALS} ${CLANG_LIBRARIES} ${LLVM_LIBRARIES})
 SET_TARGET_PROPERTIES(cis PROPERTIES VERSION ${GLOBAL_VERSION} SOVERSION ${CIS_SOVERSION})
 
 DECLARE_BOOTSTRAP("CISBootstrap" "CIS" "CellMLIntegrationService" "cellml_services" "createIntegrationService" "CreateIntegrationService" "CISBootstrap.hpp" "CIS/sources" "cis")
@@ -170,6 +184,18 @@ DECLARE_BOOTSTRAP("CISBootstrap" "CIS" "CellMLIntegrationService" "cellml_servic
 IF (BUILD_TESTING)
   ADD_EXECUTABLE(RunCellML CIS/tests/RunCellML.cpp)
   TARGET_LINK_LIBRARIES(RunCellML cellml ccgs cuses cevas malaes annotools cis)
+  ADD_EXECUTABLE(TimeControlCheck CIS/tests/TimeControlCheck.cpp)
+  TARGET_LINK_LIBRARIES(TimeControlCheck cellml ${THREADLIBRARY})
+  # These are built with the sources they check, which the library doesn't
+  # export.
+  ADD_EXECUTABLE(OptimiseCodeCheck CIS/tests/OptimiseCodeCheck.cpp
+    CIS/sources/CISJacobian.cxx CIS/sources/CISInterpreter.cxx)
+  TARGET_LINK_LIBRARIES(OptimiseCodeCheck cellml cis ${THREADLIBRARY})
+  ADD_TEST(OptimiseCodeCheck OptimiseCodeCheck)
+  ADD_EXECUTABLE(HoistInvariantCheck CIS/tests/HoistInvariantCheck.cpp
+    CIS/sources/CISCodeAnalysis.cxx CIS/sources/CISInterpreter.cxx)
+  TARGET_LINK_LIBRARIES(HoistInvariantCheck cellml cis ${THREADLIBRARY})
+  ADD_TEST(HoistInvariantCheck HoistInvariantCheck)
   ADD_TEST(CheckCIS ${BASH} ${CMAKE_CURRENT_SOURCE_DIR}/tests/RetryWrapper ${CMAKE_CURRENT_SOURCE_DIR}/tests/CheckCIS)
   DECLARE_TEST_LIB(cis)
 ENDIF()
@@ -0,0 +1,420 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "Utilities.hxx"
+#include "CISCache.hxx"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <errno.h>
+#include <algorithm>
+#include <vector>
+#include <sys/stat.h>
+#include <sys/types.h>
+#ifndef WIN32
+#include <dirent.h>
+#include <utime.h>
+#include <unistd.h>
+#include <sys/utsname.h>
+#else
+#include <io.h>
+#include <direct.h>
+#include <process.h>
+#include <sys/utime.h>
+#endif
+
+#ifndef CIS_LIBRARY_VERSION
+#define CIS_LIBRARY_VERSION "unknown"
+#endif
+
+// Temporary files older than this are assumed to have been left behind by a
+// process that died part way through storing an entry.
+#define STALE_TEMPORARY_AGE 3600
+
+#define DEFAULT_CACHE_SIZE_MB 256
+
+static CDAMutex sTemporaryMutex;
+static uint32_t sTemporaryCount = 0;
+
+static const uint32_t kSHA256RoundConstants[64] = {
+  0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+  0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+  0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+  0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+  0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+  0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+  0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+  0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+  0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+  0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+  0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+};
+
+#define ROTR32(x, n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+ContentDigest::ContentDigest()
+  : mLength(0), mBufferUsed(0)
+{
+  mState[0] = 0x6a09e667;
+  mState[1] = 0xbb67ae85;
+  mState[2] = 0x3c6ef372;
+  mState[3] = 0xa54ff53a;
+  mState[4] = 0x510e527f;
+  mState[5] = 0x9b05688c;
+  mState[6] = 0x1f83d9ab;
+  mState[7] = 0x5be0cd19;
+}
+
+void
+ContentDigest::processBlock(const uint8_t* aBlock)
+{
+  uint32_t w[64];
+  uint32_t i;
+  for (i = 0; i < 16; i++)
+    w[i] = (((uint32_t)aBlock[i * 4]) << 24) |
+      (((uint32_t)aBlock[i * 4 + 1]) << 16) |
+      (((uint32_t)aBlock[i * 4 + 2]) << 8) |
+      ((uint32_t)aBlock[i * 4 + 3]);
+  for (; i < 64; i++)
+  {
+    uint32_t s0 = ROTR32(w[i - 15], 7) ^ ROTR32(w[i - 15], 18) ^ (w[i - 15] >> 3);
+    uint32_t s1 = ROTR32(w[i - 2], 17) ^ ROTR32(w[i - 2], 19) ^ (w[i - 2] >> 10);
+    w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+  }
+
+  uint32_t a = mState[0], b = mState[1], c = mState[2], d = mState[3],
+    e = mState[4], f = mState[5], g = mState[6], h = mState[7];
+  for (i = 0; i < 64; i++)
+  {
+    uint32_t S1 = ROTR32(e, 6) ^ ROTR32(e, 11) ^ ROTR32(e, 25);
+    uint32_t ch = (e & f) ^ (~e & g);
+    uint32_t t1 = h + S1 + ch + kSHA256RoundConstants[i] + w[i];
+    uint32_t S0 = ROTR32(a, 2) ^ ROTR32(a, 13) ^ ROTR32(a, 22);
+    uint32_t maj = (a & b) ^ (a & c) ^ (b & c);
+    uint32_t t2 = S0 + maj;
+    h = g;
+    g = f;
+    f = e;
+    e = d + t1;
+    d = c;
+    c = b;
+    b = a;
+    a = t1 + t2;
+  }
+
+  mState[0] += a;
+  mState[1] += b;
+  mState[2] += c;
+  mState[3] += d;
+  mState[4] += e;
+  mState[5] += f;
+  mState[6] += g;
+  mState[7] += h;
+}
+
+void
+ContentDigest::update(const void* aData, size_t aLength)
+{
+  const uint8_t* p = static_cast<const uint8_t*>(aData);
+  mLength += aLength;
+  while (aLength > 0)
+  {
+    size_t n = 64 - mBufferUsed;
+    if (n > aLength)
+      n = aLength;
+    memcpy(mBuffer + mBufferUsed, p, n);
+    mBufferUsed += n;
+    p += n;
+    aLength -= n;
+    if (mBufferUsed == 64)
+    {
+      processBlock(mBuffer);
+      mBufferUsed = 0;
+    }
+  }
+}
+
+std::string
+ContentDigest::hexDigest()
+{
+  uint64_t bitLength = mLength * 8;
+  uint8_t pad = 0x80;
+  update(&pad, 1);
+  pad = 0;
+  while (mBufferUsed != 56)
+    update(&pad, 1);
+  uint8_t lenBytes[8];
+  for (uint32_t i = 0; i < 8; i++)
+    lenBytes[i] = (uint8_t)(bitLength >> (56 - 8 * i));
+  update(lenBytes, 8);
+
+  static const char* hex = "0123456789abcdef";
+  std::string ret;
+  for (uint32_t i = 0; i < 8; i++)
+    for (int j = 28; j >= 0; j -= 4)
+      ret += hex[(mState[i] >> j) & 0xF];
+  return ret;
+}
+
+static bool
+make_directories(const std::string& aPath)
+{
+  size_t pos = 0;
+  while (true)
+  {
+    pos = aPath.find_first_of("/\\", pos + 1);
+    std::string part = aPath.substr(0, pos);
+    if (part != "" && mkdir(part.c_str()
+#ifndef WIN32
+                            , 0700
+#endif
+                           ) != 0 && errno != EEXIST)
+      return false;
+    if (pos == std::string::npos)
+      return true;
+  }
+}
+
+CompiledObjectCache::CompiledObjectCache(const char* aSuffix)
+  : mEnabled(false), mSuffix(aSuffix),
+    mSizeLimit(((uint64_t)DEFAULT_CACHE_SIZE_MB) << 20)
+{
+  const char* size = getenv("CELLML_CIS_CACHE_SIZE");
+  if (size != NULL)
+    mSizeLimit = strtoull(size, NULL, 10) << 20;
+  if (mSizeLimit == 0)
+    return;
+
+  const char* dir = getenv("CELLML_CIS_CACHE_DIR");
+  if (dir != NULL)
+    mDirectory = dir;
+  else
+  {
+#ifdef WIN32
+    const char* base = getenv("LOCALAPPDATA");
+    if (base == NULL)
+      return;
+    mDirectory = base;
+    mDirectory += "\\cellml-api\\cis";
+#else
+    const char* base = getenv("XDG_CACHE_HOME");
+    if (base != NULL && base[0] != 0)
+      mDirectory = base;
+    else
+    {
+      base = getenv("HOME");
+      if (base == NULL || base[0] == 0)
+        return;
+      mDirectory = base;
+      mDirectory += "/.cache";
+    }
+    mDirectory += "/cellml-api/cis";
+#endif
+  }
+  if (mDirectory == "" || !make_directories(mDirectory))
+    return;
+
+#ifndef WIN32
+  // Anyone who can write to the cache can get code loaded into our process,
+  // so refuse to use a directory that somebody else controls.
+  struct stat st;
+  if (stat(mDirectory.c_str(), &st) != 0 || !S_ISDIR(st.st_mode) ||
+      st.st_uid != getuid() || (st.st_mode & (S_IWGRP | S_IWOTH)))
+    return;
+#endif
+
+  mEnabled = true;
+}
+
+std::string
+CompiledObjectCache::entryPath(const std::string& aKey)
+{
+  return mDirectory + "/" + aKey + mSuffix;
+}
+
+bool
+CompiledObjectCache::computeKey
+(
+ const std::string& aSource,
+ const std::string& aCompilerCommand,
+ std::string& aKey
+)
+{
+  ContentDigest digest;
+  // The source already holds the declarations of everything it uses from this
+  // library, so a change to those gives a new key even without a version
+  // bump, while rebuilding an unchanged library keeps the entries valid.
+  digest.update(std::string("CIS " CIS_LIBRARY_VERSION "\n"));
+#ifndef WIN32
+  utsname u;
+  uname(&u);
+  digest.update(std::string(u.sysname) + " " + u.machine + "\n");
+#endif
+  digest.update(aCompilerCommand + "\n");
+  digest.update(aSource);
+
+  aKey = digest.hexDigest();
+  return true;
+}
+
+bool
+CompiledObjectCache::lookup(const std::string& aKey, std::string& aPath)
+{
+  if (!mEnabled)
+    return false;
+
+  std::string path = entryPath(aKey);
+  struct stat st;
+  if (stat(path.c_str(), &st) != 0)
+    return false;
+
+  // Touch the entry so that eviction treats it as recently used.
+#ifdef WIN32
+  _utime(path.c_str(), NULL);
+#else
+  utime(path.c_str(), NULL);
+#endif
+  aPath = path;
+  return true;
+}
+
+void
+CompiledObjectCache::store(const std::string& aKey, const std::string& aModulePath)
+{
+  if (!mEnabled)
+    return;
+
+  // Several threads may be storing the same key at once, as well as other
+  // processes, so the temporary name includes both the process and a counter.
+  uint32_t serial;
+  {
+    CDALock l(sTemporaryMutex);
+    serial = sTemporaryCount++;
+  }
+  char tmpid[64];
+  sprintf(tmpid, ".%lu.%lu.tmp", (unsigned long)getpid(), (unsigned long)serial);
+  std::string tmp = mDirectory + "/" + aKey + tmpid;
+
+  FILE* in = fopen(aModulePath.c_str(), "rb");
+  if (in == NULL)
+    return;
+  FILE* out = fopen(tmp.c_str(), "wb");
+  if (out == NULL)
+  {
+    fclose(in);
+    return;
+  }
+
+  char buf[8192];
+  size_t n;
+  bool ok = true;
+  while (ok && (n = fread(buf, 1, sizeof(buf), in)) > 0)
+    ok = (fwrite(buf, 1, n, out) == n);
+  ok = ok && !ferror(in);
+  fclose(in);
+  ok = (fclose(out) == 0) && ok;
+
+  // The rename is atomic, so a concurrent lookup never sees a partial file.
+  // If another process stored the same key first, we simply replace it with
+  // an identical module.
+#ifdef WIN32
+  if (!ok || !MoveFileExA(tmp.c_str(), entryPath(aKey).c_str(),
+                          MOVEFILE_REPLACE_EXISTING))
+#else
+  if (!ok || rename(tmp.c_str(), entryPath(aKey).c_str()) != 0)
+#endif
+  {
+    unlink(tmp.c_str());
+    return;
+  }
+
+  evict();
+}
+
+struct CacheEntry
+{
+  time_t lastUsed;
+  uint64_t size;
+  std::string path;
+
+  bool operator<(const CacheEntry& aOther) const
+  {
+    return lastUsed < aOther.lastUsed;
+  }
+};
+
+static bool
+has_suffix(const std::string& aName, const std::string& aSuffix)
+{
+  return aName.size() >= aSuffix.size() &&
+    aName.compare(aName.size() - aSuffix.size(), aSuffix.size(), aSuffix) == 0;
+}
+
+void
+CompiledObjectCache::evict()
+{
+  std::vector<CacheEntry> entries;
+  uint64_t total = 0;
+  time_t now = time(0);
+
+#ifdef WIN32
+  struct _finddata_t d;
+  std::string pat = mDirectory + "/*";
+  intptr_t hd = _findfirst(pat.c_str(), &d);
+  if (hd == -1)
+    return;
+  do
+  {
+    std::string name = d.name;
+    CacheEntry e;
+    e.path = mDirectory + "/" + name;
+    e.lastUsed = d.time_write;
+    e.size = d.size;
+#else
+  DIR* dir = opendir(mDirectory.c_str());
+  if (dir == NULL)
+    return;
+  struct dirent* de;
+  while ((de = readdir(dir)))
+  {
+    std::string name = de->d_name;
+    CacheEntry e;
+    e.path = mDirectory + "/" + name;
+    struct stat st;
+    if (stat(e.path.c_str(), &st) != 0)
+      continue;
+    e.lastUsed = st.st_mtime;
+    e.size = st.st_size;
+#endif
+    if (has_suffix(name, ".tmp"))
+    {
+      if (now - e.lastUsed > STALE_TEMPORARY_AGE)
+        unlink(e.path.c_str());
+    }
+    else if (has_suffix(name, mSuffix))
+    {
+      entries.push_back(e);
+      total += e.size;
+    }
+  }
+#ifdef WIN32
+  while (_findnext(hd, &d) == 0);
+  _findclose(hd);
+#else
+  closedir(dir);
+#endif
+
+  if (total <= mSizeLimit)
+    return;
+
+  // Several processes may evict at once; if another process has already
+  // removed an entry, unlink simply fails and we move on. Modules that are
+  // currently loaded stay mapped after they are unlinked.
+  std::sort(entries.begin(), entries.end());
+  for (std::vector<CacheEntry>::iterator i = entries.begin();
+       i != entries.end() && total > mSizeLimit; i++)
+  {
+    unlink((*i).path.c_str());
+    total -= (*i).size;
+  }
+}
@@ -0,0 +1,91 @@
+#ifndef _CISCACHE_HXX
+#define _CISCACHE_HXX
+
+#include "cda_compiler_support.h"
+#include <string>
+#include <stdint.h>
+
+/**
+ * A SHA-256 digest, used to give compiled model code a content address.
+ */
+class ContentDigest
+{
+public:
+  ContentDigest();
+
+  void update(const void* aData, size_t aLength);
+  void update(const std::string& aData) { update(aData.data(), aData.size()); }
+  void update(const std::wstring& aData)
+  {
+    update(aData.data(), aData.size() * sizeof(wchar_t));
+  }
+
+  /**
+   * Finishes the digest and returns it as lower-case hexadecimal. The digest
+   * cannot be updated after this has been called.
+   */
+  std::string hexDigest();
+
+private:
+  void processBlock(const uint8_t* aBlock);
+
+  uint32_t mState[8];
+  uint64_t mLength;
+  uint8_t mBuffer[64];
+  uint32_t mBufferUsed;
+};
+
+/**
+ * A persistent, content-addressed cache of compiled model code modules,
+ * shared between all processes run by the same user.
+ *
+ * The cache is configured through the environment:
+ *   CELLML_CIS_CACHE_DIR: The directory holding cached modules. Defaults to
+ *     $XDG_CACHE_HOME/cellml-api/cis (or ~/.cache/cellml-api/cis; on Windows,
+ *     %LOCALAPPDATA%\cellml-api\cis). If set to an empty string, caching is
+ *     disabled.
+ *   CELLML_CIS_CACHE_SIZE: The maximum total size of cached modules, in
+ *     megabytes (default 256). Least recently used modules are evicted once
+ *     this is exceeded. A value of 0 disables caching.
+ *
+ * Entries are only ever written to a private temporary name and then renamed
+ * into place, so concurrent processes see either a complete module or none.
+ */
+class CompiledObjectCache
+{
+public:
+  CompiledObjectCache(const char* aSuffix);
+
+  bool isEnabled() { return mEnabled; }
+
+  /**
+   * Computes the cache key for source code compiled with the given compiler
+   * command line.
+   * @return false if no key could be computed.
+   */
+  bool computeKey(const std::string& aSource,
+                  const std::string& aCompilerCommand, std::string& aKey);
+
+  /**
+   * Looks up a key, marking the entry as recently used if it is present.
+   * @param aPath Set to the path of the cached module on success.
+   */
+  bool lookup(const std::string& aKey, std::string& aPath);
+
+  /**
+   * Copies a freshly compiled module into the cache, and evicts old entries
+   * if the cache is now over its size limit. Failure to store is silently
+   * ignored, since the cache is only an optimisation.
+   */
+  void store(const std::string& aKey, const std::string& aModulePath);
+
+private:
+  std::string entryPath(const std::string& aKey);
+  void evict();
+
+  bool mEnabled;
+  std::string mDirectory, mSuffix;
+  uint64_t mSizeLimit;
+};
+
+#endif // _CISCACHE_HXX
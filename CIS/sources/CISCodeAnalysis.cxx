@@ -0,0 +1,471 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "Utilities.hxx"
+#include "CISCodeAnalysis.hxx"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+#include <map>
+
+static const char* kCodeArrays[] =
+{
+  "CONSTANTS", "RATES", "STATES", "ALGEBRAIC", NULL
+};
+
+// Names which a statement can use without depending on anything but the
+// array elements it reads.
+static const char* kInvariantNames[] =
+{
+  "if", "else", "exp", "log", "pow", "sqrt", "sin", "cos", "tan", "sinh",
+  "cosh", "tanh", "asin", "acos", "atan", "asinh", "acosh", "atanh", "fabs",
+  "floor", "ceil", "arbitrary_log", NULL
+};
+
+static bool
+IsIn(const char** aNames, const std::string& aName)
+{
+  for (const char** n = aNames; *n; n++)
+    if (aName == *n)
+      return true;
+  return false;
+}
+
+static bool
+IsCodeArray(const std::string& aName)
+{
+  return IsIn(kCodeArrays, aName);
+}
+
+struct CodeToken
+{
+  std::string text;
+  bool isIdentifier, isNumber;
+  // The offset of the end of the token in the code.
+  size_t end;
+};
+
+// Thrown when code doesn't take the form SplitStatements expects.
+class CannotSplit
+{
+};
+
+static void
+Tokenise(const char* aCode, std::vector<CodeToken>& aTokens)
+{
+  const char* p = aCode;
+  while (true)
+  {
+    while (isspace(*p))
+      p++;
+    if (p[0] == '/' && p[1] == '*')
+    {
+      const char* end = strstr(p + 2, "*/");
+      if (end == NULL)
+        throw CannotSplit();
+      p = end + 2;
+      continue;
+    }
+    // Preprocessor lines can't be split between statements.
+    if (*p == '#' || *p == '"' || *p == '\'')
+      throw CannotSplit();
+    if (*p == 0)
+      return;
+
+    CodeToken t;
+    t.isIdentifier = t.isNumber = false;
+    const char* start = p;
+    if (isdigit(*p) || (*p == '.' && isdigit(p[1])))
+    {
+      t.isNumber = true;
+      while (isalnum(*p) || *p == '.' ||
+             ((*p == '+' || *p == '-') && (p[-1] == 'e' || p[-1] == 'E')))
+        p++;
+    }
+    else if (isalpha(*p) || *p == '_')
+    {
+      t.isIdentifier = true;
+      while (isalnum(*p) || *p == '_')
+        p++;
+    }
+    else
+    {
+      static const char* kTwoCharacter[] =
+        {"==", "!=", "<=", ">=", "&&", "||", "+=", "-=", "*=", "/=", "++",
+         "--", "->", NULL};
+      p++;
+      for (const char** op = kTwoCharacter; *op; op++)
+        if (start[0] == (*op)[0] && start[1] == (*op)[1])
+        {
+          p++;
+          break;
+        }
+    }
+    t.text.assign(start, p - start);
+    t.end = p - aCode;
+    aTokens.push_back(t);
+  }
+}
+
+class StatementSplitter
+{
+public:
+  StatementSplitter(const std::vector<CodeToken>& aTokens)
+    : mTokens(aTokens), mPos(0)
+  {
+  }
+
+  bool atEnd()
+  {
+    return mPos == mTokens.size();
+  }
+
+  // Skips over a statement, returning the index of the token after it.
+  size_t skipStatement()
+  {
+    if (is("if"))
+    {
+      while (true)
+      {
+        mPos++;
+        skipGroup("(", ")");
+        skipStatement();
+        if (!is("else"))
+          return mPos;
+        mPos++;
+        if (!is("if"))
+          return skipStatement();
+      }
+    }
+    if (is("{"))
+    {
+      skipGroup("{", "}");
+      return mPos;
+    }
+
+    // Declarations put names in scope for later statements.
+    if (mPos + 1 < mTokens.size() && mTokens[mPos].isIdentifier &&
+        mTokens[mPos + 1].isIdentifier)
+      throw CannotSplit();
+
+    int depth = 0;
+    while (true)
+    {
+      if (atEnd() || is("{") || is("}"))
+        throw CannotSplit();
+      if (is("(") || is("["))
+        depth++;
+      else if (is(")") || is("]"))
+        depth--;
+      else if (depth == 0 && is(";"))
+      {
+        mPos++;
+        return mPos;
+      }
+      mPos++;
+    }
+  }
+
+  size_t position()
+  {
+    return mPos;
+  }
+
+private:
+  bool is(const char* aText)
+  {
+    return !atEnd() && mTokens[mPos].text == aText;
+  }
+
+  void skipGroup(const char* aOpen, const char* aClose)
+  {
+    if (!is(aOpen))
+      throw CannotSplit();
+    int depth = 0;
+    do
+    {
+      if (atEnd())
+        throw CannotSplit();
+      if (is(aOpen))
+        depth++;
+      else if (is(aClose))
+        depth--;
+      mPos++;
+    }
+    while (depth != 0);
+  }
+
+  const std::vector<CodeToken>& mTokens;
+  size_t mPos;
+};
+
+static void
+AnalyseStatement(const std::vector<CodeToken>& aTokens, size_t aStart,
+                 size_t aEnd, CodeStatement& aStatement)
+{
+  aStatement.conditional = (aTokens[aStart].text == "if");
+  for (size_t i = aStart; i < aEnd; i++)
+  {
+    const CodeToken& t = aTokens[i];
+    if (t.text == "+=" || t.text == "-=" || t.text == "*=" ||
+        t.text == "/=" || t.text == "++" || t.text == "--" || t.text == "&")
+    {
+      aStatement.opaque = true;
+      continue;
+    }
+    if (!t.isIdentifier)
+      continue;
+    if (!IsCodeArray(t.text))
+    {
+      aStatement.names.insert(t.text);
+      continue;
+    }
+    if (i + 3 >= aEnd || aTokens[i + 1].text != "[" ||
+        !aTokens[i + 2].isNumber || aTokens[i + 3].text != "]")
+    {
+      aStatement.opaque = true;
+      continue;
+    }
+
+    char index[20];
+    sprintf(index, "[%lu]", strtoul(aTokens[i + 2].text.c_str(), NULL, 10));
+    std::string element = t.text + index;
+    if (i + 4 < aEnd && aTokens[i + 4].text == "=")
+      aStatement.writes.insert(element);
+    else
+      aStatement.reads.insert(element);
+    i += 3;
+  }
+}
+
+bool
+SplitStatements(const char* aCode, std::vector<CodeStatement>& aStatements)
+{
+  try
+  {
+    std::vector<CodeToken> tokens;
+    Tokenise(aCode, tokens);
+
+    StatementSplitter splitter(tokens);
+    size_t codeStart = 0;
+    while (!splitter.atEnd())
+    {
+      size_t start = splitter.position();
+      size_t end = splitter.skipStatement();
+      if (tokens[start].text == ";")
+        continue;
+
+      CodeStatement s;
+      s.code.assign(aCode + codeStart, tokens[end - 1].end - codeStart);
+      codeStart = tokens[end - 1].end;
+      AnalyseStatement(tokens, start, end, s);
+      aStatements.push_back(s);
+    }
+  }
+  catch (CannotSplit&)
+  {
+    aStatements.clear();
+    return false;
+  }
+  return true;
+}
+
+bool
+SelectStatements(const std::vector<CodeStatement>& aStatements,
+                 std::set<std::string>& aWanted,
+                 std::vector<char>& aSelected)
+{
+  aSelected.assign(aStatements.size(), 0);
+  bool needsAll = false;
+
+  // Work backwards, so that each statement is only selected if a statement
+  // after it, or the caller, uses what it computes.
+  for (size_t i = aStatements.size(); i-- > 0;)
+  {
+    const CodeStatement& s = aStatements[i];
+    bool wanted = needsAll || s.opaque;
+    std::set<std::string>::const_iterator j;
+    for (j = s.writes.begin(); !wanted && j != s.writes.end(); j++)
+      wanted = aWanted.count(*j) != 0;
+    if (!wanted)
+      continue;
+
+    aSelected[i] = 1;
+    if (s.opaque)
+      needsAll = true;
+    if (!s.conditional && !s.opaque)
+      for (j = s.writes.begin(); j != s.writes.end(); j++)
+        aWanted.erase(*j);
+    aWanted.insert(s.reads.begin(), s.reads.end());
+  }
+
+  return needsAll;
+}
+
+// Replaces the array elements in aCode which have an entry in aNames.
+static std::string
+RenameElements(const std::string& aCode,
+               const std::map<std::string, std::string>& aNames)
+{
+  std::vector<CodeToken> tokens;
+  Tokenise(aCode.c_str(), tokens);
+
+  std::string renamed;
+  size_t copied = 0;
+  for (size_t i = 0; i + 3 < tokens.size(); i++)
+  {
+    if (!IsCodeArray(tokens[i].text) || tokens[i + 1].text != "[" ||
+        !tokens[i + 2].isNumber || tokens[i + 3].text != "]")
+      continue;
+
+    char index[20];
+    sprintf(index, "[%lu]", strtoul(tokens[i + 2].text.c_str(), NULL, 10));
+    std::map<std::string, std::string>::const_iterator n =
+      aNames.find(tokens[i].text + index);
+    if (n == aNames.end())
+      continue;
+
+    size_t start = tokens[i].end - tokens[i].text.size();
+    renamed.append(aCode, copied, start - copied);
+    renamed += (*n).second;
+    copied = tokens[i + 3].end;
+    i += 3;
+  }
+  renamed.append(aCode, copied, std::string::npos);
+  return renamed;
+}
+
+// Replaces the right hand side of each assignment in aCode to an array
+// element which has an entry in aSources with that entry.
+static std::string
+CopyElements(const std::string& aCode,
+             const std::map<std::string, std::string>& aSources)
+{
+  std::vector<CodeToken> tokens;
+  Tokenise(aCode.c_str(), tokens);
+
+  std::string copied;
+  size_t done = 0;
+  for (size_t i = 0; i + 4 < tokens.size(); i++)
+  {
+    if (!IsCodeArray(tokens[i].text) || tokens[i + 1].text != "[" ||
+        !tokens[i + 2].isNumber || tokens[i + 3].text != "]" ||
+        tokens[i + 4].text != "=")
+      continue;
+
+    char index[20];
+    sprintf(index, "[%lu]", strtoul(tokens[i + 2].text.c_str(), NULL, 10));
+    std::map<std::string, std::string>::const_iterator n =
+      aSources.find(tokens[i].text + index);
+    if (n == aSources.end())
+      continue;
+
+    size_t j = i + 5;
+    for (int depth = 0; j < tokens.size(); j++)
+      if (tokens[j].text == "(" || tokens[j].text == "[")
+        depth++;
+      else if (tokens[j].text == ")" || tokens[j].text == "]")
+        depth--;
+      else if (depth == 0 && tokens[j].text == ";")
+        break;
+    if (j == tokens.size())
+      throw CannotSplit();
+
+    copied.append(aCode, done, tokens[i + 4].end - done);
+    copied += " " + (*n).second;
+    done = tokens[j].end - 1;
+    i = j;
+  }
+  copied.append(aCode, done, std::string::npos);
+  return copied;
+}
+
+uint32_t
+HoistInvariantStatements(const char* aCode, uint32_t aFirstSlot,
+                         std::string& aHoisted, std::string& aRates)
+{
+  std::vector<CodeStatement> statements;
+  if (!SplitStatements(aCode, statements))
+    return 0;
+
+  // The CONSTANTS element holding the current value of each element computed
+  // from constants alone.
+  std::map<std::string, std::string> slots;
+
+  std::string hoisted, rates;
+  uint32_t count = 0;
+  try
+  {
+    for (size_t s = 0; s < statements.size(); s++)
+    {
+      const CodeStatement& st = statements[s];
+
+      bool isInvariant = !st.opaque && !st.writes.empty();
+      std::set<std::string>::const_iterator i;
+      for (i = st.names.begin(); isInvariant && i != st.names.end(); i++)
+        isInvariant = IsIn(kInvariantNames, *i);
+      for (i = st.reads.begin(); isInvariant && i != st.reads.end(); i++)
+        isInvariant = (*i).compare(0, 10, "CONSTANTS[") == 0 ||
+          slots.count(*i) != 0;
+      for (i = st.writes.begin(); isInvariant && i != st.writes.end(); i++)
+        isInvariant = (*i).compare(0, 10, "ALGEBRAIC[") == 0;
+
+      if (!isInvariant)
+      {
+        for (i = st.writes.begin(); i != st.writes.end(); i++)
+          slots.erase(*i);
+        rates += st.code;
+        continue;
+      }
+
+      // A conditional assignment leaves the value from before alone when no
+      // condition holds. Unless that value is invariant too, the conditions
+      // stay in the rates code, to decide which results to copy.
+      bool keepConditions = false;
+      for (i = st.writes.begin(); i != st.writes.end(); i++)
+        if (st.conditional && slots.count(*i) == 0)
+          keepConditions = true;
+
+      // Each assignment gets a new element, so that the copies made before
+      // it still see the earlier value. Starting it with that value covers
+      // statements which read what they write.
+      std::string copies;
+      std::map<std::string, std::string> written;
+      std::set<std::string> unset;
+      for (i = st.writes.begin(); i != st.writes.end(); i++)
+      {
+        char slot[30];
+        sprintf(slot, "CONSTANTS[%lu]",
+                static_cast<unsigned long>(aFirstSlot + count++));
+        std::map<std::string, std::string>::iterator old = slots.find(*i);
+        if (old != slots.end())
+          hoisted += "\r\n" + std::string(slot) + " = " + (*old).second + ";";
+        else if (st.conditional)
+          unset.insert(*i);
+        slots[*i] = slot;
+        written[*i] = slot;
+        copies += "\r\n" + *i + " = " + slot + ";";
+      }
+      hoisted += RenameElements(st.code, slots);
+      if (keepConditions)
+        rates += CopyElements(st.code, written);
+      else
+        rates += copies;
+
+      // Elements no condition may have assigned can't be read from their
+      // new elements by the statements after this one.
+      for (i = unset.begin(); i != unset.end(); i++)
+        slots.erase(*i);
+    }
+  }
+  catch (CannotSplit&)
+  {
+    return 0;
+  }
+
+  if (count == 0)
+    return 0;
+  aHoisted = hoisted;
+  aRates = rates;
+  return count;
+}
@@ -0,0 +1,71 @@
+#ifndef _CISCODEANALYSIS_HXX
+#define _CISCODEANALYSIS_HXX
+
+#include "cda_compiler_support.h"
+#include <string>
+#include <vector>
+#include <set>
+#include <stdint.h>
+
+/**
+ * A top level statement of generated model code, with the array elements
+ * (such as ALGEBRAIC[3]) which it reads and assigns.
+ */
+struct CodeStatement
+{
+  CodeStatement() : conditional(false), opaque(false) {}
+
+  std::string code;
+  std::set<std::string> reads, writes;
+  // The other identifiers the statement uses, such as VOI and the functions
+  // it calls.
+  std::set<std::string> names;
+  // Set if the writes only happen under some condition, so that the values
+  // from before the statement may still be used afterwards.
+  bool conditional;
+  // Set if the statement may read or write array elements which aren't
+  // listed, for example by passing a whole array to a function.
+  bool opaque;
+};
+
+/**
+ * Splits code generated with the non-debug CIS patterns into its top level
+ * statements, and finds what each of them reads and writes.
+ * @return false if the code can't be split up, for example because it
+ *         declares local variables which later statements use.
+ */
+bool SplitStatements(const char* aCode, std::vector<CodeStatement>& aStatements);
+
+/**
+ * Works out which statements have to be run to compute the array elements
+ * in aWanted.
+ * @param aSelected Set to 1 for each statement which has to be run, and 0
+ *                  for the others.
+ * @param aWanted On return, holds the array elements which must be computed
+ *                before the statements are run.
+ * @return true if an opaque statement has to be run, in which case everything
+ *         computed before the statements may be needed.
+ */
+bool SelectStatements(const std::vector<CodeStatement>& aStatements,
+                      std::set<std::string>& aWanted,
+                      std::vector<char>& aSelected);
+
+/**
+ * Moves the statements of rates code generated with the non-debug CIS
+ * patterns which only compute ALGEBRAIC values from constants (directly, or
+ * through values computed the same way) into code that can be run once the
+ * constants are set up. Those values are stored in CONSTANTS from index
+ * aFirstSlot on, and the statements are replaced by copies from there, so
+ * the rest of the code still finds them where it did. An if / else if chain
+ * which may assign nothing keeps its conditions in the rates code, with each
+ * branch copying its results.
+ * @param aHoisted Set to the code which computes the values, to be run after
+ *                 the constants are set up.
+ * @param aRates Set to the rates code without those statements.
+ * @return The number of CONSTANTS elements the values take up; 0 if nothing
+ *         could be moved, in which case the original code should be used.
+ */
+uint32_t HoistInvariantStatements(const char* aCode, uint32_t aFirstSlot,
+                                  std::string& aHoisted, std::string& aRates);
+
+#endif // _CISCODEANALYSIS_HXX
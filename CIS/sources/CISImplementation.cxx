@@ -4,6 +4,8 @@
 #define __STDC_CONSTANT_MACROS
 #include "Utilities.hxx"
 #include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
 #include <string>
 #ifndef WIN32
 #include <sys/stat.h>
@@ -20,7 +22,11 @@
 #include <errno.h>
 #endif
 #include "CISImplementation.hxx"
+#include "CISCache.hxx"
+#include "CISResultFile.hxx"
 #include <fstream>
+#include <map>
+#include <sstream>
 #include "CISBootstrap.hpp"
 #ifdef _MSC_VER
 #include <direct.h>
@@ -59,54 +65,82 @@
 #include "clang/Frontend/CompilerInstance.h"
 #include "clang/Frontend/TextDiagnosticPrinter.h"
 #include <clang/CodeGen/CodeGenAction.h>
+#include "clang/Lex/PreprocessorOptions.h"
 #include <llvm/Support/MemoryBuffer.h>
-#include <sstream>
+#endif
+
+#ifdef ENABLE_CLANG
+// LLVM and Clang keep global state (such as the registered targets) which
+// isn't safe to use from several threads at once, so compiling, generating
+// machine code and freeing modules in process all happen under this.
+static CDAMutex sInProcessCompilerMutex;
 #endif
 
 class CompiledModule {
 public:
+  CompiledModule() : mLibrary(NULL) {}
+
 #ifdef ENABLE_CLANG
+  // The context the module was made in. Each module has its own, since a
+  // context can only be used by one thread at a time, and this must outlive
+  // the module and execution engine.
+  llvm::OwningPtr<llvm::LLVMContext> mContext;
+  // The module and its execution engine, if the model was compiled in
+  // process.
   llvm::OwningPtr<llvm::Module> mModule;
   llvm::OwningPtr<llvm::ExecutionEngine> mExecutionEngine;
   std::list<llvm::Function*> mFunctions;
+#endif
+  // The shared library, if the model was compiled by an external compiler.
+  void* mLibrary;
 
   void*
   getSymbol(const char* aName)
   {
-    llvm::Function* f = mModule->getFunction(aName);
-    // mFunctions.push_back(f);
-    return mExecutionEngine->getPointerToFunction(f);
-  }
-
-  ~CompiledModule()
-  {
-    for (std::list<llvm::Function*>::iterator i = mFunctions.begin();
-         i != mFunctions.end(); i++)
-      delete (*i);
-  }
-#else
-  void* mModule;
-
-  void*
-  getSymbol(const char* aName)
-  {
+#ifdef ENABLE_CLANG
+    if (mLibrary == NULL)
+    {
+      CDALock l(sInProcessCompilerMutex);
+      llvm::Function* f = mModule->getFunction(aName);
+      // Some functions are optional, and may not have been generated.
+      if (f == NULL)
+        return NULL;
+      // mFunctions.push_back(f);
+      return mExecutionEngine->getPointerToFunction(f);
+    }
+#endif
 #ifdef WIN32
 #define getsym(m,s) GetProcAddress((HMODULE)m, s)
 #else
 #define getsym(m,s) dlsym(m,s)
 #endif
-    return (void*)getsym(mModule, aName);
+    return (void*)getsym(mLibrary, aName);
 #undef getsym
   }
 
-  ~CompiledModule() {
+  ~CompiledModule()
+  {
+#ifdef ENABLE_CLANG
+    if (mLibrary == NULL)
+    {
+      CDALock l(sInProcessCompilerMutex);
+      for (std::list<llvm::Function*>::iterator i = mFunctions.begin();
+           i != mFunctions.end(); i++)
+        delete (*i);
+      mExecutionEngine.reset();
+      mModule.reset();
+      mContext.reset();
+      return;
+    }
+#endif
+    if (mLibrary == NULL)
+      return;
 #ifdef WIN32
-    FreeLibrary((HMODULE)mModule);
+    FreeLibrary((HMODULE)mLibrary);
 #else
-    dlclose(mModule);
+    dlclose(mLibrary);
 #endif
   }
-#endif
 };
 
 char*
@@ -141,6 +175,40 @@ attempt_make_tempdir(const char* parentDir)
   }
 }
 
+static bool
+MakeTempDir(std::string& aDirname)
+{
+  const char* tmpenvs[] = {"TMPDIR", "TEMP", "TMP", NULL};
+  const char** p = tmpenvs;
+  char* fn = NULL;
+  while (!fn && *p)
+  {
+    char* env = getenv(*p);
+    if (env != NULL)
+      fn = attempt_make_tempdir(env);
+    p++;
+  }
+  if (fn == NULL)
+  {
+#ifdef WIN32
+    const char* tmpdirs[] = {"c:\\temp", "c:\\tmp", "\\temp", "\\tmp", NULL};
+#else
+    const char* tmpdirs[] = {"/tmp", "/var/tmp", "/usr/tmp", NULL};
+#endif
+    p = tmpdirs;
+    while (!fn && *p)
+    {
+      fn = attempt_make_tempdir(*p);
+      p++;
+    }
+  }
+  if (fn == NULL)
+    return false;
+  aDirname = fn;
+  free(fn);
+  return true;
+}
+
 CompiledModelFunctions*
 SetupCompiledModelFunctions(CompiledModule* module)
 {
@@ -151,6 +219,18 @@ SetupCompiledModelFunctions(CompiledModule* module)
     module->getSymbol("ComputeRates");
   cmf->ComputeVariables = (void (*)(double,double*,double*,double*,double*,struct fail_info*))
     module->getSymbol("ComputeVariables");
+  cmf->ComputeRatesBatch = (void (*)(int,double,double*,double*,double*,double*,struct fail_info*))
+    module->getSymbol("ComputeRatesBatch");
+  cmf->ComputeJacobian = (void (*)(double,double*,double*,double*,double*,double*,struct fail_info*))
+    module->getSymbol("ComputeJacobian");
+  cmf->ComputeGatingJacobian = (void (*)(double,double*,double*,double*,double*,double*,struct fail_info*))
+    module->getSymbol("ComputeGatingJacobian");
+  cmf->ComputeVariablesSelected = (void (*)(double,double*,double*,double*,double*,const char*,struct fail_info*))
+    module->getSymbol("ComputeVariablesSelected");
+  cmf->SetupSensitivities = (void (*)(double*,double*,double*,struct Override*,double*,double*,struct fail_info*))
+    module->getSymbol("SetupSensitivities");
+  cmf->ComputeSensitivityRates = (void (*)(double,double*,double*,double*,double*,double*,double*,double*,struct fail_info*))
+    module->getSymbol("ComputeSensitivityRates");
   return cmf;
 }
 
@@ -166,6 +246,8 @@ SetupIDACompiledModelFunctions(CompiledModule* module)
     module->getSymbol("EvaluateEssentialVariables");
   cmf->ComputeResiduals = (void (*)(double, double*, double*, double*, double*, double*, double*, double*, double*, struct fail_info*))
     module->getSymbol("ComputeResiduals");
+  cmf->ComputeResidualJacobian = (void (*)(double, double, double*, double*, double*, double*, double*, double*, double*, double*, double*, struct fail_info*))
+    module->getSymbol("ComputeResidualJacobian");
   cmf->ComputeRootInformation = (void (*)(double, double*, double*, double*, double*, double*, double*, double*, struct fail_info*))
     module->getSymbol("ComputeRootInformation");
   cmf->SetupStateInfo = (void (*)(double*))
@@ -173,129 +255,133 @@ SetupIDACompiledModelFunctions(CompiledModule* module)
   return cmf;
 }
 
-CompiledModule*
-CDA_CellMLIntegrationService::CompileSource
+#ifdef ENABLE_CLANG
+static CompiledModule*
+CompileSourceInProcess
 (
- std::string& destDir, std::string& sourceFile, std::wstring& lastError
+ const std::string& aSource, uint32_t aLevel, std::wstring& lastError
 )
 {
-#ifdef ENABLE_CLANG
+  // This is declared first, so that the lock is released before the module
+  // is freed if compiling fails.
+  llvm::OwningPtr<CompiledModule> clangData(new CompiledModule());
+
+  CDALock l(sInProcessCompilerMutex);
   LLVMLinkInJIT();
   // This code is modified from the code in OpenCOR.
 
-  // Firstly use the driver as if we were going to do a compilation, but don't
-  // actually run the compilation (we just do this to get the arguments we need).
   clang::DiagnosticsEngine diagnosticsEngine
     (
      llvm::IntrusiveRefCntPtr<clang::DiagnosticIDs>(new clang::DiagnosticIDs()),
      NULL
     );
-  clang::driver::Driver driver(
-                               "internal code compilation",
-                               llvm::sys::getDefaultTargetTriple(),
-                               "", true, diagnosticsEngine);
 
-  const char* args[] = { "internal code compilation", "-fsyntax-only", "-Wno-implicit-function-declaration", "-O3", sourceFile.c_str()
+  // The source never goes to disk; the front end is given the arguments the
+  // driver would have passed it, and the source is mapped in from memory.
+  const char* sourceName = "generated.c";
+  std::string triple = llvm::sys::getDefaultTargetTriple();
+  char optimise[4];
+  sprintf(optimise, "-O%u", aLevel);
+  const char* args[] = { "-triple", triple.c_str(), "-fsyntax-only",
+                         "-Wno-implicit-function-declaration", optimise,
+#ifdef ENABLE_FAST_MATH
+                         "-ffast-math",
+#endif
+                         "-x", "c", sourceName
                        };
-  llvm::OwningPtr<clang::driver::Compilation> compilation
-    (driver.BuildCompilation(llvm::ArrayRef<const char*>(args, sizeof(args)/sizeof(char*))));
+  int argCount = sizeof(args) / sizeof(char*);
+  llvm::OwningPtr<clang::CompilerInvocation> compilerInvocation(new clang::CompilerInvocation());
 
-  if (!compilation)
+  if (!clang::CompilerInvocation::CreateFromArgs(*compilerInvocation.get(),
+                                                 args, args + argCount,
+                                                 diagnosticsEngine))
   {
-    mLastError = L"Cannot create an LLVM compiler driver.";
-    throw iface::cellml_api::CellMLException(L"Cannot create an LLVM compiler driver.");
+    lastError = L"Cannot set up the LLVM compiler.";
+    throw iface::cellml_api::CellMLException(lastError);
   }
 
-  const clang::driver::JobList &jobList =
-    compilation->getJobs();
-  const clang::driver::Command* command =
-    llvm::cast<clang::driver::Command>(*(compilation->getJobs().begin()));
-  const clang::driver::ArgStringList &commandArguments = command->getArguments();
-  llvm::OwningPtr<clang::CompilerInvocation> compilerInvocation(new clang::CompilerInvocation());
-
-  clang::CompilerInvocation::CreateFromArgs(*compilerInvocation.get(),
-                                            const_cast<const char **>(commandArguments.data()),
-                                            const_cast<const char **>(commandArguments.data())+
-                                            commandArguments.size(),
-                                            diagnosticsEngine);
+  compilerInvocation->getPreprocessorOpts().addRemappedFile
+    (sourceName, llvm::MemoryBuffer::getMemBufferCopy(aSource, sourceName));
 
   // By default, Clang deliberately leaks memory so it is faster if it is
   // just going to exit anyway. Tell it not to do that.
   compilerInvocation->getFrontendOpts().DisableFree = 0;
 
-    // Create a compiler instance to handle the actual work
-
-    clang::CompilerInstance compilerInstance;
-
-    compilerInstance.setInvocation(compilerInvocation.take());
-
-    // Create the compiler instance's diagnostics engine
+  // Create a compiler instance to handle the actual work
+  clang::CompilerInstance compilerInstance;
+  compilerInstance.setInvocation(compilerInvocation.take());
 
+  // Create the compiler instance's diagnostics engine
 #ifdef DEBUG_LLVM
-    llvm::IntrusiveRefCntPtr<clang::DiagnosticOptions> diagnosticOptions = new clang::DiagnosticOptions();
+  llvm::IntrusiveRefCntPtr<clang::DiagnosticOptions> diagnosticOptions = new clang::DiagnosticOptions();
 #endif
-    compilerInstance.createDiagnostics(int(commandArguments.size()),
-                                       const_cast<char **>(commandArguments.data()),
+  compilerInstance.createDiagnostics(argCount, const_cast<char **>(args),
 #ifdef DEBUG_LLVM
-                                       new clang::TextDiagnosticPrinter(llvm::outs(), &*diagnosticOptions)
+                                     new clang::TextDiagnosticPrinter(llvm::outs(), &*diagnosticOptions)
 #else
-                                       NULL
+                                     NULL
 #endif
-                                      );
-    // Create an LLVM module
-
-    llvm::OwningPtr<CompiledModule> clangData(new CompiledModule());
+                                    );
 
-    clangData->mModule.reset
-      (new llvm::Module(sourceFile, llvm::getGlobalContext()));
+  // Create an LLVM module
+  clangData->mContext.reset(new llvm::LLVMContext());
+  clangData->mModule.reset
+    (new llvm::Module(sourceName, *clangData->mContext));
 
-    // Initialise the native target, so not only can we then create a JIT
-    // execution engine, but more importantly its data layout will match that of
-    // our target platform...
+  // Initialise the native target, so not only can we then create a JIT
+  // execution engine, but more importantly its data layout will match that of
+  // our target platform...
+  llvm::InitializeNativeTarget();
 
-    llvm::InitializeNativeTarget();
-
-    // Create an execution engine
-
-    std::string whyFail;
-    clangData->mExecutionEngine.reset
-      (llvm::ExecutionEngine::createJIT(clangData->mModule.get(), &whyFail));
-
-    if (!clangData->mExecutionEngine)
+  // Create an execution engine, generating machine code at the same level of
+  // optimisation as the front end.
+  static const llvm::CodeGenOpt::Level kCodeGenLevels[] =
     {
-      wchar_t buffer[1024];
-      mbstowcs(buffer, whyFail.c_str(), 1024);
-      buffer[1023] = 0;
-      mLastError = std::wstring(L"Cannot create LLVM execution engine: ") + buffer;
-      throw iface::cellml_api::CellMLException(std::wstring(L"Cannot create LLVM execution engine: ") + buffer);
-    }
+      llvm::CodeGenOpt::None, llvm::CodeGenOpt::Less,
+      llvm::CodeGenOpt::Default, llvm::CodeGenOpt::Aggressive
+    };
+  std::string whyFail;
+  clangData->mExecutionEngine.reset
+    (llvm::ExecutionEngine::createJIT(clangData->mModule.get(), &whyFail, NULL,
+                                      kCodeGenLevels[aLevel]));
+
+  if (!clangData->mExecutionEngine)
+  {
+    wchar_t buffer[1024];
+    mbstowcs(buffer, whyFail.c_str(), 1024);
+    buffer[1023] = 0;
+    lastError = std::wstring(L"Cannot create LLVM execution engine: ") + buffer;
+    throw iface::cellml_api::CellMLException(lastError);
+  }
 
-    // Create and execute the frontend to generate the LLVM assembly code,
-    // making sure that all added functions end up in the same module
+  // Create and execute the frontend to generate the LLVM assembly code,
+  // making sure that all added functions end up in the same module
+  llvm::OwningPtr<clang::CodeGenAction> codeGenerationAction
+    (new clang::EmitLLVMOnlyAction(&clangData->mModule->getContext()));
 
-    llvm::OwningPtr<clang::CodeGenAction> codeGenerationAction
-      (new clang::EmitLLVMOnlyAction(&clangData->mModule->getContext()));
+  codeGenerationAction->setLinkModule(clangData->mModule.take());
 
-    codeGenerationAction->setLinkModule(clangData->mModule.take());
+  if (!compilerInstance.ExecuteAction(*codeGenerationAction))
+  {
+    lastError = L"Error generating code with LLVM.";
+    throw iface::cellml_api::CellMLException(lastError);
+  }
 
-    if (!compilerInstance.ExecuteAction(*codeGenerationAction))
-    {
-      mLastError = L"Error generating code with LLVM.";
-      throw iface::cellml_api::CellMLException(L"Error generating code with LLVM.");
-    }
+  // Switch from the source module to the linked module.
+  clangData->mModule.reset(codeGenerationAction->takeModule());
 
-    // Switch from the source module to the linked module.
-    clangData->mModule.reset(codeGenerationAction->takeModule());
+  return clangData.take();
+}
+#endif // ENABLE_CLANG
 
-    return clangData.take();
-#else // ENABLE_CLANG
+static CompiledModule*
+CompileSourceExternal
+(
+ const std::string& aSource, uint32_t aLevel, std::string& aDirname,
+ std::wstring& lastError
+)
+{
   setvbuf(stdout, NULL, _IONBF, 0);
-  std::string targ = destDir;
-#ifdef WIN32
-  targ += "/generated.dll";
-#else
-  targ += "/generated.so";
-#endif
   std::string cmd = "gcc -ggdb "
 #ifdef WIN32
     "-mthreads -Llib -L. -lcis "
@@ -317,7 +403,11 @@ CDA_CellMLIntegrationService::CompileSource
     "-Llib -lcis "
 #endif
 #endif
-    "-O3 "
+    ;
+  char optimise[8];
+  sprintf(optimise, "-O%u ", aLevel);
+  cmd += optimise;
+  cmd +=
 #ifdef ENABLE_FAST_MATH
     "-ffast-math "
 #endif
@@ -327,6 +417,56 @@ CDA_CellMLIntegrationService::CompileSource
     "-shared -o";
 #endif
 
+  // If an identical module has already been built by this or another process,
+  // load it from the cache rather than running the compiler again.
+#ifdef WIN32
+  CompiledObjectCache cache(".dll");
+#else
+  CompiledObjectCache cache(".so");
+#endif
+  std::string cacheKey, cachedModule;
+  if (cache.isEnabled() && cache.computeKey(aSource, cmd, cacheKey) &&
+      cache.lookup(cacheKey, cachedModule))
+  {
+#ifdef WIN32
+    void* ct = LoadLibrary(cachedModule.c_str());
+#else
+    void* ct = dlopen(cachedModule.c_str(), RTLD_NOW);
+#endif
+    // If the entry was evicted or damaged since the lookup, just rebuild it.
+    if (ct != NULL)
+    {
+      CompiledModule *mod = new CompiledModule();
+      mod->mLibrary = ct;
+      return mod;
+    }
+  }
+
+  // Otherwise, write the source out to a temporary directory and build it
+  // there.
+  if (!MakeTempDir(aDirname))
+  {
+    lastError = L"Could not make temporary directory.";
+    throw iface::cellml_api::CellMLException(lastError);
+  }
+  std::string sourceFile = aDirname + "/generated.c";
+  std::string targ = aDirname;
+#ifdef WIN32
+  targ += "/generated.dll";
+#else
+  targ += "/generated.so";
+#endif
+  {
+    std::ofstream sf(sourceFile.c_str());
+    sf << aSource;
+    sf.close();
+    if (sf.fail())
+    {
+      lastError = L"Could not write the model code.";
+      throw iface::cellml_api::CellMLException(lastError);
+    }
+  }
+
   cmd += targ;
   cmd += " ";
   cmd += sourceFile;
@@ -465,10 +605,134 @@ CDA_CellMLIntegrationService::CompileSource
     throw iface::cellml_api::CellMLException(lastError);
   }
 
+  if (cacheKey != "")
+    cache.store(cacheKey, targ);
+
   CompiledModule *mod = new CompiledModule();
-  mod->mModule = t;
+  mod->mLibrary = t;
   return mod;
-#endif // !ENABLE_CLANG
+}
+
+CompiledModule*
+CDA_CellMLIntegrationService::CompileSource
+(
+ const std::string& aSource, std::string& aDirname, std::wstring& lastError
+)
+{
+#ifdef ENABLE_CLANG
+  if (mCompilerBackend != iface::cellml_services::EXTERNAL_COMPILER)
+  {
+    try
+    {
+      return CompileSourceInProcess(aSource, mOptimisationLevel, lastError);
+    }
+    catch (iface::cellml_api::CellMLException&)
+    {
+      if (mCompilerBackend == iface::cellml_services::IN_PROCESS_COMPILER)
+        throw;
+      // Otherwise, see whether the external compiler can manage it.
+    }
+  }
+#else
+  if (mCompilerBackend == iface::cellml_services::IN_PROCESS_COMPILER)
+  {
+    lastError = L"CIS was built without an in-process compiler.";
+    throw iface::cellml_api::CellMLException(lastError);
+  }
+#endif
+
+  return CompileSourceExternal(aSource, mOptimisationLevel, aDirname,
+                               lastError);
+}
+
+// Compiled models which are still alive, keyed by the kind of compile, the
+// optimisation level and a digest of the model content. Entries don't hold a
+// reference; they are removed when the last reference to the compiled model
+// is released.
+static CDAMutex sCompiledModelCacheMutex;
+typedef std::map<std::string, CDA_CellMLCompiledModel*> CompiledModelCache;
+static CompiledModelCache sCompiledModelCache;
+
+static void
+DigestModel(ContentDigest& aDigest, iface::cellml_api::Model* aModel)
+{
+  aDigest.update(aModel->serialisedText());
+
+  // serialisedText doesn't include imports, so add them in depth first...
+  RETURN_INTO_OBJREF(imps, iface::cellml_api::CellMLImportSet, aModel->imports());
+  RETURN_INTO_OBJREF(impi, iface::cellml_api::CellMLImportIterator, imps->iterateImports());
+  for (ObjRef<iface::cellml_api::CellMLImport> import(impi->nextImport());
+       import; import = impi->nextImport())
+  {
+    if (!import->wasInstantiated())
+    {
+      aDigest.update(std::string("<uninstantiated import>"));
+      continue;
+    }
+    RETURN_INTO_OBJREF(importedModel, iface::cellml_api::Model, import->importedModel());
+    aDigest.update(std::string("<import>"));
+    DigestModel(aDigest, importedModel);
+    aDigest.update(std::string("</import>"));
+  }
+}
+
+static std::string
+CompiledModelCacheKey(iface::cellml_api::Model* aModel, const char* aKind,
+                      bool aIsDebug, uint32_t aOptimisationLevel,
+                      iface::cellml_services::CompilerBackend aBackend)
+{
+  // A service which asks for a particular compiler mustn't be given a model
+  // built by another. The interpreted and tiered kinds are already part of
+  // aKind where they make a difference.
+  const char* backend = "";
+  if (aBackend == iface::cellml_services::IN_PROCESS_COMPILER)
+    backend = "-in-process";
+  else if (aBackend == iface::cellml_services::EXTERNAL_COMPILER)
+    backend = "-external";
+
+  try
+  {
+    ContentDigest digest;
+    DigestModel(digest, aModel);
+    char level[8];
+    sprintf(level, "-O%u:", aOptimisationLevel);
+    return std::string(aKind) + backend + (aIsDebug ? "-debug" : "") + level +
+      digest.hexDigest();
+  }
+  catch (...)
+  {
+    // If the model can't be serialised, just don't cache it.
+    return "";
+  }
+}
+
+static CDA_CellMLCompiledModel*
+FindCompiledModel(const std::string& aKey)
+{
+  if (aKey == "")
+    return NULL;
+
+  CDALock l(sCompiledModelCacheMutex);
+  CompiledModelCache::iterator i = sCompiledModelCache.find(aKey);
+  if (i == sCompiledModelCache.end())
+    return NULL;
+  (*i).second->add_ref();
+  return (*i).second;
+}
+
+static void
+RegisterCompiledModel(const std::string& aKey, CDA_CellMLCompiledModel* aModel)
+{
+  if (aKey == "")
+    return;
+
+  CDALock l(sCompiledModelCacheMutex);
+  // If another thread compiled the same model at the same time, keep theirs.
+  if (sCompiledModelCache.find(aKey) != sCompiledModelCache.end())
+    return;
+  sCompiledModelCache.insert(std::pair<std::string, CDA_CellMLCompiledModel*>
+                             (aKey, aModel));
+  aModel->mCacheKey = aKey;
 }
 
 CDA_CellMLCompiledModel::CDA_CellMLCompiledModel
@@ -486,6 +750,9 @@ CDA_CellMLCompiledModel::CDA_CellMLCompiledModel
 CDA_CellMLCompiledModel::~CDA_CellMLCompiledModel()
 {
   delete mModule;
+  // Models compiled in process, or loaded from the cache, have no directory.
+  if (mDirname == "")
+    return;
 #ifdef WIN32
   struct _finddata_t d;
   intptr_t hd;
@@ -516,34 +783,57 @@ CDA_CellMLCompiledModel::~CDA_CellMLCompiledModel()
   rmdir(mDirname.c_str());
 }
 
+void
+CDA_CellMLCompiledModel::release_ref()
+  throw()
+{
+  {
+    // FindCompiledModel can only add a reference while holding the lock, so
+    // once the count reaches zero under the lock nobody can revive us.
+    CDALock l(sCompiledModelCacheMutex);
+    if (--mRefcount)
+      return;
+    if (mCacheKey != "")
+      sCompiledModelCache.erase(mCacheKey);
+  }
+  delete this;
+}
+
 CDA_CellMLIntegrationRun::CDA_CellMLIntegrationRun
 (
 )
   :
-  mIsStarted(false),
+  mIsStarted(false), mScheduler(NULL), mPriority(0), mCommand(COMMAND_RUN),
   mStepType(iface::cellml_services::RUNGE_KUTTA_FEHLBERG_4_5),
+  mLinearSolver(iface::cellml_services::AUTOMATIC_LINEAR_SOLVER),
   mEpsAbs(1E-6), mEpsRel(1E-6), mScalVar(1.0), mScalRate(0.0),
   mStepSizeMax(1.0), mStartBvar(0.0), mStopBvar(10.0), mMaxPointDensity(10000.0),
-  mTabulationStepSize(0.0), mObserver(NULL), mCancelIntegration(false),
-  mPauseIntegration(false), mStrictTabulation(false)
+  mTabulationStepSize(0.0),
+  // A little under 2MB of results, leaving room for transport overheads.
+  mResultBufferSize(262016), mResultMaxLatency(1000), mResultMaxPoints(0),
+  mResultFileChunkRecords(0), mObserver(NULL), mStrictTabulation(false),
+  mInterpolateTabulation(false),
+  mSteadyStateTolerance(0.0), mSteadyStatePeriod(0.0), mFinalStateOnly(false),
+  mIsWaiting(false)
 {
+  resetPosition();
 }
 
 CDA_CellMLIntegrationRun::~CDA_CellMLIntegrationRun()
 {
-  if (mIsStarted)
-  {
-#ifdef WIN32
-    CloseHandle(mThreadPipes[0]);
-    CloseHandle(mThreadPipes[1]);
-    CloseHandle(mThreadSemaphore);
-#else
-    close(mThreadPipes[0]);
-    close(mThreadPipes[1]);
-#endif
-  }
   if (mObserver != NULL)
     mObserver->release_ref();
+  if (mScheduler != NULL)
+    mScheduler->release_ref();
+}
+
+void
+CDA_CellMLIntegrationRun::scheduleOn(RunScheduler* aScheduler)
+{
+  aScheduler->add_ref();
+  if (mScheduler != NULL)
+    mScheduler->release_ref();
+  mScheduler = aScheduler;
 }
 
 iface::cellml_services::ODEIntegrationStepType
@@ -565,6 +855,25 @@ CDA_CellMLIntegrationRun::stepType
   mStepType = aStepType;
 }
 
+iface::cellml_services::LinearSolverType
+CDA_CellMLIntegrationRun::linearSolver
+(
+)
+  throw (std::exception&)
+{
+  return mLinearSolver;
+}
+
+void
+CDA_CellMLIntegrationRun::linearSolver
+(
+ iface::cellml_services::LinearSolverType aLinearSolver
+)
+  throw(std::exception&)
+{
+  mLinearSolver = aLinearSolver;
+}
+
 void
 CDA_CellMLIntegrationRun::setStepSizeControl
 (
@@ -591,6 +900,13 @@ CDA_CellMLIntegrationRun::setTabulationStepControl
   mStrictTabulation = strictTabulation;
 }
 
+void
+CDA_CellMLIntegrationRun::setTabulationInterpolation(bool interpolate)
+  throw (std::exception&)
+{
+  mInterpolateTabulation = interpolate;
+}
+
 void
 CDA_CellMLIntegrationRun::setResultRange
 (
@@ -603,6 +919,131 @@ CDA_CellMLIntegrationRun::setResultRange
   mMaxPointDensity = maxPointDensity;
 }
 
+void
+CDA_CellMLIntegrationRun::setResultFlushPolicy
+(
+ uint32_t bufferSize, uint32_t maxLatency, uint32_t maxPoints
+)
+  throw (std::exception&)
+{
+  mResultBufferSize = bufferSize;
+  mResultMaxLatency = maxLatency;
+  mResultMaxPoints = maxPoints;
+}
+
+void
+CDA_CellMLIntegrationRun::setSteadyStateDetection
+(
+ double tolerance, double period, bool finalStateOnly
+)
+  throw (std::exception&)
+{
+  mSteadyStateTolerance = tolerance < 0.0 ? 0.0 : tolerance;
+  mSteadyStatePeriod = period < 0.0 ? 0.0 : period;
+  mFinalStateOnly = finalStateOnly;
+}
+
+void
+CDA_CellMLIntegrationRun::setOutputVariables
+(
+ const std::vector<iface::cellml_services::ComputationTarget*>& outputs
+)
+  throw (std::exception&)
+{
+  RecordLayout layout;
+  for (std::vector<iface::cellml_services::ComputationTarget*>::const_iterator
+         i = outputs.begin(); i != outputs.end(); i++)
+  {
+    if (*i == NULL)
+      throw iface::cellml_api::CellMLException(L"Output variable is null.");
+    std::wstring name = (*i)->name();
+    std::string name8(name.begin(), name.end());
+    if (!layout.addOutput(name8))
+      throw iface::cellml_api::CellMLException(L"Can't record " + name + L".");
+  }
+  mRecordLayout = layout;
+}
+
+static std::string
+NarrowString(const std::wstring& aString)
+{
+  size_t n = wcstombs(NULL, aString.c_str(), 0);
+  if (n == static_cast<size_t>(-1))
+    throw iface::cellml_api::CellMLException(L"Can't convert string.");
+  std::vector<char> buf(n + 1);
+  wcstombs(&buf[0], aString.c_str(), n + 1);
+  return &buf[0];
+}
+
+void
+CDA_CellMLIntegrationRun::setResultFile
+(
+ const std::wstring& fileName, uint32_t chunkRecords
+)
+  throw (std::exception&)
+{
+  if (mIsStarted)
+    throw iface::cellml_api::CellMLException(L"Call to setResultFile() on an integration run that is already started.");
+  mResultFileName = NarrowString(fileName);
+  mResultFileChunkRecords = chunkRecords;
+}
+
+bool
+CDA_CellMLIntegrationRun::startResultFile
+(
+ iface::cellml_services::CodeInformation* aCCI,
+ uint32_t aRateSize, uint32_t aAlgSize
+)
+{
+  if (mResultFileName == "")
+    return true;
+
+  std::vector<std::string> names;
+  mRecordLayout.columnNames(aRateSize, aAlgSize, names);
+  std::map<std::string, ResultColumn> targets;
+  ObjRef<iface::cellml_services::ComputationTargetIterator> cti =
+    aCCI->iterateTargets();
+  while (true)
+  {
+    ObjRef<iface::cellml_services::ComputationTarget> ct =
+      cti->nextComputationTarget();
+    if (ct == NULL)
+      break;
+    ObjRef<iface::cellml_api::CellMLVariable> v = ct->variable();
+    std::wstring name = ct->name(), variable = v->componentName();
+    variable += L"/";
+    variable += v->name();
+
+    ResultColumn& column = targets[std::string(name.begin(), name.end())];
+    column.variable = NarrowString(variable);
+    column.degree = ct->degree();
+  }
+
+  std::vector<ResultColumn> columns(names.size());
+  for (uint32_t i = 0; i < names.size(); i++)
+  {
+    std::map<std::string, ResultColumn>::iterator t = targets.find(names[i]);
+    if (t != targets.end())
+      columns[i] = (*t).second;
+    columns[i].name = names[i];
+  }
+
+  ResultFileWriter* writer = new ResultFileWriter();
+  if (!writer->open(mResultFileName, columns, mResultFileChunkRecords))
+  {
+    delete writer;
+    return false;
+  }
+
+  // mObserver holds the reference from new.
+  iface::cellml_services::IntegrationProgressObserver* observer =
+    new CDA_ResultFileObserver(writer, mObserver);
+  if (mObserver != NULL)
+    mObserver->release_ref();
+  mObserver = observer;
+  return true;
+}
+
 void
 CDA_CellMLIntegrationRun::setProgressObserver
 (
@@ -639,149 +1080,364 @@ CDA_CellMLIntegrationRun::setOverride
     throw iface::cellml_api::CellMLException(L"Call to setOverride on a variable that is neither constant nor state variable");
 }
 
-void
-CDA_CellMLIntegrationRun::start()
+int32_t
+CDA_CellMLIntegrationRun::priority()
+  throw (std::exception&)
+{
+  return mPriority;
+}
+
+void
+CDA_CellMLIntegrationRun::priority(int32_t aPriority)
+  throw (std::exception&)
+{
+  mPriority = aPriority;
+}
+
+already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+CDA_CellMLIntegrationRun::checkpoint()
+  throw (std::exception&)
+{
+  CDALock l(mCommandMutex);
+  if (mFinalCheckpoint != NULL)
+  {
+    mFinalCheckpoint->add_ref();
+    return mFinalCheckpoint.getPointer();
+  }
+
+  // While the solver is waiting to be resumed, it can't change its position
+  // until this lock is released.
+  if (!mIsWaiting || mPosition.voi == NULL)
+    throw iface::cellml_api::CellMLException(L"Checkpoints can only be taken of runs which are paused or finished.");
+  return snapshot();
+}
+
+void
+CDA_CellMLIntegrationRun::resumeFrom
+(
+ iface::cellml_services::IntegrationCheckpoint* aCheckpoint
+)
+  throw (std::exception&)
+{
+  if (mIsStarted)
+    throw iface::cellml_api::CellMLException(L"Call to resumeFrom() on an integration run that is already started.");
+  if (aCheckpoint == NULL)
+    throw iface::cellml_api::CellMLException(L"Call to resumeFrom() without a checkpoint.");
+  CDA_IntegrationCheckpoint* checkpoint =
+    unsafe_dynamic_cast<CDA_IntegrationCheckpoint*>(aCheckpoint);
+  if (checkpoint->mModel != compiledModel())
+    throw iface::cellml_api::CellMLException(L"Call to resumeFrom() with a checkpoint of a different model.");
+  mResumeFrom = checkpoint;
+}
+
+void
+CDA_CellMLIntegrationRun::resetPosition()
+{
+  mPosition.voi = NULL;
+  mPosition.states = NULL;
+  mPosition.rates = NULL;
+  mPosition.rateSize = 0;
+  mPosition.orderedStates = NULL;
+  mPosition.order = NULL;
+  mPosition.cvode = NULL;
+  mPosition.ida = NULL;
+  mPosition.stepSize = NULL;
+}
+
+void
+CDA_CellMLIntegrationRun::overrideConstants(struct Override& aOverrides)
+{
+  uint32_t nConstants = static_cast<uint32_t>(aOverrides.nConstants);
+  for (uint32_t i = 0; i < nConstants; i++)
+    aOverrides.isOverriden[i] = false;
+
+  for (int pass = 0; pass < 2; pass++)
+  {
+    if (pass == 0 && mResumeFrom == NULL)
+      continue;
+    OverrideList& overrideList =
+      pass == 0 ? mResumeFrom->mConstantOverrides : mConstantOverrides;
+    for (OverrideList::iterator oli = overrideList.begin();
+         oli != overrideList.end(); oli++)
+      if ((*oli).first < nConstants)
+      {
+        aOverrides.isOverriden[(*oli).first] = true;
+        aOverrides.constants[(*oli).first] = (*oli).second;
+      }
+  }
+}
+
+void
+CDA_CellMLIntegrationRun::overrideStates
+(
+ double* aStates, double* aRates, uint32_t aRateSize
+)
+{
+  if (mResumeFrom != NULL)
+  {
+    // The sizes were checked when the checkpoint was made.
+    memcpy(aStates, &mResumeFrom->mStates[0], aRateSize * sizeof(double));
+    memcpy(aRates, &mResumeFrom->mRates[0], aRateSize * sizeof(double));
+  }
+
+  for (OverrideList::iterator oli = mIVOverrides.begin();
+       oli != mIVOverrides.end(); oli++)
+    if ((*oli).first < aRateSize)
+      aStates[(*oli).first] = (*oli).second;
+}
+
+double
+CDA_CellMLIntegrationRun::initialStepSize()
+{
+  return mResumeFrom == NULL ? 0.0 : mResumeFrom->mStepSize;
+}
+
+std::vector<uint32_t>
+CDA_IntegrationCheckpoint::constantOverrideIndices()
+  throw (std::exception&)
+{
+  std::vector<uint32_t> indices;
+  for (std::list<std::pair<uint32_t,double> >::iterator i =
+         mConstantOverrides.begin(); i != mConstantOverrides.end(); i++)
+    indices.push_back((*i).first);
+  return indices;
+}
+
+std::vector<double>
+CDA_IntegrationCheckpoint::constantOverrideValues()
+  throw (std::exception&)
+{
+  std::vector<double> values;
+  for (std::list<std::pair<uint32_t,double> >::iterator i =
+         mConstantOverrides.begin(); i != mConstantOverrides.end(); i++)
+    values.push_back((*i).second);
+  return values;
+}
+
+void
+CDA_CellMLIntegrationRun::start()
   throw (std::exception&)
 {
   if (mIsStarted)
     throw iface::cellml_api::CellMLException(L"Call to start() on an integration run that is already started.");
   mIsStarted = true;
-
-#ifdef WIN32
-  CreatePipe(mThreadPipes, mThreadPipes + 1, NULL, 0);
-  mThreadSemaphore = CreateSemaphore(NULL, 0, 0x7FFFFFFF, NULL);
-#else
-  pipe(mThreadPipes);
-#endif
+  if (mResumeFrom != NULL)
+    mStartBvar = mResumeFrom->mVOI;
 
   // The new thread accesses this, so must add_ref. Thread will release itself
   // before returning.
   add_ref();
-  startthread();
+  if (mScheduler == NULL)
+  {
+    startthread();
+    return;
+  }
+
+  if (!mScheduler->enqueue(this, compiledModel(), mPriority))
+  {
+    mIsStarted = false;
+    release_ref();
+    throw iface::cellml_api::CellMLException(L"Too many integration runs are waiting to start.");
+  }
 }
 
 void
 CDA_CellMLIntegrationRun::stop()
   throw (std::exception&)
 {
-  if (!mIsStarted || mCancelIntegration)
-    return;
-  mCancelIntegration = true;
+  {
+    CDALock l(mCommandMutex);
+    if (!mIsStarted || mCommand.load() == COMMAND_CANCEL)
+      return;
+    mCommand.store(COMMAND_CANCEL);
+    mCommandCondition.Broadcast();
+  }
 
-  int stop = 1;
-#ifdef WIN32
-  DWORD outCount;
-  WriteFile(mThreadPipes[1], &stop, sizeof(stop), &outCount, NULL);
-  ReleaseSemaphore(mThreadSemaphore, 1, NULL);
-#else
-  write(mThreadPipes[1], &stop, sizeof(stop));
-#endif
+  // A run which was paused before it was taken from the queue can now be
+  // taken, so it can finish.
+  if (mScheduler != NULL)
+    mScheduler->wake();
 }
 
 void
 CDA_CellMLIntegrationRun::pause()
   throw (std::exception&)
 {
-  if (!mIsStarted || mCancelIntegration || mPauseIntegration)
+  CDALock l(mCommandMutex);
+  if (!mIsStarted || mCommand.load() != COMMAND_RUN)
     return;
-  mPauseIntegration = true;
-
-  int pause = 2;
-#ifdef WIN32
-  DWORD outCount;
-  WriteFile(mThreadPipes[1], &pause, sizeof(pause), &outCount, NULL);
-  ReleaseSemaphore(mThreadSemaphore, 1, NULL);
-#else
-  write(mThreadPipes[1], &pause, sizeof(pause));
-#endif
+  mCommand.store(COMMAND_PAUSE);
 }
 
 void
 CDA_CellMLIntegrationRun::resume()
   throw (std::exception&)
 {
-  if (!mIsStarted || mCancelIntegration || !mPauseIntegration)
-    return;
+  {
+    CDALock l(mCommandMutex);
+    if (!mIsStarted || mCommand.load() != COMMAND_PAUSE)
+      return;
+    mCommand.store(COMMAND_RUN);
+    mCommandCondition.Broadcast();
+  }
 
-  mPauseIntegration = false;
-  int resume = 3;
-#ifdef WIN32
-  DWORD outCount;
-  WriteFile(mThreadPipes[1], &resume, sizeof(resume), &outCount, NULL);
-  ReleaseSemaphore(mThreadSemaphore, 1, NULL);
-#else
-  write(mThreadPipes[1], &resume, sizeof(resume));
-#endif
+  if (mScheduler != NULL)
+    mScheduler->wake();
 }
 
 void
 CDA_ODESolverRun::runthread()
 {
+  integrate();
+  release_ref(); // Thread is finishing, cancel the add_ref call before startthread.
+}
+
+void
+CDA_ODESolverRun::SetupInitialValues
+(
+ CompiledModelFunctions* f, uint32_t constSize, double* constants,
+ uint32_t rateSize, uint32_t algSize, double* buffer,
+ iface::cellml_services::IntegrationProgressObserver* aObserver
+)
+{
+  if (!mRecordLayout.fits(constSize, rateSize, algSize))
+    throw iface::cellml_api::CellMLException(L"Output variable not in model (internal)"); // Caught by the caller.
+
+  buffer[0] = mStartBvar;
+  double* states = buffer + 1;
+  double* rates = states + rateSize;
+  double* algebraic = rates + rateSize;
+
+  memset(rates, 0, rateSize * sizeof(double));
+
+  struct Override overrides;
+  overrides.isOverriden = new bool[constSize];
+  overrides.constants = constants;
+  overrides.nConstants = constSize;
+  overrideConstants(overrides);
+
   struct fail_info failInfo;
-  double* constants = NULL, * buffer = NULL, * algebraic, * rates, * states;
+  f->setupConstants(constants, rates, states, &overrides, &failInfo);
+  if (failInfo.failtype)
+    throw iface::cellml_api::CellMLException(L"failInfo.failtype (internal)"); // Caught by the caller.
 
-  try
+  delete [] overrides.isOverriden;
+
+  // Now apply overrides...
+  overrideStates(states, rates, rateSize);
+
+  SetupSensitivities(f, constSize, constants, rateSize);
+
+  if (aObserver != NULL)
   {
-    CompiledModelFunctions* f = mModel->mCMF;
-    uint32_t algSize = mModel->mCCI->algebraicIndexCount();
-    uint32_t constSize = mModel->mCCI->constantIndexCount();
-    uint32_t rateSize = mModel->mCCI->rateIndexCount();
+    std::vector<double> constantsVec(constants, constants + constSize);
+    aObserver->computedConstants(constantsVec);
+  }
 
-    constants = new double[constSize];
-    buffer = new double[2 * rateSize + algSize + 1];
+  f->computeRates(mStartBvar, constants, rates, states, algebraic, &failInfo);
+  f->computeVariables(mStartBvar, constants, rates, states, algebraic, &failInfo);
+  if (failInfo.failtype)
+    throw iface::cellml_api::CellMLException(L"failInfo.failtype (internal)"); // Caught by the caller.
 
-    buffer[0] = mStartBvar;
-    states = buffer + 1;
-    rates = states + rateSize;
-    algebraic = rates + rateSize;
+  if (aObserver != NULL && !mFinalStateOnly)
+  {
+    std::vector<double> resultsVec(mRecordLayout.recordSize(rateSize, algSize));
+    mRecordLayout.write(&resultsVec[0], mStartBvar, constants, states, rates,
+                        algebraic, rateSize, algSize,
+                        mSensitivities.empty() ? NULL : &mSensitivities[0]);
+    aObserver->results(resultsVec);
+  }
+}
 
-    memset(rates, 0, rateSize * sizeof(double));
+void
+CDA_ODESolverRun::SetupSensitivities
+(
+ CompiledModelFunctions* f, uint32_t constSize, const double* constants,
+ uint32_t rateSize
+)
+{
+  uint32_t count = f->sensitivityParameters.size();
+  mSensitivities.assign(rateSize * count, 0.0);
+  mConstantSensitivities.assign(f->constantSensitivityPattern.size(), 0.0);
+  if (f->SetupSensitivities == NULL)
+    return;
 
-    struct Override overrides;
-    overrides.isOverriden = new bool[constSize];
-    overrides.constants = constants;
-    overrides.nConstants = constSize;
-    for (int i = 0; i < constSize; i++)
-      overrides.isOverriden[i] = false;
-    OverrideList::iterator oli;
-    for (oli = mConstantOverrides.begin(); oli != mConstantOverrides.end();
-         oli++)
-      if ((*oli).first < constSize)
-      {
-        overrides.isOverriden[(*oli).first] = true;
-        constants[(*oli).first] = (*oli).second;
-      }
+  // The SetupConstants code is run again to find the derivatives, so it gets
+  // copies of the arrays. The copy of the constants already holds the
+  // overridden values.
+  std::vector<double> scratch(constants, constants + constSize),
+    scratchStates(rateSize + 1), scratchRates(rateSize + 1),
+    initial(f->initialSensitivityPattern.size() + 1);
+  struct Override overrides;
+  overrides.isOverriden = new bool[constSize];
+  overrides.constants = &scratch[0];
+  overrides.nConstants = constSize;
+  overrideConstants(overrides);
 
-    struct fail_info failInfo;
-    f->SetupConstants(constants, rates, states, &overrides, &failInfo);
-    if (failInfo.failtype)
-      throw iface::cellml_api::CellMLException(L"failInfo.failtype (internal)"); // Caught below.
+  struct fail_info failInfo;
+  f->SetupSensitivities(&scratch[0], &scratchRates[0], &scratchStates[0],
+                        &overrides,
+                        mConstantSensitivities.empty() ? NULL :
+                        &mConstantSensitivities[0], &initial[0], &failInfo);
+  delete [] overrides.isOverriden;
+
+  // Checkpoints don't hold the sensitivities, so a resumed run starts again
+  // from zero.
+  if (mResumeFrom != NULL)
+    return;
 
-    delete [] overrides.isOverriden;
+  const JacobianPattern& pattern = f->initialSensitivityPattern;
+  for (uint32_t k = 0; k < pattern.size(); k++)
+    mSensitivities[pattern[k].second * rateSize + pattern[k].first] =
+      initial[k];
+
+  // A state given its own initial value doesn't depend on the parameters.
+  for (OverrideList::iterator oli = mIVOverrides.begin();
+       oli != mIVOverrides.end(); oli++)
+    if ((*oli).first < rateSize)
+      for (uint32_t j = 0; j < count; j++)
+        mSensitivities[j * rateSize + (*oli).first] = 0.0;
+}
 
-    // Now apply overrides...
-    for (oli = mIVOverrides.begin(); oli != mIVOverrides.end();
-         oli++)
-      if ((*oli).first < rateSize)
-        states[(*oli).first] = (*oli).second;
+void
+CDA_ODESolverRun::integrate()
+{
+  struct fail_info failInfo;
+  double* constants = NULL, * buffer = NULL, * algebraic, * rates, * states;
 
-    if (mObserver != NULL)
+  try
+  {
+    CompiledModelFunctions* f = mModel->functions();
+    uint32_t algSize = mModel->mCCI->algebraicIndexCount();
+    uint32_t constSize = mModel->mCCI->constantIndexCount();
+    uint32_t rateSize = mModel->mCCI->rateIndexCount();
+
+    // Sensitivities are only integrated by the CVODE solvers.
+    mRecordLayout.setSensitivities(f->sensitivityParameters);
+    if (!f->sensitivityParameters.empty() &&
+        mStepType != iface::cellml_services::ADAMS_MOULTON_1_12 &&
+        mStepType != iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE)
     {
-      std::vector<double> constantsVec(constants, constants + constSize);
-      mObserver->computedConstants(constantsVec);
+      failInfo.failmsg = "Sensitivities can't be integrated with this step type";
+      throw iface::cellml_api::CellMLException(L"Sensitivities can't be integrated with this step type (internal)"); // Caught below.
     }
 
-    f->ComputeRates(mStartBvar, constants, rates, states, algebraic, &failInfo);
-    f->ComputeVariables(mStartBvar, constants, rates, states, algebraic, &failInfo);
-    if (failInfo.failtype)
-      throw iface::cellml_api::CellMLException(L"failInfo.failtype (internal)"); // Caught below.
-
-    if (mObserver != NULL)
+    if (!startResultFile(mModel->mCCI, rateSize, algSize))
     {
-      std::vector<double> resultsVec(buffer, buffer + 2 * rateSize + algSize + 1);
-      mObserver->results(resultsVec);
+      failInfo.failmsg = "Couldn't create the result file";
+      throw iface::cellml_api::CellMLException(L"Couldn't create the result file (internal)"); // Caught below.
     }
 
+    constants = new double[mModel->constantStorageSize()];
+    buffer = new double[2 * rateSize + algSize + 1];
+
+    states = buffer + 1;
+    rates = states + rateSize;
+    algebraic = rates + rateSize;
+
+    SetupInitialValues(f, constSize, constants, rateSize, algSize, buffer,
+                       mObserver);
+
     SolveODEProblem(f, constSize, constants, rateSize, rates, states,
                     algSize, algebraic);
   }
@@ -801,8 +1457,6 @@ CDA_ODESolverRun::runthread()
     delete [] constants;
   if (buffer != NULL)
     delete [] buffer;
-
-  release_ref(); // Thread is finishing, cancel the add_ref call before startthread.
 }
 
 void
@@ -820,6 +1474,17 @@ CDA_DAESolverRun::runthread()
     DECLARE_QUERY_INTERFACE_OBJREF(cci, mModel->mCCI, cellml_services::IDACodeInformation);
     uint32_t condVarSize = cci->conditionVariableCount();
 
+    if (!mRecordLayout.fits(constSize, rateSize, algSize))
+    {
+      emsg = "Output variable not in model";
+      throw iface::cellml_api::CellMLException(L"Output variable not in model (internal)"); // Caught below.
+    }
+    if (!startResultFile(mModel->mCCI, rateSize, algSize))
+    {
+      emsg = "Couldn't create the result file";
+      throw iface::cellml_api::CellMLException(L"Couldn't create the result file (internal)"); // Caught below.
+    }
+
     constants = new double[constSize];
     buffer = new double[2 * rateSize + algSize + 1 + condVarSize];
 
@@ -836,26 +1501,14 @@ CDA_DAESolverRun::runthread()
     overrides.isOverriden = new bool[constSize];
     overrides.constants = constants;
     overrides.nConstants = constSize;
-    for (int i = 0; i < constSize; i++)
-      overrides.isOverriden[i] = false;
-    OverrideList::iterator oli;
-    for (oli = mConstantOverrides.begin(); oli != mConstantOverrides.end();
-         oli++)
-      if ((*oli).first < constSize)
-      {
-        overrides.isOverriden[(*oli).first] = true;
-        constants[(*oli).first] = (*oli).second;
-      }
+    overrideConstants(overrides);
 
     struct fail_info failInfo;
     // Algebraic is needed for locally bound variables (e.g. for definite integrals).
     f->SetupFixedConstants(constants, rates, states, algebraic, &overrides, &failInfo);
 
     // Now apply overrides...
-    for (oli = mIVOverrides.begin(); oli != mIVOverrides.end();
-         oli++)
-      if ((*oli).first < rateSize)
-        states[(*oli).first] = (*oli).second;
+    overrideStates(states, rates, rateSize);
 
     delete [] overrides.isOverriden;
 
@@ -892,9 +1545,7 @@ void
 CDA_CellMLIntegrationService::setupCodeEnvironment
 (
  iface::cellml_services::CodeInformation* cci,
- std::string& dirname,
- std::string& sourcename,
- std::ofstream& ss
+ std::ostream& ss
 )
 {
   iface::cellml_services::ModelConstraintLevel mcl = cci->constraintLevel();
@@ -912,40 +1563,6 @@ CDA_CellMLIntegrationService::setupCodeEnvironment
     }
   }
 
-  // Create a temporary directory...
-  const char* tmpenvs[] = {"TMPDIR", "TEMP", "TMP", NULL};
-  const char** p = tmpenvs;
-  char* fn = NULL;
-  while (!fn && *p)
-  {
-    char* env = getenv(*p);
-    if (env != NULL)
-      fn = attempt_make_tempdir(env);
-    p++;
-  }
-  if (fn == NULL)
-  {
-#ifdef WIN32
-    const char* tmpdirs[] = {"c:\\temp", "c:\\tmp", "\\temp", "\\tmp", NULL};
-#else
-    const char* tmpdirs[] = {"/tmp", "/var/tmp", "/usr/tmp", NULL};
-#endif
-    p = tmpdirs;
-    while (!fn && *p)
-    {
-      fn = attempt_make_tempdir(*p);
-      p++;
-    }
-  }
-  if (fn == NULL)
-    throw iface::cellml_api::CellMLException(L"Could not make temporary directory");
-  dirname = fn;
-  free(fn);
-
-  // We now have a temporary directory. Make the source file...
-  sourcename = dirname + "/generated.c";
-  ss.open(sourcename.c_str());
-
   ss << "/* This file is automatically generated and will be automatically"
      << std::endl
      << " * deleted. Don't edit it or changes will be lost. */" << std::endl
@@ -1001,7 +1618,8 @@ CDA_CellMLIntegrationService::compileModelODE
 )
   throw(std::exception&)
 {
-  return compileModelODEInternal(aModel, false);
+  return compileModelODEInternal(aModel, false, std::vector<uint32_t>(),
+                                 LookupTableRequest());
 }
 
 already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
@@ -1011,7 +1629,55 @@ CDA_CellMLIntegrationService::compileDebugModelODE
 )
   throw(std::exception&)
 {
-  return compileModelODEInternal(aModel, true);
+  return compileModelODEInternal(aModel, true, std::vector<uint32_t>(),
+                                 LookupTableRequest());
+}
+
+already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+CDA_CellMLIntegrationService::compileModelODESensitivities
+(
+ iface::cellml_api::Model* aModel,
+ const std::vector<uint32_t>& parameters
+)
+  throw(std::exception&)
+{
+  return compileModelODEInternal(aModel, false, parameters,
+                                 LookupTableRequest());
+}
+
+already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+CDA_CellMLIntegrationService::compileModelODELookupTables
+(
+ iface::cellml_api::Model* aModel,
+ const std::vector<uint32_t>& states,
+ const std::vector<double>& minima,
+ const std::vector<double>& maxima,
+ double tolerance
+)
+  throw(std::exception&)
+{
+  if (minima.size() != states.size() || maxima.size() != states.size())
+  {
+    mLastError = L"Lookup table ranges don't match the states";
+    throw iface::cellml_api::CellMLException(mLastError);
+  }
+  // Written so that NaNs are rejected too.
+  bool isValid = tolerance > 0.0;
+  for (uint32_t i = 0; isValid && i < states.size(); i++)
+    isValid = maxima[i] > minima[i];
+  if (!isValid)
+  {
+    mLastError = L"Lookup table ranges and tolerance must be positive";
+    throw iface::cellml_api::CellMLException(mLastError);
+  }
+
+  LookupTableRequest tables;
+  tables.states = states;
+  tables.minima = minima;
+  tables.maxima = maxima;
+  tables.tolerance = tolerance;
+  return compileModelODEInternal(aModel, false, std::vector<uint32_t>(),
+                                 tables);
 }
 
 void
@@ -1390,75 +2056,485 @@ L"true: #prec[999]1.0\r\n"
   }
 }
 
-already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
-CDA_CellMLIntegrationService::compileModelODEInternal
-(
- iface::cellml_api::Model* aModel,
- bool aIsDebug
-)
-  throw(std::exception&)
+// Rewrites generated code which works on a single instance of a model into
+// code which works on instance INSTANCE of NINSTANCES, with all instances'
+// values for each variable stored next to each other, so that the C compiler
+// can vectorise a loop over the instances. Returns false if the code uses the
+// arrays other than by indexing them (for example, passing them to a
+// non-linear solver), in which case it can't be rewritten.
+static bool
+MakeBatchedCode(const char* aCode, std::string& aBatched)
 {
-  RETURN_INTO_OBJREF(cgb, iface::cellml_services::CodeGeneratorBootstrap,
-                     CreateCodeGeneratorBootstrap());
-  RETURN_INTO_OBJREF(cg, iface::cellml_services::CodeGenerator,
-                     cgb->createCodeGenerator());
-
-  SetupCodeGenStrings(cg, aIsDebug);
+  static const char* arrays[] = {"CONSTANTS", "RATES", "STATES", "ALGEBRAIC",
+                                 NULL};
 
-  // Generate code information...
-  ObjRef<iface::cellml_services::CodeInformation> cci;
-  try
+  const char* p = aCode;
+  while (*p)
   {
-    cci = already_AddRefd<iface::cellml_services::CodeInformation>
-      (cg->generateCode(aModel));
+    if (!isalpha(*p) && *p != '_')
+    {
+      // Skip whole numbers, so exponents aren't mistaken for identifiers.
+      const char* start = p;
+      if (isdigit(*p) || *p == '.')
+        while (isalnum(*p) || *p == '.' || *p == '_' ||
+               ((*p == '+' || *p == '-') && (p[-1] == 'e' || p[-1] == 'E')))
+          p++;
+      else
+        p++;
+      aBatched.append(start, p - start);
+      continue;
+    }
 
-    std::wstring msg = cci->errorMessage();
-    if (msg != L"")
+    const char* start = p;
+    while (isalnum(*p) || *p == '_')
+      p++;
+    std::string ident(start, p - start);
+
+    const char** a;
+    for (a = arrays; *a != NULL; a++)
+      if (ident == *a)
+        break;
+    if (*a == NULL)
     {
-      mLastError = msg;
-      throw iface::cellml_api::CellMLException(msg);
+      aBatched += ident;
+      continue;
     }
+
+    if (*p != '[')
+      return false;
+    const char* close = strchr(p, ']');
+    if (close == NULL)
+      return false;
+    aBatched += ident;
+    aBatched += "[(";
+    aBatched.append(p + 1, close - p - 1);
+    aBatched += ")*NINSTANCES+INSTANCE]";
+    p = close + 1;
   }
-  catch (...)
+
+  return true;
+}
+
+// Keeps the results of analysing the model code which the compiled functions
+// can use.
+static void
+SetupCompiledModelAnalysis(CompiledModelFunctions* aCMF,
+                           const JacobianPattern& aJacobianPattern,
+                           const JacobianPattern& aGatingPattern,
+                           const std::vector<CodeStatement>& aStatements)
+{
+  if (aCMF->ComputeJacobian != NULL)
+    aCMF->jacobianPattern = aJacobianPattern;
+  if (aCMF->ComputeGatingJacobian != NULL)
+    aCMF->gatingPattern = aGatingPattern;
+  if (aCMF->ComputeVariablesSelected != NULL)
+    aCMF->variablesStatements = aStatements;
+}
+
+// Writes SetupSensitivities and ComputeSensitivityRates, for integrating the
+// sensitivities of the states to the constants aParameters. The rates of the
+// sensitivities are the derivatives of the rates along the directions given
+// by the current sensitivities, so each parameter is a column whose seeds are
+// the sensitivities of the states and constants to it. Returns false if the
+// code can't be differentiated.
+static bool
+WriteSensitivityCode(const std::string& aInitConsts, const std::string& aRates,
+                     const std::vector<uint32_t>& aParameters,
+                     uint32_t aConstCount, uint32_t aRateCount,
+                     uint32_t aAlgCount, std::ostream& aCode,
+                     JacobianPattern& aConstantPattern,
+                     JacobianPattern& aInitialPattern,
+                     JacobianPattern& aRatesPattern)
+{
+  uint32_t count = aParameters.size();
+  JacobianGenerator constants(aConstCount, count, "CONSTANTS"),
+    initial(aRateCount, count, "STATES");
+  for (uint32_t j = 0; j < count; j++)
   {
-    mLastError = L"Unexpected exception generating code";
-    throw iface::cellml_api::CellMLException(L"Unexpected exception generating code");
+    constants.addSeed("CONSTANTS", aParameters[j], j, "1.0");
+    initial.addSeed("CONSTANTS", aParameters[j], j, "1.0");
   }
+  if (!constants.differentiate(aInitConsts.c_str()) ||
+      !initial.differentiate(aInitConsts.c_str()))
+    return false;
+  std::string constantsCode, initialCode;
+  constants.writeCode(constantsCode);
+  initial.writeCode(initialCode);
+  aConstantPattern = constants.nonZeros();
+  aInitialPattern = initial.nonZeros();
+
+  JacobianGenerator rates(aRateCount, count, "RATES");
+  char coefficient[50];
+  for (uint32_t j = 0; j < count; j++)
+    for (uint32_t i = 0; i < aRateCount; i++)
+    {
+      sprintf(coefficient, "SENSITIVITIES[%u]", j * aRateCount + i);
+      rates.addSeed("STATES", i, j, coefficient);
+    }
+  for (uint32_t k = 0; k < aConstantPattern.size(); k++)
+  {
+    sprintf(coefficient, "CONSTANT_SENSITIVITIES[%u]", k);
+    rates.addSeed("CONSTANTS", aConstantPattern[k].first,
+                  aConstantPattern[k].second, coefficient);
+  }
+  if (!rates.differentiate(aRates.c_str()))
+    return false;
+  std::string ratesCode;
+  rates.writeCode(ratesCode);
+  aRatesPattern = rates.nonZeros();
+
+  // Both sets of derivatives come from running the SetupConstants code, so
+  // each gets a block of its own for its temporaries.
+  aCode << "void SetupSensitivities(double* CONSTANTS, double* RATES, "
+        << "double* STATES, struct Override* OVERRIDES, "
+        << "double* CONSTANT_SENSITIVITIES, double* INITIAL_SENSITIVITIES, "
+        << "struct fail_info* failInfo)" << std::endl
+        << "{" << std::endl
+        << "  double ALGEBRAIC[" << aAlgCount << "];" << std::endl
+        << "#define VOI 0.0" << std::endl
+        << "#define FAIL_RETURN" << std::endl
+        << "  {" << std::endl
+        << "#define JACOBIAN CONSTANT_SENSITIVITIES" << std::endl
+        << constantsCode << std::endl
+        << "#undef JACOBIAN" << std::endl
+        << "  }" << std::endl
+        << "  {" << std::endl
+        << "#define JACOBIAN INITIAL_SENSITIVITIES" << std::endl
+        << initialCode << std::endl
+        << "#undef JACOBIAN" << std::endl
+        << "  }" << std::endl
+        << "#undef FAIL_RETURN" << std::endl
+        << "#undef VOI" << std::endl
+        << "}" << std::endl;
+
+  aCode << "void ComputeSensitivityRates(double VOI, double* CONSTANTS, "
+        << "double* RATES, double* STATES, double* ALGEBRAIC, "
+        << "double* CONSTANT_SENSITIVITIES, double* SENSITIVITIES, "
+        << "double* JACOBIAN, struct fail_info* failInfo)" << std::endl
+        << "{" << std::endl
+        << ratesCode << std::endl
+        << "}" << std::endl;
+  return true;
+}
 
-  std::ofstream ss;
+// Translates the code for a model for the interpreter, returning NULL if it
+// can't be interpreted.
+static CompiledModelFunctions*
+InterpretModelCode(const std::string& aInitConsts, const std::string& aRates,
+                   const std::string& aVariables, uint32_t aAlgebraicCount)
+{
+  InterpretedModel* interpreted = new InterpretedModel();
+  if (!interpreted->compile(aInitConsts.c_str(), aRates.c_str(),
+                            aVariables.c_str(), aAlgebraicCount))
+  {
+    delete interpreted;
+    return NULL;
+  }
 
-  std::string dirname, sourcename;
-  setupCodeEnvironment(cci, dirname, sourcename, ss);
+  CompiledModelFunctions* cmf = new CompiledModelFunctions();
+  cmf->interpreted = interpreted;
+  return cmf;
+}
 
-  ss << "void SetupConstants(double* CONSTANTS, double* RATES, "
-    "double *STATES, struct Override* OVERRIDES, struct fail_info* failInfo)" << std::endl;
-  std::wstring frag = cci->initConstsString();
+// Compiles the code for a model which is being interpreted, and hands the
+// compiled functions to the model once they are ready.
+class BackgroundCompileWorker
+  : public CDAThread
+{
+public:
+  BackgroundCompileWorker(CDA_ODESolverModel* aModel,
+                          const std::string& aSource,
+                          uint32_t aOptimisationLevel,
+                          const JacobianPattern& aJacobianPattern,
+                          const JacobianPattern& aGatingPattern,
+                          const std::vector<CodeStatement>& aStatements)
+    : mModel(aModel), mSource(aSource),
+      mOptimisationLevel(aOptimisationLevel),
+      mJacobianPattern(aJacobianPattern), mGatingPattern(aGatingPattern),
+      mStatements(aStatements)
+  {
+  }
+
+protected:
+  void runthread();
+
+private:
+  // Keeps the model alive until the compile is finished.
+  ObjRef<CDA_ODESolverModel> mModel;
+  std::string mSource;
+  uint32_t mOptimisationLevel;
+  JacobianPattern mJacobianPattern, mGatingPattern;
+  std::vector<CodeStatement> mStatements;
+};
+
+void
+BackgroundCompileWorker::runthread()
+{
+  // Compile through a service object of our own, so that lastError on the
+  // service the model came from doesn't change behind its caller's back.
+  ObjRef<CDA_CellMLIntegrationService> cis
+    (already_AddRefd<CDA_CellMLIntegrationService>
+     (new CDA_CellMLIntegrationService()));
+  cis->optimisationLevel(mOptimisationLevel);
+
+  try
+  {
+    std::string dirname;
+    CompiledModule* mod = cis->CompileSource(mSource, dirname,
+                                             cis->mLastError);
+    CompiledModelFunctions* cmf = SetupCompiledModelFunctions(mod);
+    SetupCompiledModelAnalysis(cmf, mJacobianPattern, mGatingPattern,
+                               mStatements);
+    mModel->setCompiled(mod, cmf, dirname);
+  }
+  catch (...)
+  {
+    // The model just carries on being interpreted.
+  }
+
+  delete this;
+}
+
+already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+CDA_CellMLIntegrationService::compileModelODEInternal
+(
+ iface::cellml_api::Model* aModel,
+ bool aIsDebug,
+ const std::vector<uint32_t>& aParameters,
+ const LookupTableRequest& aTables
+)
+  throw(std::exception&)
+{
+  // Debug code reports failures as it goes, which the interpreter can't do.
+  // Nor can it run the sensitivity code. It computes any values which would
+  // be looked up in tables directly, which is fine until the compiled code
+  // takes over, but would defeat the point of asking for tables otherwise.
+  bool isTiered = !aIsDebug && aParameters.empty() &&
+    mCompilerBackend == iface::cellml_services::TIERED_COMPILER;
+  bool isInterpreted = !aIsDebug && aParameters.empty() && aTables.empty() &&
+    mCompilerBackend == iface::cellml_services::INTERPRETER;
+
+  // A structurally identical model may already have been compiled, in which
+  // case we can share it rather than generating and loading the code again.
+  std::string kind = isTiered ? "ODE-tiered" :
+    isInterpreted ? "ODE-interpreted" : "ODE";
+  if (!aParameters.empty())
+  {
+    kind += "-sensitivities";
+    for (uint32_t j = 0; j < aParameters.size(); j++)
+    {
+      char index[20];
+      sprintf(index, ",%u", aParameters[j]);
+      kind += index;
+    }
+  }
+  if (!aIsDebug && !aTables.empty())
+  {
+    char tolerance[40];
+    sprintf(tolerance, "-tables,%.17g", aTables.tolerance);
+    kind += tolerance;
+    for (uint32_t i = 0; i < aTables.states.size(); i++)
+    {
+      char table[80];
+      sprintf(table, ",%u:%.17g:%.17g", aTables.states[i], aTables.minima[i],
+              aTables.maxima[i]);
+      kind += table;
+    }
+  }
+  std::string cacheKey =
+    CompiledModelCacheKey(aModel, kind.c_str(), aIsDebug, mOptimisationLevel,
+                          mCompilerBackend);
+  CDA_CellMLCompiledModel* cached = FindCompiledModel(cacheKey);
+  if (cached != NULL)
+    return static_cast<CDA_ODESolverModel*>(cached);
+
+  RETURN_INTO_OBJREF(cgb, iface::cellml_services::CodeGeneratorBootstrap,
+                     CreateCodeGeneratorBootstrap());
+  RETURN_INTO_OBJREF(cg, iface::cellml_services::CodeGenerator,
+                     cgb->createCodeGenerator());
+
+  SetupCodeGenStrings(cg, aIsDebug);
+
+  // Generate code information...
+  ObjRef<iface::cellml_services::CodeInformation> cci;
+  try
+  {
+    cci = already_AddRefd<iface::cellml_services::CodeInformation>
+      (cg->generateCode(aModel));
+
+    std::wstring msg = cci->errorMessage();
+    if (msg != L"")
+    {
+      mLastError = msg;
+      throw iface::cellml_api::CellMLException(msg);
+    }
+  }
+  catch (...)
+  {
+    mLastError = L"Unexpected exception generating code";
+    throw iface::cellml_api::CellMLException(L"Unexpected exception generating code");
+  }
+
+  uint32_t constCount = cci->constantIndexCount();
+  for (uint32_t j = 0; j < aParameters.size(); j++)
+    if (aParameters[j] >= constCount)
+    {
+      mLastError = L"Sensitivity parameter is not a constant of the model";
+      throw iface::cellml_api::CellMLException(mLastError);
+    }
+  uint32_t rateCount = cci->rateIndexCount();
+  for (uint32_t i = 0; i < aTables.states.size(); i++)
+    if (aTables.states[i] >= rateCount)
+    {
+      mLastError = L"Lookup table state is not a state of the model";
+      throw iface::cellml_api::CellMLException(mLastError);
+    }
+
+  std::ostringstream ss;
+
+  std::string dirname;
+  setupCodeEnvironment(cci, ss);
+
+  std::wstring frag = cci->ratesString();
   size_t fragLen = wcstombs(NULL, frag.c_str(), 0) + 1;
   char* frag8 = new char[fragLen];
   wcstombs(frag8, frag.c_str(), fragLen);
+  std::string ratesCode = frag8;
+  delete [] frag8;
+
+  // Values the rates compute from constants alone only change when the
+  // constants do, so they are computed once by SetupConstants, after any
+  // overrides are applied, and stored after the model's own constants. The
+  // sensitivity code only knows about the model's own constants.
+  std::string invariantCode;
+  uint32_t invariantCount = 0;
+  if (!aIsDebug && aParameters.empty())
+  {
+    std::string hoistedRates;
+    invariantCount = HoistInvariantStatements(ratesCode.c_str(), constCount,
+                                              invariantCode, hoistedRates);
+    if (invariantCount != 0)
+      ratesCode = hoistedRates;
+  }
+
+  ss << "void SetupConstants(double* CONSTANTS, double* RATES, "
+    "double *STATES, struct Override* OVERRIDES, struct fail_info* failInfo)" << std::endl;
+  frag = cci->initConstsString();
+  fragLen = wcstombs(NULL, frag.c_str(), 0) + 1;
+  frag8 = new char[fragLen];
+  wcstombs(frag8, frag.c_str(), fragLen);
+  std::string initConstsCode = frag8 + invariantCode;
   ss << "{" << std::endl
      << "  double ALGEBRAIC[" << cci->algebraicIndexCount() << "];" << std::endl
      << "#define VOI 0.0" << std::endl
      << "#define FAIL_RETURN" << std::endl
-     << frag8 << std::endl
+     << initConstsCode << std::endl
      << "#undef FAIL_RETURN" << std::endl
      << "#undef VOI" << std::endl
      << "#undef ALGEBRAIC" << std::endl
      << "}" << std::endl;
   delete [] frag8;
 
+  // Only the rates use the lookup tables; everything derived from them below
+  // is computed directly from the original code.
+  std::string tabulatedCode;
+  std::vector<LookupTable> lookupTables;
+  const char* fastRatesCode = ratesCode.c_str();
+  if (!aIsDebug &&
+      TabulateCode(ratesCode.c_str(), rateCount, cci->algebraicIndexCount(),
+                   aTables, tabulatedCode, lookupTables))
+  {
+    WriteLookupTableSupport(ss, lookupTables);
+    fastRatesCode = tabulatedCode.c_str();
+  }
+  // The code generator repeats calls like exp(...) across equations, and
+  // leaves operations on numbers and powers such as pow(x, 2.0) as they are.
+  std::string optimisedCode;
+  if (!aIsDebug && OptimiseCode(fastRatesCode, optimisedCode))
+    fastRatesCode = optimisedCode.c_str();
+
   ss << "void ComputeRates(double VOI, double* CONSTANTS, double* RATES, "
      << "double* STATES, double* ALGEBRAIC, struct fail_info* failInfo)" << std::endl;
-  frag = cci->ratesString();
-  fragLen = wcstombs(NULL, frag.c_str(), 0) + 1;
-  frag8 = new char[fragLen];
-  wcstombs(frag8, frag.c_str(), fragLen);
   ss << "{" << std::endl
      << "#define FAIL_RETURN" << std::endl
-     << frag8 << std::endl
+     << fastRatesCode << std::endl
      << "#undef FAIL_RETURN" << std::endl
      << "}" << std::endl;
-  delete [] frag8;
+
+  // Debug code reports failures through failInfo as it goes, so evaluating
+  // several instances at once would only confuse the reports.
+  std::string batched;
+  if (!aIsDebug && MakeBatchedCode(fastRatesCode, batched))
+  {
+    ss << "void ComputeRatesBatch(int NINSTANCES, double VOI, "
+       << "double* __restrict CONSTANTS, double* __restrict RATES, "
+       << "double* __restrict STATES, double* __restrict ALGEBRAIC, "
+       << "struct fail_info* failInfo)" << std::endl
+       << "{" << std::endl
+       << "  int INSTANCE;" << std::endl
+       << "  for (INSTANCE = 0; INSTANCE < NINSTANCES; INSTANCE++)" << std::endl
+       << "  {" << std::endl
+       << batched << std::endl
+       << "  }" << std::endl
+       << "}" << std::endl;
+  }
+
+  // Give the stiff solvers an exact Jacobian where the rates can be
+  // differentiated, rather than making them estimate it by finite
+  // differences.
+  JacobianGenerator jg(rateCount, "RATES");
+  for (uint32_t i = 0; i < rateCount; i++)
+    jg.addSeed("STATES", i);
+  JacobianPattern gatingPattern;
+  if (!aIsDebug && jg.differentiate(ratesCode.c_str()))
+  {
+    std::string jacobian;
+    jg.writeCode(jacobian);
+    ss << "void ComputeJacobian(double VOI, double* CONSTANTS, "
+       << "double* RATES, double* STATES, double* ALGEBRAIC, "
+       << "double* JACOBIAN, struct fail_info* failInfo)" << std::endl
+       << "{" << std::endl
+       << jacobian << std::endl
+       << "}" << std::endl;
+
+    // States whose rates are linear in themselves, such as gating variables,
+    // can be stepped exactly by RUSH_LARSEN given their own entries on the
+    // diagonal, which only need derivatives with respect to those states.
+    JacobianGenerator gg(rateCount, "RATES");
+    bool anyLinear = false;
+    const JacobianPattern& nonZeros = jg.nonZeros();
+    for (uint32_t k = 0; k < nonZeros.size(); k++)
+      if (nonZeros[k].first == nonZeros[k].second &&
+          jg.isLinearIn(nonZeros[k].first, nonZeros[k].first))
+      {
+        gg.addSeed("STATES", nonZeros[k].first);
+        anyLinear = true;
+      }
+    if (anyLinear && gg.differentiate(ratesCode.c_str()))
+    {
+      std::string gating;
+      gg.writeCode(gating, true);
+      ss << "void ComputeGatingJacobian(double VOI, double* CONSTANTS, "
+         << "double* RATES, double* STATES, double* ALGEBRAIC, "
+         << "double* JACOBIAN, struct fail_info* failInfo)" << std::endl
+         << "{" << std::endl
+         << gating << std::endl
+         << "}" << std::endl;
+      gatingPattern = gg.nonZeros();
+    }
+  }
+
+  JacobianPattern constantSensitivities, initialSensitivities, sensitivities;
+  if (!aParameters.empty() &&
+      !WriteSensitivityCode(initConstsCode, ratesCode, aParameters,
+                            constCount, rateCount, cci->algebraicIndexCount(),
+                            ss, constantSensitivities, initialSensitivities,
+                            sensitivities))
+  {
+    mLastError = L"The model can't be differentiated with respect to the "
+      L"sensitivity parameters";
+    throw iface::cellml_api::CellMLException(mLastError);
+  }
 
   ss << "void ComputeVariables(double VOI, double* CONSTANTS, double* RATES, "
     "double* STATES, double* ALGEBRAIC, struct fail_info* failInfo)" << std::endl;
@@ -1466,19 +2542,96 @@ CDA_CellMLIntegrationService::compileModelODEInternal
   fragLen = wcstombs(NULL, frag.c_str(), 0) + 1;
   frag8 = new char[fragLen];
   wcstombs(frag8, frag.c_str(), fragLen);
+  std::string variablesCode = frag8;
+  std::string optimisedVariables;
+  if (aIsDebug || !OptimiseCode(frag8, optimisedVariables))
+    optimisedVariables = frag8;
   ss << "{" << std::endl
      << "#define FAIL_RETURN" << std::endl
-     << frag8 << std::endl
+     << optimisedVariables << std::endl
      << "#undef FAIL_RETURN" << std::endl
      << "}" << std::endl;
+
+  // Runs that only record some outputs can skip the statements which those
+  // outputs don't depend on.
+  std::vector<CodeStatement> statements;
+  if (!aIsDebug && SplitStatements(frag8, statements))
+  {
+    ss << "void ComputeVariablesSelected(double VOI, double* CONSTANTS, "
+       << "double* RATES, double* STATES, double* ALGEBRAIC, "
+       << "const char* STEPS, struct fail_info* failInfo)" << std::endl
+       << "{" << std::endl
+       << "#define FAIL_RETURN" << std::endl;
+    for (uint32_t i = 0; i < statements.size(); i++)
+    {
+      ss << "if (STEPS[" << i << "])" << std::endl
+         << "{" << std::endl
+         << statements[i].code << std::endl
+         << "}" << std::endl;
+      statements[i].code.clear();
+    }
+    ss << "#undef FAIL_RETURN" << std::endl
+       << "}" << std::endl;
+  }
   delete [] frag8;
 
-  ss.close();
+  if (isTiered || isInterpreted)
+  {
+    CompiledModelFunctions* cmf =
+      InterpretModelCode(initConstsCode, ratesCode, variablesCode,
+                         cci->algebraicIndexCount());
+    if (cmf != NULL)
+    {
+      CDA_ODESolverModel* model = new CDA_ODESolverModel(NULL, cmf, aModel,
+                                                         cci, dirname);
+      model->mInvariantCount = invariantCount;
+      if (isTiered)
+        (new BackgroundCompileWorker(model, ss.str(), mOptimisationLevel,
+                                     jg.nonZeros(), gatingPattern,
+                                     statements))->startthread();
+      RegisterCompiledModel(cacheKey, model);
+      return model;
+    }
+  }
 
-  CompiledModule* mod = CompileSource(dirname, sourcename, mLastError);
+  CompiledModule* mod;
+  try
+  {
+    mod = CompileSource(ss.str(), dirname, mLastError);
+  }
+  catch (iface::cellml_api::CellMLException&)
+  {
+    // Running the model slowly is better than not being able to run it at
+    // all, which is what happens when there is no working compiler. The
+    // failure may not last, so the interpreted model isn't shared with later
+    // compiles, which try the compiler again.
+    CompiledModelFunctions* cmf = NULL;
+    if (!aIsDebug && aParameters.empty() &&
+        mCompilerBackend == iface::cellml_services::AUTOMATIC_COMPILER)
+      cmf = InterpretModelCode(initConstsCode, ratesCode, variablesCode,
+                               cci->algebraicIndexCount());
+    if (cmf == NULL)
+      throw;
+
+    CDA_ODESolverModel* model = new CDA_ODESolverModel(NULL, cmf, aModel,
+                                                       cci, dirname);
+    model->mInvariantCount = invariantCount;
+    return model;
+  }
   CompiledModelFunctions* cmf = SetupCompiledModelFunctions(mod);
+  SetupCompiledModelAnalysis(cmf, jg.nonZeros(), gatingPattern, statements);
+  if (cmf->ComputeSensitivityRates != NULL)
+  {
+    cmf->sensitivityParameters = aParameters;
+    cmf->constantSensitivityPattern = constantSensitivities;
+    cmf->initialSensitivityPattern = initialSensitivities;
+    cmf->sensitivityPattern = sensitivities;
+  }
 
-  return new CDA_ODESolverModel(mod, cmf, aModel, cci, dirname);
+  CDA_ODESolverModel* model = new CDA_ODESolverModel(mod, cmf, aModel, cci, dirname);
+  model->mInvariantCount = invariantCount;
+  RegisterCompiledModel(cacheKey, model);
+  return model;
 }
 
 already_AddRefd<iface::cellml_services::DAESolverCompiledModel>
@@ -1509,6 +2662,13 @@ CDA_CellMLIntegrationService::compileModelDAEInternal
 )
   throw(std::exception&)
 {
+  std::string cacheKey = CompiledModelCacheKey(aModel, "DAE", aIsDebug,
+                                               mOptimisationLevel,
+                                               mCompilerBackend);
+  CDA_CellMLCompiledModel* cached = FindCompiledModel(cacheKey);
+  if (cached != NULL)
+    return static_cast<CDA_DAESolverModel*>(cached);
+
   RETURN_INTO_OBJREF(cgb, iface::cellml_services::CodeGeneratorBootstrap,
                      CreateCodeGeneratorBootstrap());
   RETURN_INTO_OBJREF(cg, iface::cellml_services::IDACodeGenerator,
@@ -1535,10 +2695,10 @@ CDA_CellMLIntegrationService::compileModelDAEInternal
     throw iface::cellml_api::CellMLException(L"Unexpected exception generating code");
   }
 
-  std::ofstream ss;
+  std::ostringstream ss;
 
-  std::string dirname, sourcename;
-  setupCodeEnvironment(cci, dirname, sourcename, ss);
+  std::string dirname;
+  setupCodeEnvironment(cci, ss);
 
   ss << "void SetupFixedConstants(double* CONSTANTS, double* RATES, "
     "double *STATES, double *ALGEBRAIC, struct Override* OVERRIDES, "
@@ -1569,6 +2729,17 @@ CDA_CellMLIntegrationService::compileModelDAEInternal
      << "}" << std::endl;
   delete [] frag8;
 
+  // The residual Jacobian is dF/dy + cj dF/dy', where the residuals depend on
+  // y and y' both directly and through the essential variables.
+  uint32_t rateCount = cci->rateIndexCount();
+  JacobianGenerator jg(rateCount, "resid");
+  for (uint32_t i = 0; i < rateCount; i++)
+  {
+    jg.addSeed("STATES", i);
+    jg.addSeed("RATES", i, "cj");
+  }
+  bool canDifferentiate = !aIsDebug;
+
   ss << "void EvaluateEssentialVariables(double VOI, double* CONSTANTS, double* RATES, "
      << "double* OLDRATES, double* STATES, double* OLDSTATES, double* ALGEBRAIC, "
      << "double* CONDVAR, struct fail_info* failInfo)" << std::endl;
@@ -1581,6 +2752,7 @@ CDA_CellMLIntegrationService::compileModelDAEInternal
      << frag8 << std::endl
      << "#undef FAIL_RETURN" << std::endl
      << "}" << std::endl;
+  canDifferentiate = canDifferentiate && jg.differentiate(frag8);
   delete [] frag8;
 
   ss << "void ComputeResiduals(double VOI, double* CONSTANTS, double* RATES, double* OLDRATES, "
@@ -1595,8 +2767,22 @@ CDA_CellMLIntegrationService::compileModelDAEInternal
      << frag8 << std::endl
      << "#undef FAIL_RETURN" << std::endl
      << "}" << std::endl;
+  canDifferentiate = canDifferentiate && jg.differentiate(frag8);
   delete [] frag8;
 
+  if (canDifferentiate)
+  {
+    std::string jacobian;
+    jg.writeCode(jacobian);
+    ss << "void ComputeResidualJacobian(double VOI, double cj, double* CONSTANTS, "
+      "double* RATES, double* OLDRATES, double* STATES, double* OLDSTATES, "
+      "double* ALGEBRAIC, double* CONDVAR, double* resid, double* JACOBIAN, "
+      "struct fail_info* failInfo)" << std::endl
+       << "{" << std::endl
+       << jacobian << std::endl
+       << "}" << std::endl;
+  }
+
   ss << "void ComputeRootInformation(double VOI, double* CONSTANTS, double* RATES, double* OLDRATES, "
     "double* STATES, double* OLDSTATES, double* ALGEBRAIC, double* CONDVAR, "
     "struct fail_info* failInfo)" << std::endl;
@@ -1621,12 +2807,565 @@ CDA_CellMLIntegrationService::compileModelDAEInternal
      << "}" << std::endl;
   delete [] frag8;
 
-  ss.close();
-
-  CompiledModule* mod = CompileSource(dirname, sourcename, mLastError);
+  CompiledModule* mod = CompileSource(ss.str(), dirname, mLastError);
   IDACompiledModelFunctions* cmf = SetupIDACompiledModelFunctions(mod);
+  if (cmf->ComputeResidualJacobian != NULL)
+    cmf->jacobianPattern = jg.nonZeros();
 
-  return new CDA_DAESolverModel(mod, cmf, aModel, cci, dirname);
+  CDA_DAESolverModel* model = new CDA_DAESolverModel(mod, cmf, aModel, cci, dirname);
+  RegisterCompiledModel(cacheKey, model);
+  return model;
+}
+
+// State shared between the threads taking part in a compileModelsODE call.
+struct CompileBatch
+{
+  CDAMutex mMutex;
+  CDACondition mWorkerFinished;
+  std::vector<iface::cellml_api::Model*> mModels;
+  std::vector<iface::cellml_services::ODESolverCompiledModel*> mResults;
+  std::wstring mFirstError;
+  uint32_t mNextModel, mActiveWorkers;
+  iface::cellml_services::CompilerBackend mCompilerBackend;
+  uint32_t mOptimisationLevel;
+};
+
+class CompileBatchWorker
+  : public CDAThread
+{
+public:
+  CompileBatchWorker(CompileBatch* aBatch)
+    : mBatch(aBatch)
+  {
+  }
+
+protected:
+  void runthread();
+
+private:
+  CompileBatch* mBatch;
+};
+
+void
+CompileBatchWorker::runthread()
+{
+  // Each worker compiles through its own service object, so workers don't
+  // race on lastError.
+  ObjRef<CDA_CellMLIntegrationService> cis
+    (already_AddRefd<CDA_CellMLIntegrationService>
+     (new CDA_CellMLIntegrationService()));
+  cis->compilerBackend(mBatch->mCompilerBackend);
+  cis->optimisationLevel(mBatch->mOptimisationLevel);
+
+  while (true)
+  {
+    uint32_t i;
+    {
+      CDALock l(mBatch->mMutex);
+      if (mBatch->mNextModel == mBatch->mModels.size())
+        break;
+      i = mBatch->mNextModel++;
+    }
+
+    iface::cellml_services::ODESolverCompiledModel* result = NULL;
+    std::wstring error;
+    try
+    {
+      result = cis->compileModelODE(mBatch->mModels[i]);
+    }
+    catch (...)
+    {
+      error = cis->lastError();
+      if (error == L"")
+        error = L"Unexpected exception compiling model";
+    }
+
+    CDALock l(mBatch->mMutex);
+    mBatch->mResults[i] = result;
+    if (result == NULL && mBatch->mFirstError == L"")
+      mBatch->mFirstError = error;
+  }
+
+  {
+    CDALock l(mBatch->mMutex);
+    mBatch->mActiveWorkers--;
+    mBatch->mWorkerFinished.Signal();
+  }
+  // The batch may be gone once the lock is released, so don't touch it again.
+  delete this;
+}
+
+static uint32_t
+ProcessorCount()
+{
+#ifdef WIN32
+  SYSTEM_INFO si;
+  GetSystemInfo(&si);
+  return si.dwNumberOfProcessors;
+#else
+  long n = sysconf(_SC_NPROCESSORS_ONLN);
+  return n < 1 ? 1 : n;
+#endif
+}
+
+std::vector<iface::cellml_services::ODESolverCompiledModel*>
+CDA_CellMLIntegrationService::compileModelsODE
+(
+ const std::vector<iface::cellml_api::Model*>& aModels,
+ uint32_t aMaxJobs
+)
+  throw(std::exception&)
+{
+  // The API objects for a single model can't be used from several threads at
+  // once, so each distinct model is only compiled once.
+  CompileBatch batch;
+  std::map<iface::cellml_api::Model*, uint32_t> modelSlots;
+  std::vector<uint32_t> slots;
+  for (std::vector<iface::cellml_api::Model*>::const_iterator i = aModels.begin();
+       i != aModels.end(); i++)
+  {
+    std::map<iface::cellml_api::Model*, uint32_t>::iterator j =
+      modelSlots.find(*i);
+    if (j == modelSlots.end())
+    {
+      j = modelSlots.insert(std::pair<iface::cellml_api::Model*, uint32_t>
+                            (*i, batch.mModels.size())).first;
+      batch.mModels.push_back(*i);
+    }
+    slots.push_back((*j).second);
+  }
+  batch.mResults.resize(batch.mModels.size(), NULL);
+  batch.mNextModel = 0;
+  batch.mCompilerBackend = mCompilerBackend;
+  batch.mOptimisationLevel = mOptimisationLevel;
+
+  uint32_t nWorkers = aMaxJobs == 0 ? ProcessorCount() : aMaxJobs;
+  if (nWorkers > batch.mModels.size())
+    nWorkers = batch.mModels.size();
+  batch.mActiveWorkers = nWorkers;
+
+  for (uint32_t i = 0; i < nWorkers; i++)
+    (new CompileBatchWorker(&batch))->startthread();
+
+  {
+    CDALock l(batch.mMutex);
+    while (batch.mActiveWorkers != 0)
+      batch.mWorkerFinished.Wait(batch.mMutex);
+  }
+
+  // The first occurrence of each model gets the reference from the worker,
+  // and any duplicates need a reference of their own.
+  std::vector<iface::cellml_services::ODESolverCompiledModel*> results;
+  std::vector<bool> slotUsed(batch.mModels.size(), false);
+  for (std::vector<uint32_t>::iterator i = slots.begin(); i != slots.end(); i++)
+  {
+    iface::cellml_services::ODESolverCompiledModel* m = batch.mResults[*i];
+    if (m != NULL && slotUsed[*i])
+      m->add_ref();
+    slotUsed[*i] = true;
+    results.push_back(m);
+  }
+
+  if (batch.mFirstError != L"")
+    mLastError = batch.mFirstError;
+
+  return results;
+}
+
+CDA_ODESolverEnsembleRun::CDA_ODESolverEnsembleRun(CDA_ODESolverModel* m)
+  : CDA_ODESolverRun(m), mMemberCount(0), mNextMember(0), mActiveWorkers(0),
+    mMaxThreads(0), mLockStepWidth(1), mGroupWidth(1),
+    mEnsembleObserver(NULL)
+{
+}
+
+CDA_ODESolverEnsembleRun::~CDA_ODESolverEnsembleRun()
+{
+  if (mEnsembleObserver != NULL)
+    mEnsembleObserver->release_ref();
+}
+
+void
+CDA_ODESolverEnsembleRun::setEnsemble
+(
+ uint32_t memberCount,
+ const std::vector<uint32_t>& constantIndices,
+ const std::vector<uint32_t>& stateIndices,
+ const std::vector<double>& values
+)
+  throw (std::exception&)
+{
+  if (mIsStarted)
+    throw iface::cellml_api::CellMLException(L"Call to setEnsemble() on an integration run that is already started.");
+  if (values.size() != memberCount *
+      (constantIndices.size() + stateIndices.size()))
+    throw iface::cellml_api::CellMLException(L"Call to setEnsemble() with the wrong number of values for the number of members and indices.");
+
+  mMemberCount = memberCount;
+  mEnsembleConstants = constantIndices;
+  mEnsembleStates = stateIndices;
+  mEnsembleValues = values;
+}
+
+uint32_t
+CDA_ODESolverEnsembleRun::maxThreads()
+  throw (std::exception&)
+{
+  return mMaxThreads;
+}
+
+void
+CDA_ODESolverEnsembleRun::maxThreads(uint32_t aMaxThreads)
+  throw (std::exception&)
+{
+  mMaxThreads = aMaxThreads;
+}
+
+uint32_t
+CDA_ODESolverEnsembleRun::lockStepWidth()
+  throw (std::exception&)
+{
+  return mLockStepWidth;
+}
+
+void
+CDA_ODESolverEnsembleRun::lockStepWidth(uint32_t aLockStepWidth)
+  throw (std::exception&)
+{
+  mLockStepWidth = aLockStepWidth;
+}
+
+void
+CDA_ODESolverEnsembleRun::setEnsembleObserver
+(
+ iface::cellml_services::EnsembleProgressObserver* aObserver
+)
+  throw (std::exception&)
+{
+  CDALock l(mObserverMutex);
+  if (mEnsembleObserver != NULL)
+    mEnsembleObserver->release_ref();
+  mEnsembleObserver = aObserver;
+  if (mEnsembleObserver != NULL)
+    mEnsembleObserver->add_ref();
+}
+
+void
+CDA_ODESolverEnsembleRun::setResultFile
+(
+ const std::wstring& fileName, uint32_t chunkRecords
+)
+  throw (std::exception&)
+{
+  throw iface::cellml_api::CellMLException(L"Ensemble runs can't write a result file.");
+}
+
+already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+CDA_ODESolverEnsembleRun::checkpoint()
+  throw (std::exception&)
+{
+  // Each member is at a position of its own.
+  throw iface::cellml_api::CellMLException(L"Checkpoints can't be taken of ensemble runs.");
+}
+
+// Passes the results of one member run on to the ensemble observer.
+class CDA_EnsembleMemberObserver
+  : public iface::cellml_services::IntegrationProgressObserver
+{
+public:
+  CDA_EnsembleMemberObserver(CDA_ODESolverEnsembleRun* aEnsemble)
+    : mEnsemble(aEnsemble), mMember(0)
+  {
+  }
+
+  CDA_IMPL_REFCOUNT;
+  CDA_IMPL_ID;
+  CDA_IMPL_QI1(cellml_services::IntegrationProgressObserver);
+
+  void computedConstants(const std::vector<double>& values)
+    throw (std::exception&)
+  {
+    CDALock l(mEnsemble->mObserverMutex);
+    if (mEnsemble->mEnsembleObserver != NULL)
+      mEnsemble->mEnsembleObserver->computedConstants(mMember, values);
+  }
+
+  void results(const std::vector<double>& state)
+    throw (std::exception&)
+  {
+    CDALock l(mEnsemble->mObserverMutex);
+    if (mEnsemble->mEnsembleObserver != NULL)
+      mEnsemble->mEnsembleObserver->results(mMember, state);
+  }
+
+  void done()
+    throw (std::exception&)
+  {
+    CDALock l(mEnsemble->mObserverMutex);
+    if (mEnsemble->mEnsembleObserver != NULL)
+      mEnsemble->mEnsembleObserver->memberDone(mMember);
+  }
+
+  void failed(const std::string& errorMessage)
+    throw (std::exception&)
+  {
+    CDALock l(mEnsemble->mObserverMutex);
+    if (mEnsemble->mEnsembleObserver != NULL)
+      mEnsemble->mEnsembleObserver->memberFailed(mMember, errorMessage);
+  }
+
+  CDA_ODESolverEnsembleRun* mEnsemble;
+  uint32_t mMember;
+};
+
+// Integrates individual members of an ensemble on a worker thread. It is never
+// started, so it only uses the settings copied from the ensemble.
+class CDA_EnsembleMemberRun
+  : public CDA_ODESolverRun
+{
+public:
+  CDA_EnsembleMemberRun(CDA_ODESolverEnsembleRun* aEnsemble)
+    : CDA_ODESolverRun(aEnsemble->mModel), mEnsemble(aEnsemble)
+  {
+    mStepType = aEnsemble->mStepType;
+    mLinearSolver = aEnsemble->mLinearSolver;
+    mEpsAbs = aEnsemble->mEpsAbs;
+    mEpsRel = aEnsemble->mEpsRel;
+    mScalVar = aEnsemble->mScalVar;
+    mScalRate = aEnsemble->mScalRate;
+    mStepSizeMax = aEnsemble->mStepSizeMax;
+    mStartBvar = aEnsemble->mStartBvar;
+    mStopBvar = aEnsemble->mStopBvar;
+    mMaxPointDensity = aEnsemble->mMaxPointDensity;
+    mTabulationStepSize = aEnsemble->mTabulationStepSize;
+    mStrictTabulation = aEnsemble->mStrictTabulation;
+    mInterpolateTabulation = aEnsemble->mInterpolateTabulation;
+    mSteadyStateTolerance = aEnsemble->mSteadyStateTolerance;
+    mSteadyStatePeriod = aEnsemble->mSteadyStatePeriod;
+    mFinalStateOnly = aEnsemble->mFinalStateOnly;
+    mResultBufferSize = aEnsemble->mResultBufferSize;
+    mResultMaxLatency = aEnsemble->mResultMaxLatency;
+    mResultMaxPoints = aEnsemble->mResultMaxPoints;
+    mRecordLayout = aEnsemble->mRecordLayout;
+    mResumeFrom = aEnsemble->mResumeFrom;
+
+    mMemberObserver = new CDA_EnsembleMemberObserver(aEnsemble);
+    // mObserver holds the reference from new.
+    mObserver = mMemberObserver;
+  }
+
+  ~CDA_EnsembleMemberRun()
+  {
+    for (std::vector<CDA_EnsembleMemberObserver*>::iterator i =
+           mGroupObservers.begin(); i != mGroupObservers.end(); i++)
+      (*i)->release_ref();
+  }
+
+  void integrateMember(uint32_t aMember)
+  {
+    setMemberOverrides(aMember);
+    mMemberObserver->mMember = aMember;
+    integrate();
+  }
+
+  // Integrates aCount members, starting from aFirst, in lock step.
+  void integrateGroup(uint32_t aFirst, uint32_t aCount)
+  {
+    CompiledModelFunctions* f = mModel->functions();
+    uint32_t algSize = mModel->mCCI->algebraicIndexCount();
+    uint32_t constSize = mModel->mCCI->constantIndexCount();
+    uint32_t rateSize = mModel->mCCI->rateIndexCount();
+    // Each member's constants are followed by the values SetupConstants
+    // computes from them for the rates.
+    uint32_t storageSize = mModel->constantStorageSize();
+    uint32_t recsize = 2 * rateSize + algSize + 1;
+
+    while (mGroupObservers.size() < aCount)
+      mGroupObservers.push_back(new CDA_EnsembleMemberObserver(mEnsemble));
+
+    std::vector<double> constants(aCount * storageSize),
+      states(aCount * rateSize), buffer(recsize);
+    std::vector<iface::cellml_services::IntegrationProgressObserver*> observers;
+
+    // Members which can't be set up are reported as failed straight away, and
+    // the rest of the group carries on without them.
+    uint32_t count = 0;
+    for (uint32_t i = 0; i < aCount; i++)
+    {
+      CDA_EnsembleMemberObserver* observer = mGroupObservers[i];
+      observer->mMember = aFirst + i;
+      setMemberOverrides(aFirst + i);
+      try
+      {
+        SetupInitialValues(f, constSize, &constants[count * storageSize],
+                           rateSize, algSize, &buffer[0], observer);
+      }
+      catch (...)
+      {
+        try
+        {
+          observer->failed("");
+        }
+        catch (...)
+        {
+        }
+        continue;
+      }
+      memcpy(&states[count * rateSize], &buffer[1], rateSize * sizeof(double));
+      observers.push_back(observer);
+      count++;
+    }
+
+    if (count != 0)
+      SolveODEProblemCVODEBatch(f, count, &observers[0], storageSize,
+                                &constants[0], rateSize, &states[0], algSize);
+  }
+
+protected:
+  void setMemberOverrides(uint32_t aMember)
+  {
+    uint32_t nConstants = mEnsemble->mEnsembleConstants.size(),
+      nStates = mEnsemble->mEnsembleStates.size();
+    uint32_t row = aMember * (nConstants + nStates);
+
+    // Overrides later in the list win, so the member's own values take
+    // precedence over overrides set on the ensemble.
+    mConstantOverrides = mEnsemble->mConstantOverrides;
+    for (uint32_t i = 0; i < nConstants; i++)
+      mConstantOverrides.push_back(std::pair<uint32_t,double>
+                                   (mEnsemble->mEnsembleConstants[i],
+                                    mEnsemble->mEnsembleValues[row + i]));
+    mIVOverrides = mEnsemble->mIVOverrides;
+    for (uint32_t i = 0; i < nStates; i++)
+      mIVOverrides.push_back(std::pair<uint32_t,double>
+                             (mEnsemble->mEnsembleStates[i],
+                              mEnsemble->mEnsembleValues[row + nConstants + i]));
+  }
+
+  void runthread() {}
+
+  // Members are paused and stopped along with the ensemble.
+  bool checkPauseOrCancellation()
+  {
+    return mEnsemble->checkPauseOrCancellation();
+  }
+
+private:
+  CDA_ODESolverEnsembleRun* mEnsemble;
+  CDA_EnsembleMemberObserver* mMemberObserver;
+  std::vector<CDA_EnsembleMemberObserver*> mGroupObservers;
+};
+
+// Takes members from the ensemble until none are left, so only one thread is
+// needed for each member integrated at the same time.
+class EnsembleWorker
+  : public CDAThread
+{
+public:
+  EnsembleWorker(CDA_ODESolverEnsembleRun* aEnsemble)
+    : mEnsemble(aEnsemble)
+  {
+  }
+
+protected:
+  void runthread();
+
+private:
+  CDA_ODESolverEnsembleRun* mEnsemble;
+};
+
+void
+EnsembleWorker::runthread()
+{
+  {
+    ObjRef<CDA_EnsembleMemberRun> run
+      (already_AddRefd<CDA_EnsembleMemberRun>
+       (new CDA_EnsembleMemberRun(mEnsemble)));
+
+    uint32_t width = mEnsemble->mGroupWidth;
+
+    while (true)
+    {
+      uint32_t member, count;
+      {
+        CDALock l(mEnsemble->mEnsembleMutex);
+        if (mEnsemble->mCommand.load() ==
+              CDA_ODESolverEnsembleRun::COMMAND_CANCEL ||
+            mEnsemble->mNextMember == mEnsemble->mMemberCount)
+          break;
+        member = mEnsemble->mNextMember;
+        count = mEnsemble->mMemberCount - member;
+        if (count > width)
+          count = width;
+        mEnsemble->mNextMember += count;
+      }
+
+      if (width == 1)
+        run->integrateMember(member);
+      else
+        run->integrateGroup(member, count);
+    }
+  }
+
+  {
+    CDALock l(mEnsemble->mEnsembleMutex);
+    mEnsemble->mActiveWorkers--;
+    mEnsemble->mEnsembleCondition.Broadcast();
+  }
+  delete this;
+}
+
+void
+CDA_ODESolverEnsembleRun::runthread()
+{
+  // Lock step integration needs the batched rates function, which isn't
+  // available for every model, and only the CVODE solvers support it. Members
+  // integrated in lock step all take the same steps, so can't each stop once
+  // they are steady, and their sensitivities aren't integrated. Nor are their
+  // tabulation points interpolated, so they would be recorded differently.
+  mGroupWidth = mLockStepWidth;
+  if (mGroupWidth == 0 || mModel->functions()->ComputeRatesBatch == NULL ||
+      !mModel->functions()->sensitivityParameters.empty() ||
+      mSteadyStateTolerance != 0.0 || mFinalStateOnly ||
+      mInterpolateTabulation ||
+      mModel->mCCI->rateIndexCount() == 0 ||
+      (mStepType != iface::cellml_services::ADAMS_MOULTON_1_12 &&
+       mStepType != iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE))
+    mGroupWidth = 1;
+  uint32_t nGroups = (mMemberCount + mGroupWidth - 1) / mGroupWidth;
+
+  uint32_t nWorkers = mMaxThreads == 0 ? ProcessorCount() : mMaxThreads;
+  if (nWorkers > nGroups)
+    nWorkers = nGroups;
+
+  {
+    CDALock l(mEnsembleMutex);
+    mNextMember = 0;
+    mActiveWorkers = nWorkers;
+  }
+
+  for (uint32_t i = 0; i < nWorkers; i++)
+    (new EnsembleWorker(this))->startthread();
+
+  {
+    CDALock l(mEnsembleMutex);
+    while (mActiveWorkers != 0)
+      mEnsembleCondition.Wait(mEnsembleMutex);
+  }
+
+  {
+    CDALock l(mObserverMutex);
+    try
+    {
+      if (mEnsembleObserver != NULL)
+        mEnsembleObserver->done();
+    }
+    catch (...)
+    {
+    }
+  }
+
+  release_ref(); // Thread is finishing, cancel the add_ref call before startthread.
 }
 
 already_AddRefd<iface::cellml_services::ODESolverRun>
@@ -1636,7 +3375,10 @@ CDA_CellMLIntegrationService::createODEIntegrationRun
 )
   throw (std::exception&)
 {
-  return new CDA_ODESolverRun(unsafe_dynamic_cast<CDA_ODESolverModel*>(aModel));
+  CDA_ODESolverRun* run =
+    new CDA_ODESolverRun(unsafe_dynamic_cast<CDA_ODESolverModel*>(aModel));
+  run->scheduleOn(mScheduler);
+  return run;
 }
 
 already_AddRefd<iface::cellml_services::DAESolverRun>
@@ -1646,7 +3388,70 @@ CDA_CellMLIntegrationService::createDAEIntegrationRun
 )
   throw (std::exception&)
 {
-  return new CDA_DAESolverRun(unsafe_dynamic_cast<CDA_DAESolverModel*>(aModel));
+  CDA_DAESolverRun* run =
+    new CDA_DAESolverRun(unsafe_dynamic_cast<CDA_DAESolverModel*>(aModel));
+  run->scheduleOn(mScheduler);
+  return run;
+}
+
+already_AddRefd<iface::cellml_services::ODESolverEnsembleRun>
+CDA_CellMLIntegrationService::createODEEnsembleRun
+(
+ iface::cellml_services::ODESolverCompiledModel* aModel
+)
+  throw (std::exception&)
+{
+  CDA_ODESolverEnsembleRun* run =
+    new CDA_ODESolverEnsembleRun
+    (unsafe_dynamic_cast<CDA_ODESolverModel*>(aModel));
+  run->scheduleOn(mScheduler);
+  return run;
+}
+
+already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+CDA_CellMLIntegrationService::createCheckpoint
+(
+ iface::cellml_services::CellMLCompiledModel* aModel,
+ double aVOI, double aStepSize,
+ const std::vector<double>& aStates, const std::vector<double>& aRates,
+ const std::vector<uint32_t>& aOverrideIndices,
+ const std::vector<double>& aOverrideValues
+)
+  throw (std::exception&)
+{
+  CDA_CellMLCompiledModel* model =
+    unsafe_dynamic_cast<CDA_CellMLCompiledModel*>(aModel);
+  uint32_t rateSize = model->mCCI->rateIndexCount();
+  if (aStates.size() != rateSize || aRates.size() != rateSize ||
+      aOverrideIndices.size() != aOverrideValues.size())
+    throw iface::cellml_api::CellMLException(L"Checkpoint values don't match the model.");
+
+  CDA_IntegrationCheckpoint* checkpoint = new CDA_IntegrationCheckpoint(model);
+  checkpoint->mVOI = aVOI;
+  checkpoint->mStepSize = aStepSize;
+  checkpoint->mStates = aStates;
+  checkpoint->mRates = aRates;
+  for (size_t i = 0; i < aOverrideIndices.size(); i++)
+    checkpoint->mConstantOverrides.push_back
+      (std::pair<uint32_t,double>(aOverrideIndices[i], aOverrideValues[i]));
+  return checkpoint;
+}
+
+already_AddRefd<iface::cellml_services::ResultFile>
+CDA_CellMLIntegrationService::openResultFile
+(
+ const std::wstring& fileName
+)
+  throw (std::exception&)
+{
+  std::string name = NarrowString(fileName);
+  CDA_ResultFile* file = new CDA_ResultFile();
+  if (!file->open(name))
+  {
+    file->release_ref();
+    throw iface::cellml_api::CellMLException(L"Couldn't read result file.");
+  }
+  return file;
 }
 
 already_AddRefd<iface::cellml_services::CellMLIntegrationService>
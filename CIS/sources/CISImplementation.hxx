@@ -1,7 +1,14 @@
 #include "IfaceCCGS.hxx"
 #include "IfaceCIS.hxx"
 #include <string>
+#include <ostream>
 #include "cda_compiler_support.h"
+#include "CISJacobian.hxx"
+#include "CISCodeAnalysis.hxx"
+#include "CISLookupTables.hxx"
+#include "CISResults.hxx"
+#include "CISInterpreter.hxx"
+#include "CISScheduler.hxx"
 
 #undef ENABLE_CONTEXT
 #ifdef ENABLE_CONTEXT
@@ -29,11 +36,113 @@ struct Override
 
 struct CompiledModelFunctions
 {
+  CompiledModelFunctions()
+    : SetupConstants(NULL), ComputeRates(NULL), ComputeVariables(NULL),
+      ComputeRatesBatch(NULL), ComputeJacobian(NULL),
+      ComputeGatingJacobian(NULL), ComputeVariablesSelected(NULL),
+      SetupSensitivities(NULL), ComputeSensitivityRates(NULL),
+      interpreted(NULL)
+  {
+  }
+
+  ~CompiledModelFunctions()
+  {
+    delete interpreted;
+  }
+
+  // These run the model code whether it has been compiled or is being
+  // interpreted, and should be used rather than the function pointers.
+  void setupConstants(double* CONSTANTS, double* RATES, double* STATES,
+                      struct Override* OVERRIDES, struct fail_info* failInfo)
+  {
+    if (interpreted != NULL)
+      interpreted->setupConstants(CONSTANTS, RATES, STATES, OVERRIDES);
+    else
+      SetupConstants(CONSTANTS, RATES, STATES, OVERRIDES, failInfo);
+  }
+
+  void computeRates(double VOI, double* CONSTANTS, double* RATES,
+                    double* STATES, double* ALGEBRAIC,
+                    struct fail_info* failInfo)
+  {
+    if (interpreted != NULL)
+      interpreted->computeRates(VOI, CONSTANTS, RATES, STATES, ALGEBRAIC);
+    else
+      ComputeRates(VOI, CONSTANTS, RATES, STATES, ALGEBRAIC, failInfo);
+  }
+
+  void computeVariables(double VOI, double* CONSTANTS, double* RATES,
+                        double* STATES, double* ALGEBRAIC,
+                        struct fail_info* failInfo)
+  {
+    if (interpreted != NULL)
+      interpreted->computeVariables(VOI, CONSTANTS, RATES, STATES, ALGEBRAIC);
+    else
+      ComputeVariables(VOI, CONSTANTS, RATES, STATES, ALGEBRAIC, failInfo);
+  }
+
   void (*SetupConstants)(double* CONSTANTS, double* RATES, double* STATES, struct Override*, struct fail_info*);
   void (*ComputeRates)(double VOI, double* CONSTANTS, double* RATES,
                       double* STATES, double* ALGEBRAIC, struct fail_info*);
   void (*ComputeVariables)(double VOI, double* CONSTANTS, double* RATES,
                           double* STATES, double* ALGEBRAIC, struct fail_info*);
+  // Computes the rates for nInstances instances of the model at once. Each
+  // array holds the values of its first variable for every instance, then
+  // those of its second variable, and so on. NULL if the model can't be
+  // evaluated this way.
+  void (*ComputeRatesBatch)(int nInstances, double VOI, double* CONSTANTS,
+                            double* RATES, double* STATES, double* ALGEBRAIC,
+                            struct fail_info*);
+  // Computes the entries of d(RATES)/d(STATES) listed in jacobianPattern
+  // into JACOBIAN. RATES and ALGEBRAIC are overwritten. NULL if the model
+  // couldn't be differentiated.
+  void (*ComputeJacobian)(double VOI, double* CONSTANTS, double* RATES,
+                          double* STATES, double* ALGEBRAIC, double* JACOBIAN,
+                          struct fail_info*);
+  JacobianPattern jacobianPattern;
+  // Computes the rates, and the entries on the diagonal of d(RATES)/d(STATES)
+  // listed in gatingPattern into JACOBIAN. Those are the states whose rates
+  // are linear in themselves, such as gating variables. NULL if there are
+  // none, or the model couldn't be differentiated.
+  void (*ComputeGatingJacobian)(double VOI, double* CONSTANTS, double* RATES,
+                                double* STATES, double* ALGEBRAIC,
+                                double* JACOBIAN, struct fail_info*);
+  JacobianPattern gatingPattern;
+  // Runs the statements of ComputeVariables for which STEPS is non-zero. NULL
+  // if ComputeVariables couldn't be split into statements.
+  void (*ComputeVariablesSelected)(double VOI, double* CONSTANTS,
+                                   double* RATES, double* STATES,
+                                   double* ALGEBRAIC, const char* STEPS,
+                                   struct fail_info*);
+  // The statements of ComputeVariables, in the order used for STEPS.
+  std::vector<CodeStatement> variablesStatements;
+  // Runs the SetupConstants code on CONSTANTS (which must already hold any
+  // overridden values), RATES and STATES, computing the entries of
+  // d(CONSTANTS)/dp listed in constantSensitivityPattern and of d(STATES)/dp
+  // listed in initialSensitivityPattern, where p are the constants listed in
+  // sensitivityParameters. NULL unless the model was compiled with
+  // sensitivities.
+  void (*SetupSensitivities)(double* CONSTANTS, double* RATES, double* STATES,
+                             struct Override*,
+                             double* CONSTANT_SENSITIVITIES,
+                             double* INITIAL_SENSITIVITIES, struct fail_info*);
+  // Computes the rates, and the entries of the rates of the sensitivities
+  // listed in sensitivityPattern into JACOBIAN. SENSITIVITIES[j * rateCount +
+  // i] is d(STATES[i])/d(CONSTANTS[sensitivityParameters[j]]), and
+  // CONSTANT_SENSITIVITIES is as computed by SetupSensitivities. NULL unless
+  // the model was compiled with sensitivities.
+  void (*ComputeSensitivityRates)(double VOI, double* CONSTANTS, double* RATES,
+                                  double* STATES, double* ALGEBRAIC,
+                                  double* CONSTANT_SENSITIVITIES,
+                                  double* SENSITIVITIES, double* JACOBIAN,
+                                  struct fail_info*);
+  std::vector<uint32_t> sensitivityParameters;
+  // Each pattern is of (row, parameter) positions.
+  JacobianPattern constantSensitivityPattern, initialSensitivityPattern,
+    sensitivityPattern;
+  // The interpreted model code, if it hasn't been compiled. All of the
+  // function pointers are then NULL.
+  InterpretedModel* interpreted;
 };
 
 struct IDACompiledModelFunctions
@@ -52,6 +161,16 @@ struct IDACompiledModelFunctions
                           double* OLDRATES, double* STATES, double* OLDSTATES,
                           double* ALGEBRAIC, double* CONDVAR, double* resids,
                           struct fail_info*);
+  // Computes the entries of d(resids)/d(STATES) + cj * d(resids)/d(RATES)
+  // listed in jacobianPattern into JACOBIAN. NULL if the model couldn't be
+  // differentiated.
+  void (*ComputeResidualJacobian)(double VOI, double cj, double* CONSTANTS,
+                                  double* RATES, double* OLDRATES,
+                                  double* STATES, double* OLDSTATES,
+                                  double* ALGEBRAIC, double* CONDVAR,
+                                  double* resids, double* JACOBIAN,
+                                  struct fail_info*);
+  JacobianPattern jacobianPattern;
   void (*ComputeRootInformation)(double VOI, double* CONSTANTS, double* RATES,
                                 double* OLDRATES, double* STATES, double* OLDSTATES,
                                 double* ALGEBRAIC, double* CONDVAR,
@@ -59,6 +178,84 @@ struct IDACompiledModelFunctions
   void (*SetupStateInfo)(double * SI);
 };
 
+// The most workspaces a model keeps for later runs.
+#define SOLVER_WORKSPACE_POOL_SIZE 32
+
+/**
+ * The memory a solver needs to integrate a model, kept after a run so that
+ * later runs of the same model can reuse it.
+ */
+class SolverWorkspace
+{
+public:
+  SolverWorkspace(const std::vector<uint32_t>& aSetup)
+    : mSetup(aSetup)
+  {
+  }
+
+  virtual ~SolverWorkspace() {}
+
+  // Describes how the solver was set up; only runs which would set it up in
+  // the same way can use the workspace.
+  std::vector<uint32_t> mSetup;
+};
+
+/**
+ * Workspaces left over from earlier runs of a model. Runs take a workspace
+ * for their own use, and give it back when they are finished.
+ */
+class SolverWorkspacePool
+{
+public:
+  ~SolverWorkspacePool()
+  {
+    for (std::list<SolverWorkspace*>::iterator i = mWorkspaces.begin();
+         i != mWorkspaces.end(); i++)
+      delete *i;
+  }
+
+  /**
+   * Takes a workspace with the given setup out of the pool.
+   * @return The workspace, or NULL if there isn't one.
+   */
+  SolverWorkspace* take(const std::vector<uint32_t>& aSetup)
+  {
+    CDALock l(mMutex);
+    for (std::list<SolverWorkspace*>::iterator i = mWorkspaces.begin();
+         i != mWorkspaces.end(); i++)
+      if ((*i)->mSetup == aSetup)
+      {
+        SolverWorkspace* w = *i;
+        mWorkspaces.erase(i);
+        return w;
+      }
+    return NULL;
+  }
+
+  /**
+   * Puts a workspace back into the pool, which then owns it. The workspace
+   * used longest ago is deleted if the pool is full.
+   */
+  void give(SolverWorkspace* aWorkspace)
+  {
+    SolverWorkspace* oldest = NULL;
+    {
+      CDALock l(mMutex);
+      mWorkspaces.push_front(aWorkspace);
+      if (mWorkspaces.size() > SOLVER_WORKSPACE_POOL_SIZE)
+      {
+        oldest = mWorkspaces.back();
+        mWorkspaces.pop_back();
+      }
+    }
+    delete oldest;
+  }
+
+private:
+  CDAMutex mMutex;
+  std::list<SolverWorkspace*> mWorkspaces;
+};
+
 class CDA_CellMLCompiledModel
   : public iface::cellml_services::ODESolverCompiledModel,
     public iface::cellml_services::DAESolverCompiledModel
@@ -72,7 +269,15 @@ public:
                          );
   ~CDA_CellMLCompiledModel();
 
-  CDA_IMPL_REFCOUNT;
+  // The refcount is managed by hand rather than with CDA_IMPL_REFCOUNT, because
+  // the final release has to remove the model from the compiled model cache
+  // while the cache is locked.
+  void add_ref() throw()
+  {
+    ++mRefcount;
+  }
+  void release_ref() throw();
+
   CDA_IMPL_ID;
 
   already_AddRefd<iface::cellml_api::Model> model()
@@ -95,6 +300,14 @@ public:
   ObjRef<iface::cellml_api::Model> mModel;
   ObjRef<iface::cellml_services::CodeInformation> mCCI;
   std::string mDirname;
+  // The key under which this model is in the compiled model cache, or empty
+  // if it is not in the cache.
+  std::string mCacheKey;
+  // Solver memory for runs of the model to reuse.
+  SolverWorkspacePool mWorkspaces;
+
+private:
+  CDA_RefCount mRefcount;
 };
 
 class CDA_ODESolverModel
@@ -108,13 +321,58 @@ public:
    iface::cellml_services::CodeInformation* aCCI,
    std::string& aDirname
   )
-    : CDA_CellMLCompiledModel(aModule, aModel, aCCI, aDirname), mCMF(aCMF)
+    : CDA_CellMLCompiledModel(aModule, aModel, aCCI, aDirname), mCMF(aCMF),
+      mInvariantCount(0), mCompiled(0), mCompiledCMF(NULL)
   {}
 
-  ~CDA_ODESolverModel() { delete mCMF; }
+  ~CDA_ODESolverModel()
+  {
+    delete mCMF;
+    delete mCompiledCMF;
+  }
 
   CDA_IMPL_QI2(cellml_services::CellMLCompiledModel, cellml_services::ODESolverCompiledModel);
+
+  /**
+   * Returns the functions to run the model with. For a model which started
+   * out interpreted, these are the compiled functions once setCompiled has
+   * been called. Either set stays valid as long as the model does.
+   */
+  CompiledModelFunctions* functions()
+  {
+    return mCompiled.load() ? mCompiledCMF : mCMF;
+  }
+
+  /**
+   * Hands over the compiled code for an interpreted model, from any thread.
+   * Runs already in progress switch over to it between steps.
+   */
+  void setCompiled(CompiledModule* aModule, CompiledModelFunctions* aCMF,
+                   const std::string& aDirname)
+  {
+    mModule = aModule;
+    mDirname = aDirname;
+    mCompiledCMF = aCMF;
+    mCompiled.store(1);
+  }
+
+  /**
+   * Returns how many elements the CONSTANTS array passed to the functions
+   * must have. Beyond the model's own constants, these hold the values which
+   * the rates code only computes from constants.
+   */
+  uint32_t constantStorageSize()
+  {
+    return mCCI->constantIndexCount() + mInvariantCount;
+  }
+
   CompiledModelFunctions* mCMF;
+  // The number of values moved out of the rates code into SetupConstants.
+  uint32_t mInvariantCount;
+
+private:
+  CDA_AtomicWord mCompiled;
+  CompiledModelFunctions* mCompiledCMF;
 };
 
 class CDA_DAESolverModel
@@ -138,9 +396,35 @@ public:
   IDACompiledModelFunctions* mCMF;
 };
 
+class CDA_IntegrationCheckpoint
+  : public iface::cellml_services::IntegrationCheckpoint
+{
+public:
+  CDA_IntegrationCheckpoint(CDA_CellMLCompiledModel* aModel)
+    : mModel(aModel), mVOI(0.0), mStepSize(0.0)
+  {
+  }
+
+  CDA_IMPL_REFCOUNT;
+  CDA_IMPL_ID;
+  CDA_IMPL_QI1(cellml_services::IntegrationCheckpoint);
+
+  double variableOfIntegration() throw(std::exception&) { return mVOI; }
+  double stepSize() throw(std::exception&) { return mStepSize; }
+  std::vector<double> states() throw(std::exception&) { return mStates; }
+  std::vector<double> rates() throw(std::exception&) { return mRates; }
+  std::vector<uint32_t> constantOverrideIndices() throw(std::exception&);
+  std::vector<double> constantOverrideValues() throw(std::exception&);
+
+  ObjRef<CDA_CellMLCompiledModel> mModel;
+  double mVOI, mStepSize;
+  std::vector<double> mStates, mRates;
+  std::list<std::pair<uint32_t,double> > mConstantOverrides;
+};
+
 class CDA_CellMLIntegrationRun
-  : public iface::cellml_services::ODESolverRun,
-    public iface::cellml_services::DAESolverRun,
+  : public virtual iface::cellml_services::ODESolverRun,
+    public virtual iface::cellml_services::DAESolverRun,
     public CDAThread
 {
 public:
@@ -156,45 +440,137 @@ public:
   void stepType(iface::cellml_services::ODEIntegrationStepType ist)
     throw (std::exception&);
 
+  iface::cellml_services::LinearSolverType linearSolver()
+    throw (std::exception&);
+
+  void linearSolver(iface::cellml_services::LinearSolverType lst)
+    throw (std::exception&);
+
   void setStepSizeControl(double epsAbs, double epsRel, double scalVar,
                           double scalRate, double maxStep) throw (std::exception&);
   void setTabulationStepControl(double tabulationStepSize, bool strictTabulation)
     throw (std::exception&);
+  void setTabulationInterpolation(bool interpolate)
+    throw (std::exception&);
   void setResultRange(double startBvar, double stopBvar, double incrementBvar)
     throw (std::exception&);
+  void setResultFlushPolicy(uint32_t bufferSize, uint32_t maxLatency,
+                            uint32_t maxPoints)
+    throw (std::exception&);
+  void setSteadyStateDetection(double tolerance, double period,
+                               bool finalStateOnly)
+    throw (std::exception&);
+  void setOutputVariables(const std::vector<iface::cellml_services::ComputationTarget*>& outputs)
+    throw (std::exception&);
+  void setResultFile(const std::wstring& fileName, uint32_t chunkRecords)
+    throw (std::exception&);
   void setProgressObserver(iface::cellml_services::IntegrationProgressObserver*
                            aIpo)
     throw (std::exception&);
   void setOverride(iface::cellml_services::VariableEvaluationType aType,
                    uint32_t variableIndex, double newValue)
     throw (std::exception&);
+  int32_t priority() throw (std::exception&);
+  void priority(int32_t aPriority) throw (std::exception&);
+  already_AddRefd<iface::cellml_services::IntegrationCheckpoint> checkpoint()
+    throw (std::exception&);
+  void resumeFrom(iface::cellml_services::IntegrationCheckpoint* aCheckpoint)
+    throw (std::exception&);
   void start() throw (std::exception&);
   void stop() throw (std::exception&);
   void pause() throw (std::exception&);
   void resume() throw (std::exception&);
 
+  // Makes start() queue the run on aScheduler, rather than starting a thread
+  // for it.
+  void scheduleOn(RunScheduler* aScheduler);
+
 protected:
+  friend class RunScheduler;
+  friend class RunWorker;
   virtual void runthread() = 0;
 
+  // The model being integrated, which runs are queued by.
+  virtual CDA_CellMLCompiledModel* compiledModel() = 0;
+
 protected:
   bool mIsStarted;
-#ifdef WIN32
-  HANDLE mThreadPipes[2];
-  HANDLE mThreadSemaphore;
-#else
-  int mThreadPipes[2];
-#endif
+  RunScheduler* mScheduler;
+  int32_t mPriority;
+
+  // The integration thread checks mCommand after every step without taking
+  // any locks. mCommandMutex is held while changing it, and mCommandCondition
+  // is only waited on while paused.
+  enum
+  {
+    COMMAND_RUN,
+    COMMAND_CANCEL,
+    COMMAND_PAUSE
+  };
+  CDA_AtomicWord mCommand;
+  CDAMutex mCommandMutex;
+  CDACondition mCommandCondition;
 
   iface::cellml_services::ODEIntegrationStepType mStepType;
+  iface::cellml_services::LinearSolverType mLinearSolver;
   double mEpsAbs, mEpsRel, mScalVar, mScalRate, mStepSizeMax;
   double mStartBvar, mStopBvar, mMaxPointDensity, mTabulationStepSize;
+  uint32_t mResultBufferSize, mResultMaxLatency, mResultMaxPoints;
+  RecordLayout mRecordLayout;
+  std::string mResultFileName;
+  uint32_t mResultFileChunkRecords;
   iface::cellml_services::IntegrationProgressObserver* mObserver;
   typedef std::list<std::pair<uint32_t,double> > OverrideList;
   OverrideList mConstantOverrides, mIVOverrides;
-  bool mCancelIntegration, mPauseIntegration;
-  bool mStrictTabulation;
+  bool mStrictTabulation, mInterpolateTabulation;
+  double mSteadyStateTolerance, mSteadyStatePeriod;
+  bool mFinalStateOnly;
+
+  virtual bool checkPauseOrCancellation();
 
-  bool checkPauseOrCancellation();
+  // Where a solver is up to, set before its first step so that a checkpoint
+  // can be taken while the run is paused. The values only change while the
+  // solver isn't waiting in checkPauseOrCancellation.
+  struct RunPosition
+  {
+    const double* voi, * states, * rates;
+    uint32_t rateSize;
+    // Set if the solver integrates a reordered copy of the states, so that
+    // orderedStates[k] is states[order[k]].
+    const double* orderedStates;
+    const uint32_t* order;
+    // Where the step size comes from: the solver memory of CVODE or IDA, or
+    // a variable for the other solvers.
+    void* cvode, * ida;
+    const double* stepSize;
+  };
+  RunPosition mPosition;
+  // True while the solver is waiting for the run to be resumed.
+  bool mIsWaiting;
+  ObjRef<CDA_IntegrationCheckpoint> mFinalCheckpoint, mResumeFrom;
+
+  // Clears mPosition, for a solver to fill in.
+  void resetPosition();
+  // Called by a solver once it has finished, to keep a checkpoint of where
+  // it stopped.
+  void finishPosition();
+  // Returns a new checkpoint of mPosition.
+  CDA_IntegrationCheckpoint* snapshot();
+
+  // Sets aOverrides up with the constant overrides of the checkpoint being
+  // resumed from, if any, followed by those set on this run.
+  void overrideConstants(struct Override& aOverrides);
+  // Sets the states (and rates) from the checkpoint being resumed from, if
+  // any, and then applies the initial value overrides set on this run.
+  void overrideStates(double* aStates, double* aRates, uint32_t aRateSize);
+  // The initial step size for the solver, or 0 to let it choose.
+  double initialStepSize();
+
+  // If a result file has been set, creates it and replaces mObserver with an
+  // observer which writes results to it. Returns false if the file can't be
+  // created.
+  bool startResultFile(iface::cellml_services::CodeInformation* aCCI,
+                       uint32_t aRateSize, uint32_t aAlgSize);
 };
 
 class CDA_ODESolverRun
@@ -206,6 +582,7 @@ public:
   CDA_IMPL_QI2(cellml_services::CellMLIntegrationRun, cellml_services::ODESolverRun);
 protected:
   ObjRef<CDA_ODESolverModel> mModel;
+  CDA_CellMLCompiledModel* compiledModel() { return mModel; }
   void SolveODEProblem(CompiledModelFunctions* f, uint32_t constSize,
                        double* constants, uint32_t rateSize, double* rates,
                        double* states, uint32_t algSize, double* algebraic);
@@ -215,7 +592,89 @@ protected:
   void SolveODEProblemCVODE(CompiledModelFunctions* f, uint32_t constSize,
                        double* constants, uint32_t rateSize, double* rates,
                        double* states, uint32_t algSize, double* algebraic);
+  void SolveODEProblemRushLarsen(CompiledModelFunctions* f, uint32_t constSize,
+                       double* constants, uint32_t rateSize, double* rates,
+                       double* states, uint32_t algSize, double* algebraic);
+  // Integrates count instances of the model in lock step. constants and
+  // states hold the values for each instance in turn, and results for each
+  // instance are sent to the corresponding observer.
+  void SolveODEProblemCVODEBatch(CompiledModelFunctions* f, uint32_t count,
+                                 iface::cellml_services::IntegrationProgressObserver** observers,
+                                 uint32_t constSize, double* constants,
+                                 uint32_t rateSize, double* states,
+                                 uint32_t algSize);
+  // Computes the constants and initial values, applying the overrides, and
+  // reports them to aObserver. buffer is laid out as a result record.
+  void SetupInitialValues(CompiledModelFunctions* f, uint32_t constSize,
+                          double* constants, uint32_t rateSize,
+                          uint32_t algSize, double* buffer,
+                          iface::cellml_services::IntegrationProgressObserver* aObserver);
+  // Sets mSensitivities and mConstantSensitivities to their initial values,
+  // once the constants have been set up.
+  void SetupSensitivities(CompiledModelFunctions* f, uint32_t constSize,
+                          const double* constants, uint32_t rateSize);
+  // Sets up and integrates the model, reporting to mObserver.
+  void integrate();
   void runthread();
+
+  // For a model compiled with sensitivities, the sensitivities of the states
+  // as laid out in result records, and the entries of d(CONSTANTS)/dp listed
+  // in its constantSensitivityPattern.
+  std::vector<double> mSensitivities, mConstantSensitivities;
+};
+
+class CDA_ODESolverEnsembleRun
+  : public CDA_ODESolverRun,
+    public iface::cellml_services::ODESolverEnsembleRun
+{
+public:
+  CDA_ODESolverEnsembleRun(CDA_ODESolverModel* m);
+  ~CDA_ODESolverEnsembleRun();
+
+  CDA_IMPL_QI3(cellml_services::CellMLIntegrationRun,
+               cellml_services::ODESolverRun,
+               cellml_services::ODESolverEnsembleRun);
+
+  void setEnsemble(uint32_t memberCount,
+                   const std::vector<uint32_t>& constantIndices,
+                   const std::vector<uint32_t>& stateIndices,
+                   const std::vector<double>& values)
+    throw (std::exception&);
+  uint32_t maxThreads() throw (std::exception&);
+  void maxThreads(uint32_t aMaxThreads) throw (std::exception&);
+  uint32_t lockStepWidth() throw (std::exception&);
+  void lockStepWidth(uint32_t aLockStepWidth) throw (std::exception&);
+  void setEnsembleObserver(iface::cellml_services::EnsembleProgressObserver*
+                           aObserver)
+    throw (std::exception&);
+  void setResultFile(const std::wstring& fileName, uint32_t chunkRecords)
+    throw (std::exception&);
+  already_AddRefd<iface::cellml_services::IntegrationCheckpoint> checkpoint()
+    throw (std::exception&);
+
+protected:
+  void runthread();
+
+private:
+  friend class CDA_EnsembleMemberRun;
+  friend class CDA_EnsembleMemberObserver;
+  friend class EnsembleWorker;
+
+  // Protects the member queue.
+  CDAMutex mEnsembleMutex;
+  // Signalled when a worker finishes.
+  CDACondition mEnsembleCondition;
+  uint32_t mMemberCount, mNextMember, mActiveWorkers, mMaxThreads,
+    mLockStepWidth;
+  // The number of members integrated together by each worker; 1 unless lock
+  // step integration can be used.
+  uint32_t mGroupWidth;
+  std::vector<uint32_t> mEnsembleConstants, mEnsembleStates;
+  std::vector<double> mEnsembleValues;
+
+  // Serialises calls to the observer.
+  CDAMutex mObserverMutex;
+  iface::cellml_services::EnsembleProgressObserver* mEnsembleObserver;
 };
 
 class CDA_DAESolverRun
@@ -227,6 +686,7 @@ public:
   CDA_IMPL_QI2(cellml_services::CellMLIntegrationRun, cellml_services::DAESolverRun);
 protected:
   ObjRef<CDA_DAESolverModel> mModel;
+  CDA_CellMLCompiledModel* compiledModel() { return mModel; }
   void runthread();
 
   void SolveDAEProblem(IDACompiledModelFunctions* f, uint32_t constSize,
@@ -243,14 +703,18 @@ class CDA_CellMLIntegrationService
 {
 public:
   CDA_CellMLIntegrationService()
+    : mCompilerBackend(iface::cellml_services::AUTOMATIC_COMPILER),
+      mOptimisationLevel(3), mScheduler(new RunScheduler())
 #ifdef ENABLE_CONTEXT
-    : mUnload(NULL)
+      , mUnload(NULL)
 #endif
   {
   }
 
   ~CDA_CellMLIntegrationService()
   {
+    // Runs which are still queued keep the scheduler alive.
+    mScheduler->release_ref();
   }
 
   CDA_IMPL_REFCOUNT;
@@ -264,9 +728,7 @@ public:
 #endif
 
   void setupCodeEnvironment(iface::cellml_services::CodeInformation* cci,
-                            std::string& dirname,
-                            std::string& sourcename,
-                            std::ofstream& ss);
+                            std::ostream& ss);
 
   already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
   compileModelODE(iface::cellml_api::Model* aModel)
@@ -277,9 +739,24 @@ public:
   already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
   compileDebugModelODE(iface::cellml_api::Model* aModel)
     throw(std::exception&);
+  already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+  compileModelODESensitivities(iface::cellml_api::Model* aModel,
+                               const std::vector<uint32_t>& parameters)
+    throw(std::exception&);
+  already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+  compileModelODELookupTables(iface::cellml_api::Model* aModel,
+                              const std::vector<uint32_t>& states,
+                              const std::vector<double>& minima,
+                              const std::vector<double>& maxima,
+                              double tolerance)
+    throw(std::exception&);
   already_AddRefd<iface::cellml_services::DAESolverCompiledModel>
   compileDebugModelDAE(iface::cellml_api::Model* aModel)
     throw(std::exception&);
+  std::vector<iface::cellml_services::ODESolverCompiledModel*>
+  compileModelsODE(const std::vector<iface::cellml_api::Model*>& aModels,
+                   uint32_t aMaxJobs)
+    throw(std::exception&);
 
   already_AddRefd<iface::cellml_services::ODESolverRun>
   createODEIntegrationRun(iface::cellml_services::ODESolverCompiledModel* aModel)
@@ -287,12 +764,68 @@ public:
   already_AddRefd<iface::cellml_services::DAESolverRun>
   createDAEIntegrationRun(iface::cellml_services::DAESolverCompiledModel* aModel)
     throw(std::exception&);
+  already_AddRefd<iface::cellml_services::ODESolverEnsembleRun>
+  createODEEnsembleRun(iface::cellml_services::ODESolverCompiledModel* aModel)
+    throw(std::exception&);
+  already_AddRefd<iface::cellml_services::ResultFile>
+  openResultFile(const std::wstring& fileName)
+    throw(std::exception&);
+  already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+  createCheckpoint(iface::cellml_services::CellMLCompiledModel* aModel,
+                   double aVOI, double aStepSize,
+                   const std::vector<double>& aStates,
+                   const std::vector<double>& aRates,
+                   const std::vector<uint32_t>& aOverrideIndices,
+                   const std::vector<double>& aOverrideValues)
+    throw(std::exception&);
 
   std::wstring lastError() throw(std::exception&)
   {
     return mLastError;
   }
 
+  iface::cellml_services::CompilerBackend compilerBackend()
+    throw(std::exception&)
+  {
+    return mCompilerBackend;
+  }
+
+  void compilerBackend(iface::cellml_services::CompilerBackend aBackend)
+    throw(std::exception&)
+  {
+    mCompilerBackend = aBackend;
+  }
+
+  uint32_t optimisationLevel() throw(std::exception&)
+  {
+    return mOptimisationLevel;
+  }
+
+  void optimisationLevel(uint32_t aLevel) throw(std::exception&)
+  {
+    mOptimisationLevel = aLevel > 3 ? 3 : aLevel;
+  }
+
+  uint32_t maxRunThreads() throw(std::exception&)
+  {
+    return mScheduler->maxThreads();
+  }
+
+  void maxRunThreads(uint32_t aMaxThreads) throw(std::exception&)
+  {
+    mScheduler->maxThreads(aMaxThreads);
+  }
+
+  uint32_t maxQueuedRuns() throw(std::exception&)
+  {
+    return mScheduler->maxQueued();
+  }
+
+  void maxQueuedRuns(uint32_t aMaxQueued) throw(std::exception&)
+  {
+    mScheduler->maxQueued(aMaxQueued);
+  }
+
 #ifdef ENABLE_CONTEXT
   iface::cellml_context::CellMLModule::ModuleTypes moduleType()
     throw(std::exception&)
@@ -333,17 +866,28 @@ public:
 #endif
 
 private:
+  friend class BackgroundCompileWorker;
+
   already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
-  compileModelODEInternal(iface::cellml_api::Model* aModel, bool aIsDebug)
+  compileModelODEInternal(iface::cellml_api::Model* aModel, bool aIsDebug,
+                          const std::vector<uint32_t>& aParameters,
+                          const LookupTableRequest& aTables)
     throw(std::exception&);
   already_AddRefd<iface::cellml_services::DAESolverCompiledModel>
   compileModelDAEInternal(iface::cellml_api::Model* aModel, bool aIsDebug)
     throw(std::exception&);
 
-  CompiledModule* CompileSource(std::string& destDir, std::string& sourceFile,
+  // Compiles aSource with the chosen backend. If it has to be written to a
+  // temporary directory, which must be deleted once the module is no longer
+  // needed, aDirname is set to its name; otherwise it is left empty.
+  CompiledModule* CompileSource(const std::string& aSource,
+                                std::string& aDirname,
                                 std::wstring& lastError);
   void SetupCodeGenStrings(iface::cellml_services::CodeGenerator* aCGS, bool aIsDebug);
   std::wstring mLastError;
+  iface::cellml_services::CompilerBackend mCompilerBackend;
+  uint32_t mOptimisationLevel;
+  RunScheduler* mScheduler;
 #ifdef ENABLE_CONTEXT
   void (*mUnload)();
 #endif
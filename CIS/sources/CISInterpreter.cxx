@@ -0,0 +1,1044 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "Utilities.hxx"
+#include "CISImplementation.hxx"
+#include "CISInterpreter.hxx"
+#include "CISModelSupport.h"
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+#include <map>
+
+// The number of registers run keeps on the stack; functions which need more
+// allocate them.
+#define INTERPRETER_STACK_REGISTERS 256
+
+enum BytecodeArea
+{
+  AREA_REGISTER,
+  AREA_NUMBER,
+  AREA_CONSTANTS,
+  AREA_RATES,
+  AREA_STATES,
+  AREA_ALGEBRAIC,
+  AREA_COUNT
+};
+
+#define LOCATION(area, index) ((static_cast<uint32_t>(area) << 28) | (index))
+#define LOCATION_AREA(location) ((location) >> 28)
+#define LOCATION_INDEX(location) ((location) & 0x0FFFFFFF)
+#define MAX_LOCATION_INDEX 0x0FFFFFFF
+
+// Register 0 holds the variable of integration.
+#define VOI_REGISTER 0
+
+enum BytecodeOp
+{
+  OP_MOVE,
+  OP_NEGATE,
+  OP_NOT,
+  OP_TO_INT,
+  OP_ADD,
+  OP_SUBTRACT,
+  OP_MULTIPLY,
+  OP_DIVIDE,
+  OP_INT_DIVIDE,
+  OP_INT_REMAINDER,
+  OP_EQUAL,
+  OP_NOT_EQUAL,
+  OP_LESS,
+  OP_LESS_EQUAL,
+  OP_GREATER,
+  OP_GREATER_EQUAL,
+  OP_AND,
+  OP_OR,
+  OP_BIT_AND,
+  OP_BIT_OR,
+  OP_BIT_XOR,
+  OP_MIN,
+  OP_MAX,
+  OP_CALL1,
+  OP_CALL2,
+  OP_JUMP,
+  OP_JUMP_IF_FALSE,
+  // Jump unless the comparison holds, in the same order as OP_EQUAL to
+  // OP_GREATER_EQUAL. These replace a comparison which only feeds a jump.
+  OP_JUMP_UNLESS_EQUAL,
+  OP_JUMP_UNLESS_NOT_EQUAL,
+  OP_JUMP_UNLESS_LESS,
+  OP_JUMP_UNLESS_LESS_EQUAL,
+  OP_JUMP_UNLESS_GREATER,
+  OP_JUMP_UNLESS_GREATER_EQUAL,
+  OP_OVERRIDE_ASSIGN,
+  // Ends every function, so that the dispatch loop needn't check for the end.
+  OP_RETURN
+};
+
+// GCC can jump straight from each instruction to the code for the next one,
+// which predicts much better than going back to a single switch.
+#ifdef __GNUC__
+#define INTERPRETER_COMPUTED_GOTO
+#endif
+
+// The C library functions are wrapped so that the overloads C++ adds don't
+// make taking their addresses ambiguous.
+#define WRAP_FUNCTION(name, call) \
+  static double Interpret_##name(double x) { return call(x); }
+WRAP_FUNCTION(fabs, fabs)
+WRAP_FUNCTION(acos, acos)
+WRAP_FUNCTION(asin, asin)
+WRAP_FUNCTION(atan, atan)
+WRAP_FUNCTION(ceil, ceil)
+WRAP_FUNCTION(cos, cos)
+WRAP_FUNCTION(cosh, cosh)
+WRAP_FUNCTION(tan, tan)
+WRAP_FUNCTION(tanh, tanh)
+WRAP_FUNCTION(sin, sin)
+WRAP_FUNCTION(sinh, sinh)
+WRAP_FUNCTION(exp, exp)
+WRAP_FUNCTION(floor, floor)
+WRAP_FUNCTION(log, log)
+WRAP_FUNCTION(sqrt, sqrt)
+#ifdef WIN32
+WRAP_FUNCTION(acosh, cdamath::acosh)
+WRAP_FUNCTION(asinh, cdamath::asinh)
+WRAP_FUNCTION(atanh, cdamath::atanh)
+#else
+WRAP_FUNCTION(acosh, ::acosh)
+WRAP_FUNCTION(asinh, ::asinh)
+WRAP_FUNCTION(atanh, ::atanh)
+#endif
+#undef WRAP_FUNCTION
+
+static double
+Interpret_pow(double x, double y)
+{
+  return pow(x, y);
+}
+
+static const struct
+{
+  const char* name;
+  double (*function)(double);
+} kUnaryFunctions[] =
+{
+  {"fabs", Interpret_fabs}, {"acos", Interpret_acos},
+  {"acosh", Interpret_acosh}, {"asin", Interpret_asin},
+  {"asinh", Interpret_asinh}, {"atan", Interpret_atan},
+  {"atanh", Interpret_atanh}, {"ceil", Interpret_ceil},
+  {"cos", Interpret_cos}, {"cosh", Interpret_cosh}, {"tan", Interpret_tan},
+  {"tanh", Interpret_tanh}, {"sin", Interpret_sin}, {"sinh", Interpret_sinh},
+  {"exp", Interpret_exp}, {"floor", Interpret_floor}, {"log", Interpret_log},
+  {"sqrt", Interpret_sqrt}, {"factorial", factorial}, {NULL, NULL}
+};
+
+static const struct
+{
+  const char* name;
+  double (*function)(double, double);
+} kBinaryFunctions[] =
+{
+  {"pow", Interpret_pow}, {"arbitrary_log", arbitrary_log},
+  // Only used to fold gcd_multi and lcm_multi.
+  {"gcd_pair", gcd_pair}, {"lcm_pair", lcm_pair}, {NULL, NULL}
+};
+
+// Thrown when code can't be interpreted.
+class CannotInterpret
+{
+};
+
+/*
+ * Translates the subset of C produced by the code generator with the CIS
+ * patterns into bytecode, in a single recursive descent pass.
+ *
+ * Values keep their C type, since integer division and remainder (which the
+ * generated code uses for quotient and rem) differ from their floating point
+ * versions. Temporaries are allocated like a stack, and are all free again at
+ * the end of each statement.
+ */
+class BytecodeCompiler
+{
+public:
+  BytecodeCompiler(BytecodeFunction* aFunction, const char* aCode)
+    : mFunction(aFunction), mPos(aCode), mFirstTemporary(VOI_REGISTER + 1),
+      mNextTemporary(VOI_REGISTER + 1)
+  {
+    mFunction->mCode.clear();
+    mFunction->mNumbers.clear();
+    mFunction->mRegisterCount = mNextTemporary;
+    next();
+  }
+
+  void compileCode()
+  {
+    compileStatements(false);
+    emit(OP_RETURN, 0);
+  }
+
+private:
+  enum TokenType
+  {
+    TOKEN_END,
+    TOKEN_NUMBER,
+    TOKEN_IDENTIFIER,
+    TOKEN_PUNCTUATION
+  };
+
+  struct Operand
+  {
+    Operand(uint32_t aLocation, bool aIsInteger, int32_t aProducer = -1)
+      : location(aLocation), isInteger(aIsInteger), producer(aProducer) {}
+
+    uint32_t location;
+    bool isInteger;
+    // The instruction which computed the value into a temporary, if it was
+    // the only one that could have, so that it can be made to store straight
+    // into a variable instead; -1 otherwise.
+    int32_t producer;
+  };
+
+  void next()
+  {
+    while (true)
+    {
+      while (isspace(*mPos))
+        mPos++;
+      if (mPos[0] != '/' || mPos[1] != '*')
+        break;
+      const char* end = strstr(mPos + 2, "*/");
+      if (end == NULL)
+        throw CannotInterpret();
+      mPos = end + 2;
+    }
+
+    const char* start = mPos;
+    if (*mPos == 0)
+      mTokenType = TOKEN_END;
+    else if (isdigit(*mPos) || (*mPos == '.' && isdigit(mPos[1])))
+    {
+      mTokenType = TOKEN_NUMBER;
+      while (isdigit(*mPos) || *mPos == '.')
+        mPos++;
+      if (*mPos == 'e' || *mPos == 'E')
+      {
+        mPos++;
+        if (*mPos == '+' || *mPos == '-')
+          mPos++;
+        while (isdigit(*mPos))
+          mPos++;
+      }
+    }
+    else if (isalpha(*mPos) || *mPos == '_')
+    {
+      mTokenType = TOKEN_IDENTIFIER;
+      while (isalnum(*mPos) || *mPos == '_')
+        mPos++;
+    }
+    else
+    {
+      mTokenType = TOKEN_PUNCTUATION;
+      static const char* kTwoCharacter[] =
+        {"==", "!=", "<=", ">=", "&&", "||", NULL};
+      mPos++;
+      for (const char** op = kTwoCharacter; *op; op++)
+        if (start[0] == (*op)[0] && start[1] == (*op)[1])
+        {
+          mPos++;
+          break;
+        }
+    }
+    mToken.assign(start, mPos - start);
+  }
+
+  bool isPunctuation(const char* aText)
+  {
+    return mTokenType == TOKEN_PUNCTUATION && mToken == aText;
+  }
+
+  bool isIdentifier(const char* aText)
+  {
+    return mTokenType == TOKEN_IDENTIFIER && mToken == aText;
+  }
+
+  void expect(const char* aText)
+  {
+    if (!isPunctuation(aText))
+      throw CannotInterpret();
+    next();
+  }
+
+  uint32_t emit(BytecodeOp aOp, uint32_t aDest, uint32_t aA = 0,
+                uint32_t aB = 0, uint16_t aFunction = 0)
+  {
+    BytecodeFunction::Instruction i;
+    i.op = aOp;
+    i.function = aFunction;
+    i.dest = aDest;
+    i.a = aA;
+    i.b = aB;
+    mFunction->mCode.push_back(i);
+    return mFunction->mCode.size() - 1;
+  }
+
+  // Emits a jump taken if aCondition is false, to be patched later.
+  uint32_t jumpIfFalse(const Operand& aCondition)
+  {
+    std::vector<BytecodeFunction::Instruction>& code = mFunction->mCode;
+    if (aCondition.producer >= 0 &&
+        static_cast<uint32_t>(aCondition.producer) + 1 == code.size() &&
+        code.back().op >= OP_EQUAL && code.back().op <= OP_GREATER_EQUAL)
+    {
+      // Nothing else reads the result of the comparison, so it can be the
+      // jump itself.
+      code.back().op += OP_JUMP_UNLESS_EQUAL - OP_EQUAL;
+      return code.size() - 1;
+    }
+    return emit(OP_JUMP_IF_FALSE, 0, aCondition.location);
+  }
+
+  // Makes a jump go to the next instruction emitted.
+  void patch(uint32_t aJump)
+  {
+    mFunction->mCode[aJump].dest = mFunction->mCode.size();
+  }
+
+  uint32_t allocateTemporary()
+  {
+    if (mNextTemporary == MAX_LOCATION_INDEX)
+      throw CannotInterpret();
+    uint32_t r = mNextTemporary++;
+    if (mNextTemporary > mFunction->mRegisterCount)
+      mFunction->mRegisterCount = mNextTemporary;
+    return LOCATION(AREA_REGISTER, r);
+  }
+
+  void store(uint32_t aDest, const Operand& aValue)
+  {
+    if (aValue.producer >= 0 &&
+        static_cast<uint32_t>(aValue.producer) + 1 == mFunction->mCode.size())
+      mFunction->mCode[aValue.producer].dest = aDest;
+    else
+      emit(OP_MOVE, aDest, aValue.location);
+  }
+
+  uint32_t number(double aValue)
+  {
+    // NaN can't be a map key, as it isn't ordered.
+    std::map<double, uint32_t>::iterator i = mNumbers.find(aValue);
+    if (aValue == aValue && i != mNumbers.end())
+      return LOCATION(AREA_NUMBER, (*i).second);
+
+    uint32_t index = mFunction->mNumbers.size();
+    if (index == MAX_LOCATION_INDEX)
+      throw CannotInterpret();
+    mFunction->mNumbers.push_back(aValue);
+    if (aValue == aValue)
+      mNumbers.insert(std::pair<double, uint32_t>(aValue, index));
+    return LOCATION(AREA_NUMBER, index);
+  }
+
+  Operand number(const std::string& aText)
+  {
+    return Operand(number(strtod(aText.c_str(), NULL)),
+                   aText.find_first_of(".eE") == std::string::npos);
+  }
+
+  /*
+   * Emits an operation into a new temporary. Operations on numbers alone are
+   * done straight away, so the result is just another number. Operations
+   * taking one value should pass it as both aA and aB.
+   */
+  Operand operation(BytecodeOp aOp, bool aIsInteger, uint32_t aA,
+                    uint32_t aB, uint16_t aFunction = 0)
+  {
+    uint32_t dest = allocateTemporary();
+    int32_t producer = emit(aOp, dest, aA, aB, aFunction);
+    if (LOCATION_AREA(aA) != AREA_NUMBER || LOCATION_AREA(aB) != AREA_NUMBER)
+      return Operand(dest, aIsInteger, producer);
+
+    // Run the operation on its own, with the result going to CONSTANTS[0].
+    BytecodeFunction constant;
+    constant.mCode.push_back(mFunction->mCode.back());
+    constant.mCode.back().dest = LOCATION(AREA_CONSTANTS, 0);
+    constant.mCode.push_back(mFunction->mCode.back());
+    constant.mCode.back().op = OP_RETURN;
+    constant.mNumbers.swap(mFunction->mNumbers);
+    double value;
+    constant.run(0.0, &value, NULL, NULL, NULL, NULL);
+    constant.mNumbers.swap(mFunction->mNumbers);
+
+    mFunction->mCode.pop_back();
+    mNextTemporary--;
+    return Operand(number(value), aIsInteger);
+  }
+
+  Operand operation(BytecodeOp aOp, bool aIsInteger, uint32_t aA)
+  {
+    return operation(aOp, aIsInteger, aA, aA);
+  }
+
+  void compileStatements(bool aInBlock)
+  {
+    while (true)
+    {
+      if (mTokenType == TOKEN_END)
+      {
+        if (aInBlock)
+          throw CannotInterpret();
+        return;
+      }
+      if (isPunctuation("}"))
+      {
+        if (!aInBlock)
+          throw CannotInterpret();
+        return;
+      }
+      mNextTemporary = mFirstTemporary;
+      compileStatement();
+    }
+  }
+
+  void compileStatement()
+  {
+    if (isIdentifier("if"))
+    {
+      compileIf();
+      return;
+    }
+    if (isPunctuation("{"))
+    {
+      next();
+      compileStatements(true);
+      expect("}");
+      return;
+    }
+    if (isPunctuation(";"))
+    {
+      next();
+      return;
+    }
+    if (isIdentifier("double"))
+    {
+      next();
+      if (mTokenType != TOKEN_IDENTIFIER ||
+          mLocals.find(mToken) != mLocals.end())
+        throw CannotInterpret();
+      // Locals keep their register for the rest of the function.
+      mLocals.insert(std::pair<std::string, uint32_t>
+                     (mToken, allocateTemporary()));
+      mFirstTemporary = mNextTemporary;
+      next();
+      expect(";");
+      return;
+    }
+    if (isIdentifier("OverrideAssign"))
+    {
+      // OverrideAssign(&(<LHS>), <RHS>, OVERRIDES);
+      next();
+      expect("(");
+      expect("&");
+      expect("(");
+      uint32_t lhs = compileLValue();
+      expect(")");
+      expect(",");
+      Operand rhs = compileExpression();
+      expect(",");
+      if (!isIdentifier("OVERRIDES"))
+        throw CannotInterpret();
+      next();
+      expect(")");
+      expect(";");
+      emit(OP_OVERRIDE_ASSIGN, lhs, rhs.location);
+      return;
+    }
+
+    uint32_t lhs = compileLValue();
+    expect("=");
+    Operand rhs = compileExpression();
+    expect(";");
+    store(lhs, rhs);
+  }
+
+  void compileIf()
+  {
+    std::vector<uint32_t> ends;
+    while (true)
+    {
+      // On an if...
+      next();
+      expect("(");
+      Operand condition = compileExpression();
+      expect(")");
+      uint32_t skip = jumpIfFalse(condition);
+      compileBranch();
+
+      if (!isIdentifier("else"))
+      {
+        patch(skip);
+        break;
+      }
+      ends.push_back(emit(OP_JUMP, 0));
+      patch(skip);
+      next();
+      if (!isIdentifier("if"))
+      {
+        compileBranch();
+        break;
+      }
+    }
+
+    for (std::vector<uint32_t>::iterator i = ends.begin(); i != ends.end(); i++)
+      patch(*i);
+  }
+
+  void compileBranch()
+  {
+    if (isPunctuation("{"))
+    {
+      next();
+      compileStatements(true);
+      expect("}");
+    }
+    else
+    {
+      mNextTemporary = mFirstTemporary;
+      compileStatement();
+    }
+  }
+
+  uint32_t compileLValue()
+  {
+    if (mTokenType != TOKEN_IDENTIFIER)
+      throw CannotInterpret();
+    std::string name = mToken;
+    next();
+    if (isPunctuation("["))
+      return compileIndex(name);
+    std::map<std::string, uint32_t>::iterator i = mLocals.find(name);
+    if (i == mLocals.end())
+      throw CannotInterpret();
+    return (*i).second;
+  }
+
+  uint32_t compileIndex(const std::string& aArray)
+  {
+    static const struct
+    {
+      const char* name;
+      BytecodeArea area;
+    } kArrays[] =
+    {
+      {"CONSTANTS", AREA_CONSTANTS},
+      {"RATES", AREA_RATES},
+      {"STATES", AREA_STATES},
+      {"ALGEBRAIC", AREA_ALGEBRAIC}
+    };
+
+    next();
+    if (mTokenType != TOKEN_NUMBER)
+      throw CannotInterpret();
+    unsigned long index = strtoul(mToken.c_str(), NULL, 10);
+    if (index > MAX_LOCATION_INDEX)
+      throw CannotInterpret();
+    next();
+    expect("]");
+
+    for (uint32_t a = 0; a < sizeof(kArrays) / sizeof(kArrays[0]); a++)
+      if (aArray == kArrays[a].name)
+        return LOCATION(kArrays[a].area, index);
+    throw CannotInterpret();
+  }
+
+  Operand compileExpression()
+  {
+    uint32_t mark = mNextTemporary;
+    Operand condition = compileBinary(1);
+    if (!isPunctuation("?"))
+      return condition;
+    next();
+
+    uint32_t skip = jumpIfFalse(condition);
+    mNextTemporary = mark;
+    uint32_t result = allocateTemporary();
+    Operand ifTrue = compileExpression();
+    store(result, ifTrue);
+    uint32_t end = emit(OP_JUMP, 0);
+    expect(":");
+    patch(skip);
+    Operand ifFalse = compileExpression();
+    store(result, ifFalse);
+    patch(end);
+
+    mNextTemporary = LOCATION_INDEX(result) + 1;
+    return Operand(result, ifTrue.isInteger && ifFalse.isInteger);
+  }
+
+  int precedence()
+  {
+    if (mTokenType != TOKEN_PUNCTUATION)
+      return 0;
+    static const struct { const char* op; int precedence; } kPrecedences[] =
+      {
+        {"||", 1}, {"&&", 2}, {"|", 3}, {"^", 4}, {"&", 5}, {"==", 6},
+        {"!=", 6}, {"<", 7}, {"<=", 7}, {">", 7}, {">=", 7}, {"+", 8},
+        {"-", 8}, {"*", 9}, {"/", 9}, {"%", 9}, {NULL, 0}
+      };
+    for (uint32_t i = 0; kPrecedences[i].op; i++)
+      if (mToken == kPrecedences[i].op)
+        return kPrecedences[i].precedence;
+    return 0;
+  }
+
+  Operand compileBinary(int aMinPrecedence)
+  {
+    uint32_t mark = mNextTemporary;
+    Operand left = compileUnary();
+    while (true)
+    {
+      int p = precedence();
+      if (p == 0 || p < aMinPrecedence)
+        return left;
+      std::string op = mToken;
+      next();
+      Operand right = compileBinary(p + 1);
+      mNextTemporary = mark;
+      left = binaryOperation(op, left, right);
+    }
+  }
+
+  Operand binaryOperation(const std::string& aOp, const Operand& aLeft,
+                          const Operand& aRight)
+  {
+    static const struct
+    {
+      const char* op;
+      BytecodeOp code;
+      BytecodeOp integerCode;
+    } kOperations[] =
+    {
+      {"+", OP_ADD, OP_ADD},
+      {"-", OP_SUBTRACT, OP_SUBTRACT},
+      {"*", OP_MULTIPLY, OP_MULTIPLY},
+      {"/", OP_DIVIDE, OP_INT_DIVIDE},
+      {"%", OP_MOVE, OP_INT_REMAINDER},
+      {"==", OP_EQUAL, OP_EQUAL},
+      {"!=", OP_NOT_EQUAL, OP_NOT_EQUAL},
+      {"<", OP_LESS, OP_LESS},
+      {"<=", OP_LESS_EQUAL, OP_LESS_EQUAL},
+      {">", OP_GREATER, OP_GREATER},
+      {">=", OP_GREATER_EQUAL, OP_GREATER_EQUAL},
+      {"&&", OP_AND, OP_AND},
+      {"||", OP_OR, OP_OR},
+      {"&", OP_MOVE, OP_BIT_AND},
+      {"|", OP_MOVE, OP_BIT_OR},
+      {"^", OP_MOVE, OP_BIT_XOR}
+    };
+
+    bool isInteger = aLeft.isInteger && aRight.isInteger;
+    for (uint32_t i = 0; i < sizeof(kOperations) / sizeof(kOperations[0]); i++)
+    {
+      if (aOp != kOperations[i].op)
+        continue;
+      BytecodeOp code = isInteger ? kOperations[i].integerCode :
+        kOperations[i].code;
+      // The bitwise operators and % aren't valid C on doubles.
+      if (code == OP_MOVE)
+        throw CannotInterpret();
+      // Comparisons and logical operators give ints.
+      if (code >= OP_EQUAL)
+        isInteger = true;
+      return operation(code, isInteger, aLeft.location, aRight.location);
+    }
+    throw CannotInterpret();
+  }
+
+  Operand compileUnary()
+  {
+    uint32_t mark = mNextTemporary;
+    if (isPunctuation("+"))
+    {
+      next();
+      return compileUnary();
+    }
+    if (isPunctuation("-") || isPunctuation("!"))
+    {
+      bool isNot = isPunctuation("!");
+      next();
+      Operand arg = compileUnary();
+      mNextTemporary = mark;
+      return operation(isNot ? OP_NOT : OP_NEGATE, isNot || arg.isInteger,
+                       arg.location);
+    }
+    if (isPunctuation("("))
+    {
+      next();
+      if (isIdentifier("double") || isIdentifier("int"))
+      {
+        bool toInt = isIdentifier("int");
+        next();
+        expect(")");
+        Operand arg = compileUnary();
+        if (!toInt)
+          return Operand(arg.location, false, arg.producer);
+        if (arg.isInteger)
+          return arg;
+        mNextTemporary = mark;
+        return operation(OP_TO_INT, true, arg.location);
+      }
+      Operand e = compileExpression();
+      expect(")");
+      return e;
+    }
+    return compilePrimary();
+  }
+
+  Operand compilePrimary()
+  {
+    if (mTokenType == TOKEN_NUMBER)
+    {
+      Operand n = number(mToken);
+      next();
+      return n;
+    }
+    if (mTokenType != TOKEN_IDENTIFIER)
+      throw CannotInterpret();
+
+    std::string name = mToken;
+    next();
+    if (isPunctuation("["))
+      return Operand(compileIndex(name), false);
+    if (isPunctuation("("))
+      return compileCall(name);
+    if (name == "VOI")
+      return Operand(LOCATION(AREA_REGISTER, VOI_REGISTER), false);
+    std::map<std::string, uint32_t>::iterator i = mLocals.find(name);
+    if (i == mLocals.end())
+      throw CannotInterpret();
+    return Operand((*i).second, false);
+  }
+
+  Operand compileCall(const std::string& aName)
+  {
+    uint32_t mark = mNextTemporary;
+    std::vector<Operand> args;
+    next();
+    if (!isPunctuation(")"))
+      while (true)
+      {
+        args.push_back(compileExpression());
+        if (isPunctuation(")"))
+          break;
+        expect(",");
+      }
+    next();
+
+    if (args.size() == 1)
+      for (uint16_t f = 0; kUnaryFunctions[f].name != NULL; f++)
+        if (aName == kUnaryFunctions[f].name)
+        {
+          mNextTemporary = mark;
+          return operation(OP_CALL1, false, args[0].location, args[0].location,
+                           f);
+        }
+    if (args.size() == 2)
+      for (uint16_t f = 0; kBinaryFunctions[f].name != NULL; f++)
+        if (aName == kBinaryFunctions[f].name)
+        {
+          mNextTemporary = mark;
+          return operation(OP_CALL2, false, args[0].location,
+                           args[1].location, f);
+        }
+
+    // The functions taking any number of values are given the count first,
+    // and are folded into pairwise operations.
+    BytecodeOp op;
+    uint16_t function = 0;
+    if (aName == "multi_min")
+      op = OP_MIN;
+    else if (aName == "multi_max")
+      op = OP_MAX;
+    else if (aName == "gcd_multi" || aName == "lcm_multi")
+    {
+      op = OP_CALL2;
+      const char* pairName = aName == "gcd_multi" ? "gcd_pair" : "lcm_pair";
+      while (strcmp(kBinaryFunctions[function].name, pairName))
+        function++;
+    }
+    else
+      throw CannotInterpret();
+
+    if (args.size() < 2 || LOCATION_AREA(args[0].location) != AREA_NUMBER ||
+        mFunction->mNumbers[LOCATION_INDEX(args[0].location)] !=
+        static_cast<double>(args.size() - 1))
+      throw CannotInterpret();
+
+    // Later values may be in the registers just above mark, so the result
+    // goes above all of them.
+    uint32_t dest = allocateTemporary();
+    if (args.size() == 2)
+      return Operand(dest, false, emit(OP_MOVE, dest, args[1].location));
+    emit(op, dest, args[1].location, args[2].location, function);
+    for (uint32_t i = 3; i < args.size(); i++)
+      emit(op, dest, dest, args[i].location, function);
+    return Operand(dest, false);
+  }
+
+  BytecodeFunction* mFunction;
+  const char* mPos;
+  TokenType mTokenType;
+  std::string mToken;
+  std::map<std::string, uint32_t> mLocals;
+  std::map<double, uint32_t> mNumbers;
+  // Registers below mFirstTemporary hold local variables.
+  uint32_t mFirstTemporary, mNextTemporary;
+};
+
+BytecodeFunction::BytecodeFunction()
+  : mRegisterCount(VOI_REGISTER + 1)
+{
+}
+
+bool
+BytecodeFunction::compile(const char* aCode)
+{
+  // Numbers in the code always use a decimal point.
+  CNumericLocale locobj;
+  try
+  {
+    BytecodeCompiler(this, aCode).compileCode();
+  }
+  catch (CannotInterpret&)
+  {
+    mCode.clear();
+    mNumbers.clear();
+    return false;
+  }
+  return true;
+}
+
+void
+BytecodeFunction::run
+(
+ double VOI, double* CONSTANTS, double* RATES, double* STATES,
+ double* ALGEBRAIC, struct Override* OVERRIDES
+) const
+{
+  if (mCode.empty())
+    return;
+
+  double stackRegisters[INTERPRETER_STACK_REGISTERS];
+  std::vector<double> heapRegisters;
+  double* registers = stackRegisters;
+  if (mRegisterCount > INTERPRETER_STACK_REGISTERS)
+  {
+    heapRegisters.resize(mRegisterCount);
+    registers = &heapRegisters[0];
+  }
+  registers[VOI_REGISTER] = VOI;
+
+  double* areas[AREA_COUNT];
+  areas[AREA_REGISTER] = registers;
+  areas[AREA_NUMBER] = mNumbers.empty() ? NULL :
+    const_cast<double*>(&mNumbers[0]);
+  areas[AREA_CONSTANTS] = CONSTANTS;
+  areas[AREA_RATES] = RATES;
+  areas[AREA_STATES] = STATES;
+  areas[AREA_ALGEBRAIC] = ALGEBRAIC;
+
+#define VALUE(location) areas[LOCATION_AREA(location)][LOCATION_INDEX(location)]
+#define INT_VALUE(location) static_cast<int>(VALUE(location))
+#ifdef INTERPRETER_COMPUTED_GOTO
+  // In the same order as BytecodeOp.
+  static const void* const kTargets[] =
+  {
+    &&TARGET_OP_MOVE, &&TARGET_OP_NEGATE, &&TARGET_OP_NOT, &&TARGET_OP_TO_INT,
+    &&TARGET_OP_ADD, &&TARGET_OP_SUBTRACT, &&TARGET_OP_MULTIPLY,
+    &&TARGET_OP_DIVIDE, &&TARGET_OP_INT_DIVIDE, &&TARGET_OP_INT_REMAINDER,
+    &&TARGET_OP_EQUAL, &&TARGET_OP_NOT_EQUAL, &&TARGET_OP_LESS,
+    &&TARGET_OP_LESS_EQUAL, &&TARGET_OP_GREATER, &&TARGET_OP_GREATER_EQUAL,
+    &&TARGET_OP_AND, &&TARGET_OP_OR, &&TARGET_OP_BIT_AND, &&TARGET_OP_BIT_OR,
+    &&TARGET_OP_BIT_XOR, &&TARGET_OP_MIN, &&TARGET_OP_MAX, &&TARGET_OP_CALL1,
+    &&TARGET_OP_CALL2, &&TARGET_OP_JUMP, &&TARGET_OP_JUMP_IF_FALSE,
+    &&TARGET_OP_JUMP_UNLESS_EQUAL, &&TARGET_OP_JUMP_UNLESS_NOT_EQUAL,
+    &&TARGET_OP_JUMP_UNLESS_LESS, &&TARGET_OP_JUMP_UNLESS_LESS_EQUAL,
+    &&TARGET_OP_JUMP_UNLESS_GREATER, &&TARGET_OP_JUMP_UNLESS_GREATER_EQUAL,
+    &&TARGET_OP_OVERRIDE_ASSIGN, &&TARGET_OP_RETURN
+  };
+#define TARGET(op) TARGET_##op: case op
+#define DISPATCH() goto *kTargets[i->op]
+#else
+#define TARGET(op) case op
+#define DISPATCH() continue
+#endif
+#define NEXT() i++; DISPATCH()
+#define JUMP_UNLESS(condition) \
+  if (condition) { NEXT(); } \
+  i = code + i->dest; \
+  DISPATCH()
+
+  const Instruction* code = &mCode[0];
+  const Instruction* i = code;
+#ifdef INTERPRETER_COMPUTED_GOTO
+  DISPATCH();
+#endif
+  while (true)
+  {
+    switch (i->op)
+    {
+    TARGET(OP_MOVE):
+      VALUE(i->dest) = VALUE(i->a);
+      NEXT();
+    TARGET(OP_NEGATE):
+      VALUE(i->dest) = -VALUE(i->a);
+      NEXT();
+    TARGET(OP_NOT):
+      VALUE(i->dest) = VALUE(i->a) == 0.0;
+      NEXT();
+    TARGET(OP_TO_INT):
+      VALUE(i->dest) = INT_VALUE(i->a);
+      NEXT();
+    TARGET(OP_ADD):
+      VALUE(i->dest) = VALUE(i->a) + VALUE(i->b);
+      NEXT();
+    TARGET(OP_SUBTRACT):
+      VALUE(i->dest) = VALUE(i->a) - VALUE(i->b);
+      NEXT();
+    TARGET(OP_MULTIPLY):
+      VALUE(i->dest) = VALUE(i->a) * VALUE(i->b);
+      NEXT();
+    TARGET(OP_DIVIDE):
+      VALUE(i->dest) = VALUE(i->a) / VALUE(i->b);
+      NEXT();
+    TARGET(OP_INT_DIVIDE):
+      // Compiled code would crash dividing by an integer zero, which the
+      // generated code never does; this just keeps the interpreter safe.
+      if (INT_VALUE(i->b) == 0)
+        VALUE(i->dest) = VALUE(i->a) / 0.0;
+      else
+        VALUE(i->dest) = INT_VALUE(i->a) / INT_VALUE(i->b);
+      NEXT();
+    TARGET(OP_INT_REMAINDER):
+      if (INT_VALUE(i->b) == 0)
+        VALUE(i->dest) = VALUE(i->a) / 0.0;
+      else
+        VALUE(i->dest) = INT_VALUE(i->a) % INT_VALUE(i->b);
+      NEXT();
+    TARGET(OP_EQUAL):
+      VALUE(i->dest) = VALUE(i->a) == VALUE(i->b);
+      NEXT();
+    TARGET(OP_NOT_EQUAL):
+      VALUE(i->dest) = VALUE(i->a) != VALUE(i->b);
+      NEXT();
+    TARGET(OP_LESS):
+      VALUE(i->dest) = VALUE(i->a) < VALUE(i->b);
+      NEXT();
+    TARGET(OP_LESS_EQUAL):
+      VALUE(i->dest) = VALUE(i->a) <= VALUE(i->b);
+      NEXT();
+    TARGET(OP_GREATER):
+      VALUE(i->dest) = VALUE(i->a) > VALUE(i->b);
+      NEXT();
+    TARGET(OP_GREATER_EQUAL):
+      VALUE(i->dest) = VALUE(i->a) >= VALUE(i->b);
+      NEXT();
+    TARGET(OP_AND):
+      // The operands have no side effects, so needn't be short circuited.
+      VALUE(i->dest) = VALUE(i->a) != 0.0 && VALUE(i->b) != 0.0;
+      NEXT();
+    TARGET(OP_OR):
+      VALUE(i->dest) = VALUE(i->a) != 0.0 || VALUE(i->b) != 0.0;
+      NEXT();
+    TARGET(OP_BIT_AND):
+      VALUE(i->dest) = INT_VALUE(i->a) & INT_VALUE(i->b);
+      NEXT();
+    TARGET(OP_BIT_OR):
+      VALUE(i->dest) = INT_VALUE(i->a) | INT_VALUE(i->b);
+      NEXT();
+    TARGET(OP_BIT_XOR):
+      VALUE(i->dest) = INT_VALUE(i->a) ^ INT_VALUE(i->b);
+      NEXT();
+    TARGET(OP_MIN):
+      // As multi_min, which keeps the first of equal (or NaN) values.
+      {
+        double a = VALUE(i->a), b = VALUE(i->b);
+        VALUE(i->dest) = b < a ? b : a;
+      }
+      NEXT();
+    TARGET(OP_MAX):
+      {
+        double a = VALUE(i->a), b = VALUE(i->b);
+        VALUE(i->dest) = b > a ? b : a;
+      }
+      NEXT();
+    TARGET(OP_CALL1):
+      VALUE(i->dest) = kUnaryFunctions[i->function].function(VALUE(i->a));
+      NEXT();
+    TARGET(OP_CALL2):
+      VALUE(i->dest) = kBinaryFunctions[i->function].function(VALUE(i->a),
+                                                              VALUE(i->b));
+      NEXT();
+    TARGET(OP_JUMP):
+      i = code + i->dest;
+      DISPATCH();
+    TARGET(OP_JUMP_IF_FALSE):
+      JUMP_UNLESS(VALUE(i->a) != 0.0);
+    TARGET(OP_JUMP_UNLESS_EQUAL):
+      JUMP_UNLESS(VALUE(i->a) == VALUE(i->b));
+    TARGET(OP_JUMP_UNLESS_NOT_EQUAL):
+      JUMP_UNLESS(VALUE(i->a) != VALUE(i->b));
+    TARGET(OP_JUMP_UNLESS_LESS):
+      JUMP_UNLESS(VALUE(i->a) < VALUE(i->b));
+    TARGET(OP_JUMP_UNLESS_LESS_EQUAL):
+      JUMP_UNLESS(VALUE(i->a) <= VALUE(i->b));
+    TARGET(OP_JUMP_UNLESS_GREATER):
+      JUMP_UNLESS(VALUE(i->a) > VALUE(i->b));
+    TARGET(OP_JUMP_UNLESS_GREATER_EQUAL):
+      JUMP_UNLESS(VALUE(i->a) >= VALUE(i->b));
+    TARGET(OP_OVERRIDE_ASSIGN):
+      // As OverrideAssign: overridden constants keep their value.
+      if (LOCATION_AREA(i->dest) != AREA_CONSTANTS ||
+          LOCATION_INDEX(i->dest) >=
+            static_cast<uint32_t>(OVERRIDES->nConstants) ||
+          !OVERRIDES->isOverriden[LOCATION_INDEX(i->dest)])
+        VALUE(i->dest) = VALUE(i->a);
+      NEXT();
+    TARGET(OP_RETURN):
+      return;
+    }
+  }
+#undef JUMP_UNLESS
+#undef NEXT
+#undef DISPATCH
+#undef TARGET
+#undef INT_VALUE
+#undef VALUE
+}
+
+bool
+InterpretedModel::compile
+(
+ const char* aInitConsts, const char* aRates, const char* aVariables,
+ uint32_t aAlgebraicCount
+)
+{
+  mAlgebraicCount = aAlgebraicCount;
+  return mSetupConstants.compile(aInitConsts) && mRates.compile(aRates) &&
+    mVariables.compile(aVariables);
+}
+
+void
+InterpretedModel::setupConstants
+(
+ double* CONSTANTS, double* RATES, double* STATES,
+ struct Override* OVERRIDES
+) const
+{
+  // As in the compiled SetupConstants, VOI is zero and the algebraic
+  // variables are only scratch space.
+  std::vector<double> algebraic(mAlgebraicCount + 1);
+  mSetupConstants.run(0.0, CONSTANTS, RATES, STATES, &algebraic[0],
+                      OVERRIDES);
+}
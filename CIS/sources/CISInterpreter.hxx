@@ -0,0 +1,93 @@
+#ifndef _CISINTERPRETER_HXX
+#define _CISINTERPRETER_HXX
+
+#include "cda_compiler_support.h"
+#include <string>
+#include <vector>
+#include <stdint.h>
+
+struct Override;
+
+/**
+ * A function of generated model code, translated into bytecode so that it
+ * can be run without a C compiler.
+ *
+ * Only code generated with the non-debug CIS patterns is understood, and only
+ * if it calls nothing but the C library and the CIS support functions which
+ * work on single values. Code that needs a numerical solve, a definite
+ * integral or sampling can't be interpreted.
+ *
+ * Instructions read up to two locations and write a third. A location is an
+ * area (one of the model arrays, the registers which hold temporaries and
+ * local variables, or the numbers in the code) and an index into it, so
+ * values in the model arrays are used where they are rather than being
+ * loaded into registers first.
+ */
+class BytecodeFunction
+{
+public:
+  BytecodeFunction();
+
+  /**
+   * Translates the body of a generated function.
+   * @return false if the code can't be interpreted.
+   */
+  bool compile(const char* aCode);
+
+  /**
+   * Runs the function. OVERRIDES may only be NULL if the code doesn't assign
+   * any constants.
+   */
+  void run(double VOI, double* CONSTANTS, double* RATES, double* STATES,
+           double* ALGEBRAIC, struct Override* OVERRIDES) const;
+
+private:
+  friend class BytecodeCompiler;
+
+  struct Instruction
+  {
+    uint16_t op, function;
+    uint32_t dest, a, b;
+  };
+
+  std::vector<Instruction> mCode;
+  std::vector<double> mNumbers;
+  uint32_t mRegisterCount;
+};
+
+/**
+ * The functions of an ODE model, run by the interpreter rather than compiled.
+ * The interpreted code never reports failures, just as the compiled non-debug
+ * code doesn't.
+ */
+class InterpretedModel
+{
+public:
+  /**
+   * Translates the code generated for a model.
+   * @return false if any of it can't be interpreted.
+   */
+  bool compile(const char* aInitConsts, const char* aRates,
+               const char* aVariables, uint32_t aAlgebraicCount);
+
+  void setupConstants(double* CONSTANTS, double* RATES, double* STATES,
+                      struct Override* OVERRIDES) const;
+
+  void computeRates(double VOI, double* CONSTANTS, double* RATES,
+                    double* STATES, double* ALGEBRAIC) const
+  {
+    mRates.run(VOI, CONSTANTS, RATES, STATES, ALGEBRAIC, NULL);
+  }
+
+  void computeVariables(double VOI, double* CONSTANTS, double* RATES,
+                        double* STATES, double* ALGEBRAIC) const
+  {
+    mVariables.run(VOI, CONSTANTS, RATES, STATES, ALGEBRAIC, NULL);
+  }
+
+private:
+  BytecodeFunction mSetupConstants, mRates, mVariables;
+  uint32_t mAlgebraicCount;
+};
+
+#endif // _CISINTERPRETER_HXX
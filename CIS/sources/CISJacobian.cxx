@@ -0,0 +1,1332 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "Utilities.hxx"
+#include "CISJacobian.hxx"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+#include <math.h>
+#include <algorithm>
+#include <deque>
+
+enum JacobianExpressionKind
+{
+  JE_NUMBER,
+  JE_VARIABLE,
+  JE_CALL,
+  JE_UNARY,
+  JE_BINARY,
+  JE_CONDITIONAL,
+  JE_CAST
+};
+
+struct JacobianExpression
+{
+  JacobianExpression(int aKind, const std::string& aText)
+    : kind(aKind), text(aText) {}
+
+  int kind;
+  // The number, variable name, function name, operator or cast type.
+  std::string text;
+  std::vector<JacobianExpression*> args;
+};
+
+// Thrown when code can't be differentiated.
+class CannotDifferentiate
+{
+};
+
+static const char* kArrayNames[] =
+{
+  "CONSTANTS", "RATES", "STATES", "ALGEBRAIC", "OLDRATES", "OLDSTATES",
+  "CONDVAR", "resid", NULL
+};
+
+static bool
+IsArrayName(const std::string& aName)
+{
+  for (const char** n = kArrayNames; *n; n++)
+    if (aName == *n)
+      return true;
+  return false;
+}
+
+static bool
+IsOne(JacobianExpression* aExpr)
+{
+  return aExpr != NULL && aExpr->kind == JE_NUMBER &&
+    strtod(aExpr->text.c_str(), NULL) == 1.0;
+}
+
+static std::string
+FormatUnsigned(uint32_t aValue)
+{
+  char buf[20];
+  sprintf(buf, "%u", aValue);
+  return buf;
+}
+
+// Formats a value so that it reads back exactly, and as a double rather than
+// an int.
+static std::string
+FormatDouble(double aValue)
+{
+  CNumericLocale locobj;
+  char buf[40];
+  sprintf(buf, "%.17g", aValue);
+  if (strpbrk(buf, ".e") == NULL)
+    strcat(buf, ".0");
+  return buf;
+}
+
+// The functions of one argument which are folded when given a number.
+static const struct
+{
+  const char* name;
+  double (*function)(double);
+} kFoldableFunctions[] =
+{
+  {"exp", exp}, {"log", log}, {"sin", sin}, {"cos", cos}, {"tan", tan},
+  {"sinh", sinh}, {"cosh", cosh}, {"tanh", tanh}, {"asin", asin},
+  {"acos", acos}, {"atan", atan}, {"fabs", fabs}, {"floor", floor},
+  {"ceil", ceil}, {NULL, NULL}
+};
+
+// Calls which are worth keeping the values of, rather than making again.
+static bool
+IsExpensiveFunction(const std::string& aName)
+{
+  static const char* kExpensiveFunctions[] =
+  {
+    "exp", "log", "pow", "sin", "cos", "tan", "sinh", "cosh", "tanh", "asin",
+    "acos", "atan", "asinh", "acosh", "atanh", "arbitrary_log", NULL
+  };
+  for (const char** f = kExpensiveFunctions; *f; f++)
+    if (aName == *f)
+      return true;
+  return false;
+}
+
+// Whether an expression is cheap enough to evaluate more than once.
+static bool
+IsCheap(JacobianExpression* aExpr)
+{
+  if (aExpr->kind == JE_CALL || aExpr->kind == JE_CONDITIONAL)
+    return false;
+  std::vector<JacobianExpression*>::iterator i;
+  for (i = aExpr->args.begin(); i != aExpr->args.end(); i++)
+    if (!IsCheap(*i))
+      return false;
+  return true;
+}
+
+/*
+ * A recursive descent parser for the subset of C produced by the code
+ * generator with the CIS patterns.
+ */
+class JacobianParser
+{
+public:
+  JacobianParser(JacobianGenerator* aGenerator, const char* aCode)
+    : mGenerator(aGenerator), mPos(aCode)
+  {
+    next();
+  }
+
+  void parseCode()
+  {
+    parseStatements(false);
+  }
+
+private:
+  enum TokenType
+  {
+    TOKEN_END,
+    TOKEN_NUMBER,
+    TOKEN_IDENTIFIER,
+    TOKEN_PUNCTUATION
+  };
+
+  void next()
+  {
+    while (true)
+    {
+      while (isspace(*mPos))
+        mPos++;
+      if (mPos[0] != '/' || mPos[1] != '*')
+        break;
+      const char* end = strstr(mPos + 2, "*/");
+      if (end == NULL)
+        throw CannotDifferentiate();
+      mPos = end + 2;
+    }
+
+    const char* start = mPos;
+    if (*mPos == 0)
+      mTokenType = TOKEN_END;
+    else if (isdigit(*mPos) || (*mPos == '.' && isdigit(mPos[1])))
+    {
+      mTokenType = TOKEN_NUMBER;
+      while (isdigit(*mPos) || *mPos == '.')
+        mPos++;
+      if (*mPos == 'e' || *mPos == 'E')
+      {
+        mPos++;
+        if (*mPos == '+' || *mPos == '-')
+          mPos++;
+        while (isdigit(*mPos))
+          mPos++;
+      }
+    }
+    else if (isalpha(*mPos) || *mPos == '_')
+    {
+      mTokenType = TOKEN_IDENTIFIER;
+      while (isalnum(*mPos) || *mPos == '_')
+        mPos++;
+    }
+    else
+    {
+      mTokenType = TOKEN_PUNCTUATION;
+      static const char* kTwoCharacter[] =
+        {"==", "!=", "<=", ">=", "&&", "||", NULL};
+      mPos++;
+      for (const char** op = kTwoCharacter; *op; op++)
+        if (start[0] == (*op)[0] && start[1] == (*op)[1])
+        {
+          mPos++;
+          break;
+        }
+    }
+    mToken.assign(start, mPos - start);
+  }
+
+  bool isPunctuation(const char* aText)
+  {
+    return mTokenType == TOKEN_PUNCTUATION && mToken == aText;
+  }
+
+  bool isIdentifier(const char* aText)
+  {
+    return mTokenType == TOKEN_IDENTIFIER && mToken == aText;
+  }
+
+  void expect(const char* aText)
+  {
+    if (!isPunctuation(aText))
+      throw CannotDifferentiate();
+    next();
+  }
+
+  void parseStatements(bool aInBlock)
+  {
+    while (true)
+    {
+      if (mTokenType == TOKEN_END)
+      {
+        if (aInBlock)
+          throw CannotDifferentiate();
+        return;
+      }
+      if (isPunctuation("}"))
+      {
+        if (!aInBlock)
+          throw CannotDifferentiate();
+        return;
+      }
+      parseStatement();
+    }
+  }
+
+  void parseStatement()
+  {
+    if (isIdentifier("if"))
+    {
+      parseIf();
+      return;
+    }
+    if (isPunctuation("{"))
+    {
+      next();
+      mGenerator->mBody += "{\r\n";
+      parseStatements(true);
+      expect("}");
+      mGenerator->mBody += "}\r\n";
+      return;
+    }
+    if (isPunctuation(";"))
+    {
+      next();
+      return;
+    }
+    if (isIdentifier("double"))
+    {
+      next();
+      if (mTokenType != TOKEN_IDENTIFIER)
+        throw CannotDifferentiate();
+      mGenerator->mBody += "double " + mToken + ";\r\n";
+      mGenerator->forget(mToken);
+      next();
+      expect(";");
+      return;
+    }
+
+    if (isIdentifier("OverrideAssign"))
+    {
+      // OverrideAssign(&(<LHS>), <RHS>, OVERRIDES);
+      next();
+      expect("(");
+      expect("&");
+      expect("(");
+      std::string lhs = parseLValue();
+      expect(")");
+      expect(",");
+      JacobianExpression* rhs = parseExpression();
+      expect(",");
+      if (!isIdentifier("OVERRIDES"))
+        throw CannotDifferentiate();
+      next();
+      expect(")");
+      expect(";");
+      mGenerator->assign(lhs, rhs, true);
+      return;
+    }
+
+    std::string lhs = parseLValue();
+    expect("=");
+    JacobianExpression* rhs = parseExpression();
+    expect(";");
+    mGenerator->assign(lhs, rhs);
+  }
+
+  void parseIf()
+  {
+    bool isElse = false;
+    while (true)
+    {
+      // On an if...
+      next();
+      expect("(");
+      // Calls in an else if condition can't be made ahead of it.
+      std::string code, cond;
+      mGenerator->print(mGenerator->share(parseExpression(), code, !isElse),
+                        cond);
+      mGenerator->mBody += code;
+      expect(")");
+      mGenerator->mBody += (isElse ? "else if (" : "if (") + cond + ")\r\n";
+      parseBranch();
+
+      if (!isIdentifier("else"))
+        return;
+      next();
+      if (!isIdentifier("if"))
+      {
+        mGenerator->mBody += "else\r\n";
+        parseBranch();
+        return;
+      }
+      isElse = true;
+    }
+  }
+
+  void parseBranch()
+  {
+    mGenerator->mBody += "{\r\n";
+    mGenerator->enterBranch();
+    if (isPunctuation("{"))
+    {
+      next();
+      parseStatements(true);
+      expect("}");
+    }
+    else
+      parseStatement();
+    mGenerator->leaveBranch();
+    mGenerator->mBody += "}\r\n";
+  }
+
+  std::string parseLValue()
+  {
+    if (mTokenType != TOKEN_IDENTIFIER)
+      throw CannotDifferentiate();
+    std::string name = mToken;
+    next();
+    if (isPunctuation("["))
+      return parseIndex(name);
+    if (IsArrayName(name))
+      throw CannotDifferentiate();
+    return name;
+  }
+
+  std::string parseIndex(const std::string& aArray)
+  {
+    next();
+    if (mTokenType != TOKEN_NUMBER)
+      throw CannotDifferentiate();
+    std::string name = aArray + "[" +
+      FormatUnsigned(strtoul(mToken.c_str(), NULL, 10)) + "]";
+    next();
+    expect("]");
+    return name;
+  }
+
+  JacobianExpression* parseExpression()
+  {
+    JacobianExpression* cond = parseBinary(1);
+    if (!isPunctuation("?"))
+      return cond;
+    next();
+    JacobianExpression* e = mGenerator->makeExpression(JE_CONDITIONAL, "?");
+    e->args.push_back(cond);
+    e->args.push_back(parseExpression());
+    expect(":");
+    e->args.push_back(parseExpression());
+    return e;
+  }
+
+  int precedence()
+  {
+    if (mTokenType != TOKEN_PUNCTUATION)
+      return 0;
+    static const struct { const char* op; int precedence; } kPrecedences[] =
+      {
+        {"||", 1}, {"&&", 2}, {"|", 3}, {"^", 4}, {"&", 5}, {"==", 6},
+        {"!=", 6}, {"<", 7}, {"<=", 7}, {">", 7}, {">=", 7}, {"+", 8},
+        {"-", 8}, {"*", 9}, {"/", 9}, {"%", 9}, {NULL, 0}
+      };
+    for (uint32_t i = 0; kPrecedences[i].op; i++)
+      if (mToken == kPrecedences[i].op)
+        return kPrecedences[i].precedence;
+    return 0;
+  }
+
+  JacobianExpression* parseBinary(int aMinPrecedence)
+  {
+    JacobianExpression* left = parseUnary();
+    while (true)
+    {
+      int p = precedence();
+      if (p == 0 || p < aMinPrecedence)
+        return left;
+      JacobianExpression* e = mGenerator->makeExpression(JE_BINARY, mToken);
+      next();
+      e->args.push_back(left);
+      e->args.push_back(parseBinary(p + 1));
+      left = e;
+    }
+  }
+
+  JacobianExpression* parseUnary()
+  {
+    if (isPunctuation("-") || isPunctuation("+") || isPunctuation("!"))
+    {
+      JacobianExpression* e = mGenerator->makeExpression(JE_UNARY, mToken);
+      next();
+      e->args.push_back(parseUnary());
+      return e;
+    }
+    if (isPunctuation("("))
+    {
+      next();
+      if (isIdentifier("double") || isIdentifier("int"))
+      {
+        JacobianExpression* e = mGenerator->makeExpression(JE_CAST, mToken);
+        next();
+        expect(")");
+        e->args.push_back(parseUnary());
+        return e;
+      }
+      JacobianExpression* e = parseExpression();
+      expect(")");
+      return e;
+    }
+    return parsePrimary();
+  }
+
+  JacobianExpression* parsePrimary()
+  {
+    if (mTokenType == TOKEN_NUMBER)
+    {
+      JacobianExpression* e = mGenerator->makeExpression(JE_NUMBER, mToken);
+      next();
+      return e;
+    }
+    if (mTokenType != TOKEN_IDENTIFIER)
+      throw CannotDifferentiate();
+
+    std::string name = mToken;
+    next();
+    if (isPunctuation("["))
+      return mGenerator->makeExpression(JE_VARIABLE, parseIndex(name));
+    if (!isPunctuation("("))
+    {
+      // Arrays are only ever passed whole to functions we can't differentiate.
+      if (IsArrayName(name))
+        throw CannotDifferentiate();
+      return mGenerator->makeExpression(JE_VARIABLE, name);
+    }
+
+    next();
+    JacobianExpression* e = mGenerator->makeExpression(JE_CALL, name);
+    if (isPunctuation(")"))
+    {
+      next();
+      return e;
+    }
+    while (true)
+    {
+      e->args.push_back(parseExpression());
+      if (isPunctuation(")"))
+        break;
+      expect(",");
+    }
+    next();
+    return e;
+  }
+
+  JacobianGenerator* mGenerator;
+  const char* mPos;
+  TokenType mTokenType;
+  std::string mToken;
+};
+
+JacobianGenerator::JacobianGenerator(uint32_t aSize, const char* aOutputArray)
+  : mRows(aSize), mColumns(aSize), mOutputArray(aOutputArray),
+    mNextPartial(0), mNextCommon(0)
+{
+}
+
+JacobianGenerator::JacobianGenerator(uint32_t aRows, uint32_t aColumns,
+                                     const char* aOutputArray)
+  : mRows(aRows), mColumns(aColumns), mOutputArray(aOutputArray),
+    mNextPartial(0), mNextCommon(0)
+{
+}
+
+JacobianGenerator::~JacobianGenerator()
+{
+  std::vector<JacobianExpression*>::iterator i;
+  for (i = mExpressions.begin(); i != mExpressions.end(); i++)
+    delete *i;
+}
+
+void
+JacobianGenerator::addSeed(const char* aArray, uint32_t aIndex,
+                           const char* aCoefficient)
+{
+  std::string name = std::string(aArray) + "[" + FormatUnsigned(aIndex) + "]";
+  mSeeds[name][aIndex] = aCoefficient;
+}
+
+void
+JacobianGenerator::addSeed(const char* aArray, uint32_t aIndex,
+                           uint32_t aColumn, const char* aCoefficient)
+{
+  std::string name = std::string(aArray) + "[" + FormatUnsigned(aIndex) + "]";
+  mSeeds[name][aColumn] = aCoefficient;
+}
+
+bool
+JacobianGenerator::differentiate(const char* aCode)
+{
+  try
+  {
+    JacobianParser parser(this, aCode);
+    parser.parseCode();
+  }
+  catch (CannotDifferentiate&)
+  {
+    return false;
+  }
+  return true;
+}
+
+void
+JacobianGenerator::writeCode(std::string& aCode, bool aDiagonalOnly)
+{
+  mNonZeros.clear();
+
+  aCode += mDeclarations;
+  aCode += mBody;
+
+  for (uint32_t i = 0; i < mRows; i++)
+  {
+    std::string name = mOutputArray + "[" + FormatUnsigned(i) + "]";
+    const DerivativeMap* dm = derivativesOf(name);
+    if (dm == NULL)
+      continue;
+    DerivativeMap::const_iterator j;
+    for (j = dm->begin(); j != dm->end(); j++)
+    {
+      if ((*j).first >= mColumns || (aDiagonalOnly && (*j).first != i))
+        continue;
+      aCode += "JACOBIAN[" + FormatUnsigned(mNonZeros.size()) + "] = " +
+        (*j).second + ";\r\n";
+      mNonZeros.push_back(std::pair<uint32_t, uint32_t>(i, (*j).first));
+    }
+  }
+}
+
+bool
+JacobianGenerator::isLinearIn(uint32_t aRow, uint32_t aColumn)
+{
+  std::string name = mOutputArray + "[" + FormatUnsigned(aRow) + "]";
+  const DerivativeMap* dm = derivativesOf(name);
+  if (dm == NULL)
+    return true;
+  DerivativeMap::const_iterator d = dm->find(aColumn);
+  if (d == dm->end())
+    return true;
+  std::map<std::string, std::set<uint32_t> >::iterator c =
+    mDerivativeColumns.find((*d).second);
+  return c == mDerivativeColumns.end() || (*c).second.count(aColumn) == 0;
+}
+
+JacobianExpression*
+JacobianGenerator::makeExpression(int aKind, const std::string& aText)
+{
+  JacobianExpression* e = new JacobianExpression(aKind, aText);
+  mExpressions.push_back(e);
+  return e;
+}
+
+JacobianExpression*
+JacobianGenerator::number(const char* aValue)
+{
+  return makeExpression(JE_NUMBER, aValue);
+}
+
+JacobianExpression*
+JacobianGenerator::unary(const char* aOp, JacobianExpression* aArg)
+{
+  JacobianExpression* e = makeExpression(JE_UNARY, aOp);
+  e->args.push_back(aArg);
+  return e;
+}
+
+JacobianExpression*
+JacobianGenerator::binary(const char* aOp, JacobianExpression* aLeft,
+                          JacobianExpression* aRight)
+{
+  JacobianExpression* e = makeExpression(JE_BINARY, aOp);
+  e->args.push_back(aLeft);
+  e->args.push_back(aRight);
+  return e;
+}
+
+JacobianExpression*
+JacobianGenerator::call(const char* aFunction, JacobianExpression* aArg1,
+                        JacobianExpression* aArg2)
+{
+  JacobianExpression* e = makeExpression(JE_CALL, aFunction);
+  e->args.push_back(aArg1);
+  if (aArg2 != NULL)
+    e->args.push_back(aArg2);
+  return e;
+}
+
+JacobianExpression*
+JacobianGenerator::add(JacobianExpression* aLeft, JacobianExpression* aRight)
+{
+  if (aLeft == NULL)
+    return aRight;
+  if (aRight == NULL)
+    return aLeft;
+  return binary("+", aLeft, aRight);
+}
+
+JacobianExpression*
+JacobianGenerator::subtract(JacobianExpression* aLeft,
+                            JacobianExpression* aRight)
+{
+  if (aRight == NULL)
+    return aLeft;
+  if (aLeft == NULL)
+    return negate(aRight);
+  return binary("-", aLeft, aRight);
+}
+
+JacobianExpression*
+JacobianGenerator::multiply(JacobianExpression* aLeft,
+                            JacobianExpression* aRight)
+{
+  if (aLeft == NULL || aRight == NULL)
+    return NULL;
+  if (IsOne(aLeft))
+    return aRight;
+  if (IsOne(aRight))
+    return aLeft;
+  return binary("*", aLeft, aRight);
+}
+
+JacobianExpression*
+JacobianGenerator::divide(JacobianExpression* aLeft,
+                          JacobianExpression* aRight)
+{
+  if (aLeft == NULL)
+    return NULL;
+  if (IsOne(aRight))
+    return aLeft;
+  return binary("/", aLeft, aRight);
+}
+
+JacobianExpression*
+JacobianGenerator::negate(JacobianExpression* aArg)
+{
+  if (aArg == NULL)
+    return NULL;
+  return unary("-", aArg);
+}
+
+JacobianExpression*
+JacobianGenerator::derivative(JacobianExpression* aExpr,
+                              const std::string& aVariable)
+{
+  switch (aExpr->kind)
+  {
+  case JE_NUMBER:
+    return NULL;
+
+  case JE_VARIABLE:
+    return (aExpr->text == aVariable) ? number("1.0") : NULL;
+
+  case JE_UNARY:
+    if (aExpr->text == "-")
+      return negate(derivative(aExpr->args[0], aVariable));
+    if (aExpr->text == "+")
+      return derivative(aExpr->args[0], aVariable);
+    // Logical not is piecewise constant.
+    return NULL;
+
+  case JE_CAST:
+    if (aExpr->text == "int")
+      return NULL;
+    return derivative(aExpr->args[0], aVariable);
+
+  case JE_CONDITIONAL:
+    {
+      JacobianExpression* da = derivative(aExpr->args[1], aVariable);
+      JacobianExpression* db = derivative(aExpr->args[2], aVariable);
+      if (da == NULL && db == NULL)
+        return NULL;
+      return conditional(aExpr->args[0], da, db);
+    }
+
+  case JE_BINARY:
+    {
+      JacobianExpression* a = aExpr->args[0], * b = aExpr->args[1];
+      if (aExpr->text == "+")
+        return add(derivative(a, aVariable), derivative(b, aVariable));
+      if (aExpr->text == "-")
+        return subtract(derivative(a, aVariable), derivative(b, aVariable));
+      if (aExpr->text == "*")
+        return add(multiply(derivative(a, aVariable), b),
+                   multiply(a, derivative(b, aVariable)));
+      if (aExpr->text == "/")
+      {
+        JacobianExpression* db = derivative(b, aVariable);
+        return subtract(divide(derivative(a, aVariable), b),
+                        divide(multiply(aExpr, db), b));
+      }
+      // Comparisons, logical operators and integer operators are all
+      // piecewise constant.
+      return NULL;
+    }
+
+  case JE_CALL:
+    break;
+  }
+
+  const std::string& f = aExpr->text;
+  if (f == "floor" || f == "ceil" || f == "factorial" || f == "gcd_multi" ||
+      f == "lcm_multi")
+    return NULL;
+
+  bool anyDerivative = false;
+  std::vector<JacobianExpression*> d;
+  std::vector<JacobianExpression*>::iterator i;
+  for (i = aExpr->args.begin(); i != aExpr->args.end(); i++)
+  {
+    d.push_back(derivative(*i, aVariable));
+    if (d.back() != NULL)
+      anyDerivative = true;
+  }
+  if (!anyDerivative)
+    return NULL;
+
+  JacobianExpression* a = aExpr->args[0], * da = d[0];
+  if (aExpr->args.size() == 1)
+  {
+    if (f == "fabs")
+      return multiply(da, conditional(binary("<", a, number("0.0")),
+                                      number("-1.0"), number("1.0")));
+    if (f == "exp")
+      return multiply(aExpr, da);
+    if (f == "log")
+      return divide(da, a);
+    if (f == "sin")
+      return multiply(call("cos", a), da);
+    if (f == "cos")
+      return negate(multiply(call("sin", a), da));
+    if (f == "tan")
+      return divide(da, binary("*", call("cos", a), call("cos", a)));
+    if (f == "sinh")
+      return multiply(call("cosh", a), da);
+    if (f == "cosh")
+      return multiply(call("sinh", a), da);
+    if (f == "tanh")
+      return multiply(subtract(number("1.0"), binary("*", aExpr, aExpr)), da);
+    if (f == "asin" || f == "acos")
+    {
+      // The generated code doesn't declare sqrt, so use pow instead.
+      JacobianExpression* e =
+        divide(da, call("pow", binary("-", number("1.0"), binary("*", a, a)),
+                        number("0.5")));
+      return (f == "asin") ? e : negate(e);
+    }
+    if (f == "atan")
+      return divide(da, binary("+", number("1.0"), binary("*", a, a)));
+    if (f == "asinh")
+      return divide(da, call("pow", binary("+", binary("*", a, a),
+                                           number("1.0")), number("0.5")));
+    if (f == "acosh")
+      return divide(da, call("pow", binary("-", binary("*", a, a),
+                                           number("1.0")), number("0.5")));
+    if (f == "atanh")
+      return divide(da, binary("-", number("1.0"), binary("*", a, a)));
+  }
+  else if (aExpr->args.size() == 2)
+  {
+    JacobianExpression* b = aExpr->args[1], * db = d[1];
+    if (f == "pow")
+    {
+      if (db == NULL)
+        return multiply(multiply(b, call("pow", a, binary("-", b,
+                                                          number("1.0")))),
+                        da);
+      return multiply(aExpr, add(multiply(db, call("log", a)),
+                                 divide(multiply(b, da), a)));
+    }
+    if (f == "arbitrary_log")
+      return derivative(binary("/", call("log", a), call("log", b)),
+                        aVariable);
+  }
+
+  // Includes multi_max, multi_min, and anything else we don't know about.
+  throw CannotDifferentiate();
+}
+
+JacobianExpression*
+JacobianGenerator::conditional(JacobianExpression* aCondition,
+                               JacobianExpression* aIfTrue,
+                               JacobianExpression* aIfFalse)
+{
+  JacobianExpression* e = makeExpression(JE_CONDITIONAL, "?");
+  e->args.push_back(aCondition);
+  e->args.push_back(aIfTrue ? aIfTrue : number("0.0"));
+  e->args.push_back(aIfFalse ? aIfFalse : number("0.0"));
+  return e;
+}
+
+void
+JacobianGenerator::collectVariables(JacobianExpression* aExpr,
+                                    std::set<std::string>& aVariables)
+{
+  if (aExpr->kind == JE_VARIABLE)
+    aVariables.insert(aExpr->text);
+  std::vector<JacobianExpression*>::iterator i;
+  for (i = aExpr->args.begin(); i != aExpr->args.end(); i++)
+    collectVariables(*i, aVariables);
+}
+
+void
+JacobianGenerator::print(JacobianExpression* aExpr, std::string& aTo)
+{
+  switch (aExpr->kind)
+  {
+  case JE_NUMBER:
+  case JE_VARIABLE:
+    aTo += aExpr->text;
+    break;
+
+  case JE_CALL:
+    {
+      aTo += aExpr->text + "(";
+      std::vector<JacobianExpression*>::iterator i;
+      for (i = aExpr->args.begin(); i != aExpr->args.end(); i++)
+      {
+        if (i != aExpr->args.begin())
+          aTo += ", ";
+        print(*i, aTo);
+      }
+      aTo += ")";
+    }
+    break;
+
+  case JE_UNARY:
+    aTo += "(" + aExpr->text;
+    print(aExpr->args[0], aTo);
+    aTo += ")";
+    break;
+
+  case JE_BINARY:
+    aTo += "(";
+    print(aExpr->args[0], aTo);
+    aTo += " " + aExpr->text + " ";
+    print(aExpr->args[1], aTo);
+    aTo += ")";
+    break;
+
+  case JE_CONDITIONAL:
+    aTo += "(";
+    print(aExpr->args[0], aTo);
+    aTo += " ? ";
+    print(aExpr->args[1], aTo);
+    aTo += " : ";
+    print(aExpr->args[2], aTo);
+    aTo += ")";
+    break;
+
+  case JE_CAST:
+    aTo += "((" + aExpr->text + ")";
+    print(aExpr->args[0], aTo);
+    aTo += ")";
+    break;
+  }
+}
+
+// Returns aExpr simplified, with the calls of expensive functions in it
+// replaced by temporaries holding their values. The assignments of any new
+// temporaries are appended to aCode, which must run just before aExpr would,
+// unless aMayHoist is false.
+JacobianExpression*
+JacobianGenerator::share(JacobianExpression* aExpr, std::string& aCode,
+                         bool aMayHoist)
+{
+  if (aExpr->kind == JE_NUMBER || aExpr->kind == JE_VARIABLE)
+    return aExpr;
+
+  JacobianExpression* e = makeExpression(aExpr->kind, aExpr->text);
+  for (uint32_t i = 0; i < aExpr->args.size(); i++)
+  {
+    // Only the parts which are always evaluated can be made ahead of time.
+    bool isAlwaysEvaluated = i == 0 ||
+      (aExpr->kind != JE_CONDITIONAL &&
+       (aExpr->kind != JE_BINARY ||
+        (aExpr->text != "&&" && aExpr->text != "||")));
+    e->args.push_back(share(aExpr->args[i], aCode,
+                            aMayHoist && isAlwaysEvaluated));
+  }
+  e = simplify(e);
+  if (e->kind != JE_CALL || !IsExpensiveFunction(e->text))
+    return e;
+
+  std::string call;
+  print(e, call);
+  std::map<std::string, std::string>::iterator c = mCommon.find(call);
+  if (c != mCommon.end())
+    return makeExpression(JE_VARIABLE, (*c).second);
+  if (!aMayHoist)
+    return e;
+
+  std::string name = "JC" + FormatUnsigned(mNextCommon++);
+  mDeclarations += "double " + name + ";\r\n";
+  aCode += name + " = " + call + ";\r\n";
+  mCommon[call] = name;
+  std::set<std::string>& reads = mCommonReads[call];
+  reads.clear();
+  collectVariables(e, reads);
+  return makeExpression(JE_VARIABLE, name);
+}
+
+// Folds operations on numbers, and turns small integer powers into
+// multiplications.
+JacobianExpression*
+JacobianGenerator::simplify(JacobianExpression* aExpr)
+{
+  std::vector<double> values;
+  std::vector<JacobianExpression*>::iterator i;
+  for (i = aExpr->args.begin(); i != aExpr->args.end(); i++)
+    if ((*i)->kind == JE_NUMBER)
+      values.push_back(strtod((*i)->text.c_str(), NULL));
+
+  const std::string& op = aExpr->text;
+  if (!values.empty() && values.size() == aExpr->args.size())
+  {
+    // Anything else is left for the compiler.
+    bool isFolded = true;
+    double value = 0.0;
+    if (aExpr->kind == JE_UNARY && op == "-")
+      value = -values[0];
+    else if (aExpr->kind == JE_UNARY && op == "+")
+      value = values[0];
+    else if (aExpr->kind == JE_BINARY && op == "+")
+      value = values[0] + values[1];
+    else if (aExpr->kind == JE_BINARY && op == "-")
+      value = values[0] - values[1];
+    else if (aExpr->kind == JE_BINARY && op == "*")
+      value = values[0] * values[1];
+    else if (aExpr->kind == JE_BINARY && op == "/")
+      value = values[0] / values[1];
+    else if (aExpr->kind == JE_CALL && op == "pow" && values.size() == 2)
+      value = pow(values[0], values[1]);
+    else
+    {
+      isFolded = false;
+      for (uint32_t f = 0; kFoldableFunctions[f].name; f++)
+        if (aExpr->kind == JE_CALL && op == kFoldableFunctions[f].name &&
+            values.size() == 1)
+        {
+          value = kFoldableFunctions[f].function(values[0]);
+          isFolded = true;
+        }
+    }
+    // Infinities and NaNs have no C literals, so are left to arise at run
+    // time.
+    if (isFolded && value - value == 0.0)
+      return number(FormatDouble(value).c_str());
+  }
+
+  if (aExpr->kind != JE_CALL || op != "pow" || aExpr->args.size() != 2 ||
+      aExpr->args[1]->kind != JE_NUMBER)
+    return aExpr;
+  JacobianExpression* a = aExpr->args[0];
+  double n = strtod(aExpr->args[1]->text.c_str(), NULL);
+  if (n == 1.0)
+    return a;
+  if (n == -1.0)
+    return binary("/", number("1.0"), a);
+  if ((n == 2.0 || n == 3.0) && IsCheap(a))
+  {
+    JacobianExpression* e = binary("*", a, a);
+    return (n == 2.0) ? e : binary("*", e, a);
+  }
+  return aExpr;
+}
+
+// Called when aVariable is assigned, after which the calls which used its old
+// value have to be made again.
+void
+JacobianGenerator::forget(const std::string& aVariable)
+{
+  std::map<std::string, std::string>::iterator c = mCommon.begin();
+  while (c != mCommon.end())
+  {
+    std::map<std::string, std::set<std::string> >::iterator r =
+      mCommonReads.find((*c).first);
+    if (r != mCommonReads.end() && (*r).second.count(aVariable))
+    {
+      mCommonReads.erase(r);
+      mCommon.erase(c++);
+    }
+    else
+      c++;
+  }
+}
+
+void
+JacobianGenerator::enterBranch()
+{
+  mBranchCommon.push_back(mCommon);
+}
+
+// After a branch, only the temporaries set before it which it left alone can
+// be relied on.
+void
+JacobianGenerator::leaveBranch()
+{
+  std::map<std::string, std::string> common;
+  std::map<std::string, std::string>::iterator c;
+  for (c = mBranchCommon.back().begin(); c != mBranchCommon.back().end(); c++)
+  {
+    std::map<std::string, std::string>::iterator now =
+      mCommon.find((*c).first);
+    if (now != mCommon.end() && (*now).second == (*c).second)
+      common.insert(*c);
+  }
+  mCommon.swap(common);
+  mBranchCommon.pop_back();
+}
+
+const JacobianGenerator::DerivativeMap*
+JacobianGenerator::derivativesOf(const std::string& aVariable)
+{
+  std::map<std::string, DerivativeMap>::iterator i =
+    mDerivatives.find(aVariable);
+  if (i != mDerivatives.end())
+    return &(*i).second;
+  i = mSeeds.find(aVariable);
+  if (i != mSeeds.end())
+    return &(*i).second;
+  return NULL;
+}
+
+void
+JacobianGenerator::assign(const std::string& aVariable,
+                          JacobianExpression* aValue, bool aIsOverridable)
+{
+  // A seeded constant is one of the variables being differentiated with
+  // respect to, whatever the model computes it from.
+  if (aIsOverridable && mSeeds.count(aVariable))
+  {
+    writeAssignment(aVariable, aValue, true);
+    return;
+  }
+
+  std::string code;
+  std::map<uint32_t, std::string> sums;
+  // The columns each sum depends on.
+  std::map<uint32_t, std::set<uint32_t> > sumColumns;
+
+  // Chain rule: dx/dj = sum over u of (df/du) * (du/dj).
+  std::set<std::string> variables;
+  collectVariables(aValue, variables);
+  std::set<std::string>::iterator i;
+  for (i = variables.begin(); i != variables.end(); i++)
+  {
+    const DerivativeMap* du = derivativesOf(*i);
+    if (du == NULL || du->empty())
+      continue;
+    JacobianExpression* partial = derivative(aValue, *i);
+    if (partial == NULL)
+      continue;
+
+    std::string name = "JP" + FormatUnsigned(mNextPartial++);
+    JacobianExpression* shared = share(partial, code, true);
+    code += "double " + name + " = ";
+    print(shared, code);
+    code += ";\r\n";
+
+    // The partial depends on whatever the variables in it depend on.
+    std::set<uint32_t> partialColumns;
+    std::set<std::string> partialVariables;
+    collectVariables(partial, partialVariables);
+    std::set<std::string>::iterator pv;
+    for (pv = partialVariables.begin(); pv != partialVariables.end(); pv++)
+    {
+      const DerivativeMap* dp = derivativesOf(*pv);
+      if (dp == NULL)
+        continue;
+      DerivativeMap::const_iterator k;
+      for (k = dp->begin(); k != dp->end(); k++)
+        partialColumns.insert((*k).first);
+    }
+
+    DerivativeMap::const_iterator j;
+    for (j = du->begin(); j != du->end(); j++)
+    {
+      std::string& sum = sums[(*j).first];
+      if (!sum.empty())
+        sum += " + ";
+      sum += name;
+      if ((*j).second != "1.0")
+        sum += " * " + (*j).second;
+
+      std::set<uint32_t>& columns = sumColumns[(*j).first];
+      columns.insert(partialColumns.begin(), partialColumns.end());
+      std::map<std::string, std::set<uint32_t> >::iterator c =
+        mDerivativeColumns.find((*j).second);
+      if (c != mDerivativeColumns.end())
+        columns.insert((*c).second.begin(), (*c).second.end());
+    }
+  }
+
+  // Once assigned, a variable only depends on the columns through the value
+  // assigned to it, even if it was seeded.
+  std::map<std::string, DerivativeMap>::iterator dit =
+    mDerivatives.find(aVariable);
+  if (dit == mDerivatives.end())
+  {
+    if (sums.empty())
+    {
+      writeAssignment(aVariable, aValue, aIsOverridable);
+      if (mSeeds.count(aVariable))
+        mDerivatives[aVariable];
+      return;
+    }
+    dit = mDerivatives.insert(std::pair<std::string, DerivativeMap>
+                              (aVariable, DerivativeMap())).first;
+  }
+  DerivativeMap& derivatives = (*dit).second;
+
+  std::map<std::string, uint32_t>::iterator idit = mVariableIds.find(aVariable);
+  uint32_t id;
+  if (idit == mVariableIds.end())
+  {
+    id = mVariableIds.size();
+    mVariableIds.insert(std::pair<std::string, uint32_t>(aVariable, id));
+  }
+  else
+    id = (*idit).second;
+
+  std::map<uint32_t, std::string>::iterator s;
+  for (s = sums.begin(); s != sums.end(); s++)
+  {
+    std::string& temp = derivatives[(*s).first];
+    if (temp.empty())
+    {
+      temp = "JD" + FormatUnsigned(id) + "_" + FormatUnsigned((*s).first);
+      mDeclarations += "double " + temp + " = 0.0;\r\n";
+    }
+    code += temp + " = " + (*s).second + ";\r\n";
+    // In other branches, the temporary may be assigned something which
+    // depends on other columns, so collect them all.
+    std::set<uint32_t>& columns = sumColumns[(*s).first];
+    mDerivativeColumns[temp].insert(columns.begin(), columns.end());
+  }
+  // Columns this variable used to depend on, but doesn't in this branch.
+  DerivativeMap::iterator d;
+  for (d = derivatives.begin(); d != derivatives.end(); d++)
+    if (sums.count((*d).first) == 0)
+      code += (*d).second + " = 0.0;\r\n";
+
+  if (!code.empty())
+    mBody += "{\r\n" + code + "}\r\n";
+  writeAssignment(aVariable, aValue, aIsOverridable);
+}
+
+void
+JacobianGenerator::writeAssignment(const std::string& aVariable,
+                                   JacobianExpression* aValue,
+                                   bool aIsOverridable)
+{
+  std::string value;
+  print(share(aValue, mBody, true), value);
+  forget(aVariable);
+  if (!aIsOverridable)
+  {
+    mBody += aVariable + " = " + value + ";\r\n";
+    return;
+  }
+
+  mBody += "OverrideAssign(&(" + aVariable + "), " + value +
+    ", OVERRIDES);\r\n";
+
+  // An overridden constant keeps the value it was given, which doesn't depend
+  // on anything. Only elements of CONSTANTS can be overridden.
+  static const std::string kConstants = "CONSTANTS[";
+  std::map<std::string, DerivativeMap>::iterator dit =
+    mDerivatives.find(aVariable);
+  if (dit == mDerivatives.end() || (*dit).second.empty() ||
+      aVariable.compare(0, kConstants.size(), kConstants) != 0)
+    return;
+  mBody += "if (OVERRIDES->isOverriden[" +
+    aVariable.substr(kConstants.size(),
+                     aVariable.size() - kConstants.size() - 1) + "])\r\n{\r\n";
+  DerivativeMap::iterator d;
+  for (d = (*dit).second.begin(); d != (*dit).second.end(); d++)
+    mBody += (*d).second + " = 0.0;\r\n";
+  mBody += "}\r\n";
+}
+
+bool
+OptimiseCode(const char* aCode, std::string& aOptimised)
+{
+  JacobianGenerator optimiser(0, "RATES");
+  if (!optimiser.differentiate(aCode))
+    return false;
+  optimiser.writeCode(aOptimised);
+  return true;
+}
+
+// Orders variables by how many others they are coupled to.
+class DegreeLess
+{
+public:
+  DegreeLess(const std::vector<std::vector<uint32_t> >& aNeighbours)
+    : mNeighbours(aNeighbours) {}
+
+  bool operator()(uint32_t a, uint32_t b) const
+  {
+    return mNeighbours[a].size() < mNeighbours[b].size();
+  }
+
+private:
+  const std::vector<std::vector<uint32_t> >& mNeighbours;
+};
+
+void
+ReduceBandwidth(uint32_t aSize, const JacobianPattern& aPattern,
+                std::vector<uint32_t>& aOrder)
+{
+  // The ordering only depends on which variables are coupled, not on the
+  // direction of the coupling.
+  std::vector<std::vector<uint32_t> > neighbours(aSize);
+  JacobianPattern::const_iterator p;
+  for (p = aPattern.begin(); p != aPattern.end(); p++)
+  {
+    if ((*p).first == (*p).second)
+      continue;
+    neighbours[(*p).first].push_back((*p).second);
+    neighbours[(*p).second].push_back((*p).first);
+  }
+  DegreeLess degreeLess(neighbours);
+  for (uint32_t i = 0; i < aSize; i++)
+  {
+    std::vector<uint32_t>& n = neighbours[i];
+    std::sort(n.begin(), n.end());
+    n.erase(std::unique(n.begin(), n.end()), n.end());
+  }
+  for (uint32_t i = 0; i < aSize; i++)
+    std::stable_sort(neighbours[i].begin(), neighbours[i].end(), degreeLess);
+
+  // Start each connected group from its least coupled variable.
+  std::vector<uint32_t> starts;
+  for (uint32_t i = 0; i < aSize; i++)
+    starts.push_back(i);
+  std::stable_sort(starts.begin(), starts.end(), degreeLess);
+
+  aOrder.clear();
+  std::vector<bool> seen(aSize, false);
+  std::vector<uint32_t>::iterator s;
+  for (s = starts.begin(); s != starts.end(); s++)
+  {
+    if (seen[*s])
+      continue;
+    std::deque<uint32_t> queue;
+    queue.push_back(*s);
+    seen[*s] = true;
+    while (!queue.empty())
+    {
+      uint32_t v = queue.front();
+      queue.pop_front();
+      aOrder.push_back(v);
+      std::vector<uint32_t>::iterator n;
+      for (n = neighbours[v].begin(); n != neighbours[v].end(); n++)
+        if (!seen[*n])
+        {
+          seen[*n] = true;
+          queue.push_back(*n);
+        }
+    }
+  }
+
+  std::reverse(aOrder.begin(), aOrder.end());
+}
+
+void
+MeasureBandwidth(const JacobianPattern& aPattern,
+                 const std::vector<uint32_t>& aOrder,
+                 uint32_t& aUpper, uint32_t& aLower)
+{
+  std::vector<uint32_t> position(aOrder.size());
+  for (uint32_t i = 0; i < aOrder.size(); i++)
+    position[aOrder[i]] = i;
+
+  aUpper = 0;
+  aLower = 0;
+  JacobianPattern::const_iterator p;
+  for (p = aPattern.begin(); p != aPattern.end(); p++)
+  {
+    uint32_t row = (*p).first, column = (*p).second;
+    if (!aOrder.empty())
+    {
+      row = position[row];
+      column = position[column];
+    }
+    if (column > row && column - row > aUpper)
+      aUpper = column - row;
+    else if (row > column && row - column > aLower)
+      aLower = row - column;
+  }
+}
@@ -0,0 +1,194 @@
+#ifndef _CISJACOBIAN_HXX
+#define _CISJACOBIAN_HXX
+
+#include "cda_compiler_support.h"
+#include <string>
+#include <vector>
+#include <map>
+#include <set>
+#include <stdint.h>
+
+struct JacobianExpression;
+class JacobianParser;
+
+// The (row, column) positions of the entries of a Jacobian.
+typedef std::vector<std::pair<uint32_t, uint32_t> > JacobianPattern;
+
+/**
+ * Generates C code for the Jacobian of generated model code, by symbolically
+ * differentiating each statement in turn and applying the chain rule through
+ * the variables it assigns.
+ *
+ * Only code generated with the non-debug patterns that CIS gives the code
+ * generator is understood: assignments, if / else if chains and the C
+ * expressions produced by the MaLaES transform. Constants assigned with
+ * OverrideAssign which have been seeded are treated as independent of the
+ * values assigned to them, and those which have been overridden as having no
+ * derivatives. Code that needs a numerical
+ * solve, a definite integral or sampling can't be differentiated this way, in
+ * which case the solver has to fall back to a difference quotient Jacobian.
+ *
+ * The code written is simplified as it goes: operations on numbers are done
+ * once here, small integer powers become multiplications, and each call of
+ * an expensive function such as exp is made once and its value kept in a
+ * temporary for as long as its arguments are unchanged, so that the
+ * derivatives and later statements can share it.
+ */
+class JacobianGenerator
+{
+public:
+  /**
+   * @param aSize The number of rows and columns in the Jacobian.
+   * @param aOutputArray The array holding the function being differentiated,
+   *                     such as RATES or resid.
+   */
+  JacobianGenerator(uint32_t aSize, const char* aOutputArray);
+
+  /**
+   * Makes a generator for a Jacobian which isn't square, such as that of the
+   * rates with respect to some of the constants.
+   */
+  JacobianGenerator(uint32_t aRows, uint32_t aColumns,
+                    const char* aOutputArray);
+  ~JacobianGenerator();
+
+  /**
+   * Makes column aIndex of the Jacobian the derivative with respect to element
+   * aIndex of aArray, scaled by aCoefficient (a C expression, such as "cj").
+   * If more than one array is seeded with the same index, the column is the
+   * sum of the scaled derivatives.
+   */
+  void addSeed(const char* aArray, uint32_t aIndex,
+               const char* aCoefficient = "1.0");
+
+  /**
+   * As above, but adds to column aColumn rather than column aIndex. Seeding
+   * the same element of an array for several columns gives directional
+   * derivatives, one for each column.
+   */
+  void addSeed(const char* aArray, uint32_t aIndex, uint32_t aColumn,
+               const char* aCoefficient);
+
+  /**
+   * Differentiates a fragment of code. Fragments must be given in the order in
+   * which they are run.
+   * @return false if the code can't be differentiated.
+   */
+  bool differentiate(const char* aCode);
+
+  /**
+   * Appends a function body which runs the code given to differentiate and
+   * stores the entries of the Jacobian which aren't always zero into
+   * JACOBIAN, in the order given by nonZeros.
+   * @param aDiagonalOnly If true, only the entries on the diagonal are
+   *                      stored.
+   */
+  void writeCode(std::string& aCode, bool aDiagonalOnly = false);
+
+  /**
+   * Whether row aRow of the function is linear in the variable of column
+   * aColumn, meaning that the entry at (aRow, aColumn) doesn't depend on that
+   * variable, other than through the conditions of if statements. Only valid
+   * after differentiate.
+   */
+  bool isLinearIn(uint32_t aRow, uint32_t aColumn);
+
+  /**
+   * The (row, column) position of each entry written by the code from
+   * writeCode; all others are always zero. Only valid after writeCode.
+   */
+  const JacobianPattern& nonZeros() const
+  {
+    return mNonZeros;
+  }
+
+private:
+  friend class JacobianParser;
+  typedef std::map<uint32_t, std::string> DerivativeMap;
+
+  JacobianExpression* makeExpression(int aKind, const std::string& aText);
+  JacobianExpression* derivative(JacobianExpression* aExpr,
+                                 const std::string& aVariable);
+  void collectVariables(JacobianExpression* aExpr,
+                        std::set<std::string>& aVariables);
+  void print(JacobianExpression* aExpr, std::string& aTo);
+  JacobianExpression* share(JacobianExpression* aExpr, std::string& aCode,
+                            bool aMayHoist);
+  JacobianExpression* simplify(JacobianExpression* aExpr);
+  void forget(const std::string& aVariable);
+  void enterBranch();
+  void leaveBranch();
+  const DerivativeMap* derivativesOf(const std::string& aVariable);
+  void assign(const std::string& aVariable, JacobianExpression* aValue,
+              bool aIsOverridable = false);
+  void writeAssignment(const std::string& aVariable,
+                       JacobianExpression* aValue, bool aIsOverridable);
+
+  // Expression builders, which treat NULL as zero and simplify as they go.
+  JacobianExpression* number(const char* aValue);
+  JacobianExpression* unary(const char* aOp, JacobianExpression* aArg);
+  JacobianExpression* binary(const char* aOp, JacobianExpression* aLeft,
+                             JacobianExpression* aRight);
+  JacobianExpression* call(const char* aFunction, JacobianExpression* aArg1,
+                           JacobianExpression* aArg2 = NULL);
+  JacobianExpression* add(JacobianExpression* aLeft,
+                          JacobianExpression* aRight);
+  JacobianExpression* subtract(JacobianExpression* aLeft,
+                               JacobianExpression* aRight);
+  JacobianExpression* multiply(JacobianExpression* aLeft,
+                               JacobianExpression* aRight);
+  JacobianExpression* divide(JacobianExpression* aLeft,
+                             JacobianExpression* aRight);
+  JacobianExpression* negate(JacobianExpression* aArg);
+  JacobianExpression* conditional(JacobianExpression* aCondition,
+                                  JacobianExpression* aIfTrue,
+                                  JacobianExpression* aIfFalse);
+
+  uint32_t mRows, mColumns;
+  std::string mOutputArray;
+  // For each seeded variable, its derivative with respect to each column.
+  std::map<std::string, DerivativeMap> mSeeds;
+  // For each assigned variable, the temporaries holding its derivatives.
+  std::map<std::string, DerivativeMap> mDerivatives;
+  // For each of those temporaries, the columns its value depends on.
+  std::map<std::string, std::set<uint32_t> > mDerivativeColumns;
+  std::map<std::string, uint32_t> mVariableIds;
+  // The temporaries holding the values of the calls made so far which are
+  // still valid, by the printed call, and the variables each call reads.
+  std::map<std::string, std::string> mCommon;
+  std::map<std::string, std::set<std::string> > mCommonReads;
+  // mCommon as it was on entering each of the branches being parsed.
+  std::vector<std::map<std::string, std::string> > mBranchCommon;
+  std::string mDeclarations, mBody;
+  uint32_t mNextPartial, mNextCommon;
+  std::vector<JacobianExpression*> mExpressions;
+  JacobianPattern mNonZeros;
+};
+
+/**
+ * Rewrites code with the same simplifications as the code JacobianGenerator
+ * writes, without computing any derivatives.
+ * @return false if the code can't be parsed, in which case it should be used
+ *         as it is.
+ */
+bool OptimiseCode(const char* aCode, std::string& aOptimised);
+
+/**
+ * Finds an order for the variables of a square Jacobian with the given
+ * sparsity pattern which keeps the non-zero entries close to the diagonal,
+ * using the reverse Cuthill-McKee algorithm.
+ * @param aOrder Set to the variables in their new order.
+ */
+void ReduceBandwidth(uint32_t aSize, const JacobianPattern& aPattern,
+                     std::vector<uint32_t>& aOrder);
+
+/**
+ * Measures the upper and lower bandwidths of a sparsity pattern once its
+ * variables have been put into the order aOrder (or their original order, if
+ * aOrder is empty).
+ */
+void MeasureBandwidth(const JacobianPattern& aPattern,
+                      const std::vector<uint32_t>& aOrder,
+                      uint32_t& aUpper, uint32_t& aLower);
+
+#endif // _CISJACOBIAN_HXX
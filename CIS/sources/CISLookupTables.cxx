@@ -0,0 +1,309 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "Utilities.hxx"
+#include "CISLookupTables.hxx"
+#include "CISCodeAnalysis.hxx"
+#include "CISInterpreter.hxx"
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <map>
+#include <set>
+
+// The number of intervals the first attempt at each table has. Tables are
+// doubled in size until they are accurate enough.
+#define LOOKUP_TABLE_MIN_INTERVALS 64
+
+// Functions which are worth replacing with a lookup.
+static const char* kExpensiveFunctions[] =
+{
+  "exp", "log", "pow", "sin", "cos", "tan", "sinh", "cosh", "tanh", "asin",
+  "acos", "atan", "asinh", "acosh", "atanh", NULL
+};
+
+// Functions a tabulated statement may call, which only depend on their
+// arguments.
+static const char* kPureFunctions[] =
+{
+  "fabs", "floor", "ceil", NULL
+};
+
+static bool
+IsIn(const char** aNames, const std::string& aName)
+{
+  for (const char** n = aNames; *n; n++)
+    if (aName == *n)
+      return true;
+  return false;
+}
+
+// Splits an array element such as STATES[3] into its array and index.
+static bool
+ParseElement(const std::string& aElement, std::string& aArray,
+             uint32_t& aIndex)
+{
+  size_t open = aElement.find('[');
+  if (open == std::string::npos)
+    return false;
+  aArray = aElement.substr(0, open);
+  aIndex = strtoul(aElement.c_str() + open + 1, NULL, 10);
+  return true;
+}
+
+static bool
+IsFinite(double aValue)
+{
+  return aValue - aValue == 0.0;
+}
+
+// Evaluates a value computed by some statements from one state, by
+// interpreting them.
+class TabulatedFunction
+{
+public:
+  TabulatedFunction(uint32_t aRateCount, uint32_t aAlgebraicCount,
+                    uint32_t aState, uint32_t aResult)
+    : mStates(aRateCount), mAlgebraic(aAlgebraicCount + 1), mUnused(1),
+      mState(aState), mResult(aResult)
+  {
+  }
+
+  bool compile(const std::string& aCode)
+  {
+    return mCode.compile(aCode.c_str());
+  }
+
+  double operator()(double aX)
+  {
+    mStates[mState] = aX;
+    mCode.run(0.0, &mUnused[0], &mUnused[0], &mStates[0], &mAlgebraic[0],
+              NULL);
+    return mAlgebraic[mResult];
+  }
+
+private:
+  BytecodeFunction mCode;
+  std::vector<double> mStates, mAlgebraic, mUnused;
+  uint32_t mState, mResult;
+};
+
+// Fills aTable with the values of aFunction over [aMinimum, aMaximum], using
+// as few intervals as meet aTolerance. Returns false if no table of
+// LOOKUP_TABLE_MAX_INTERVALS or fewer does.
+static bool
+BuildTable(TabulatedFunction& aFunction, double aMinimum, double aMaximum,
+           double aTolerance, LookupTable& aTable)
+{
+  for (uint32_t n = LOOKUP_TABLE_MIN_INTERVALS;
+       n <= LOOKUP_TABLE_MAX_INTERVALS; n *= 2)
+  {
+    double step = (aMaximum - aMinimum) / n;
+    aTable.minimum = aMinimum;
+    aTable.scale = n / (aMaximum - aMinimum);
+    aTable.values.resize(n + 1);
+
+    bool isFinite = true;
+    for (uint32_t i = 0; isFinite && i <= n; i++)
+    {
+      double x = aMinimum + i * step;
+      double v = aFunction(x);
+      // Rate expressions often have removable singularities, such as
+      // x / (exp(x) - 1) at 0, which a table can hold the limit at.
+      if (!IsFinite(v))
+        v = 0.5 * (aFunction(x - step * 1E-3) + aFunction(x + step * 1E-3));
+      isFinite = IsFinite(v);
+      aTable.values[i] = v;
+    }
+    if (!isFinite)
+      return false;
+
+    bool isAccurate = true;
+    for (uint32_t i = 0; isAccurate && i < n; i++)
+      for (int q = 1; isAccurate && q < 4; q++)
+      {
+        double v = aFunction(aMinimum + (i + q * 0.25) * step);
+        if (!IsFinite(v))
+          continue;
+        double lookup = aTable.values[i] +
+          q * 0.25 * (aTable.values[i + 1] - aTable.values[i]);
+        isAccurate = fabs(lookup - v) <= aTolerance * (1.0 + fabs(v));
+      }
+    if (isAccurate)
+      return true;
+  }
+
+  aTable.values.clear();
+  return false;
+}
+
+// How a value is computed from one of the requested states.
+struct Dependence
+{
+  // The index of the state in the request.
+  uint32_t request;
+  // Set if computing the value calls one of kExpensiveFunctions.
+  bool isExpensive;
+  // The statements which have to be run to compute the value.
+  std::set<uint32_t> statements;
+};
+
+bool
+TabulateCode(const char* aCode, uint32_t aRateCount, uint32_t aAlgebraicCount,
+             const LookupTableRequest& aRequest, std::string& aTabulated,
+             std::vector<LookupTable>& aTables)
+{
+  std::vector<CodeStatement> statements;
+  if (aRequest.empty() || !SplitStatements(aCode, statements))
+    return false;
+
+  std::map<uint32_t, uint32_t> requested;
+  for (uint32_t i = 0; i < aRequest.states.size(); i++)
+    requested[aRequest.states[i]] = i;
+
+  // The values so far which are computed from just one state.
+  std::map<std::string, Dependence> dependences;
+
+  // Numbers in the code always use a decimal point.
+  CNumericLocale locobj;
+
+  std::string tabulated;
+  bool any = false;
+  for (uint32_t s = 0; s < statements.size(); s++)
+  {
+    CodeStatement& st = statements[s];
+
+    // Work out whether this statement computes a value from one state.
+    bool isCandidate = !st.conditional && !st.opaque &&
+      st.writes.size() == 1;
+    Dependence d;
+    d.request = 0;
+    d.isExpensive = false;
+    bool haveState = false;
+    std::set<std::string>::iterator i;
+    for (i = st.names.begin(); isCandidate && i != st.names.end(); i++)
+    {
+      if (IsIn(kExpensiveFunctions, *i))
+        d.isExpensive = true;
+      else if (!IsIn(kPureFunctions, *i))
+        isCandidate = false;
+    }
+    for (i = st.reads.begin(); isCandidate && i != st.reads.end(); i++)
+    {
+      std::string array;
+      uint32_t index, request;
+      ParseElement(*i, array, index);
+      std::map<std::string, Dependence>::iterator di;
+      if (array == "STATES" && requested.count(index))
+        request = requested[index];
+      else if ((di = dependences.find(*i)) != dependences.end())
+      {
+        request = (*di).second.request;
+        d.isExpensive = d.isExpensive || (*di).second.isExpensive;
+        d.statements.insert((*di).second.statements.begin(),
+                            (*di).second.statements.end());
+      }
+      else
+      {
+        isCandidate = false;
+        break;
+      }
+      if (haveState && request != d.request)
+        isCandidate = false;
+      d.request = request;
+      haveState = true;
+    }
+
+    std::string written;
+    uint32_t result = 0;
+    if (isCandidate)
+    {
+      written = *st.writes.begin();
+      std::string array;
+      isCandidate = haveState && ParseElement(written, array, result) &&
+        array == "ALGEBRAIC" && result < aAlgebraicCount;
+    }
+
+    // Anything this statement writes is no longer what it was.
+    for (i = st.writes.begin(); i != st.writes.end(); i++)
+      dependences.erase(*i);
+    if (!isCandidate)
+    {
+      tabulated += st.code;
+      continue;
+    }
+    d.statements.insert(s);
+    dependences[written] = d;
+
+    LookupTable table;
+    bool isTabulated = false;
+    if (d.isExpensive)
+    {
+      std::string code;
+      std::set<uint32_t>::iterator j;
+      for (j = d.statements.begin(); j != d.statements.end(); j++)
+        code += statements[*j].code;
+      TabulatedFunction f(aRateCount, aAlgebraicCount,
+                          aRequest.states[d.request], result);
+      isTabulated = f.compile(code) &&
+        BuildTable(f, aRequest.minima[d.request], aRequest.maxima[d.request],
+                   aRequest.tolerance, table);
+    }
+    if (!isTabulated)
+    {
+      tabulated += st.code;
+      continue;
+    }
+
+    // Written as plain assignments and an if, so that OptimiseCode can still
+    // parse the code.
+    char lookup[300];
+    sprintf(lookup, "\r\n%s = LookupTable(LOOKUP_TABLE_%lu, %lu, "
+            "(STATES[%lu] - (%.17g)) * %.17g);\r\nif (%s != %s)\r\n{",
+            written.c_str(), static_cast<unsigned long>(aTables.size()),
+            static_cast<unsigned long>(table.values.size() - 1),
+            static_cast<unsigned long>(aRequest.states[d.request]),
+            table.minimum, table.scale, written.c_str(), written.c_str());
+    tabulated += lookup + st.code + "\r\n}";
+    aTables.push_back(table);
+    any = true;
+  }
+
+  if (!any)
+    return false;
+  aTabulated = tabulated;
+  return true;
+}
+
+void
+WriteLookupTableSupport(std::ostream& aTo,
+                        const std::vector<LookupTable>& aTables)
+{
+  CNumericLocale locobj;
+  for (uint32_t t = 0; t < aTables.size(); t++)
+  {
+    aTo << "static const double LOOKUP_TABLE_" << t << "[] =" << std::endl
+        << "{" << std::endl;
+    const std::vector<double>& values = aTables[t].values;
+    for (uint32_t i = 0; i < values.size(); i++)
+    {
+      char value[40];
+      sprintf(value, "%.17g,", values[i]);
+      aTo << value << ((i % 4 == 3) ? "\n" : " ");
+    }
+    aTo << std::endl << "};" << std::endl;
+  }
+
+  // Off the table, which includes a NaN position, the value is NaN so that
+  // the code computes it directly instead. The tables never hold NaNs.
+  aTo << "static double LookupTable(const double* TABLE, int INTERVALS, "
+      << "double POSITION)" << std::endl
+      << "{" << std::endl
+      << "  int i;" << std::endl
+      << "  double zero = 0.0;" << std::endl
+      << "  if (!(POSITION >= 0.0 && POSITION < INTERVALS))" << std::endl
+      << "    return zero / zero;" << std::endl
+      << "  i = (int)POSITION;" << std::endl
+      << "  return TABLE[i] + (POSITION - i) * (TABLE[i + 1] - TABLE[i]);"
+      << std::endl
+      << "}" << std::endl;
+}
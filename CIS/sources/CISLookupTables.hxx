@@ -0,0 +1,74 @@
+#ifndef _CISLOOKUPTABLES_HXX
+#define _CISLOOKUPTABLES_HXX
+
+#include "cda_compiler_support.h"
+#include <string>
+#include <vector>
+#include <ostream>
+#include <stdint.h>
+
+/**
+ * The states to tabulate functions of, each over the range of values it is
+ * declared to stay within, and how accurate the tables must be.
+ */
+struct LookupTableRequest
+{
+  LookupTableRequest() : tolerance(0.0) {}
+
+  bool empty() const
+  {
+    return states.empty();
+  }
+
+  std::vector<uint32_t> states;
+  std::vector<double> minima, maxima;
+  // The largest error allowed in a value looked up, relative to one plus
+  // the magnitude of the value.
+  double tolerance;
+};
+
+/**
+ * The values of a function of one state at evenly spaced points, between
+ * which the generated code interpolates linearly. The value at x is found
+ * at position (x - minimum) * scale in values.
+ */
+struct LookupTable
+{
+  double minimum, scale;
+  std::vector<double> values;
+};
+
+/**
+ * Replaces the statements of code generated with the non-debug CIS patterns
+ * which compute an ALGEBRAIC value from just one of the requested states,
+ * using the C library's transcendental functions, with lookups in tables of
+ * that value. Such statements may use numbers and other values computed this
+ * way from the same state, but not constants, which runs may override.
+ *
+ * Each table is made just fine enough to meet the requested tolerance at the
+ * points checked between its entries; statements that would need a table
+ * larger than LOOKUP_TABLE_MAX_INTERVALS are left alone. Outside the declared
+ * range, the original code is run instead.
+ *
+ * @param aTabulated Set to the code with the lookups, which must follow the
+ *                   code WriteLookupTableSupport writes for aTables.
+ * @param aTables Set to the tables, in the order the code uses them.
+ * @return false if nothing was tabulated, in which case the original code
+ *         should be used.
+ */
+bool TabulateCode(const char* aCode, uint32_t aRateCount,
+                  uint32_t aAlgebraicCount, const LookupTableRequest& aRequest,
+                  std::string& aTabulated, std::vector<LookupTable>& aTables);
+
+/**
+ * Writes the tables, and the other declarations the code from TabulateCode
+ * needs.
+ */
+void WriteLookupTableSupport(std::ostream& aTo,
+                             const std::vector<LookupTable>& aTables);
+
+// The values are written into the generated code, so this also bounds how
+// much bigger the code can get.
+#define LOOKUP_TABLE_MAX_INTERVALS 16384
+
+#endif // _CISLOOKUPTABLES_HXX
@@ -0,0 +1,597 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "CISResultFile.hxx"
+#include <string.h>
+#include <stdlib.h>
+#include <algorithm>
+
+static const char kFileMagic[] = "CISRSLT1";
+static const char kTrailerMagic[] = "CISREND1";
+
+// The size of the trailer at the end of a finished file.
+#define RESULT_FILE_TRAILER_SIZE 16
+
+static void
+PutUint32(std::string& aOut, uint32_t aValue)
+{
+  for (int i = 0; i < 4; i++)
+    aOut += static_cast<char>((aValue >> (i * 8)) & 0xFF);
+}
+
+static void
+PutUint64(std::string& aOut, uint64_t aValue)
+{
+  for (int i = 0; i < 8; i++)
+    aOut += static_cast<char>((aValue >> (i * 8)) & 0xFF);
+}
+
+static void
+PutDouble(std::string& aOut, double aValue)
+{
+  uint64_t bits;
+  memcpy(&bits, &aValue, sizeof(bits));
+  PutUint64(aOut, bits);
+}
+
+static void
+PutString(std::string& aOut, const std::string& aValue)
+{
+  PutUint32(aOut, aValue.size());
+  aOut += aValue;
+}
+
+// Reads values written with the Put functions, failing (rather than running
+// off the end) if there aren't enough bytes left.
+class ByteReader
+{
+public:
+  ByteReader(const unsigned char* aData, size_t aLength)
+    : mData(aData), mLength(aLength), mPos(0), mFailed(false)
+  {
+  }
+
+  bool failed()
+  {
+    return mFailed;
+  }
+
+  uint64_t getBytes(int aCount)
+  {
+    if (mFailed || mLength - mPos < static_cast<size_t>(aCount))
+    {
+      mFailed = true;
+      return 0;
+    }
+    uint64_t value = 0;
+    for (int i = 0; i < aCount; i++)
+      value |= static_cast<uint64_t>(mData[mPos++]) << (i * 8);
+    return value;
+  }
+
+  uint32_t getUint32()
+  {
+    return static_cast<uint32_t>(getBytes(4));
+  }
+
+  double getDouble()
+  {
+    uint64_t bits = getBytes(8);
+    double value;
+    memcpy(&value, &bits, sizeof(value));
+    return value;
+  }
+
+private:
+  const unsigned char* mData;
+  size_t mLength, mPos;
+  bool mFailed;
+};
+
+static bool
+SeekTo(FILE* aFile, uint64_t aOffset)
+{
+#ifdef WIN32
+  return _fseeki64(aFile, static_cast<__int64>(aOffset), SEEK_SET) == 0;
+#else
+  return fseeko(aFile, static_cast<off_t>(aOffset), SEEK_SET) == 0;
+#endif
+}
+
+static bool
+ReadAt(FILE* aFile, uint64_t aOffset, size_t aLength,
+       std::vector<unsigned char>& aData)
+{
+  aData.resize(aLength);
+  if (aLength == 0)
+    return true;
+  return SeekTo(aFile, aOffset) &&
+    fread(&aData[0], 1, aLength, aFile) == aLength;
+}
+
+static void
+EncodeColumn(const double* aValues, uint32_t aCount, std::string& aOut)
+{
+  uint64_t last = 0;
+  for (uint32_t i = 0; i < aCount; i++)
+  {
+    uint64_t bits;
+    memcpy(&bits, aValues + i, sizeof(bits));
+    uint64_t change = bits ^ last;
+    last = bits;
+
+    int lead = 0, trail = 0;
+    if (change == 0)
+      lead = 8;
+    else
+    {
+      while (((change >> (56 - lead * 8)) & 0xFF) == 0)
+        lead++;
+      while (((change >> (trail * 8)) & 0xFF) == 0)
+        trail++;
+    }
+    aOut += static_cast<char>(lead | (trail << 4));
+    for (int b = trail; b < 8 - lead; b++)
+      aOut += static_cast<char>((change >> (b * 8)) & 0xFF);
+  }
+}
+
+static bool
+DecodeColumn(const unsigned char* aData, size_t aLength, uint32_t aCount,
+             double* aValues)
+{
+  const unsigned char* end = aData + aLength;
+  uint64_t last = 0;
+  for (uint32_t i = 0; i < aCount; i++)
+  {
+    if (aData == end)
+      return false;
+    int lead = *aData & 0xF, trail = *aData >> 4;
+    aData++;
+    if (lead + trail > 8 || end - aData < 8 - lead - trail)
+      return false;
+
+    uint64_t change = 0;
+    for (int b = trail; b < 8 - lead; b++)
+      change |= static_cast<uint64_t>(*aData++) << (b * 8);
+    last ^= change;
+    memcpy(aValues + i, &last, sizeof(last));
+  }
+  return aData == end;
+}
+
+ResultFileWriter::ResultFileWriter()
+  : mFile(NULL), mFailed(false), mOffset(0), mColumnCount(0),
+    mChunkRecords(0), mRecords(0)
+{
+}
+
+ResultFileWriter::~ResultFileWriter()
+{
+  if (mFile != NULL)
+    fclose(mFile);
+}
+
+bool
+ResultFileWriter::open(const std::string& aFileName,
+                       const std::vector<ResultColumn>& aColumns,
+                       uint32_t aChunkRecords)
+{
+  mFile = fopen(aFileName.c_str(), "wb");
+  if (mFile == NULL)
+    return false;
+
+  mColumnCount = aColumns.size();
+  mChunkRecords = aChunkRecords;
+  if (mChunkRecords == 0)
+    mChunkRecords = RESULT_FILE_DEFAULT_CHUNK_RECORDS;
+  mChunk.resize(mColumnCount * mChunkRecords);
+
+  std::string header(kFileMagic, 8);
+  PutUint32(header, mColumnCount);
+  PutUint32(header, mChunkRecords);
+  for (std::vector<ResultColumn>::const_iterator i = aColumns.begin();
+       i != aColumns.end(); i++)
+  {
+    PutString(header, (*i).name);
+    PutString(header, (*i).variable);
+    PutUint32(header, (*i).degree);
+  }
+  write(header);
+  return !mFailed;
+}
+
+void
+ResultFileWriter::addRecords(const double* aValues, uint32_t aCount)
+{
+  for (uint32_t i = 0; i + mColumnCount <= aCount; i += mColumnCount)
+  {
+    for (uint32_t c = 0; c < mColumnCount; c++)
+      mChunk[c * mChunkRecords + mRecords] = aValues[i + c];
+    if (++mRecords == mChunkRecords)
+      writeChunk();
+  }
+}
+
+bool
+ResultFileWriter::close()
+{
+  if (mFile == NULL)
+    return false;
+
+  writeChunk();
+
+  uint64_t indexOffset = mOffset;
+  std::string index("INDX");
+  PutUint32(index, mChunks.size());
+  for (std::vector<ChunkInfo>::iterator i = mChunks.begin();
+       i != mChunks.end(); i++)
+  {
+    PutUint64(index, (*i).offset);
+    PutUint32(index, (*i).records);
+    PutDouble(index, (*i).firstVOI);
+    PutDouble(index, (*i).lastVOI);
+  }
+  PutUint64(index, indexOffset);
+  index.append(kTrailerMagic, 8);
+  write(index);
+
+  if (fclose(mFile) != 0)
+    mFailed = true;
+  mFile = NULL;
+  return !mFailed;
+}
+
+void
+ResultFileWriter::writeChunk()
+{
+  if (mRecords == 0)
+    return;
+
+  // The byte counts go before the data, so the columns are compressed
+  // first.
+  std::vector<std::string> columns(mColumnCount);
+  std::string chunk("CHNK");
+  PutUint32(chunk, mRecords);
+  for (uint32_t c = 0; c < mColumnCount; c++)
+  {
+    EncodeColumn(&mChunk[c * mChunkRecords], mRecords, columns[c]);
+    PutUint32(chunk, columns[c].size());
+  }
+  for (uint32_t c = 0; c < mColumnCount; c++)
+    chunk += columns[c];
+
+  ChunkInfo info;
+  info.offset = mOffset;
+  info.records = mRecords;
+  // The first column is always the variable of integration.
+  info.firstVOI = mChunk[0];
+  info.lastVOI = mChunk[mRecords - 1];
+  mChunks.push_back(info);
+
+  write(chunk);
+  mRecords = 0;
+}
+
+void
+ResultFileWriter::write(const std::string& aData)
+{
+  if (mFailed)
+    return;
+  if (fwrite(aData.data(), 1, aData.size(), mFile) != aData.size())
+    mFailed = true;
+  mOffset += aData.size();
+}
+
+CDA_ResultFileObserver::CDA_ResultFileObserver
+(
+ ResultFileWriter* aWriter,
+ iface::cellml_services::IntegrationProgressObserver* aObserver
+)
+  : mWriter(aWriter), mObserver(aObserver)
+{
+}
+
+CDA_ResultFileObserver::~CDA_ResultFileObserver()
+{
+  delete mWriter;
+}
+
+void
+CDA_ResultFileObserver::computedConstants(const std::vector<double>& values)
+  throw(std::exception&)
+{
+  if (mObserver != NULL)
+    mObserver->computedConstants(values);
+}
+
+void
+CDA_ResultFileObserver::results(const std::vector<double>& state)
+  throw(std::exception&)
+{
+  if (!state.empty())
+    mWriter->addRecords(&state[0], state.size());
+}
+
+void
+CDA_ResultFileObserver::resultBlock(iface::cellml_services::ResultBlock* block)
+  throw(std::exception&)
+{
+  mWriter->addRecords(reinterpret_cast<const double*>(block->address()),
+                      block->length());
+}
+
+void
+CDA_ResultFileObserver::done()
+  throw(std::exception&)
+{
+  bool written = mWriter->close();
+  if (mObserver == NULL)
+    return;
+  if (written)
+    mObserver->done();
+  else
+    mObserver->failed("Couldn't write the result file");
+}
+
+void
+CDA_ResultFileObserver::failed(const std::string& errorMessage)
+  throw(std::exception&)
+{
+  // Keep what was computed before the failure.
+  mWriter->close();
+  if (mObserver != NULL)
+    mObserver->failed(errorMessage);
+}
+
+CDA_ResultFile::CDA_ResultFile()
+  : mFile(NULL), mRecordCount(0)
+{
+}
+
+CDA_ResultFile::~CDA_ResultFile()
+{
+  if (mFile != NULL)
+    fclose(mFile);
+}
+
+bool
+CDA_ResultFile::open(const std::string& aFileName)
+{
+  mFile = fopen(aFileName.c_str(), "rb");
+  if (mFile == NULL)
+    return false;
+
+  std::vector<unsigned char> data;
+  if (!ReadAt(mFile, 0, 16, data) || memcmp(&data[0], kFileMagic, 8))
+    return false;
+  ByteReader counts(&data[0], data.size());
+  counts.getBytes(8);
+  uint32_t columnCount = counts.getUint32();
+
+  // The column descriptions are of unknown length, so read them a piece at a
+  // time.
+  uint64_t offset = 16;
+  for (uint32_t c = 0; c < columnCount; c++)
+  {
+    ResultColumn column;
+    std::string* strings[] = {&column.name, &column.variable};
+    for (int s = 0; s < 2; s++)
+    {
+      if (!ReadAt(mFile, offset, 4, data))
+        return false;
+      uint32_t length = ByteReader(&data[0], 4).getUint32();
+      if (!ReadAt(mFile, offset + 4, length, data))
+        return false;
+      strings[s]->assign(data.begin(), data.end());
+      offset += 4 + length;
+    }
+    if (!ReadAt(mFile, offset, 4, data))
+      return false;
+    column.degree = ByteReader(&data[0], 4).getUint32();
+    offset += 4;
+    mColumns.push_back(column);
+  }
+  if (mColumns.empty())
+    return false;
+
+  // Use the index if the file was finished, and otherwise find the chunks
+  // which were written.
+  if (fseek(mFile, -RESULT_FILE_TRAILER_SIZE, SEEK_END) == 0)
+  {
+    unsigned char trailer[RESULT_FILE_TRAILER_SIZE];
+    if (fread(trailer, 1, RESULT_FILE_TRAILER_SIZE, mFile) ==
+          RESULT_FILE_TRAILER_SIZE &&
+        !memcmp(trailer + 8, kTrailerMagic, 8) &&
+        readIndex(ByteReader(trailer, 8).getBytes(8)))
+      return true;
+  }
+  mChunks.clear();
+  mRecordCount = 0;
+  return scanChunks(offset);
+}
+
+bool
+CDA_ResultFile::readIndex(uint64_t aIndexOffset)
+{
+  std::vector<unsigned char> data;
+  if (!ReadAt(mFile, aIndexOffset, 8, data) || memcmp(&data[0], "INDX", 4))
+    return false;
+  uint32_t chunkCount = ByteReader(&data[4], 4).getUint32();
+
+  // Each entry is a uint64, a uint32 and two doubles.
+  if (!ReadAt(mFile, aIndexOffset + 8, chunkCount * 28, data))
+    return false;
+  ByteReader index(data.empty() ? NULL : &data[0], data.size());
+  for (uint32_t i = 0; i < chunkCount; i++)
+  {
+    ChunkInfo info;
+    info.offset = index.getBytes(8);
+    info.records = index.getUint32();
+    info.firstVOI = index.getDouble();
+    info.lastVOI = index.getDouble();
+    // The writer never indexes an empty chunk, so the index is damaged.
+    if (info.records == 0)
+      return false;
+    info.firstRecord = mRecordCount;
+    mRecordCount += info.records;
+    mChunks.push_back(info);
+  }
+  return !index.failed();
+}
+
+bool
+CDA_ResultFile::scanChunks(uint64_t aOffset)
+{
+  uint32_t columnCount = mColumns.size();
+  std::vector<unsigned char> data;
+  std::vector<double> voi;
+  while (ReadAt(mFile, aOffset, 8 + 4 * columnCount, data) &&
+         !memcmp(&data[0], "CHNK", 4))
+  {
+    ByteReader header(&data[4], data.size() - 4);
+    ChunkInfo info;
+    info.offset = aOffset;
+    info.records = header.getUint32();
+    info.firstRecord = mRecordCount;
+    uint64_t length = 8 + 4 * columnCount;
+    for (uint32_t c = 0; c < columnCount; c++)
+      length += header.getUint32();
+
+    // A chunk which is still being written (or was cut short) ends the
+    // results.
+    if (info.records == 0 || !readChunkColumn(info, 0, voi))
+      break;
+    info.firstVOI = voi.front();
+    info.lastVOI = voi.back();
+    mChunks.push_back(info);
+    mRecordCount += info.records;
+    aOffset += length;
+  }
+  return true;
+}
+
+bool
+CDA_ResultFile::readChunkColumn(const ChunkInfo& aChunk, uint32_t aColumn,
+                                std::vector<double>& aValues)
+{
+  uint32_t columnCount = mColumns.size();
+  std::vector<unsigned char> data;
+  if (!ReadAt(mFile, aChunk.offset + 8, 4 * columnCount, data))
+    return false;
+  ByteReader lengths(&data[0], data.size());
+  uint64_t offset = aChunk.offset + 8 + 4 * columnCount;
+  for (uint32_t c = 0; c < aColumn; c++)
+    offset += lengths.getUint32();
+  uint32_t length = lengths.getUint32();
+
+  if (!ReadAt(mFile, offset, length, data))
+    return false;
+  aValues.resize(aChunk.records);
+  return DecodeColumn(data.empty() ? NULL : &data[0], length, aChunk.records,
+                      &aValues[0]);
+}
+
+const ResultColumn&
+CDA_ResultFile::checkColumn(uint32_t aColumn)
+{
+  if (aColumn >= mColumns.size())
+    throw iface::cellml_api::CellMLException(L"Result file column out of range.");
+  return mColumns[aColumn];
+}
+
+uint32_t
+CDA_ResultFile::columnCount()
+  throw(std::exception&)
+{
+  return mColumns.size();
+}
+
+uint32_t
+CDA_ResultFile::recordCount()
+  throw(std::exception&)
+{
+  return mRecordCount;
+}
+
+static std::wstring
+WidenUTF8(const std::string& aValue)
+{
+  size_t n = mbstowcs(NULL, aValue.c_str(), 0);
+  if (n == static_cast<size_t>(-1))
+    return std::wstring(aValue.begin(), aValue.end());
+  std::vector<wchar_t> buf(n + 1);
+  mbstowcs(&buf[0], aValue.c_str(), n + 1);
+  return &buf[0];
+}
+
+std::wstring
+CDA_ResultFile::columnName(uint32_t column)
+  throw(std::exception&)
+{
+  return WidenUTF8(checkColumn(column).name);
+}
+
+std::wstring
+CDA_ResultFile::columnVariable(uint32_t column)
+  throw(std::exception&)
+{
+  return WidenUTF8(checkColumn(column).variable);
+}
+
+uint32_t
+CDA_ResultFile::columnDegree(uint32_t column)
+  throw(std::exception&)
+{
+  return checkColumn(column).degree;
+}
+
+uint32_t
+CDA_ResultFile::findRecord(double voi)
+  throw(std::exception&)
+{
+  CDALock l(mMutex);
+
+  // Only the chunk which could hold the record is read.
+  std::vector<ChunkInfo>::iterator i;
+  for (i = mChunks.begin(); i != mChunks.end(); i++)
+    if ((*i).lastVOI >= voi)
+      break;
+  if (i == mChunks.end())
+    return mRecordCount;
+
+  std::vector<double> values;
+  if (!readChunkColumn(*i, 0, values))
+    throw iface::cellml_api::CellMLException(L"Couldn't read result file.");
+  return (*i).firstRecord +
+    (std::lower_bound(values.begin(), values.end(), voi) - values.begin());
+}
+
+std::vector<double>
+CDA_ResultFile::readColumn(uint32_t column, uint32_t firstRecord,
+                           uint32_t count)
+  throw(std::exception&)
+{
+  checkColumn(column);
+  CDALock l(mMutex);
+
+  std::vector<double> result, values;
+  if (firstRecord >= mRecordCount)
+    return result;
+  if (count > mRecordCount - firstRecord)
+    count = mRecordCount - firstRecord;
+  result.reserve(count);
+
+  for (std::vector<ChunkInfo>::iterator i = mChunks.begin();
+       i != mChunks.end() && result.size() < count; i++)
+  {
+    if ((*i).firstRecord + (*i).records <= firstRecord)
+      continue;
+    if (!readChunkColumn(*i, column, values))
+      throw iface::cellml_api::CellMLException(L"Couldn't read result file.");
+    uint32_t start = firstRecord + result.size() - (*i).firstRecord;
+    uint32_t end = std::min((*i).records,
+                            static_cast<uint32_t>(start + count - result.size()));
+    result.insert(result.end(), values.begin() + start, values.begin() + end);
+  }
+  return result;
+}
@@ -0,0 +1,182 @@
+#ifndef _CISRESULTFILE_HXX
+#define _CISRESULTFILE_HXX
+
+#include "cda_compiler_support.h"
+#include "Utilities.hxx"
+#include "IfaceCIS.hxx"
+#include <stdio.h>
+#include <string>
+#include <vector>
+#include <stdint.h>
+
+/*
+ * Result files hold the records from a run a column at a time, in chunks of
+ * a fixed number of records. All numbers are little endian, and strings are
+ * a uint32 length followed by that many bytes of UTF-8.
+ *
+ *   header:  "CISRSLT1", uint32 column count, uint32 records per chunk, then
+ *            for each column its name, its variable and a uint32 degree.
+ *   chunk:   "CHNK", uint32 record count, a uint32 byte count for each
+ *            column, then the compressed values of each column.
+ *   index:   "INDX", uint32 chunk count, then for each chunk a uint64 file
+ *            offset, a uint32 record count, and the first and last values
+ *            of the variable of integration as doubles.
+ *   trailer: uint64 file offset of the index, "CISREND1".
+ *
+ * The index and trailer are written when the run finishes. Files without
+ * them, because the run is still going or was killed, can still be read by
+ * walking through the chunks.
+ *
+ * Each column is compressed separately, by XORing each value with the one
+ * before (so values that change slowly have many zero bits), and storing
+ * only the bytes of the result between its leading and trailing zero bytes.
+ */
+
+#define RESULT_FILE_DEFAULT_CHUNK_RECORDS 4096
+
+struct ResultColumn
+{
+  ResultColumn() : degree(0) {}
+
+  // The name in generated code, such as ALGEBRAIC[3].
+  std::string name;
+  // The CellML variable, as component/variable, or empty if not known.
+  std::string variable;
+  uint32_t degree;
+};
+
+/**
+ * Writes records to a result file. Only one chunk of values is held in
+ * memory at a time.
+ */
+class ResultFileWriter
+{
+public:
+  ResultFileWriter();
+  ~ResultFileWriter();
+
+  /**
+   * Creates the file and writes its header.
+   * @return false if the file can't be written.
+   */
+  bool open(const std::string& aFileName,
+            const std::vector<ResultColumn>& aColumns,
+            uint32_t aChunkRecords);
+
+  /**
+   * Adds whole records, laid out as they are sent to progress observers.
+   * @param aCount The number of values (not records).
+   */
+  void addRecords(const double* aValues, uint32_t aCount);
+
+  /**
+   * Writes any records left, then the index, and closes the file.
+   * @return false if anything couldn't be written.
+   */
+  bool close();
+
+private:
+  struct ChunkInfo
+  {
+    uint64_t offset;
+    uint32_t records;
+    double firstVOI, lastVOI;
+  };
+
+  void writeChunk();
+  void write(const std::string& aData);
+
+  FILE* mFile;
+  bool mFailed;
+  uint64_t mOffset;
+  uint32_t mColumnCount, mChunkRecords, mRecords;
+  // The values of the current chunk, one column after another.
+  std::vector<double> mChunk;
+  std::vector<ChunkInfo> mChunks;
+};
+
+/**
+ * An observer which writes the results from a run to a result file, and
+ * passes everything else on to the observer of the run.
+ */
+class CDA_ResultFileObserver
+  : public iface::cellml_services::ResultBlockObserver
+{
+public:
+  /**
+   * @param aWriter An open writer, which is deleted with the observer.
+   * @param aObserver The observer to pass everything but results to, or
+   *                  NULL.
+   */
+  CDA_ResultFileObserver(ResultFileWriter* aWriter,
+                         iface::cellml_services::IntegrationProgressObserver*
+                         aObserver);
+  ~CDA_ResultFileObserver();
+
+  CDA_IMPL_REFCOUNT;
+  CDA_IMPL_ID;
+  CDA_IMPL_QI2(cellml_services::IntegrationProgressObserver,
+               cellml_services::ResultBlockObserver);
+
+  void computedConstants(const std::vector<double>& values)
+    throw(std::exception&);
+  void results(const std::vector<double>& state) throw(std::exception&);
+  void resultBlock(iface::cellml_services::ResultBlock* block)
+    throw(std::exception&);
+  void done() throw(std::exception&);
+  void failed(const std::string& errorMessage) throw(std::exception&);
+
+private:
+  ResultFileWriter* mWriter;
+  ObjRef<iface::cellml_services::IntegrationProgressObserver> mObserver;
+};
+
+class CDA_ResultFile
+  : public iface::cellml_services::ResultFile
+{
+public:
+  CDA_ResultFile();
+  ~CDA_ResultFile();
+
+  CDA_IMPL_REFCOUNT;
+  CDA_IMPL_ID;
+  CDA_IMPL_QI1(cellml_services::ResultFile);
+
+  /**
+   * Reads the header and finds the chunks of a result file.
+   * @return false if the file can't be read.
+   */
+  bool open(const std::string& aFileName);
+
+  uint32_t columnCount() throw(std::exception&);
+  uint32_t recordCount() throw(std::exception&);
+  std::wstring columnName(uint32_t column) throw(std::exception&);
+  std::wstring columnVariable(uint32_t column) throw(std::exception&);
+  uint32_t columnDegree(uint32_t column) throw(std::exception&);
+  uint32_t findRecord(double voi) throw(std::exception&);
+  std::vector<double> readColumn(uint32_t column, uint32_t firstRecord,
+                                 uint32_t count)
+    throw(std::exception&);
+
+private:
+  struct ChunkInfo
+  {
+    uint64_t offset;
+    uint32_t firstRecord, records;
+    double firstVOI, lastVOI;
+  };
+
+  bool readIndex(uint64_t aIndexOffset);
+  bool scanChunks(uint64_t aOffset);
+  bool readChunkColumn(const ChunkInfo& aChunk, uint32_t aColumn,
+                       std::vector<double>& aValues);
+  const ResultColumn& checkColumn(uint32_t aColumn);
+
+  CDAMutex mMutex;
+  FILE* mFile;
+  std::vector<ResultColumn> mColumns;
+  std::vector<ChunkInfo> mChunks;
+  uint32_t mRecordCount;
+};
+
+#endif // _CISRESULTFILE_HXX
@@ -0,0 +1,375 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "CISResults.hxx"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <algorithm>
+#ifdef WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#include <unistd.h>
+#include <sys/time.h>
+#endif
+
+// The number of blocks kept for reuse for an observer which takes result
+// blocks. Holding more than this costs an allocation for each new block.
+#define RESULT_RING_BLOCKS 4
+
+CDA_ResultBlock::CDA_ResultBlock(ResultRing* aRing, uint32_t aCapacity)
+  : mRing(aRing), mData(new double[aCapacity]), mLength(0)
+{
+}
+
+CDA_ResultBlock::~CDA_ResultBlock()
+{
+  delete [] mData;
+}
+
+void
+CDA_ResultBlock::add_ref()
+  throw()
+{
+  ++mRefcount;
+}
+
+void
+CDA_ResultBlock::release_ref()
+  throw()
+{
+  if (!--mRefcount)
+    mRing->recycle(this);
+}
+
+uint32_t
+CDA_ResultBlock::length()
+  throw(std::exception&)
+{
+  return mLength;
+}
+
+uint64_t
+CDA_ResultBlock::address()
+  throw(std::exception&)
+{
+  return static_cast<uint64_t>(reinterpret_cast<uintptr_t>(mData));
+}
+
+double
+CDA_ResultBlock::valueAt(uint32_t index)
+  throw(std::exception&)
+{
+  if (index >= mLength)
+    throw iface::cellml_api::CellMLException(L"Result index out of range.");
+  return mData[index];
+}
+
+std::vector<double>
+CDA_ResultBlock::values()
+  throw(std::exception&)
+{
+  return std::vector<double>(mData, mData + mLength);
+}
+
+ResultRing::ResultRing(uint32_t aMaxBlocks, uint32_t aCapacity)
+  : mMaxBlocks(aMaxBlocks), mCapacity(aCapacity)
+{
+}
+
+ResultRing::~ResultRing()
+{
+  for (std::vector<CDA_ResultBlock*>::iterator i = mBlocks.begin();
+       i != mBlocks.end(); i++)
+    delete *i;
+}
+
+CDA_ResultBlock*
+ResultRing::acquire()
+{
+  CDA_ResultBlock* block;
+  {
+    CDALock l(mMutex);
+    if (!mFreeBlocks.empty())
+    {
+      block = mFreeBlocks.front();
+      mFreeBlocks.pop_front();
+    }
+    else
+    {
+      // Waiting for the observer to release a block could stall the run for
+      // good, so a spare block is used instead.
+      block = new CDA_ResultBlock(this, mCapacity);
+      if (mBlocks.size() < mMaxBlocks)
+        mBlocks.push_back(block);
+    }
+  }
+
+  // Each block in use keeps the ring alive.
+  add_ref();
+  block->mRefcount = 1;
+  block->mLength = 0;
+  return block;
+}
+
+void
+ResultRing::add_ref()
+{
+  ++mRefcount;
+}
+
+void
+ResultRing::release_ref()
+{
+  if (!--mRefcount)
+    delete this;
+}
+
+void
+ResultRing::recycle(CDA_ResultBlock* aBlock)
+{
+  {
+    CDALock l(mMutex);
+    if (std::find(mBlocks.begin(), mBlocks.end(), aBlock) != mBlocks.end())
+      mFreeBlocks.push_back(aBlock);
+    else
+      delete aBlock;
+  }
+  release_ref();
+}
+
+bool
+RecordLayout::addOutput(const std::string& aName)
+{
+  if (aName == "VOI")
+  {
+    mOutputs.push_back(std::pair<OutputSource, uint32_t>(OUTPUT_VOI, 0));
+    mNames.push_back(aName);
+    return true;
+  }
+
+  static const struct
+  {
+    const char* array;
+    OutputSource source;
+  } kArrays[] =
+  {
+    {"CONSTANTS", OUTPUT_CONSTANT},
+    {"STATES", OUTPUT_STATE},
+    {"RATES", OUTPUT_RATE},
+    {"ALGEBRAIC", OUTPUT_ALGEBRAIC}
+  };
+
+  size_t open = aName.find('[');
+  if (open == std::string::npos || aName[aName.size() - 1] != ']')
+    return false;
+  std::string array = aName.substr(0, open);
+  const char* index = aName.c_str() + open + 1;
+  char* end;
+  unsigned long i = strtoul(index, &end, 10);
+  if (end == index || *end != ']')
+    return false;
+
+  for (size_t a = 0; a < sizeof(kArrays) / sizeof(kArrays[0]); a++)
+    if (array == kArrays[a].array)
+    {
+      // Use the same form of the name as SplitStatements.
+      char canonical[20];
+      sprintf(canonical, "[%lu]", i);
+      mOutputs.push_back(std::pair<OutputSource, uint32_t>
+                         (kArrays[a].source, static_cast<uint32_t>(i)));
+      mNames.push_back(array + canonical);
+      return true;
+    }
+  return false;
+}
+
+bool
+RecordLayout::fits(uint32_t aConstSize, uint32_t aRateSize,
+                   uint32_t aAlgSize) const
+{
+  std::vector<std::pair<OutputSource, uint32_t> >::const_iterator i;
+  for (i = mOutputs.begin(); i != mOutputs.end(); i++)
+  {
+    uint32_t size = 1;
+    switch ((*i).first)
+    {
+    case OUTPUT_VOI:
+      continue;
+    case OUTPUT_CONSTANT:
+      size = aConstSize;
+      break;
+    case OUTPUT_STATE:
+    case OUTPUT_RATE:
+      size = aRateSize;
+      break;
+    case OUTPUT_ALGEBRAIC:
+      size = aAlgSize;
+      break;
+    }
+    if ((*i).second >= size)
+      return false;
+  }
+  return true;
+}
+
+void
+RecordLayout::computedOutputs(std::set<std::string>& aNames) const
+{
+  for (size_t i = 0; i < mOutputs.size(); i++)
+    if (mOutputs[i].first == OUTPUT_RATE ||
+        mOutputs[i].first == OUTPUT_ALGEBRAIC)
+      aNames.insert(mNames[i]);
+}
+
+void
+RecordLayout::columnNames(uint32_t aRateSize, uint32_t aAlgSize,
+                          std::vector<std::string>& aNames) const
+{
+  aNames.push_back("VOI");
+  if (!mOutputs.empty())
+    aNames.insert(aNames.end(), mNames.begin(), mNames.end());
+  else
+  {
+    static const char* kArrays[] = {"STATES", "RATES", "ALGEBRAIC"};
+    for (int a = 0; a < 3; a++)
+    {
+      uint32_t size = a == 2 ? aAlgSize : aRateSize;
+      for (uint32_t i = 0; i < size; i++)
+      {
+        char index[20];
+        sprintf(index, "[%lu]", static_cast<unsigned long>(i));
+        aNames.push_back(std::string(kArrays[a]) + index);
+      }
+    }
+  }
+
+  for (uint32_t j = 0; j < mSensitivityParameters.size(); j++)
+    for (uint32_t i = 0; i < aRateSize; i++)
+    {
+      char name[60];
+      sprintf(name, "d(STATES[%lu])/d(CONSTANTS[%lu])",
+              static_cast<unsigned long>(i),
+              static_cast<unsigned long>(mSensitivityParameters[j]));
+      aNames.push_back(name);
+    }
+}
+
+void
+RecordLayout::write
+(
+ double* aRecord, double aVOI, const double* aConstants,
+ const double* aStates, const double* aRates, const double* aAlgebraic,
+ uint32_t aRateSize, uint32_t aAlgSize, const double* aSensitivities
+) const
+{
+  if (!mSensitivityParameters.empty())
+    memcpy(aRecord + outputsSize(aRateSize, aAlgSize), aSensitivities,
+           aRateSize * mSensitivityParameters.size() * sizeof(double));
+
+  aRecord[0] = aVOI;
+  if (mOutputs.empty())
+  {
+    memcpy(aRecord + 1, aStates, aRateSize * sizeof(double));
+    memcpy(aRecord + 1 + aRateSize, aRates, aRateSize * sizeof(double));
+    memcpy(aRecord + 1 + aRateSize * 2, aAlgebraic, aAlgSize * sizeof(double));
+    return;
+  }
+
+  for (size_t i = 0; i < mOutputs.size(); i++)
+  {
+    uint32_t index = mOutputs[i].second;
+    switch (mOutputs[i].first)
+    {
+    case OUTPUT_VOI:
+      aRecord[i + 1] = aVOI;
+      break;
+    case OUTPUT_CONSTANT:
+      aRecord[i + 1] = aConstants[index];
+      break;
+    case OUTPUT_STATE:
+      aRecord[i + 1] = aStates[index];
+      break;
+    case OUTPUT_RATE:
+      aRecord[i + 1] = aRates[index];
+      break;
+    case OUTPUT_ALGEBRAIC:
+      aRecord[i + 1] = aAlgebraic[index];
+      break;
+    }
+  }
+}
+
+uint32_t
+MonotonicMilliseconds()
+{
+#if defined(WIN32)
+  return GetTickCount();
+#elif defined(_POSIX_MONOTONIC_CLOCK) && _POSIX_MONOTONIC_CLOCK >= 0
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return static_cast<uint32_t>(ts.tv_sec) * 1000 + ts.tv_nsec / 1000000;
+#else
+  // No monotonic clock, so this can jump if the system time is changed.
+  struct timeval tv;
+  gettimeofday(&tv, NULL);
+  return static_cast<uint32_t>(tv.tv_sec) * 1000 + tv.tv_usec / 1000;
+#endif
+}
+
+ResultBuffer::ResultBuffer
+(
+ iface::cellml_services::IntegrationProgressObserver* aObserver,
+ uint32_t aRecordSize, uint32_t aCapacity, uint32_t aMaxLatency,
+ uint32_t aMaxPoints, ResultRing* aRing
+)
+  : mObserver(aObserver), mRecordSize(aRecordSize), mMaxLatency(aMaxLatency),
+    mFirstRecordTime(0), mBlock(NULL)
+{
+  QUERY_INTERFACE(mBlockObserver, aObserver,
+                  cellml_services::ResultBlockObserver);
+
+  if (aMaxPoints != 0 && aMaxPoints < aCapacity / aRecordSize)
+    aCapacity = aMaxPoints * aRecordSize;
+  mCapacity = (aCapacity / aRecordSize) * aRecordSize;
+  if (mCapacity == 0)
+    mCapacity = aRecordSize;
+
+  // Other observers never hold on to blocks, so only need one.
+  uint32_t maxBlocks = mBlockObserver == NULL ? 1 : RESULT_RING_BLOCKS;
+  if (aRing != NULL && aRing->hasShape(maxBlocks, mCapacity))
+  {
+    mRing = aRing;
+    mRing->add_ref();
+  }
+  else
+    mRing = new ResultRing(maxBlocks, mCapacity);
+}
+
+ResultBuffer::~ResultBuffer()
+{
+  if (mBlock != NULL)
+    mBlock->release_ref();
+  mRing->release_ref();
+}
+
+void
+ResultBuffer::flush()
+{
+  if (isEmpty())
+    return;
+
+  if (mBlockObserver != NULL)
+  {
+    // The observer now shares the block, so it can't be filled again until
+    // the observer is done with it.
+    mBlockObserver->resultBlock(mBlock);
+    mBlock->release_ref();
+    mBlock = NULL;
+    return;
+  }
+
+  if (mObserver != NULL)
+    mObserver->results(mBlock->values());
+  mBlock->mLength = 0;
+}
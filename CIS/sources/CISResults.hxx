@@ -0,0 +1,278 @@
+#ifndef _CISRESULTS_HXX
+#define _CISRESULTS_HXX
+
+#include "cda_compiler_support.h"
+#include "Utilities.hxx"
+#include "IfaceCIS.hxx"
+#include <list>
+#include <set>
+#include <string>
+#include <vector>
+#include <stdint.h>
+
+class ResultRing;
+
+/**
+ * A block of result records. Blocks belong to a ResultRing, and go back to it
+ * to be reused (rather than being deleted) when their last reference is
+ * released.
+ */
+class CDA_ResultBlock
+  : public iface::cellml_services::ResultBlock
+{
+public:
+  CDA_ResultBlock(ResultRing* aRing, uint32_t aCapacity);
+  ~CDA_ResultBlock();
+
+  CDA_IMPL_ID;
+  CDA_IMPL_QI1(cellml_services::ResultBlock);
+
+  void add_ref() throw();
+  void release_ref() throw();
+
+  uint32_t length() throw(std::exception&);
+  uint64_t address() throw(std::exception&);
+  double valueAt(uint32_t index) throw(std::exception&);
+  std::vector<double> values() throw(std::exception&);
+
+private:
+  friend class ResultRing;
+  friend class ResultBuffer;
+
+  CDA_RefCount mRefcount;
+  ResultRing* mRing;
+  double* mData;
+  uint32_t mLength;
+};
+
+/**
+ * A pool of result blocks of the same capacity. Blocks are only allocated as
+ * they are needed, and up to a fixed maximum are kept for reuse. Beyond that,
+ * acquire hands out spare blocks which are deleted when they are released,
+ * rather than waiting for an observer to release one, which it may never do
+ * while the run is going. The ring stays alive until it has been released
+ * and all of its blocks have come back.
+ */
+class ResultRing
+{
+public:
+  ResultRing(uint32_t aMaxBlocks, uint32_t aCapacity);
+
+  /**
+   * Takes an empty block from the ring, or a spare one if they are all in
+   * use. The caller holds the only reference to the block.
+   */
+  CDA_ResultBlock* acquire();
+
+  bool hasShape(uint32_t aMaxBlocks, uint32_t aCapacity) const
+  {
+    return mMaxBlocks == aMaxBlocks && mCapacity == aCapacity;
+  }
+
+  void add_ref();
+  void release_ref();
+
+private:
+  friend class CDA_ResultBlock;
+  ~ResultRing();
+
+  // Called by a block once its last reference has been released.
+  void recycle(CDA_ResultBlock* aBlock);
+
+  CDA_RefCount mRefcount;
+  CDAMutex mMutex;
+  uint32_t mMaxBlocks, mCapacity;
+  std::vector<CDA_ResultBlock*> mBlocks;
+  std::list<CDA_ResultBlock*> mFreeBlocks;
+};
+
+/**
+ * Describes the values in each result record: either the variable of
+ * integration, states, rates and algebraic variables, or the variable of
+ * integration followed by a chosen set of outputs. Either may be followed by
+ * the sensitivities of the states to some constants.
+ */
+class RecordLayout
+{
+public:
+  /**
+   * Adds an output to the record.
+   * @param aName The name of the output in generated code, such as VOI or
+   *              ALGEBRAIC[3].
+   * @return false if the name isn't one which can be recorded.
+   */
+  bool addOutput(const std::string& aName);
+
+  /**
+   * Goes back to recording everything.
+   */
+  void clear()
+  {
+    mOutputs.clear();
+    mNames.clear();
+  }
+
+  bool isSelective() const
+  {
+    return !mOutputs.empty();
+  }
+
+  /**
+   * Adds the sensitivities of the states to the constants aParameters to the
+   * end of the record, parameter by parameter.
+   */
+  void setSensitivities(const std::vector<uint32_t>& aParameters)
+  {
+    mSensitivityParameters = aParameters;
+  }
+
+  uint32_t recordSize(uint32_t aRateSize, uint32_t aAlgSize) const
+  {
+    return outputsSize(aRateSize, aAlgSize) +
+      aRateSize * mSensitivityParameters.size();
+  }
+
+  /**
+   * Checks that every output is in a model with arrays of the given sizes.
+   */
+  bool fits(uint32_t aConstSize, uint32_t aRateSize, uint32_t aAlgSize) const;
+
+  /**
+   * Adds the names of the outputs which are computed by the model code (that
+   * is, rates and algebraic variables) to aNames.
+   */
+  void computedOutputs(std::set<std::string>& aNames) const;
+
+  /**
+   * Finds the name in generated code of each value in a record, starting
+   * with VOI.
+   */
+  void columnNames(uint32_t aRateSize, uint32_t aAlgSize,
+                   std::vector<std::string>& aNames) const;
+
+  /**
+   * Writes a record. aSensitivities is laid out as in the record, and may be
+   * NULL if there are no sensitivities.
+   */
+  void write(double* aRecord, double aVOI, const double* aConstants,
+             const double* aStates, const double* aRates,
+             const double* aAlgebraic, uint32_t aRateSize,
+             uint32_t aAlgSize, const double* aSensitivities = NULL) const;
+
+private:
+  // The size of the record without the sensitivities.
+  uint32_t outputsSize(uint32_t aRateSize, uint32_t aAlgSize) const
+  {
+    if (mOutputs.empty())
+      return 1 + 2 * aRateSize + aAlgSize;
+    return 1 + mOutputs.size();
+  }
+
+  enum OutputSource
+  {
+    OUTPUT_VOI,
+    OUTPUT_CONSTANT,
+    OUTPUT_STATE,
+    OUTPUT_RATE,
+    OUTPUT_ALGEBRAIC
+  };
+  std::vector<std::pair<OutputSource, uint32_t> > mOutputs;
+  std::vector<std::string> mNames;
+  std::vector<uint32_t> mSensitivityParameters;
+};
+
+/**
+ * Returns the time in milliseconds from a clock which is never adjusted, and
+ * so is only useful for measuring intervals. It wraps around, so intervals
+ * must be found by unsigned subtraction.
+ */
+uint32_t MonotonicMilliseconds();
+
+/**
+ * Collects result records in blocks, and sends them to a progress observer.
+ * Observers which support ResultBlockObserver are given the blocks
+ * themselves, so that records are written once and never copied; other
+ * observers get a copy of the records in each block, after which the block
+ * is reused straight away.
+ */
+class ResultBuffer
+{
+public:
+  /**
+   * @param aObserver The observer to send results to, or NULL to discard
+   *                  them.
+   * @param aRecordSize The number of doubles in each record.
+   * @param aCapacity The number of doubles to hold before the buffer is full;
+   *                  rounded down to a whole number of records (but always
+   *                  at least one).
+   * @param aMaxLatency The longest time in milliseconds to hold a record
+   *                    before it is due to be sent, or 0 for no limit.
+   * @param aMaxPoints The most records to hold before they are due to be
+   *                   sent, or 0 for no limit.
+   * @param aRing A ring from an earlier buffer to use, if its blocks are the
+   *              right size, rather than allocating new blocks; may be NULL.
+   */
+  ResultBuffer(iface::cellml_services::IntegrationProgressObserver* aObserver,
+               uint32_t aRecordSize, uint32_t aCapacity,
+               uint32_t aMaxLatency = 0, uint32_t aMaxPoints = 0,
+               ResultRing* aRing = NULL);
+  ~ResultBuffer();
+
+  /**
+   * Returns the space for the next record, which is added by calling
+   * addRecord once it has been filled in.
+   */
+  double* nextRecord()
+  {
+    if (mBlock == NULL)
+      mBlock = mRing->acquire();
+    return mBlock->mData + mBlock->mLength;
+  }
+
+  /**
+   * Adds the record written to the space from nextRecord.
+   * @return true if the records held are due to be sent, in which case
+   *         flush must be called before another record is added.
+   */
+  bool addRecord()
+  {
+    mBlock->mLength += mRecordSize;
+    if (mBlock->mLength + mRecordSize > mCapacity)
+      return true;
+    if (mMaxLatency == 0)
+      return false;
+
+    uint32_t now = MonotonicMilliseconds();
+    if (mBlock->mLength == mRecordSize)
+      mFirstRecordTime = now;
+    return now - mFirstRecordTime >= mMaxLatency;
+  }
+
+  bool isEmpty()
+  {
+    return mBlock == NULL || mBlock->mLength == 0;
+  }
+
+  /**
+   * Sends any records held to the observer.
+   */
+  void flush();
+
+  /**
+   * The ring the buffer takes blocks from, which can be kept (with add_ref)
+   * for a later buffer to reuse.
+   */
+  ResultRing* ring()
+  {
+    return mRing;
+  }
+
+private:
+  iface::cellml_services::IntegrationProgressObserver* mObserver;
+  ObjRef<iface::cellml_services::ResultBlockObserver> mBlockObserver;
+  uint32_t mRecordSize, mCapacity, mMaxLatency, mFirstRecordTime;
+  ResultRing* mRing;
+  CDA_ResultBlock* mBlock;
+};
+
+#endif // _CISRESULTS_HXX
@@ -0,0 +1,179 @@
+#define IN_CIS_MODULE
+#define MODULE_CONTAINS_CIS
+#include "CISScheduler.hxx"
+#include "CISImplementation.hxx"
+
+// Integrates queued runs until none can be taken.
+class RunWorker
+  : public CDAThread
+{
+public:
+  RunWorker(RunScheduler* aScheduler)
+    : mScheduler(aScheduler)
+  {
+  }
+
+protected:
+  void runthread();
+
+private:
+  RunScheduler* mScheduler;
+};
+
+void
+RunWorker::runthread()
+{
+  while (true)
+  {
+    CDA_CellMLIntegrationRun* run;
+    {
+      CDALock l(mScheduler->mMutex);
+      run = mScheduler->takeRun();
+      if (run == NULL)
+      {
+        mScheduler->mThreadCount--;
+        break;
+      }
+    }
+
+    // Releases the reference start() added once the run is done.
+    run->runthread();
+  }
+
+  mScheduler->release_ref();
+  delete this;
+}
+
+RunScheduler::RunScheduler()
+  : mMaxThreads(0), mMaxQueued(0), mThreadCount(0), mQueuedCount(0)
+{
+}
+
+RunScheduler::~RunScheduler()
+{
+}
+
+void
+RunScheduler::add_ref()
+{
+  ++mRefcount;
+}
+
+void
+RunScheduler::release_ref()
+{
+  if (!--mRefcount)
+    delete this;
+}
+
+uint32_t
+RunScheduler::maxThreads()
+{
+  CDALock l(mMutex);
+  return mMaxThreads;
+}
+
+void
+RunScheduler::maxThreads(uint32_t aMaxThreads)
+{
+  CDALock l(mMutex);
+  mMaxThreads = aMaxThreads;
+
+  // A higher limit may let queued runs start now.
+  while (mThreadCount < mQueuedCount &&
+         (mMaxThreads == 0 || mThreadCount < mMaxThreads))
+    startWorker();
+}
+
+uint32_t
+RunScheduler::maxQueued()
+{
+  CDALock l(mMutex);
+  return mMaxQueued;
+}
+
+void
+RunScheduler::maxQueued(uint32_t aMaxQueued)
+{
+  CDALock l(mMutex);
+  mMaxQueued = aMaxQueued;
+}
+
+bool
+RunScheduler::enqueue
+(
+ CDA_CellMLIntegrationRun* aRun, CDA_CellMLCompiledModel* aModel,
+ int32_t aPriority
+)
+{
+  CDALock l(mMutex);
+  if (mMaxQueued != 0 && mQueuedCount >= mMaxQueued)
+    return false;
+
+  PriorityQueue& queue = mQueues[aPriority];
+  PriorityQueue::iterator i;
+  for (i = queue.begin(); i != queue.end(); i++)
+    if ((*i).model == aModel)
+      break;
+  if (i == queue.end())
+  {
+    queue.push_back(ModelQueue());
+    i = --queue.end();
+    (*i).model = aModel;
+  }
+  (*i).runs.push_back(aRun);
+  mQueuedCount++;
+
+  if (mMaxThreads == 0 || mThreadCount < mMaxThreads)
+    startWorker();
+  return true;
+}
+
+void
+RunScheduler::wake()
+{
+  CDALock l(mMutex);
+  if (mQueuedCount != 0 && (mMaxThreads == 0 || mThreadCount < mMaxThreads))
+    startWorker();
+}
+
+void
+RunScheduler::startWorker()
+{
+  mThreadCount++;
+  add_ref();
+  (new RunWorker(this))->startthread();
+}
+
+CDA_CellMLIntegrationRun*
+RunScheduler::takeRun()
+{
+  std::map<int32_t, PriorityQueue>::reverse_iterator p;
+  for (p = mQueues.rbegin(); p != mQueues.rend(); p++)
+  {
+    PriorityQueue& queue = (*p).second;
+    for (PriorityQueue::iterator m = queue.begin(); m != queue.end(); m++)
+    {
+      std::list<CDA_CellMLIntegrationRun*>& runs = (*m).runs;
+      for (std::list<CDA_CellMLIntegrationRun*>::iterator r = runs.begin();
+           r != runs.end(); r++)
+      {
+        CDA_CellMLIntegrationRun* run = *r;
+        if (run->mCommand.load() == CDA_CellMLIntegrationRun::COMMAND_PAUSE)
+          continue;
+
+        runs.erase(r);
+        // The model has had its turn, so goes behind the others.
+        if (runs.empty())
+          queue.erase(m);
+        else
+          queue.splice(queue.end(), queue, m);
+        if (queue.empty())
+          mQueues.erase(--p.base());
+        mQueuedCount--;
+        return run;
+      }
+    }
+  }
+  return NULL;
+}
@@ -0,0 +1,86 @@
+#ifndef _CISSCHEDULER_HXX
+#define _CISSCHEDULER_HXX
+
+#include "cda_compiler_support.h"
+#include "Utilities.hxx"
+#include <list>
+#include <map>
+#include <stdint.h>
+
+class CDA_CellMLIntegrationRun;
+class CDA_CellMLCompiledModel;
+
+/**
+ * Runs started integrations on a bounded set of worker threads, rather than
+ * on a thread each.
+ *
+ * Runs with a higher priority are run first. Runs with the same priority
+ * take turns by compiled model, so a model with many runs queued doesn't hold
+ * up the runs of other models, and are run in the order they were started
+ * otherwise. Paused runs stay queued without holding a worker until they are
+ * resumed or stopped.
+ *
+ * Workers are only started while there are runs to take, and finish once
+ * there are none left.
+ */
+class RunScheduler
+{
+public:
+  RunScheduler();
+
+  void add_ref();
+  void release_ref();
+
+  /**
+   * The most runs integrated at once, or 0 (the default) for no limit, in
+   * which case each run gets its own thread as soon as it starts.
+   */
+  uint32_t maxThreads();
+  void maxThreads(uint32_t aMaxThreads);
+
+  /**
+   * The most runs waiting to be integrated, or 0 (the default) for no limit.
+   */
+  uint32_t maxQueued();
+  void maxQueued(uint32_t aMaxQueued);
+
+  /**
+   * Queues a run which has been started. The scheduler calls its runthread
+   * on a worker, and so takes over the reference start() added.
+   * @return false, without queueing the run, if the queue is full.
+   */
+  bool enqueue(CDA_CellMLIntegrationRun* aRun, CDA_CellMLCompiledModel* aModel,
+               int32_t aPriority);
+
+  /**
+   * Tells the scheduler a queued run may have been resumed or stopped, and
+   * so can be taken by a worker again.
+   */
+  void wake();
+
+private:
+  friend class RunWorker;
+  ~RunScheduler();
+
+  // Starts a worker if the thread limit allows. Called with mMutex held.
+  void startWorker();
+
+  // Removes and returns the next run to integrate, or NULL if every queued run
+  // is paused. Called with mMutex held.
+  CDA_CellMLIntegrationRun* takeRun();
+
+  struct ModelQueue
+  {
+    CDA_CellMLCompiledModel* model;
+    std::list<CDA_CellMLIntegrationRun*> runs;
+  };
+  typedef std::list<ModelQueue> PriorityQueue;
+
+  CDA_RefCount mRefcount;
+  CDAMutex mMutex;
+  uint32_t mMaxThreads, mMaxQueued, mThreadCount, mQueuedCount;
+  // Keyed by priority, so the highest priority is last.
+  std::map<int32_t, PriorityQueue> mQueues;
+};
+
+#endif // _CISSCHEDULER_HXX
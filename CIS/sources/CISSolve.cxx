@@ -6,6 +6,7 @@
 #include <sstream>
 #include "Utilities.hxx"
 #include "CISImplementation.hxx"
+#include "CISResults.hxx"
 #ifdef ENABLE_GSL_INTEGRATORS
 #include <gsl/gsl_odeiv.h>
 #include <gsl/gsl_errno.h>
@@ -35,6 +36,8 @@
 #include <sundials/sundials_types.h>
 #include <cvode/cvode_dense.h>
 #include <cvode/cvode_dense.h>
+#include <cvode/cvode_band.h>
+#include <cvode/cvode_spgmr.h>
 
 #include <kinsol/kinsol.h>
 #include <kinsol/kinsol_spgmr.h>
@@ -69,15 +72,98 @@ void failAddCause(struct fail_info* aFail, const char* aCause)
   aFail->failmsg = aCause + (", caused by " + aFail->failmsg);
 }
 
+// Works out how little of the model has to be evaluated to fill in a record,
+// given the outputs it holds. The states are always up to date, so records
+// which only hold states and constants need no evaluation at all.
+class OutputEvaluation
+{
+public:
+  OutputEvaluation(CompiledModelFunctions* f, const RecordLayout& aLayout)
+    : mComputeRates(true), mComputeVariables(true),
+      mComputeVariablesSelected(NULL)
+  {
+    if (!aLayout.isSelective())
+      return;
+
+    std::set<std::string> wanted;
+    aLayout.computedOutputs(wanted);
+    if (wanted.empty())
+    {
+      mComputeRates = mComputeVariables = false;
+      return;
+    }
+    if (f->ComputeVariablesSelected == NULL)
+      return;
+
+    bool needsAll = SelectStatements(f->variablesStatements, wanted, mSteps);
+    mComputeVariablesSelected = f->ComputeVariablesSelected;
+    mComputeVariables = false;
+    for (std::vector<char>::iterator i = mSteps.begin(); i != mSteps.end(); i++)
+      if (*i)
+        mComputeVariables = true;
+
+    // Whatever ComputeVariables reads without computing itself comes from
+    // ComputeRates (or is a state or constant, which are already known).
+    mComputeRates = needsAll;
+    for (std::set<std::string>::iterator i = wanted.begin();
+         !mComputeRates && i != wanted.end(); i++)
+      mComputeRates = (*i).compare(0, 6, "RATES[") == 0 ||
+        (*i).compare(0, 10, "ALGEBRAIC[") == 0;
+  }
+
+  void evaluate(CompiledModelFunctions* f, double voi, double* constants,
+                double* rates, double* states, double* algebraic,
+                struct fail_info* failInfo)
+  {
+    if (mComputeRates)
+      f->computeRates(voi, constants, rates, states, algebraic, failInfo);
+    if (!mComputeVariables)
+      return;
+    if (mComputeVariablesSelected != NULL)
+      mComputeVariablesSelected(voi, constants, rates, states, algebraic,
+                                &mSteps[0], failInfo);
+    else
+      f->computeVariables(voi, constants, rates, states, algebraic, failInfo);
+  }
+
+private:
+  bool mComputeRates, mComputeVariables;
+  void (*mComputeVariablesSelected)(double VOI, double* CONSTANTS,
+                                    double* RATES, double* STATES,
+                                    double* ALGEBRAIC, const char* STEPS,
+                                    struct fail_info*);
+  std::vector<char> mSteps;
+};
+
 struct EvaluationInformation
 {
   double* constants, * rates, * algebraic, * states;
   uint32_t rateSizeBytes, rateSize;
   struct fail_info* failInfo;
-  void (*ComputeRates)(double VOI, double* CONSTANTS, double* RATES,
-                       double* STATES, double* ALGEBRAIC, struct fail_info*);
-  void (*ComputeVariables)(double VOI, double* CONSTANTS, double* RATES,
-                           double* STATES, double* ALGEBRAIC, struct fail_info*);
+  CompiledModelFunctions* functions;
+  void (*ComputeJacobian)(double VOI, double* CONSTANTS, double* RATES,
+                          double* STATES, double* ALGEBRAIC, double* JACOBIAN,
+                          struct fail_info*);
+  // The entries of the Jacobian which ComputeJacobian computes, and space for
+  // their values.
+  const JacobianPattern* jacobianPattern;
+  double* jacobianValues;
+  // If the solver keeps the states in a different order, order[k] is the
+  // state at position k of its vectors and position[order[k]] is k. NULL if
+  // the states are in their original order.
+  uint32_t* order, * position;
+  class BlockPreconditioner* preconditioner;
+  // The number of parameters whose sensitivities follow the states in the
+  // solver's vectors, the values of d(CONSTANTS)/dp for the model's
+  // constantSensitivityPattern, and space for the entries in its
+  // sensitivityPattern.
+  uint32_t sensitivityCount;
+  double* constantSensitivities, * sensitivityValues;
+
+  EvaluationInformation()
+    : jacobianPattern(NULL), jacobianValues(NULL), order(NULL),
+      position(NULL), preconditioner(NULL), sensitivityCount(0),
+      constantSensitivities(NULL), sensitivityValues(NULL) {}
 };
 
 #ifdef ENABLE_GSL_INTEGRATORS
@@ -88,7 +174,7 @@ EvaluateRatesGSL(double voi, const double vars[],
   EvaluationInformation* ei = reinterpret_cast<EvaluationInformation*>(params);
 
   // Update variables that change based on bound/other vars...
-  int ret = ei->ComputeRates(voi, ei->constants, ei->rates, const_cast<double*>(vars),
+  int ret = ei->functions->computeRates(voi, ei->constants, ei->rates, const_cast<double*>(vars),
                              ei->algebraic);
 
   if (rates != ei->rates)
@@ -119,8 +205,8 @@ EvaluateJacobianGSL
   double* rate1 = new double[ei->rateSize];
 
   // Initial rates...
-  ei->ComputeRates(voi, ei->constants, rate0, states,
-                   ei->algebraic);
+  ei->functions->computeRates(voi, ei->constants, rate0, states,
+                              ei->algebraic);
 
   uint32_t i, j;
   for (i = 0; i < ei->rateSize; i++)
@@ -131,7 +217,8 @@ EvaluateJacobianGSL
 
     states[i] = vars[i] + perturb;
 
-    ei->ComputeRates(voi, ei->constants, rate1, states, ei->algebraic);
+    ei->functions->computeRates(voi, ei->constants, rate1, states,
+                                ei->algebraic);
 
     for (j = 0; j < ei->rateSize; j++)
     {
@@ -147,7 +234,8 @@ EvaluateJacobianGSL
     perturb = 1E-90;
   double newvoi = voi + perturb;
 
-  ei->ComputeRates(newvoi, ei->constants, rate1, states, ei->algebraic);
+  ei->functions->computeRates(newvoi, ei->constants, rate1, states,
+                              ei->algebraic);
 
   for (i = 0; i < ei->rateSize; i++)
   {
@@ -173,17 +261,116 @@ bool floatsEqual
   return std::abs(candidate - expected) / (std::abs(expected) + std::numeric_limits<double>::min()) <= tolerance;
 }
 
+// Picks out the tabulation points a solver has stepped past, so the results at
+// them can be interpolated rather than the solver being stopped at each one.
+class TabulationPoints
+{
+public:
+  TabulationPoints(double aStart, double aStep, double aStop)
+    : mStart(aStart), mStep(aStep), mStop(aStop), mNumber(1)
+  {
+  }
+
+  // Sets aPoint to the next tabulation point before aVOI, or at aVOI if
+  // aIncludeVOI is set, and moves past it. Returns false if there is none.
+  bool next(double aVOI, bool aIncludeVOI, double& aPoint)
+  {
+    if (mStep == 0.0)
+      return false;
+    double point = current();
+    if (point > mStop)
+      return false;
+    if (floatsEqual(point, aVOI, tabulationRelativeTolerance))
+    {
+      if (!aIncludeVOI)
+        return false;
+    }
+    else if (point > aVOI)
+      return false;
+    aPoint = point;
+    mNumber++;
+    return true;
+  }
+
+  // Moves past the next tabulation point if it is at aVOI, which the solver
+  // has stepped to exactly. Returns whether it was.
+  bool skip(double aVOI)
+  {
+    if (mStep == 0.0 ||
+        !floatsEqual(current(), aVOI, tabulationRelativeTolerance))
+      return false;
+    mNumber++;
+    return true;
+  }
+
+private:
+  double current()
+  {
+    double point = mStep * mNumber + mStart;
+    return floatsEqual(point, mStop, tabulationRelativeTolerance) ?
+      mStop : point;
+  }
+
+  double mStart, mStep, mStop;
+  uint32_t mNumber;
+};
+
+// Gets the states from the solver's vector, putting them back into their
+// original order if necessary.
+static double*
+SolverStatesToModel(EvaluationInformation* ei, N_Vector varsV)
+{
+  double* vars = N_VGetArrayPointer_Serial(varsV);
+  if (ei->order == NULL)
+    return vars;
+
+  for (uint32_t k = 0; k < ei->rateSize; k++)
+    ei->states[ei->order[k]] = vars[k];
+  return ei->states;
+}
+
+// Computes the rates into ei->rates, and the rates of the sensitivities, which
+// follow the states in the solver's vectors.
+static void
+ComputeSensitivityRates(EvaluationInformation* ei, double bound,
+                        N_Vector varsV, N_Vector ratesV)
+{
+  CompiledModelFunctions* f = ei->functions;
+  double* sensitivities = N_VGetArrayPointer_Serial(varsV) + ei->rateSize;
+  f->ComputeSensitivityRates(bound, ei->constants, ei->rates,
+                             SolverStatesToModel(ei, varsV), ei->algebraic,
+                             ei->constantSensitivities, sensitivities,
+                             ei->sensitivityValues, ei->failInfo);
+
+  double* sensitivityRates = N_VGetArrayPointer_Serial(ratesV) + ei->rateSize;
+  memset(sensitivityRates, 0,
+         ei->sensitivityCount * ei->rateSizeBytes);
+  const JacobianPattern& pattern = f->sensitivityPattern;
+  for (uint32_t k = 0; k < pattern.size(); k++)
+    sensitivityRates[pattern[k].second * ei->rateSize + pattern[k].first] =
+      ei->sensitivityValues[k];
+}
+
 int
 EvaluateRatesCVODE(double bound, N_Vector varsV, N_Vector ratesV, void* params)
 {
   EvaluationInformation* ei = reinterpret_cast<EvaluationInformation*>(params);
 
   // Update variables that change based on bound/other vars...
-  ei->ComputeRates(bound, ei->constants, ei->rates, N_VGetArrayPointer_Serial(varsV),
-                   ei->algebraic, ei->failInfo);
+  if (ei->sensitivityCount != 0)
+    ComputeSensitivityRates(ei, bound, varsV, ratesV);
+  else
+    ei->functions->computeRates(bound, ei->constants, ei->rates,
+                                SolverStatesToModel(ei, varsV), ei->algebraic,
+                                ei->failInfo);
 
   double* rates = N_VGetArrayPointer_Serial(ratesV);
-  if (rates != ei->rates)
+  if (ei->order != NULL)
+  {
+    for (uint32_t k = 0; k < ei->rateSize; k++)
+      rates[k] = ei->rates[ei->order[k]];
+  }
+  else if (rates != ei->rates)
     memcpy(rates, ei->rates, ei->rateSizeBytes);
 
   for (int i = 0; i < NV_LENGTH_S(ratesV); i++)
@@ -200,62 +387,323 @@ EvaluateRatesCVODE(double bound, N_Vector varsV, N_Vector ratesV, void* params)
   return ei->failInfo->failtype;
 }
 
-// Don't cache more than 2MB of variables (assuming 8 bytes per variable). This
-// leaves a little bit of room in the 2MB for CORBA overhead.
-#define VARIABLE_STORAGE_LIMIT 262016
-// Don't cache for more than 1 second...
-#define VARIABLE_TIME_LIMIT 1
-
-bool
-CDA_CellMLIntegrationRun::checkPauseOrCancellation()
+// Computes the entries of the Jacobian listed in ei->jacobianPattern into
+// ei->jacobianValues.
+static int
+ComputeJacobianValues(EvaluationInformation* ei, realtype bound,
+                      N_Vector varsV)
 {
-#ifndef WIN32
-  fd_set pipeset;
-  FD_ZERO(&pipeset);
-  FD_SET(mThreadPipes[0], &pipeset);
-  struct timeval to;
-#endif
-  while (true)
+  ei->ComputeJacobian(bound, ei->constants, ei->rates,
+                      SolverStatesToModel(ei, varsV), ei->algebraic,
+                      ei->jacobianValues, ei->failInfo);
+
+  for (uint32_t i = 0; i < ei->jacobianPattern->size(); i++)
   {
-#ifdef WIN32
-    if (WaitForSingleObject(mThreadSemaphore, 0) != WAIT_OBJECT_0)
-      return false;
-#else
-    to.tv_sec = 0;
-    to.tv_usec = 0;
-    if (select(mThreadPipes[0] + 1, &pipeset, NULL, NULL, &to) == 0)
-      return false;
-#endif
+    if (!cdamath::isfinite(ei->jacobianValues[i]))
+    {
+      if (!ei->failInfo->failtype)
+        setFailure(ei->failInfo, "One of the entries in the Jacobian cannot be represented as a valid finite number", -1);
+    }
+    if (ei->failInfo->failtype)
+      break;
+  }
 
-    int command;
-#ifdef WIN32
-    DWORD readLen;
-    ReadFile(mThreadPipes[0], &command, sizeof(command), &readLen, NULL);
-#else
-    read(mThreadPipes[0], &command, sizeof(command));
-#endif
+  return ei->failInfo->failtype;
+}
 
-    if (command == 1) // Cancel
-      return true;
-    else if (command == 2) // Pause
+// The matrices passed to the Jacobian functions have already been zeroed, so
+// only the entries in the pattern need to be filled in.
+static int
+EvaluateJacobianCVODE(long int N, realtype bound, N_Vector varsV,
+                      N_Vector ratesV, DlsMat jac, void* params,
+                      N_Vector tmp1, N_Vector tmp2, N_Vector tmp3)
+{
+  EvaluationInformation* ei = reinterpret_cast<EvaluationInformation*>(params);
+  if (ComputeJacobianValues(ei, bound, varsV))
+    return ei->failInfo->failtype;
+
+  const JacobianPattern& pattern = *ei->jacobianPattern;
+  for (uint32_t i = 0; i < pattern.size(); i++)
+    DENSE_ELEM(jac, pattern[i].first, pattern[i].second) = ei->jacobianValues[i];
+
+  return 0;
+}
+
+static int
+EvaluateBandJacobianCVODE(long int N, long int mupper, long int mlower,
+                          realtype bound, N_Vector varsV, N_Vector ratesV,
+                          DlsMat jac, void* params,
+                          N_Vector tmp1, N_Vector tmp2, N_Vector tmp3)
+{
+  EvaluationInformation* ei = reinterpret_cast<EvaluationInformation*>(params);
+  if (ComputeJacobianValues(ei, bound, varsV))
+    return ei->failInfo->failtype;
+
+  // With sensitivities, the Jacobian of the rates is also used for the block
+  // of each parameter's sensitivities, ignoring how the rates of the
+  // sensitivities depend on the states. This is the approximation made by
+  // the simultaneous corrector in CVODES.
+  const JacobianPattern& pattern = *ei->jacobianPattern;
+  for (uint32_t b = 0; b <= ei->sensitivityCount; b++)
+  {
+    uint32_t offset = b * ei->rateSize;
+    for (uint32_t i = 0; i < pattern.size(); i++)
     {
-      while (command == 2)
+      uint32_t row = pattern[i].first, column = pattern[i].second;
+      if (ei->position != NULL)
       {
-#ifdef WIN32
-        if (WaitForSingleObject(mThreadSemaphore, INFINITE) != WAIT_OBJECT_0)
-          return false;
-        ReadFile(mThreadPipes[0], &command, sizeof(command),
-                 &readLen, NULL);
-#else
-        read(mThreadPipes[0], &command, sizeof(command));
-#endif
-        if (command == 1) // Cancel
-          return true;
-        else if (command == 3) // Resume
-          break;
+        row = ei->position[row];
+        column = ei->position[column];
       }
+      BAND_ELEM(jac, offset + row, offset + column) = ei->jacobianValues[i];
     }
   }
+
+  return 0;
+}
+
+// Approximates I - gamma J by its blocks along the diagonal, ignoring the
+// coupling between blocks, for preconditioning the Krylov solver. Blocks are
+// taken from a bandwidth reducing order, so that strongly coupled states tend
+// to share a block.
+class BlockPreconditioner
+{
+public:
+  BlockPreconditioner(uint32_t aSize, const JacobianPattern& aPattern,
+                      uint32_t aMaxBlockSize)
+    : mPattern(aPattern), mBlockOf(aSize), mIndexInBlock(aSize),
+      mScratch(aMaxBlockSize)
+  {
+    std::vector<uint32_t> order;
+    ReduceBandwidth(aSize, aPattern, order);
+    for (uint32_t k = 0; k < aSize; k++)
+    {
+      if (k % aMaxBlockSize == 0)
+        mBlocks.push_back(Block());
+      Block& b = mBlocks.back();
+      mBlockOf[order[k]] = mBlocks.size() - 1;
+      mIndexInBlock[order[k]] = b.variables.size();
+      b.variables.push_back(order[k]);
+    }
+    std::vector<Block>::iterator b;
+    for (b = mBlocks.begin(); b != mBlocks.end(); b++)
+    {
+      (*b).matrix = NewDenseMat((*b).variables.size(), (*b).variables.size());
+      (*b).pivots = NewLintArray((*b).variables.size());
+    }
+  }
+
+  ~BlockPreconditioner()
+  {
+    std::vector<Block>::iterator b;
+    for (b = mBlocks.begin(); b != mBlocks.end(); b++)
+    {
+      DestroyMat((*b).matrix);
+      DestroyArray((*b).pivots);
+    }
+  }
+
+  // Forms and factorises the blocks. Returns false if any are singular.
+  bool setup(const double* aJacobianValues, double aGamma)
+  {
+    std::vector<Block>::iterator b;
+    for (b = mBlocks.begin(); b != mBlocks.end(); b++)
+    {
+      SetToZero((*b).matrix);
+      AddIdentity((*b).matrix);
+    }
+    for (uint32_t i = 0; i < mPattern.size(); i++)
+    {
+      uint32_t row = mPattern[i].first, column = mPattern[i].second;
+      if (mBlockOf[row] != mBlockOf[column])
+        continue;
+      DENSE_ELEM(mBlocks[mBlockOf[row]].matrix, mIndexInBlock[row],
+                 mIndexInBlock[column]) -= aGamma * aJacobianValues[i];
+    }
+    for (b = mBlocks.begin(); b != mBlocks.end(); b++)
+      if (DenseGETRF((*b).matrix, (*b).pivots) != 0)
+        return false;
+    return true;
+  }
+
+  // Solves P z = r.
+  void solve(const double* r, double* z)
+  {
+    std::vector<Block>::iterator b;
+    for (b = mBlocks.begin(); b != mBlocks.end(); b++)
+    {
+      uint32_t n = (*b).variables.size();
+      for (uint32_t i = 0; i < n; i++)
+        mScratch[i] = r[(*b).variables[i]];
+      DenseGETRS((*b).matrix, (*b).pivots, &mScratch[0]);
+      for (uint32_t i = 0; i < n; i++)
+        z[(*b).variables[i]] = mScratch[i];
+    }
+  }
+
+private:
+  struct Block
+  {
+    std::vector<uint32_t> variables;
+    DlsMat matrix;
+    long int* pivots;
+  };
+
+  const JacobianPattern& mPattern;
+  std::vector<Block> mBlocks;
+  std::vector<uint32_t> mBlockOf, mIndexInBlock;
+  std::vector<double> mScratch;
+};
+
+// The largest block used by BlockPreconditioner. Factorising a block costs
+// O(size^3), so this keeps the preconditioner close to linear in the number of
+// states.
+#define PRECONDITIONER_BLOCK_SIZE 16
+
+static int
+SetupPreconditionerCVODE(realtype bound, N_Vector varsV, N_Vector ratesV,
+                         booleantype jok, booleantype* jcurPtr,
+                         realtype gamma, void* params,
+                         N_Vector tmp1, N_Vector tmp2, N_Vector tmp3)
+{
+  EvaluationInformation* ei = reinterpret_cast<EvaluationInformation*>(params);
+
+  // CVODE tells us when the last Jacobian is still good enough to reuse.
+  if (jok)
+    *jcurPtr = FALSE;
+  else
+  {
+    if (ComputeJacobianValues(ei, bound, varsV))
+      return ei->failInfo->failtype;
+    *jcurPtr = TRUE;
+  }
+
+  // A singular block is recoverable: CVODE retries with a smaller step.
+  return ei->preconditioner->setup(ei->jacobianValues, gamma) ? 0 : 1;
+}
+
+static int
+SolvePreconditionerCVODE(realtype bound, N_Vector varsV, N_Vector ratesV,
+                         N_Vector r, N_Vector z, realtype gamma,
+                         realtype delta, int lr, void* params, N_Vector tmp)
+{
+  EvaluationInformation* ei = reinterpret_cast<EvaluationInformation*>(params);
+  ei->preconditioner->solve(N_VGetArrayPointer_Serial(r),
+                            N_VGetArrayPointer_Serial(z));
+  return 0;
+}
+
+struct BatchEvaluationInformation
+{
+  uint32_t count, rateSize;
+  // Scratch space laid out for ComputeRatesBatch, as each variable for every
+  // instance in turn.
+  double* constants, * rates, * states, * algebraic;
+  struct fail_info* failInfo;
+  void (*ComputeRatesBatch)(int nInstances, double VOI, double* CONSTANTS,
+                            double* RATES, double* STATES, double* ALGEBRAIC,
+                            struct fail_info*);
+};
+
+int
+EvaluateRatesBatchCVODE(double bound, N_Vector varsV, N_Vector ratesV,
+                        void* params)
+{
+  BatchEvaluationInformation* bei =
+    reinterpret_cast<BatchEvaluationInformation*>(params);
+
+  // The solver keeps each instance's states together, so its Jacobian stays
+  // banded, but the batched code wants each variable's values together.
+  double* vars = N_VGetArrayPointer_Serial(varsV);
+  uint32_t i, k;
+  for (k = 0; k < bei->count; k++)
+    for (i = 0; i < bei->rateSize; i++)
+      bei->states[i * bei->count + k] = vars[k * bei->rateSize + i];
+
+  bei->ComputeRatesBatch(bei->count, bound, bei->constants, bei->rates,
+                         bei->states, bei->algebraic, bei->failInfo);
+
+  double* rates = N_VGetArrayPointer_Serial(ratesV);
+  for (k = 0; k < bei->count; k++)
+    for (i = 0; i < bei->rateSize; i++)
+      rates[k * bei->rateSize + i] = bei->rates[i * bei->count + k];
+
+  for (int i = 0; i < NV_LENGTH_S(ratesV); i++)
+  {
+    if (!cdamath::isfinite(NV_Ith_S(ratesV, i)))
+    {
+      if (!bei->failInfo->failtype)
+        setFailure(bei->failInfo, "One of the rates cannot be represented as a valid finite number", -1);
+    }
+    if (bei->failInfo->failtype)
+      break;
+  }
+
+  return bei->failInfo->failtype;
+}
+
+bool
+CDA_CellMLIntegrationRun::checkPauseOrCancellation()
+{
+  // This is called after every step, so the common case mustn't lock or make
+  // system calls.
+  uint32_t command = mCommand.load();
+  if (command == COMMAND_RUN)
+    return false;
+  if (command == COMMAND_CANCEL)
+    return true;
+
+  CDALock l(mCommandMutex);
+  mIsWaiting = true;
+  while (mCommand.load() == COMMAND_PAUSE)
+    mCommandCondition.Wait(mCommandMutex);
+  mIsWaiting = false;
+  return mCommand.load() == COMMAND_CANCEL;
+}
+
+CDA_IntegrationCheckpoint*
+CDA_CellMLIntegrationRun::snapshot()
+{
+  CDA_IntegrationCheckpoint* checkpoint =
+    new CDA_IntegrationCheckpoint(compiledModel());
+  checkpoint->mVOI = *mPosition.voi;
+
+  uint32_t rateSize = mPosition.rateSize;
+  if (mPosition.orderedStates != NULL)
+  {
+    checkpoint->mStates.resize(rateSize);
+    for (uint32_t k = 0; k < rateSize; k++)
+      checkpoint->mStates[mPosition.order[k]] = mPosition.orderedStates[k];
+  }
+  else
+    checkpoint->mStates.assign(mPosition.states, mPosition.states + rateSize);
+  checkpoint->mRates.assign(mPosition.rates, mPosition.rates + rateSize);
+
+  // Both solvers give the step size they will try next.
+  realtype stepSize = 0.0;
+  if (mPosition.cvode != NULL)
+    CVodeGetCurrentStep(mPosition.cvode, &stepSize);
+  else if (mPosition.ida != NULL)
+    IDAGetCurrentStep(mPosition.ida, &stepSize);
+  else if (mPosition.stepSize != NULL)
+    stepSize = *mPosition.stepSize;
+  checkpoint->mStepSize = stepSize;
+
+  if (mResumeFrom != NULL)
+    checkpoint->mConstantOverrides = mResumeFrom->mConstantOverrides;
+  checkpoint->mConstantOverrides.insert(checkpoint->mConstantOverrides.end(),
+                                        mConstantOverrides.begin(),
+                                        mConstantOverrides.end());
+  return checkpoint;
+}
+
+void
+CDA_CellMLIntegrationRun::finishPosition()
+{
+  CDALock l(mCommandMutex);
+  if (mPosition.voi != NULL)
+    mFinalCheckpoint = already_AddRefd<CDA_IntegrationCheckpoint>(snapshot());
+  resetPosition();
 }
 
 #define NR_RANDOM_STARTS_MAX 100000
@@ -287,8 +735,7 @@ CDA_ODESolverRun::SolveODEProblemGSL
   ei.rateSize = rateSize;
   ei.rateSizeBytes = rateSize * sizeof(double);
 
-  ei.ComputeRates = f->ComputeRates;
-  ei.ComputeVariables = f->ComputeVariables;
+  ei.functions = f;
 
   gsl_odeiv_step* s;
   gsl_odeiv_evolve* e = gsl_odeiv_evolve_alloc(rateSize);
@@ -329,29 +776,690 @@ CDA_ODESolverRun::SolveODEProblemGSL
   case iface::cellml_services::GEAR_1:
     T = gsl_odeiv_step_gear1;
     break;
-  case iface::cellml_services::GEAR_2:
+  case iface::cellml_services::GEAR_2:
+  default:
+    T = gsl_odeiv_step_gear2;
+    break;
+  }
+  s = gsl_odeiv_step_alloc(T, rateSize);
+
+  // Start the main loop...
+  double voi = mStartBvar;
+  double stepSize = initialStepSize();
+  if (stepSize <= 0.0)
+    stepSize = 1E-6;
+
+  mPosition.voi = &voi;
+  mPosition.states = states;
+  mPosition.rates = rates;
+  mPosition.rateSize = rateSize;
+  mPosition.stepSize = &stepSize;
+
+  uint32_t recsize = mRecordLayout.recordSize(rateSize, algSize);
+  ResultBuffer storage(mObserver, recsize, mResultBufferSize,
+                       mResultMaxLatency, mResultMaxPoints);
+
+  double lastVOI = 0.0 /* initialised only to avoid extraneous warning. */;
+  bool isFirst = true;
+
+  double minReportForDensity = (mStopBvar - mStartBvar) / mMaxPointDensity;
+  uint32_t tabStepNumber = 1;
+  double nextStopPoint = mTabulationStepSize + voi;
+  if (mTabulationStepSize == 0.0)
+    nextStopPoint = mStopBvar;
+
+  while (voi < mStopBvar)
+  {
+    double bhl = mStopBvar;
+    if (mStepSizeMax != 0.0 && bhl - voi > mStepSizeMax)
+      bhl = voi + mStepSizeMax;
+    if(bhl > nextStopPoint)
+      bhl = nextStopPoint;
+    if (floatsEqual(bhl, mStopBvar, tabulationRelativeTolerance))
+    {
+      nextStopPoint = mStopBvar;
+      bhl = mStopBvar;
+    }
+
+    gsl_odeiv_evolve_apply(e, c, s, &sys, &voi, bhl,
+                           &stepSize, states);
+    if (checkPauseOrCancellation())
+      break;
+
+    if (isFirst)
+      isFirst = false;
+    else if (voi - lastVOI < minReportForDensity && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+      continue;
+
+    if(mStrictTabulation && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+      continue;
+
+    if (voi==nextStopPoint)
+      nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+
+    lastVOI = voi;
+
+    // Compute the extra variables that are only computed for display
+    // purposes...
+    f->computeVariables(voi, constants, rates, states, algebraic);
+
+    // Add to storage...
+    mRecordLayout.write(storage.nextRecord(), voi, constants, states, rates,
+                        algebraic, rateSize, algSize);
+    // Are we ready to send?
+    if (storage.addRecord())
+      storage.flush();
+  }
+  finishPosition();
+  storage.flush();
+  if (mObserver != NULL)
+    mObserver->done();
+
+  // Free gsl structures...
+  gsl_odeiv_evolve_free(e);
+  gsl_odeiv_control_free(c);
+  gsl_odeiv_step_free(s);
+}
+#endif
+
+void
+cda_cvode_error_handler(int error_code, const char* module,
+                        const char* function, char* msg, void* eh_data)
+{
+  struct fail_info* failInfo = reinterpret_cast<struct fail_info*>(eh_data);
+  setFailure(failInfo, msg, -1);
+}
+
+void
+cda_ida_error_handler(int error_code, const char* module,
+                        const char* function, char* msg, void* eh_data)
+{
+  setFailure(reinterpret_cast<struct fail_info*>(eh_data), msg, -1);
+}
+
+// Decides when a run has reached a steady state: either once every rate is
+// small, or for a periodic model, once the states at the start of a period
+// are close to those a period earlier. Each difference is scaled by one plus
+// the magnitude of its state, so the tolerance is relative for large states
+// and absolute for small ones.
+class SteadyStateMonitor
+{
+public:
+  SteadyStateMonitor(double aTolerance, double aPeriod, double aStart,
+                     uint32_t aRateSize)
+    : mTolerance(aTolerance), mPeriod(aPeriod), mStart(aStart),
+      mRateSize(aRateSize), mCycle(1), mHavePrevious(false)
+  {
+    if (mPeriod != 0.0)
+      mPrevious.resize(aRateSize);
+  }
+
+  bool isEnabled() const
+  {
+    return mTolerance != 0.0;
+  }
+
+  // Only the rate test needs the rates to be up to date.
+  bool needsRates() const
+  {
+    return mPeriod == 0.0;
+  }
+
+  // Limits the end of a step so that steps end at the start of each period.
+  double limit(double aEnd) const
+  {
+    if (mTolerance == 0.0 || mPeriod == 0.0)
+      return aEnd;
+    double periodEnd = mStart + mCycle * mPeriod;
+    return aEnd > periodEnd ? periodEnd : aEnd;
+  }
+
+  bool isSteady(double aVOI, const double* aStates, const double* aRates)
+  {
+    if (mPeriod == 0.0)
+    {
+      for (uint32_t i = 0; i < mRateSize; i++)
+        if (fabs(aRates[i]) > mTolerance * (1.0 + fabs(aStates[i])))
+          return false;
+      return true;
+    }
+
+    double periodEnd = mStart + mCycle * mPeriod;
+    if (aVOI < periodEnd &&
+        !floatsEqual(aVOI, periodEnd, tabulationRelativeTolerance))
+      return false;
+    mCycle++;
+
+    bool isSteady = mHavePrevious;
+    for (uint32_t i = 0; i < mRateSize; i++)
+    {
+      if (isSteady &&
+          fabs(aStates[i] - mPrevious[i]) > mTolerance * (1.0 + fabs(aStates[i])))
+        isSteady = false;
+      mPrevious[i] = aStates[i];
+    }
+    mHavePrevious = true;
+    return isSteady;
+  }
+
+private:
+  double mTolerance, mPeriod, mStart;
+  uint32_t mRateSize, mCycle;
+  std::vector<double> mPrevious;
+  bool mHavePrevious;
+};
+
+// The memory CVODE needs to integrate a model, and the results of working
+// out how to solve its linear systems.
+class CVODEWorkspace
+  : public SolverWorkspace
+{
+public:
+  CVODEWorkspace(const std::vector<uint32_t>& aSetup)
+    : SolverWorkspace(aSetup), solver(NULL), y(NULL), upper(0), lower(0),
+      preconditioner(NULL), ring(NULL)
+  {
+  }
+
+  ~CVODEWorkspace()
+  {
+    if (solver != NULL)
+      CVodeFree(&solver);
+    if (y != NULL)
+      N_VDestroy(y);
+    delete preconditioner;
+    if (ring != NULL)
+      ring->release_ref();
+  }
+
+  void keepRing(ResultRing* aRing)
+  {
+    aRing->add_ref();
+    if (ring != NULL)
+      ring->release_ref();
+    ring = aRing;
+  }
+
+  void* solver;
+  N_Vector y;
+  iface::cellml_services::LinearSolverType linearSolver;
+  std::vector<uint32_t> order, position;
+  uint32_t upper, lower;
+  std::vector<double> orderedStates, jacobianValues;
+  BlockPreconditioner* preconditioner;
+  ResultRing* ring;
+};
+
+void
+CDA_ODESolverRun::SolveODEProblemCVODE
+(
+ CompiledModelFunctions* f, uint32_t constSize,
+ double* constants, uint32_t rateSize, double* rates,
+ double* states, uint32_t algSize, double* algebraic
+)
+{
+  EvaluationInformation ei;
+
+  // Sensitivities are integrated along with the states, in a system holding
+  // the states followed by their sensitivities to each parameter in turn.
+  uint32_t sensitivityCount = f->sensitivityParameters.size();
+  uint32_t systemSize = rateSize * (1 + sensitivityCount);
+
+  // Everything set up below depends only on these, so a workspace left by an
+  // earlier run with the same settings can be used again as it is.
+  std::vector<uint32_t> setup;
+  setup.push_back(mStepType);
+  setup.push_back(mLinearSolver);
+  setup.push_back(rateSize);
+  setup.push_back(f->ComputeJacobian != NULL);
+  setup.push_back(sensitivityCount);
+  CVODEWorkspace* ws =
+    static_cast<CVODEWorkspace*>(mModel->mWorkspaces.take(setup));
+  bool isNewWorkspace = (ws == NULL);
+  if (isNewWorkspace)
+    ws = new CVODEWorkspace(setup);
+
+  // Work out how the linear systems in implicit steps will be solved. The
+  // banded solver works best with the states reordered to narrow the band.
+  std::vector<uint32_t>& order = ws->order, & position = ws->position;
+  uint32_t& upper = ws->upper, & lower = ws->lower;
+  if (isNewWorkspace)
+  {
+    ws->linearSolver = mLinearSolver;
+    iface::cellml_services::LinearSolverType& linearSolver = ws->linearSolver;
+    if (sensitivityCount != 0)
+    {
+      // The system is larger than the states, so the solver needs a copy of
+      // them, which is kept in their original order. Its Jacobian is
+      // approximated by blocks along the diagonal, which fit in a band. Models
+      // with sensitivities can always be differentiated.
+      order.resize(rateSize);
+      for (uint32_t k = 0; k < rateSize; k++)
+        order[k] = k;
+      if (mStepType == iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE &&
+          rateSize != 0)
+      {
+        linearSolver = iface::cellml_services::BANDED_LINEAR_SOLVER;
+        upper = lower = rateSize - 1;
+      }
+    }
+    else if (mStepType == iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE &&
+             rateSize != 0)
+    {
+      if (f->ComputeJacobian == NULL)
+      {
+        if (linearSolver != iface::cellml_services::KRYLOV_LINEAR_SOLVER)
+          linearSolver = iface::cellml_services::DENSE_LINEAR_SOLVER;
+      }
+      else if (linearSolver == iface::cellml_services::AUTOMATIC_LINEAR_SOLVER ||
+               linearSolver == iface::cellml_services::BANDED_LINEAR_SOLVER)
+      {
+        // order is still empty, so this measures the original order.
+        MeasureBandwidth(f->jacobianPattern, order, upper, lower);
+        ReduceBandwidth(rateSize, f->jacobianPattern, order);
+        uint32_t orderedUpper, orderedLower;
+        MeasureBandwidth(f->jacobianPattern, order, orderedUpper, orderedLower);
+        if (orderedUpper + orderedLower < upper + lower)
+        {
+          upper = orderedUpper;
+          lower = orderedLower;
+        }
+        else
+          order.clear();
+
+        // Banded LU factorisation takes about 2 n lower (upper + lower)
+        // operations, and dense factorisation about 2 n^3 / 3.
+        if (linearSolver == iface::cellml_services::AUTOMATIC_LINEAR_SOLVER)
+          linearSolver = (3 * lower * (upper + lower) < rateSize * rateSize) ?
+            iface::cellml_services::BANDED_LINEAR_SOLVER :
+            iface::cellml_services::DENSE_LINEAR_SOLVER;
+        if (linearSolver != iface::cellml_services::BANDED_LINEAR_SOLVER)
+          order.clear();
+      }
+    }
+
+    if (!order.empty())
+    {
+      position.resize(rateSize);
+      ws->orderedStates.resize(systemSize);
+      for (uint32_t k = 0; k < rateSize; k++)
+        position[order[k]] = k;
+    }
+    ws->jacobianValues.resize(f->jacobianPattern.size());
+  }
+
+  // If the states are reordered, the solver gets its own copy of them.
+  N_Vector& y = ws->y;
+  double* solverStates = states;
+  if (!order.empty())
+  {
+    for (uint32_t k = 0; k < rateSize; k++)
+      ws->orderedStates[k] = states[order[k]];
+    ei.order = &order[0];
+    ei.position = &position[0];
+    solverStates = &ws->orderedStates[0];
+  }
+  if (sensitivityCount != 0 && rateSize != 0)
+    memcpy(solverStates + rateSize, &mSensitivities[0],
+           rateSize * sensitivityCount * sizeof(double));
+  if (rateSize != 0)
+  {
+    if (y == NULL)
+      y = N_VMake_Serial(systemSize, solverStates);
+    else
+      N_VSetArrayPointer_Serial(solverStates, y);
+  }
+  void*& solver = ws->solver;
+  struct fail_info failInfo;
+
+  if (rateSize != 0 && solver == NULL)
+  {
+    switch (mStepType)
+    {
+    case iface::cellml_services::ADAMS_MOULTON_1_12:
+      solver = CVodeCreate(CV_ADAMS, CV_FUNCTIONAL);
+      break;
+    case iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE:
+    default:
+      solver = CVodeCreate(CV_BDF, CV_NEWTON);
+      break;
+    }
+
+    CVodeSetErrHandlerFn(solver, cda_cvode_error_handler, &failInfo);
+    CVodeInit(solver, EvaluateRatesCVODE, mStartBvar, y);
+    if (mStepType == iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE)
+    {
+      switch (ws->linearSolver)
+      {
+      case iface::cellml_services::BANDED_LINEAR_SOLVER:
+        CVBand(solver, systemSize, upper, lower);
+        CVDlsSetBandJacFn(solver, EvaluateBandJacobianCVODE);
+        break;
+      case iface::cellml_services::KRYLOV_LINEAR_SOLVER:
+        if (f->ComputeJacobian != NULL)
+        {
+          ws->preconditioner =
+            new BlockPreconditioner(rateSize, f->jacobianPattern,
+                                    PRECONDITIONER_BLOCK_SIZE);
+          CVSpgmr(solver, PREC_LEFT, 0);
+          CVSpilsSetPreconditioner(solver, SetupPreconditionerCVODE,
+                                   SolvePreconditionerCVODE);
+        }
+        else
+          CVSpgmr(solver, PREC_NONE, 0);
+        break;
+      default:
+        CVDense(solver, rateSize);
+        if (f->ComputeJacobian != NULL)
+          CVDlsSetDenseJacFn(solver, EvaluateJacobianCVODE);
+        break;
+      }
+    }
+  }
+  else if (rateSize != 0)
+  {
+    // The linear solver stays attached, and is set up again on the first
+    // step after CVodeReInit.
+    CVodeSetErrHandlerFn(solver, cda_cvode_error_handler, &failInfo);
+    CVodeReInit(solver, mStartBvar, y);
+  }
+
+  ei.failInfo = &failInfo;
+  if (!ws->jacobianValues.empty())
+    ei.jacobianValues = &ws->jacobianValues[0];
+  ei.jacobianPattern = &f->jacobianPattern;
+  ei.preconditioner = ws->preconditioner;
+
+  if (rateSize != 0)
+  {
+    CVodeSStolerances(solver, mEpsRel, mEpsAbs);
+    CVodeSetUserData(solver, &ei);
+    // This is kept by a pooled solver, so must be reset when not resuming.
+    CVodeSetInitStep(solver, initialStepSize());
+  }
+
+  ei.constants = constants;
+  ei.states = states;
+  ei.rates = rates;
+  ei.algebraic = algebraic;
+  ei.rateSize = rateSize;
+  ei.rateSizeBytes = rateSize * sizeof(double);
+  ei.functions = f;
+  ei.ComputeJacobian = f->ComputeJacobian;
+
+  std::vector<double> sensitivityValues(f->sensitivityPattern.size() + 1);
+  double* sensitivities = NULL;
+  if (sensitivityCount != 0 && rateSize != 0)
+  {
+    ei.sensitivityCount = sensitivityCount;
+    if (!mConstantSensitivities.empty())
+      ei.constantSensitivities = &mConstantSensitivities[0];
+    ei.sensitivityValues = &sensitivityValues[0];
+    sensitivities = solverStates + rateSize;
+  }
+
+  uint32_t recsize = mRecordLayout.recordSize(rateSize, algSize);
+  ResultBuffer storage(mObserver, recsize, mResultBufferSize,
+                       mResultMaxLatency, mResultMaxPoints, ws->ring);
+  ws->keepRing(storage.ring());
+  OutputEvaluation outputs(f, mRecordLayout);
+
+  double voi = mStartBvar;
+  double lastVOI = 0.0 /* initialised only to avoid extraneous warning. */;
+  bool isFirst = true;
+
+  double minReportForDensity = (mStopBvar - mStartBvar) / mMaxPointDensity;
+  uint32_t tabStepNumber = 1;
+  double nextStopPoint = mTabulationStepSize + voi;
+
+  if (mTabulationStepSize == 0.0)
+    nextStopPoint = mStopBvar;
+
+  // When interpolating, the solver steps past the tabulation points instead
+  // of stopping at them, and they are recorded from its interpolant.
+  bool interpolate = mInterpolateTabulation && mTabulationStepSize != 0.0 &&
+    rateSize != 0;
+  TabulationPoints tabulation(mStartBvar,
+                              interpolate ? mTabulationStepSize : 0.0,
+                              mStopBvar);
+  std::vector<double> tabRates, tabStates, tabAlgebraic;
+  N_Vector dky = NULL;
+  if (interpolate)
+  {
+    tabRates.resize(rateSize);
+    tabStates.resize(rateSize);
+    tabAlgebraic.resize(algSize);
+    dky = N_VNew_Serial(systemSize);
+  }
+  double* tabAlgebraicValues = tabAlgebraic.empty() ? NULL : &tabAlgebraic[0];
+
+  SteadyStateMonitor steadyState(mSteadyStateTolerance, mSteadyStatePeriod,
+                                 mStartBvar, rateSize);
+
+  mPosition.voi = &voi;
+  mPosition.states = states;
+  mPosition.rates = rates;
+  mPosition.rateSize = rateSize;
+  mPosition.cvode = solver;
+  if (ei.order != NULL)
+  {
+    mPosition.orderedStates = solverStates;
+    mPosition.order = ei.order;
+  }
+
+  if (rateSize != 0)
+  {
+    while (voi < mStopBvar)
+    {
+      double bhl = mStopBvar;
+      if (mStepSizeMax != 0.0 && bhl - voi > mStepSizeMax)
+        bhl = voi + mStepSizeMax;
+      if(!interpolate && bhl > nextStopPoint)
+        bhl = nextStopPoint;
+      bhl = steadyState.limit(bhl);
+
+      CVodeSetStopTime(solver, bhl);
+      if (CVode(solver, bhl, y, &voi, CV_ONE_STEP) < 0)
+      {
+        if (!failInfo.failtype)
+          setFailure(&failInfo, "CVODE failure", -1);
+        break;
+      }
+
+      if (checkPauseOrCancellation())
+        break;
+
+      // If the model was being interpreted while it was compiled, switch to
+      // the compiled code as soon as it is ready. The solver keeps the setup
+      // it was given for the interpreted model.
+      f = mModel->functions();
+      ei.functions = f;
+
+      // Record the tabulation points the step went past. A point the step
+      // ended on exactly is recorded with the step, unless only tabulation
+      // points are.
+      double point;
+      while (!mFinalStateOnly &&
+             tabulation.next(voi, mStrictTabulation, point))
+      {
+        CVodeGetDky(solver, point, 0, dky);
+        double* values = NV_DATA_S(dky);
+        for (uint32_t k = 0; k < rateSize; k++)
+          tabStates[ei.order == NULL ? k : order[k]] = values[k];
+
+        outputs.evaluate(f, point, constants, &tabRates[0], &tabStates[0],
+                         tabAlgebraicValues, &failInfo);
+        mRecordLayout.write(storage.nextRecord(), point, constants,
+                            &tabStates[0], &tabRates[0], tabAlgebraicValues,
+                            rateSize, algSize,
+                            sensitivities == NULL ? NULL : values + rateSize);
+        if (storage.addRecord())
+          storage.flush();
+      }
+
+      bool isSteady = false;
+      if (steadyState.isEnabled())
+      {
+        if (ei.order != NULL)
+          for (uint32_t k = 0; k < rateSize; k++)
+            states[order[k]] = NV_Ith_S(y, k);
+        // The rates were last evaluated wherever the solver needed them.
+        if (steadyState.needsRates())
+          f->computeRates(voi, constants, rates, states, algebraic, &failInfo);
+        isSteady = steadyState.isSteady(voi, states, rates);
+      }
+
+      // The state the run stops at is always recorded, and when only the
+      // final state is wanted, nothing else is.
+      if (mFinalStateOnly)
+      {
+        if (!isSteady && voi < mStopBvar)
+        {
+          if (voi==nextStopPoint)
+            nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+          continue;
+        }
+      }
+      else if (interpolate && !isSteady)
+      {
+        if (mStrictTabulation)
+          continue;
+        if (!tabulation.skip(voi) && !isFirst &&
+            voi - lastVOI < minReportForDensity)
+          continue;
+
+        isFirst = false;
+        lastVOI = voi;
+      }
+      else if (!isSteady)
+      {
+        if (isFirst)
+          isFirst = false;
+        else if (voi - lastVOI < minReportForDensity && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+          continue;
+
+        if(mStrictTabulation && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+          continue;
+
+        if (voi==nextStopPoint)
+          nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+
+        lastVOI = voi;
+      }
+
+      if (ei.order != NULL)
+        for (uint32_t k = 0; k < rateSize; k++)
+          states[order[k]] = NV_Ith_S(y, k);
+
+      outputs.evaluate(f, voi, constants, rates, states, algebraic, &failInfo);
+
+      // Add to storage...
+      mRecordLayout.write(storage.nextRecord(), voi, constants, states, rates,
+                          algebraic, rateSize, algSize, sensitivities);
+      // Are we ready to send?
+      if (storage.addRecord())
+        storage.flush();
+
+      if (isSteady)
+        break;
+    }
+  }
+  if (dky != NULL)
+    N_VDestroy(dky);
+  finishPosition();
+  storage.flush();
+  if (mObserver != NULL)
+  {
+    if (failInfo.failtype)
+      mObserver->failed(failInfo.failmsg);
+    else
+      mObserver->done();
+  }
+
+  // A solver which failed may be left in a state that a later run shouldn't
+  // inherit.
+  if (failInfo.failtype)
+    delete ws;
+  else
+    mModel->mWorkspaces.give(ws);
+}
+
+void
+CDA_ODESolverRun::SolveODEProblemCVODEBatch
+(
+ CompiledModelFunctions* f, uint32_t count,
+ iface::cellml_services::IntegrationProgressObserver** observers,
+ uint32_t constSize, double* constants, uint32_t rateSize,
+ double* states, uint32_t algSize
+)
+{
+  uint32_t systemSize = count * rateSize;
+  N_Vector y = N_VMake_Serial(systemSize, states);
+  void* solver;
+  struct fail_info failInfo;
+
+  switch (mStepType)
+  {
+  case iface::cellml_services::ADAMS_MOULTON_1_12:
+    solver = CVodeCreate(CV_ADAMS, CV_FUNCTIONAL);
+    break;
+  case iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE:
   default:
-    T = gsl_odeiv_step_gear2;
+    solver = CVodeCreate(CV_BDF, CV_NEWTON);
     break;
   }
-  s = gsl_odeiv_step_alloc(T, rateSize);
-
-  // Start the main loop...
-  double voi = mStartBvar;
-  double stepSize = 1E-6;
 
-  uint32_t recsize = rateSize * 2 + algSize + 1;
-  uint32_t storageCapacity = (VARIABLE_STORAGE_LIMIT / recsize) * recsize;
-  double* storage = new double[storageCapacity];
-  uint32_t storageExpiry = time(0) + VARIABLE_TIME_LIMIT;
-  uint32_t storageSize = 0;
+  CVodeSetErrHandlerFn(solver, cda_cvode_error_handler, &failInfo);
+
+  std::vector<double> batchConstants(count * constSize),
+    batchRates(systemSize), batchStates(systemSize),
+    batchAlgebraic(count * algSize);
+  uint32_t i, k;
+  for (k = 0; k < count; k++)
+    for (i = 0; i < constSize; i++)
+      batchConstants[i * count + k] = constants[k * constSize + i];
+
+  BatchEvaluationInformation bei;
+  bei.count = count;
+  bei.rateSize = rateSize;
+  // &v[0] is undefined for an empty vector, and empty arrays are never
+  // indexed by the model code anyway.
+  bei.constants = constSize == 0 ? NULL : &batchConstants[0];
+  bei.rates = &batchRates[0];
+  bei.states = &batchStates[0];
+  bei.algebraic = algSize == 0 ? NULL : &batchAlgebraic[0];
+  bei.failInfo = &failInfo;
+  bei.ComputeRatesBatch = f->ComputeRatesBatch;
+
+  CVodeInit(solver, EvaluateRatesBatchCVODE, mStartBvar, y);
+  CVodeSStolerances(solver, mEpsRel, mEpsAbs);
+  // Instances don't affect each other, so a band covering one instance's
+  // states holds the whole Jacobian, and costs time linear in the group size.
+  if (mStepType == iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE)
+    CVBand(solver, systemSize, rateSize - 1, rateSize - 1);
+  CVodeSetUserData(solver, &bei);
+
+  // Results are stored separately for each instance, sharing the buffer size
+  // between them.
+  uint32_t recsize = mRecordLayout.recordSize(rateSize, algSize);
+  std::vector<ResultBuffer*> storage(count);
+  for (k = 0; k < count; k++)
+    storage[k] = new ResultBuffer(observers[k], recsize,
+                                  mResultBufferSize / count,
+                                  mResultMaxLatency, mResultMaxPoints);
+  OutputEvaluation outputs(f, mRecordLayout);
+  std::vector<double> recValues(2 * rateSize + algSize);
+  double* recStates = &recValues[0], * recRates = recStates + rateSize,
+    * recAlgebraic = recRates + rateSize;
 
+  double voi = mStartBvar;
   double lastVOI = 0.0 /* initialised only to avoid extraneous warning. */;
   bool isFirst = true;
 
   double minReportForDensity = (mStopBvar - mStartBvar) / mMaxPointDensity;
   uint32_t tabStepNumber = 1;
   double nextStopPoint = mTabulationStepSize + voi;
+
   if (mTabulationStepSize == 0.0)
     nextStopPoint = mStopBvar;
 
@@ -362,14 +1470,15 @@ CDA_ODESolverRun::SolveODEProblemGSL
       bhl = voi + mStepSizeMax;
     if(bhl > nextStopPoint)
       bhl = nextStopPoint;
-    if (floatsEqual(bhl, mStopBvar, tabulationRelativeTolerance))
+
+    CVodeSetStopTime(solver, bhl);
+    if (CVode(solver, bhl, y, &voi, CV_ONE_STEP) < 0)
     {
-      nextStopPoint = mStopBvar;
-      bhl = mStopBvar;
+      if (!failInfo.failtype)
+        setFailure(&failInfo, "CVODE failure", -1);
+      break;
     }
 
-    gsl_odeiv_evolve_apply(e, c, s, &sys, &voi, bhl,
-                           &stepSize, states);
     if (checkPauseOrCancellation())
       break;
 
@@ -386,117 +1495,66 @@ CDA_ODESolverRun::SolveODEProblemGSL
 
     lastVOI = voi;
 
-    // Compute the extra variables that are only computed for display
-    // purposes...
-    f->ComputeVariables(voi, constants, rates, states, algebraic);
-
-    // Add to storage...
-    storage[storageSize] = voi;
-    memcpy(storage + storageSize + 1, states, rateSize * sizeof(double));
-    memcpy(storage + storageSize + 1 + rateSize, rates,
-           rateSize * sizeof(double));
-    memcpy(storage + storageSize + 1 + rateSize * 2, algebraic,
-           algSize * sizeof(double));
-
-    storageSize += recsize;
-
-    // Are we ready to send?
-    uint32_t timeNow = time(0);
-    if (timeNow >= storageExpiry || storageSize == storageCapacity)
+    // The algebraic variables for output are computed one instance at a time,
+    // since they aren't needed at every step.
+    for (k = 0; k < count; k++)
     {
-      if (mObserver != NULL)
-        mObserver->results(storageSize, storage);
-      storageExpiry = timeNow + VARIABLE_TIME_LIMIT;
-      storageSize = 0;
+      memcpy(recStates, states + k * rateSize, rateSize * sizeof(double));
+      outputs.evaluate(f, voi, constants + k * constSize, recRates, recStates,
+                       recAlgebraic, &failInfo);
+      mRecordLayout.write(storage[k]->nextRecord(), voi,
+                          constants + k * constSize, recStates, recRates,
+                          recAlgebraic, rateSize, algSize);
+
+      // Are we ready to send?
+      if (storage[k]->addRecord())
+        storage[k]->flush();
     }
   }
-  if (storageSize != 0 && mObserver != NULL)
+
+  for (k = 0; k < count; k++)
   {
-    mObserver->results(storageSize, storage);
+    storage[k]->flush();
+    delete storage[k];
+    if (observers[k] == NULL)
+      continue;
+    if (failInfo.failtype)
+      observers[k]->failed(failInfo.failmsg);
+    else
+      observers[k]->done();
   }
-  if (mObserver != NULL)
-    mObserver->done();
-
-  delete [] storage;
-
-  // Free gsl structures...
-  gsl_odeiv_evolve_free(e);
-  gsl_odeiv_control_free(c);
-  gsl_odeiv_step_free(s);
-}
-#endif
 
-void
-cda_cvode_error_handler(int error_code, const char* module,
-                        const char* function, char* msg, void* eh_data)
-{
-  struct fail_info* failInfo = reinterpret_cast<struct fail_info*>(eh_data);
-  setFailure(failInfo, msg, -1);
+  CVodeFree(&solver);
+  N_VDestroy(y);
 }
 
-void
-cda_ida_error_handler(int error_code, const char* module,
-                        const char* function, char* msg, void* eh_data)
-{
-  setFailure(reinterpret_cast<struct fail_info*>(eh_data), msg, -1);
-}
+// Below this, exp(x) - 1 loses too much precision to be worth using.
+#define RUSH_LARSEN_MIN_EXPONENT 1E-6
 
 void
-CDA_ODESolverRun::SolveODEProblemCVODE
+CDA_ODESolverRun::SolveODEProblemRushLarsen
 (
  CompiledModelFunctions* f, uint32_t constSize,
  double* constants, uint32_t rateSize, double* rates,
  double* states, uint32_t algSize, double* algebraic
 )
 {
-  N_Vector y = NULL;
-  if (rateSize != 0)
-    y = N_VMake_Serial(rateSize, states);
-  void* solver = NULL;
   struct fail_info failInfo;
 
-  if (rateSize != 0)
-  {
-    switch (mStepType)
-    {
-    case iface::cellml_services::ADAMS_MOULTON_1_12:
-      solver = CVodeCreate(CV_ADAMS, CV_FUNCTIONAL);
-      break;
-    case iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE:
-    default:
-      solver = CVodeCreate(CV_BDF, CV_NEWTON);
-      break;
-    }
-
-    CVodeSetErrHandlerFn(solver, cda_cvode_error_handler, &failInfo);
-  }
-
-  EvaluationInformation ei;
-  ei.failInfo = &failInfo;
-
-  if (rateSize != 0)
+  // The steps are fixed, and no smaller than they need to be to tabulate.
+  double stepSize = mStepSizeMax;
+  if (stepSize <= 0.0)
   {
-    CVodeInit(solver, EvaluateRatesCVODE, mStartBvar, y);
-    CVodeSStolerances(solver, mEpsRel, mEpsAbs);
-    if (mStepType == iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE)
-      CVDense(solver, rateSize);
-    CVodeSetUserData(solver, &ei);
+    if (mObserver != NULL)
+      mObserver->failed("RUSH_LARSEN needs a maximum step size to step by");
+    return;
   }
 
-  ei.constants = constants;
-  ei.states = states;
-  ei.rates = rates;
-  ei.algebraic = algebraic;
-  ei.rateSize = rateSize;
-  ei.rateSizeBytes = rateSize * sizeof(double);
-  ei.ComputeRates = f->ComputeRates;
-  ei.ComputeVariables = f->ComputeVariables;
-
-  uint32_t recsize = rateSize * 2 + algSize + 1;
-  uint32_t storageCapacity = (VARIABLE_STORAGE_LIMIT / recsize) * recsize;
-  double* storage = new double[storageCapacity];
-  uint32_t storageExpiry = (uint32_t) time(0) + VARIABLE_TIME_LIMIT;
-  uint32_t storageSize = 0;
+  uint32_t recsize = mRecordLayout.recordSize(rateSize, algSize);
+  ResultBuffer storage(mObserver, recsize, mResultBufferSize,
+                       mResultMaxLatency, mResultMaxPoints);
+  OutputEvaluation outputs(f, mRecordLayout);
+  std::vector<double> jacobian, increments(rateSize);
 
   double voi = mStartBvar;
   double lastVOI = 0.0 /* initialised only to avoid extraneous warning. */;
@@ -505,31 +1563,93 @@ CDA_ODESolverRun::SolveODEProblemCVODE
   double minReportForDensity = (mStopBvar - mStartBvar) / mMaxPointDensity;
   uint32_t tabStepNumber = 1;
   double nextStopPoint = mTabulationStepSize + voi;
-
   if (mTabulationStepSize == 0.0)
     nextStopPoint = mStopBvar;
 
-  if (rateSize != 0)
+  SteadyStateMonitor steadyState(mSteadyStateTolerance, mSteadyStatePeriod,
+                                 mStartBvar, rateSize);
+
+  mPosition.voi = &voi;
+  mPosition.states = states;
+  mPosition.rates = rates;
+  mPosition.rateSize = rateSize;
+  mPosition.stepSize = &stepSize;
+
+  while (voi < mStopBvar)
   {
-    while (voi < mStopBvar)
+    double bhl = voi + stepSize;
+    if (bhl > mStopBvar)
+      bhl = mStopBvar;
+    if(bhl > nextStopPoint)
+      bhl = nextStopPoint;
+    bhl = steadyState.limit(bhl);
+    if (floatsEqual(bhl, mStopBvar, tabulationRelativeTolerance))
     {
-      double bhl = mStopBvar;
-      if (mStepSizeMax != 0.0 && bhl - voi > mStepSizeMax)
-        bhl = voi + mStepSizeMax;
-      if(bhl > nextStopPoint)
-        bhl = nextStopPoint;
+      nextStopPoint = mStopBvar;
+      bhl = mStopBvar;
+    }
+    double h = bhl - voi;
 
-      CVodeSetStopTime(solver, bhl);
-      if (CVode(solver, bhl, y, &voi, CV_ONE_STEP) < 0)
+    // If the model was being interpreted while it was compiled, switch to
+    // the compiled code as soon as it is ready.
+    f = mModel->functions();
+
+    // States whose rates are linear in themselves, dy/dt = a + b * y, are
+    // stepped exactly for a and b frozen over the step, and the others by
+    // forward Euler.
+    const JacobianPattern& pattern = f->gatingPattern;
+    if (f->ComputeGatingJacobian != NULL)
+    {
+      jacobian.resize(pattern.size());
+      f->ComputeGatingJacobian(voi, constants, rates, states, algebraic,
+                               &jacobian[0], &failInfo);
+    }
+    else
+      f->computeRates(voi, constants, rates, states, algebraic, &failInfo);
+    if (failInfo.failtype)
+      break;
+
+    for (uint32_t i = 0; i < rateSize; i++)
+      increments[i] = h * rates[i];
+    if (f->ComputeGatingJacobian != NULL)
+      for (uint32_t k = 0; k < pattern.size(); k++)
       {
-        if (!failInfo.failtype)
-          setFailure(&failInfo, "CVODE failure", -1);
-        break;
+        // The exact increment is rate * (exp(b * h) - 1) / b.
+        double bh = jacobian[k] * h;
+        if (fabs(bh) > RUSH_LARSEN_MIN_EXPONENT)
+          increments[pattern[k].first] *= (exp(bh) - 1.0) / bh;
+        else
+          increments[pattern[k].first] *= 1.0 + bh * (0.5 + bh / 6.0);
       }
+    for (uint32_t i = 0; i < rateSize; i++)
+      states[i] += increments[i];
+    voi = bhl;
 
-      if (checkPauseOrCancellation())
-        break;
+    if (checkPauseOrCancellation())
+      break;
+
+    bool isSteady = false;
+    if (steadyState.isEnabled())
+    {
+      // The rates were last evaluated at the start of the step.
+      if (steadyState.needsRates())
+        f->computeRates(voi, constants, rates, states, algebraic, &failInfo);
+      isSteady = steadyState.isSteady(voi, states, rates);
+    }
 
+    // The state the run stops at is always recorded, and when only the
+    // final state is wanted, nothing else is.
+    if (mFinalStateOnly)
+    {
+      if (!isSteady && voi < mStopBvar)
+      {
+        if (voi==nextStopPoint)
+          nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+        continue;
+      }
+    }
+    else if (!isSteady)
+    {
       if (isFirst)
         isFirst = false;
       else if (voi - lastVOI < minReportForDensity && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
@@ -542,54 +1662,29 @@ CDA_ODESolverRun::SolveODEProblemCVODE
         nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
 
       lastVOI = voi;
+    }
 
-      f->    ComputeRates(voi, constants, rates, states, algebraic, &failInfo);
-      f->ComputeVariables(voi, constants, rates, states, algebraic, &failInfo);
-
-      // Add to storage...
-      storage[storageSize] = voi;
-      memcpy(storage + storageSize + 1, states, rateSize * sizeof(double));
-      memcpy(storage + storageSize + 1 + rateSize, rates,
-             rateSize * sizeof(double));
-      memcpy(storage + storageSize + 1 + rateSize * 2, algebraic,
-             algSize * sizeof(double));
+    outputs.evaluate(f, voi, constants, rates, states, algebraic, &failInfo);
 
-      storageSize += recsize;
+    // Add to storage...
+    mRecordLayout.write(storage.nextRecord(), voi, constants, states, rates,
+                        algebraic, rateSize, algSize);
+    // Are we ready to send?
+    if (storage.addRecord())
+      storage.flush();
 
-      // Are we ready to send?
-      uint32_t timeNow = (uint32_t) time(0);
-      if (timeNow >= storageExpiry || storageSize == storageCapacity)
-      {
-        if (mObserver != NULL)
-        {
-          std::vector<double> resultsVector(storage, storage + storageSize);
-          mObserver->results(resultsVector);
-        }
-        storageExpiry = timeNow + VARIABLE_TIME_LIMIT;
-        storageSize = 0;
-      }
-    }
-  }
-  if (storageSize != 0 && mObserver != NULL)
-  {
-    std::vector<double> resultsVector(storage, storage + storageSize);
-    mObserver->results(resultsVector);
+    if (isSteady)
+      break;
   }
+  finishPosition();
+  storage.flush();
   if (mObserver != NULL)
   {
     if (failInfo.failtype)
-      mObserver->failed(failInfo.failmsg);
+      mObserver->failed(failInfo.failmsg.c_str());
     else
       mObserver->done();
   }
-
-  delete [] storage;
-
-  if (rateSize != 0)
-  {
-    CVodeFree(&solver);
-    N_VDestroy(y);
-  }
 }
 
 #ifdef DEBUG_MODE
@@ -612,6 +1707,9 @@ CDA_ODESolverRun::SolveODEProblem
       mStepType == iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE)
     SolveODEProblemCVODE(f, constSize, constants, rateSize, rates, states,
                          algSize, algebraic);
+  else if (mStepType == iface::cellml_services::RUSH_LARSEN)
+    SolveODEProblemRushLarsen(f, constSize, constants, rateSize, rates,
+                              states, algSize, algebraic);
   else
 #ifdef ENABLE_GSL_INTEGRATORS
     SolveODEProblemGSL(f, constSize, constants, rateSize, rates, states,
@@ -1012,6 +2110,14 @@ struct DAEEvaluationInformation
   void (*EvaluateVariables)(double VOI, double* CONSTANTS, double* RATES,
                             double* STATES, double* ALGEBRAIC, double* CONDVAR,
                             struct fail_info* failInfo);
+  void (*ComputeResidualJacobian)(double VOI, double cj, double* CONSTANTS,
+                                  double* RATES, double* OLDRATES,
+                                  double* STATES, double* OLDSTATES,
+                                  double* ALGEBRAIC, double* CONDVAR,
+                                  double* resids, double* JACOBIAN,
+                                  struct fail_info* failInfo);
+  const JacobianPattern* jacobianPattern;
+  double* jacobianValues;
   struct fail_info* failInfo;
 
   ~DAEEvaluationInformation()
@@ -1045,6 +2151,36 @@ ida_resfn(double t, N_Vector yy, N_Vector yp, N_Vector resval, void* userdata)
   return d->failInfo->failtype;
 }
 
+static int
+ida_jacfn(long int N, realtype t, realtype cj, N_Vector yy, N_Vector yp,
+          N_Vector resval, DlsMat jac, void* userdata,
+          N_Vector tmp1, N_Vector tmp2, N_Vector tmp3)
+{
+  DAEEvaluationInformation * d = reinterpret_cast<DAEEvaluationInformation*>(userdata);
+  // The generated code recomputes the residuals as it goes, so give it scratch
+  // space rather than clobbering the ones IDA passed in.
+  d->ComputeResidualJacobian(t, cj, d->constants, N_VGetArrayPointer(yp),
+                             d->oldrates, N_VGetArrayPointer(yy),
+                             d->oldstates, d->algebraic, d->condvars,
+                             N_VGetArrayPointer(tmp1), d->jacobianValues,
+                             d->failInfo);
+  if (d->failInfo->failtype == 0)
+  {
+    // IDA has already zeroed the rest of the matrix.
+    const JacobianPattern& pattern = *d->jacobianPattern;
+    for (uint32_t i = 0; i < pattern.size(); i++)
+    {
+      double value = d->jacobianValues[i];
+      if (!(value < 1E200)) // Clip the data to deal with NaN / inf / -inf.
+        value = 1E200;
+      else if (!(value > -1E200))
+        value = -1E200;
+      DENSE_ELEM(jac, pattern[i].first, pattern[i].second) = value;
+    }
+  }
+  return d->failInfo->failtype;
+}
+
 static int
 ida_rootfn(double t, N_Vector y, N_Vector yp, double *gout, void *userdata)
 {
@@ -1192,6 +2328,71 @@ static int dae_iv_paramfinder(N_Vector p, N_Vector hx, void *adata)
   return 0;
 }
 
+// The memory IDA and the initial value solver need to integrate a model.
+class IDAWorkspace
+  : public SolverWorkspace
+{
+public:
+  IDAWorkspace(const std::vector<uint32_t>& aSetup, uint32_t aRateSize,
+               uint32_t aStateSize, uint32_t aCondVarSize)
+    : SolverWorkspace(aSetup), idamem(NULL), y0(NULL), dy0(NULL), ring(NULL)
+  {
+    params = N_VNew_Serial(aStateSize);
+    ones = N_VNew_Serial(aStateSize);
+    N_VConst(1.0, ones);
+    kin_mem = KINCreate();
+    KINInit(kin_mem, dae_iv_paramfinder, params);
+    if (aStateSize > 0)
+      KINDense(kin_mem, aStateSize);
+    KINSetNumMaxIters(kin_mem, 100);
+
+    icinfo = new double[aStateSize];
+    hx = new double[aStateSize];
+    hxtmp = new double[aStateSize];
+    oldrates = new double[aRateSize];
+    oldstates = new double[aStateSize];
+    roots = new int[aCondVarSize];
+  }
+
+  ~IDAWorkspace()
+  {
+    // idamem is only created just before IDAInit, as IDAFree fails on memory
+    // that was never initialised.
+    if (idamem != NULL)
+      IDAFree(&idamem);
+    if (y0 != NULL)
+      N_VDestroy(y0);
+    if (dy0 != NULL)
+      N_VDestroy(dy0);
+    KINFree(&kin_mem);
+    N_VDestroy(ones);
+    N_VDestroy(params);
+    delete [] icinfo;
+    delete [] hx;
+    delete [] hxtmp;
+    delete [] oldrates;
+    delete [] oldstates;
+    delete [] roots;
+    if (ring != NULL)
+      ring->release_ref();
+  }
+
+  void keepRing(ResultRing* aRing)
+  {
+    aRing->add_ref();
+    if (ring != NULL)
+      ring->release_ref();
+    ring = aRing;
+  }
+
+  void* idamem;
+  void* kin_mem;
+  N_Vector params, ones, y0, dy0;
+  double* icinfo, * hx, * hxtmp, * oldrates, * oldstates;
+  int* roots;
+  ResultRing* ring;
+};
+
 void
 CDA_DAESolverRun::SolveDAEProblem
 (
@@ -1201,29 +2402,45 @@ CDA_DAESolverRun::SolveDAEProblem
  double* algebraic, uint32_t condVarSize, double* condvars
 )
 {
+  std::vector<uint32_t> setup;
+  setup.push_back(rateSize);
+  setup.push_back(stateSize);
+  setup.push_back(condVarSize);
+  setup.push_back(f->ComputeResidualJacobian != NULL);
+  IDAWorkspace* ws =
+    static_cast<IDAWorkspace*>(mModel->mWorkspaces.take(setup));
+  if (ws == NULL)
+    ws = new IDAWorkspace(setup, rateSize, stateSize, condVarSize);
+
   struct fail_info failInfo;
-  double* icinfo = new double[stateSize];
-  N_Vector params = N_VNew_Serial(stateSize);
-  N_Vector ones = N_VNew_Serial(stateSize);
-  N_VConst(1.0, ones);
+  double* icinfo = ws->icinfo;
+  N_Vector params = ws->params;
+  N_Vector ones = ws->ones;
   bool isFirst = true;
 
   MersenneTwister searchRandom(RANDOM_SEED);
 
-  void* idamem = IDACreate();
+  void*& idamem = ws->idamem;
   double voi = mStartBvar;
 
-  uint32_t recsize = rateSize * 2 + algSize + 1;
-  uint32_t storageCapacity = (VARIABLE_STORAGE_LIMIT / recsize) * recsize;
-  double* storage = new double[storageCapacity];
-  uint32_t storageExpiry = (uint32_t) time(0) + VARIABLE_TIME_LIMIT;
-  uint32_t storageSize = 0;
-  N_Vector y0 = NULL, dy0 = NULL;
+  uint32_t recsize = mRecordLayout.recordSize(rateSize, algSize);
+  ResultBuffer storage(mObserver, recsize, mResultBufferSize,
+                       mResultMaxLatency, mResultMaxPoints, ws->ring);
+  ws->keepRing(storage.ring());
+  N_Vector& y0 = ws->y0, & dy0 = ws->dy0;
 
   if (rateSize != 0)
   {
-    y0 = N_VMake_Serial(stateSize, states);
-    dy0 = N_VMake_Serial(rateSize, rates);
+    if (y0 == NULL)
+    {
+      y0 = N_VMake_Serial(stateSize, states);
+      dy0 = N_VMake_Serial(rateSize, rates);
+    }
+    else
+    {
+      N_VSetArrayPointer_Serial(states, y0);
+      N_VSetArrayPointer_Serial(rates, dy0);
+    }
   }
 
   DAEEvaluationInformation ei;
@@ -1238,14 +2455,18 @@ CDA_DAESolverRun::SolveDAEProblem
   ei.ComputeRootInformation = f->ComputeRootInformation;
   ei.EvaluateEssentialVariables = f->EvaluateEssentialVariables;
   ei.EvaluateVariables = f->EvaluateVariables;
-  ei.oldrates = new double[rateSize];
-  ei.oldstates = new double[stateSize];
+  ei.ComputeResidualJacobian = f->ComputeResidualJacobian;
+  std::vector<double> jacobianValues(f->jacobianPattern.size());
+  ei.jacobianPattern = &f->jacobianPattern;
+  ei.jacobianValues = jacobianValues.empty() ? NULL : &jacobianValues[0];
+  ei.oldrates = ws->oldrates;
+  ei.oldstates = ws->oldstates;
   ei.condVarSize = condVarSize;
   memcpy(ei.oldrates, rates, rateSize * sizeof(double));
   memcpy(ei.oldstates, states, stateSize * sizeof(double));
 
   DAEIVFindingInformation ivf;
-  ivf.hxtmp = new double[stateSize];
+  ivf.hxtmp = ws->hxtmp;
   ivf.n = stateSize;
   ivf.voi0 = voi;
   ivf.constants = constants;
@@ -1260,15 +2481,11 @@ CDA_DAESolverRun::SolveDAEProblem
   ivf.ComputeRootInformation = f->ComputeRootInformation;
   ivf.oldrates = ei.oldrates;
   ivf.oldstates = ei.oldstates;
-  double * hx = new double[stateSize];
-  int * roots = new int[condVarSize];
+  double * hx = ws->hx;
+  int * roots = ws->roots;
   memset(roots, 0, sizeof(int) * condVarSize);
 
-  void* kin_mem = KINCreate();
-  KINInit(kin_mem, dae_iv_paramfinder, params);
-  if (stateSize > 0)
-    KINDense(kin_mem, stateSize);
-  KINSetNumMaxIters(kin_mem, 100);
+  void* kin_mem = ws->kin_mem;
   KINSetUserData(kin_mem, &ivf);
   KINSetErrHandlerFn(kin_mem, cda_ida_error_handler, &failInfo);
 
@@ -1277,8 +2494,37 @@ CDA_DAESolverRun::SolveDAEProblem
   double lastVOI = 0.0 /* initialised only to avoid extraneous warning. */;
 
   double minReportForDensity = (mStopBvar - mStartBvar) / mMaxPointDensity;
+  // When interpolating, the solver steps past the tabulation points instead
+  // of stopping at them, and they are recorded from its interpolant.
+  bool interpolate = mInterpolateTabulation && mTabulationStepSize != 0.0;
+  double tabulationStepSize = interpolate ? 0.0 : mTabulationStepSize;
+  TabulationPoints tabulation(mStartBvar,
+                              interpolate ? mTabulationStepSize : 0.0,
+                              mStopBvar);
+  std::vector<double> tabRates, tabStates, tabAlgebraic, tabCondvars;
+  N_Vector dky = NULL, dkyRates = NULL;
+  if (interpolate && rateSize != 0)
+  {
+    tabRates.resize(stateSize);
+    tabStates.resize(stateSize);
+    tabAlgebraic.resize(algSize);
+    tabCondvars.resize(condVarSize);
+    dky = N_VMake_Serial(stateSize, &tabStates[0]);
+    dkyRates = N_VMake_Serial(stateSize, &tabRates[0]);
+  }
+  double* tabAlgebraicValues = tabAlgebraic.empty() ? NULL : &tabAlgebraic[0];
+  double* tabCondvarValues = tabCondvars.empty() ? NULL : &tabCondvars[0];
+
   uint32_t tabStepNumber = 0;
-  double nextStopPoint = mTabulationStepSize == 0.0 ? mStopBvar : voi;
+  double nextStopPoint = tabulationStepSize == 0.0 ? mStopBvar : voi;
+
+  SteadyStateMonitor steadyState(mSteadyStateTolerance, mSteadyStatePeriod,
+                                 mStartBvar, rateSize);
+
+  mPosition.voi = &voi;
+  mPosition.states = states;
+  mPosition.rates = rates;
+  mPosition.rateSize = rateSize;
 
   if (rateSize > 0)
   {
@@ -1338,9 +2584,6 @@ CDA_DAESolverRun::SolveDAEProblem
         failInfo.failtype = lastKINFail.failtype;
         failInfo.failmsg = lastKINFail.failmsg;
         failAddCause(&failInfo, "Could not find a starting point where the initial value solver converges");
-
-        // Apparently IDAFree after IDACreate but before IDAInit fails, so lets IDAInit...
-        IDAInit(idamem, ida_resfn, /* t0 = */voi, y0, dy0);
         break;
       }
 
@@ -1356,13 +2599,27 @@ CDA_DAESolverRun::SolveDAEProblem
       }
       DetermineRateOrStateSensitivity(hx, stateSize, &ivf);
 
-      IDAInit(idamem, ida_resfn, /* t0 = */voi, y0, dy0);
-      IDASetMaxConvFails(idamem, 100);
+      // The memory and the linear solver are set up once, and just
+      // reinitialised on later restarts and runs.
+      if (idamem == NULL)
+      {
+        idamem = IDACreate();
+        IDAInit(idamem, ida_resfn, /* t0 = */voi, y0, dy0);
+        IDASetMaxConvFails(idamem, 100);
+        // IDASpgmr(idamem, 0);
+        // IDASptfqmr(idamem, 0);
+        IDADense(idamem, stateSize);
+        if (f->ComputeResidualJacobian != NULL)
+          IDADlsSetDenseJacFn(idamem, ida_jacfn);
+      }
+      else
+        IDAReInit(idamem, /* t0 = */voi, y0, dy0);
+      // Only the first solve of a resumed run starts with the step size it
+      // was resumed with.
+      IDASetInitStep(idamem, isFirst ? initialStepSize() : 0.0);
+      mPosition.ida = idamem;
       IDARootInit(idamem, condVarSize, ida_rootfn);
       IDASStolerances(idamem, mEpsRel, mEpsAbs);
-      // IDASpgmr(idamem, 0);
-      // IDASptfqmr(idamem, 0);
-      IDADense(idamem, stateSize);
       IDASetErrHandlerFn(idamem, cda_ida_error_handler, &failInfo);
       IDASetUserData(idamem, &ei);
 
@@ -1371,21 +2628,22 @@ CDA_DAESolverRun::SolveDAEProblem
       while (1)
       {
         if (firstAfterRestart &&
-            (isFirst || mTabulationStepSize == 0.0 ||
+            (isFirst ||
+             (tabulationStepSize == 0.0 && !(interpolate && mStrictTabulation)) ||
              floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance) ||
              voi >= nextStopPoint || voi >= mStopBvar))
         {
-          f->EvaluateVariables(voi, constants, rates, states, algebraic, condvars, &failInfo);
-          storage[storageSize] = voi;
-          memcpy(storage + storageSize + 1, states, rateSize * sizeof(double));
-          memcpy(storage + storageSize + 1 + rateSize, rates,
-                 rateSize * sizeof(double));
-          memcpy(storage + storageSize + 1 + rateSize * 2, algebraic,
-                 algSize * sizeof(double));
-          storageSize += recsize;
-
-          nextStopPoint = mTabulationStepSize == 0.0 ? mStopBvar :
-            (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+          if (!mFinalStateOnly)
+          {
+            f->EvaluateVariables(voi, constants, rates, states, algebraic, condvars, &failInfo);
+            mRecordLayout.write(storage.nextRecord(), voi, constants, states,
+                                rates, algebraic, rateSize, algSize);
+            if (storage.addRecord())
+              storage.flush();
+          }
+
+          nextStopPoint = tabulationStepSize == 0.0 ? mStopBvar :
+            (tabulationStepSize * ++tabStepNumber) + mStartBvar;
         }
         firstAfterRestart = false;
 
@@ -1397,6 +2655,7 @@ CDA_DAESolverRun::SolveDAEProblem
           bhl = voi + mStepSizeMax;
         if(bhl > nextStopPoint)
           bhl = nextStopPoint;
+        bhl = steadyState.limit(bhl);
 
         IDASetStopTime(idamem, bhl);
 
@@ -1422,73 +2681,104 @@ CDA_DAESolverRun::SolveDAEProblem
         if (checkPauseOrCancellation())
           break;
 
-        if (isFirst)
+        // Record the tabulation points the step went past. A point the step
+        // ended on exactly is recorded with the step, unless only tabulation
+        // points are.
+        double point;
+        while (!mFinalStateOnly &&
+               tabulation.next(voi, mStrictTabulation, point))
+        {
+          IDAGetDky(idamem, point, 0, dky);
+          IDAGetDky(idamem, point, 1, dkyRates);
+          if (algSize != 0)
+            memcpy(tabAlgebraicValues, algebraic, algSize * sizeof(double));
+          if (condVarSize != 0)
+            memcpy(tabCondvarValues, condvars, condVarSize * sizeof(double));
+
+          f->EvaluateVariables(point, constants, &tabRates[0], &tabStates[0],
+                               tabAlgebraicValues, tabCondvarValues,
+                               &failInfo);
+          mRecordLayout.write(storage.nextRecord(), point, constants,
+                              &tabStates[0], &tabRates[0], tabAlgebraicValues,
+                              rateSize, algSize);
+          if (storage.addRecord())
+            storage.flush();
+        }
+
+        // The state the run stops at is always recorded, and when only the
+        // final state is wanted, nothing else is.
+        bool isSteady = steadyState.isEnabled() &&
+          steadyState.isSteady(voi, states, rates);
+        bool isEnd = isSteady || (mFinalStateOnly && voi >= mStopBvar);
+        if (mFinalStateOnly && !isEnd)
+        {
           isFirst = false;
-        else if (voi - lastVOI < minReportForDensity && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+          if (voi==nextStopPoint)
+            nextStopPoint = (tabulationStepSize * ++tabStepNumber) + mStartBvar;
           continue;
+        }
+        else if (!isEnd && interpolate)
+        {
+          bool isPoint = tabulation.skip(voi);
+          if (isFirst)
+            isFirst = false;
+          else if (!isPoint && voi - lastVOI < minReportForDensity)
+            continue;
 
-        if(mStrictTabulation && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
-          continue;
+          if (mStrictTabulation)
+            continue;
 
-        if (voi==nextStopPoint)
-          nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+          lastVOI = voi;
+        }
+        else if (!isEnd)
+        {
+          if (isFirst)
+            isFirst = false;
+          else if (voi - lastVOI < minReportForDensity && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+            continue;
 
-        lastVOI = voi;
+          if(mStrictTabulation && !floatsEqual(voi, nextStopPoint, tabulationRelativeTolerance))
+            continue;
+
+          if (voi==nextStopPoint)
+            nextStopPoint = (mTabulationStepSize * ++tabStepNumber) + mStartBvar;
+
+          lastVOI = voi;
+        }
 
         f->EvaluateVariables(voi, constants, rates, states, algebraic, condvars, &failInfo);
 
-        if (!restart)
+        if (isEnd)
         {
-          // Add to storage...
-          storage[storageSize] = voi;
-          memcpy(storage + storageSize + 1, states, rateSize * sizeof(double));
-          memcpy(storage + storageSize + 1 + rateSize, rates,
-                 rateSize * sizeof(double));
-          memcpy(storage + storageSize + 1 + rateSize * 2, algebraic,
-                 algSize * sizeof(double));
-          storageSize += recsize;
+          mRecordLayout.write(storage.nextRecord(), voi, constants, states,
+                              rates, algebraic, rateSize, algSize);
+          if (storage.addRecord())
+            storage.flush();
+          restart = false;
+          break;
         }
 
-        // Are we ready to send?
-        uint32_t timeNow = (uint32_t) time(0);
-        if (timeNow >= storageExpiry || storageSize == storageCapacity)
+        if (!restart)
         {
-          if (mObserver != NULL)
-          {
-            std::vector<double> resultsVector(storage, storage + storageSize);
-            mObserver->results(resultsVector);
-          }
-          storageExpiry = timeNow + VARIABLE_TIME_LIMIT;
-          storageSize = 0;
+          // Add to storage...
+          mRecordLayout.write(storage.nextRecord(), voi, constants, states,
+                              rates, algebraic, rateSize, algSize);
+
+          // Are we ready to send?
+          if (storage.addRecord())
+            storage.flush();
         }
       }
     }
   }
 
-  delete [] ei.oldstates;
-  delete [] ei.oldrates;
-  delete [] hx;
-  delete [] icinfo;
-  delete [] ivf.hxtmp;
-  delete [] roots;
-  KINFree(&kin_mem);
-  N_VDestroy(ones);
-  N_VDestroy(params);
-
-  if (storageSize != 0 && mObserver != NULL)
-  {
-    std::vector<double> resultsVector(storage, storage + storageSize);
-    mObserver->results(resultsVector);
-  }
-
-  delete [] storage;
-
-  if (rateSize != 0)
+  if (dky != NULL)
   {
-    IDAFree(&idamem);
-    N_VDestroy(y0);
-    N_VDestroy(dy0);
+    N_VDestroy(dky);
+    N_VDestroy(dkyRates);
   }
+  finishPosition();
+  storage.flush();
 
   if (mObserver != NULL)
   {
@@ -1497,6 +2787,13 @@ CDA_DAESolverRun::SolveDAEProblem
     else
       mObserver->done();
   }
+
+  // A solver which failed may be left in a state that a later run shouldn't
+  // inherit.
+  if (failInfo.failtype)
+    delete ws;
+  else
+    mModel->mWorkspaces.give(ws);
 }
 
 int
@@ -0,0 +1,165 @@
+// Checks that HoistInvariantStatements moves the statements of rates code
+// which only depend on constants, and that the hoisted code followed by the
+// rates code computes the same values as the original rates code, for
+// constants taking every branch.
+#include "CISCodeAnalysis.hxx"
+#include "CISInterpreter.hxx"
+#include <math.h>
+#include <stdio.h>
+#include <string>
+
+#define CONSTANT_COUNT 3
+#define ARRAY_SIZE 16
+
+struct HoistCase
+{
+  const char* name;
+  const char* code;
+  // Whether anything should be hoisted, in which case the rates code should
+  // no longer call exp.
+  bool hoists;
+};
+
+static const HoistCase kCases[] =
+{
+  // Values computed from constants, directly or through each other, even
+  // when the variable holding one is later reassigned.
+  {
+    "straight line",
+    "ALGEBRAIC[0] = exp(CONSTANTS[0]/CONSTANTS[1]);\r\n"
+    "ALGEBRAIC[1] = ALGEBRAIC[0]*STATES[0];\r\n"
+    "ALGEBRAIC[2] = pow(ALGEBRAIC[0], 2.00000)+CONSTANTS[2];\r\n"
+    "ALGEBRAIC[0] = VOI*2.00000;\r\n"
+    "RATES[0] = ALGEBRAIC[2] - ALGEBRAIC[1]+ALGEBRAIC[0];\r\n",
+    true
+  },
+  // A chain on constants, as the code generator writes a piecewise
+  // expression with an otherwise case.
+  {
+    "chain with otherwise",
+    "if (CONSTANTS[0]>1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = exp(CONSTANTS[1]);\r\n"
+    "}\r\n"
+    "else if (CONSTANTS[0]>0.500000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = 2.00000*exp(CONSTANTS[2]);\r\n"
+    "}\r\n"
+    "else if (1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = CONSTANTS[2];\r\n"
+    "}\r\n"
+    "RATES[0] = - ALGEBRAIC[0]*STATES[0];\r\n",
+    true
+  },
+  // A chain which may assign nothing leaves the value as it was.
+  {
+    "chain without otherwise",
+    "ALGEBRAIC[0] = CONSTANTS[2]*STATES[0];\r\n"
+    "if (CONSTANTS[0]>1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = exp(CONSTANTS[1]);\r\n"
+    "}\r\n"
+    "else if (CONSTANTS[0]>0.500000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = 2.00000*exp(CONSTANTS[2]);\r\n"
+    "}\r\n"
+    "RATES[0] = - ALGEBRAIC[0]*STATES[0];\r\n",
+    true
+  },
+  // Nothing which depends on a state or the variable of integration moves.
+  {
+    "not invariant",
+    "ALGEBRAIC[0] = exp(CONSTANTS[0]*STATES[0]);\r\n"
+    "if (VOI>1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[1] = exp(CONSTANTS[1]);\r\n"
+    "}\r\n"
+    "else if (1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[1] = CONSTANTS[2];\r\n"
+    "}\r\n"
+    "RATES[0] = ALGEBRAIC[0]+ALGEBRAIC[1];\r\n",
+    false
+  },
+  { NULL, NULL, false }
+};
+
+static bool
+SameValue(double a, double b)
+{
+  return fabs(a - b) <= 1E-12 * (fabs(a) + fabs(b));
+}
+
+static bool
+CheckCase(const HoistCase& aCase)
+{
+  std::string hoisted, rates;
+  uint32_t slots = HoistInvariantStatements(aCase.code, CONSTANT_COUNT,
+                                            hoisted, rates);
+  if ((slots != 0) != aCase.hoists)
+  {
+    printf("%s: %u values were hoisted\n", aCase.name, slots);
+    return false;
+  }
+  if (slots == 0)
+    return true;
+  if (CONSTANT_COUNT + slots > ARRAY_SIZE)
+  {
+    printf("%s: too many values were hoisted\n", aCase.name);
+    return false;
+  }
+
+  BytecodeFunction original, setup, rewritten;
+  if (!original.compile(aCase.code) || !setup.compile(hoisted.c_str()) ||
+      !rewritten.compile(rates.c_str()))
+  {
+    printf("%s: couldn't interpret the code\n", aCase.name);
+    return false;
+  }
+
+  bool ok = true;
+  if (rates.find("exp(") != std::string::npos)
+  {
+    printf("%s: the rates code still calls exp\n", aCase.name);
+    ok = false;
+  }
+
+  // Each new value of CONSTANTS[0] is set up again, as an override would be.
+  static const double kConstants[] = { 2.5, 0.75, 0.25, -1.0 };
+  for (unsigned int i = 0; i < sizeof(kConstants) / sizeof(kConstants[0]); i++)
+  {
+    double constants[ARRAY_SIZE] = { kConstants[i], 0.5, 1.5 };
+    double states[ARRAY_SIZE] = { 0.5 + kConstants[i] };
+    double rates1[ARRAY_SIZE] = { 0.0 }, rates2[ARRAY_SIZE] = { 0.0 };
+    double algebraic1[ARRAY_SIZE] = { 0.0 }, algebraic2[ARRAY_SIZE] = { 0.0 };
+    double scratch[ARRAY_SIZE] = { 0.0 };
+    setup.run(0.0, constants, rates2, states, scratch, NULL);
+    rewritten.run(1.5, constants, rates2, states, algebraic2, NULL);
+    original.run(1.5, constants, rates1, states, algebraic1, NULL);
+    for (unsigned int j = 0; j < ARRAY_SIZE; j++)
+      if (!SameValue(rates1[j], rates2[j]) ||
+          !SameValue(algebraic1[j], algebraic2[j]))
+      {
+        printf("%s: at CONSTANTS[0] = %g, RATES[%u] = %g rather than %g, "
+               "ALGEBRAIC[%u] = %g rather than %g\n", aCase.name,
+               kConstants[i], j, rates2[j], rates1[j], j, algebraic2[j],
+               algebraic1[j]);
+        ok = false;
+      }
+  }
+
+  if (!ok)
+    printf("The hoisted code was:\n%s\nThe rates code was:\n%s\n",
+           hoisted.c_str(), rates.c_str());
+  return ok;
+}
+
+int main(int argc, char** argv)
+{
+  bool ok = true;
+  for (const HoistCase* c = kCases; c->name; c++)
+    if (!CheckCase(*c))
+      ok = false;
+  return ok ? 0 : 1;
+}
@@ -0,0 +1,163 @@
+// Checks that the code OptimiseCode writes computes the same values as the
+// code it was given, by interpreting both at a range of states, and that it
+// shares, keeps and rewrites the calls it should.
+#include "CISJacobian.hxx"
+#include "CISInterpreter.hxx"
+#include <ctype.h>
+#include <math.h>
+#include <stdio.h>
+#include <string>
+
+#define ARRAY_SIZE 4
+
+struct OptimiseCase
+{
+  const char* name;
+  const char* code;
+  // The number of times the optimised code should call exp, and whether it
+  // should still call pow once.
+  unsigned int expCalls;
+  bool keepsPow;
+};
+
+static const OptimiseCase kCases[] =
+{
+  // The same call in several equations is made once.
+  {
+    "shared across equations",
+    "ALGEBRAIC[0] = exp(- CONSTANTS[0]*STATES[0]);\r\n"
+    "RATES[0] = - ALGEBRAIC[0]*STATES[1];\r\n"
+    "RATES[1] = exp(- CONSTANTS[0]*STATES[0])+STATES[0]*exp(- CONSTANTS[0]*STATES[0]);\r\n",
+    1, false
+  },
+  // Calls in the branches of a chain can't be used after it, where another
+  // branch may have been taken.
+  {
+    "repeated in branches",
+    "if (STATES[0]>1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = exp(STATES[1]);\r\n"
+    "}\r\n"
+    "else if (STATES[0]>0.500000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = 2.00000*exp(STATES[1]);\r\n"
+    "}\r\n"
+    "else if (1.00000)\r\n"
+    "{\r\n"
+    "ALGEBRAIC[0] = CONSTANTS[1];\r\n"
+    "}\r\n"
+    "RATES[0] = exp(STATES[1]) - ALGEBRAIC[0];\r\n"
+    "RATES[1] = exp(STATES[1])*STATES[0];\r\n",
+    3, false
+  },
+  // A call is made again once a variable it reads has been assigned.
+  {
+    "reassigned between calls",
+    "ALGEBRAIC[0] = STATES[0]*2.00000;\r\n"
+    "ALGEBRAIC[1] = exp(ALGEBRAIC[0]);\r\n"
+    "ALGEBRAIC[0] = STATES[1]+CONSTANTS[1];\r\n"
+    "RATES[0] = exp(ALGEBRAIC[0])+ALGEBRAIC[1];\r\n"
+    "RATES[1] = exp(ALGEBRAIC[0])*STATES[0];\r\n",
+    2, false
+  },
+  // Squares and cubes are multiplications, but other powers are left to pow.
+  {
+    "small powers",
+    "RATES[0] = pow(STATES[0], 2.00000)+CONSTANTS[0]*pow(STATES[1], 3.00000);\r\n"
+    "RATES[1] = pow(STATES[0]+STATES[1], 2.00000) - pow(CONSTANTS[1], 1.00000)+pow(CONSTANTS[1], 2.50000);\r\n",
+    0, true
+  },
+  { NULL, NULL, 0, false }
+};
+
+static unsigned int
+CountCalls(const std::string& aCode, const char* aFunction)
+{
+  std::string call = std::string(aFunction) + "(";
+  unsigned int count = 0;
+  for (size_t i = aCode.find(call); i != std::string::npos;
+       i = aCode.find(call, i + 1))
+    if (i == 0 || !isalnum(aCode[i - 1]))
+      count++;
+  return count;
+}
+
+static bool
+SameValue(double a, double b)
+{
+  return fabs(a - b) <= 1E-12 * (fabs(a) + fabs(b));
+}
+
+static bool
+CheckCase(const OptimiseCase& aCase)
+{
+  std::string optimised;
+  if (!OptimiseCode(aCase.code, optimised))
+  {
+    printf("%s: OptimiseCode couldn't parse the code\n", aCase.name);
+    return false;
+  }
+
+  BytecodeFunction original, rewritten;
+  if (!original.compile(aCase.code) || !rewritten.compile(optimised.c_str()))
+  {
+    printf("%s: couldn't interpret the code:\n%s\n", aCase.name,
+           optimised.c_str());
+    return false;
+  }
+
+  bool ok = true;
+  unsigned int expCalls = CountCalls(optimised, "exp");
+  if (expCalls != aCase.expCalls)
+  {
+    printf("%s: %u calls to exp rather than %u\n", aCase.name, expCalls,
+           aCase.expCalls);
+    ok = false;
+  }
+  if (!aCase.keepsPow && CountCalls(optimised, "pow") != 0)
+  {
+    printf("%s: pow wasn't rewritten\n", aCase.name);
+    ok = false;
+  }
+  if (aCase.keepsPow && CountCalls(optimised, "pow") != 1)
+  {
+    printf("%s: only the fractional power should be left to pow\n", aCase.name);
+    ok = false;
+  }
+
+  // Covers every branch of the chains above.
+  static const double kStates[] = { -1.5, 0.25, 0.75, 1.0, 2.5 };
+  for (unsigned int i = 0; i < sizeof(kStates) / sizeof(kStates[0]); i++)
+  {
+    double constants[ARRAY_SIZE] = { 0.5, 3.0, 0.0, 0.0 };
+    double states[ARRAY_SIZE] = { kStates[i], 0.5 - kStates[i], 0.0, 0.0 };
+    double rates1[ARRAY_SIZE] = { 0.0 }, rates2[ARRAY_SIZE] = { 0.0 };
+    double algebraic1[ARRAY_SIZE] = { 0.0 }, algebraic2[ARRAY_SIZE] = { 0.0 };
+    // The rewritten code goes first so that a temporary it reads before
+    // setting doesn't just pick up the value the original code left.
+    rewritten.run(0.0, constants, rates2, states, algebraic2, NULL);
+    original.run(0.0, constants, rates1, states, algebraic1, NULL);
+    for (unsigned int j = 0; j < ARRAY_SIZE; j++)
+      if (!SameValue(rates1[j], rates2[j]) ||
+          !SameValue(algebraic1[j], algebraic2[j]))
+      {
+        printf("%s: at STATES[0] = %g, RATES[%u] = %g rather than %g, "
+               "ALGEBRAIC[%u] = %g rather than %g\n", aCase.name, kStates[i],
+               j, rates2[j], rates1[j], j, algebraic2[j], algebraic1[j]);
+        ok = false;
+      }
+  }
+
+  if (!ok)
+    printf("The optimised code was:\n%s\n", optimised.c_str());
+  return ok;
+}
+
+int main(int argc, char** argv)
+{
+  bool ok = true;
+  for (const OptimiseCase* c = kCases; c->name; c++)
+    if (!CheckCase(*c))
+      ok = false;
+  return ok ? 0 : 1;
+}
@@ -10,6 +10,7 @@
 #include <cstdlib>
 #include <ctime>
 #include <cstring>
+#include <cmath>
 #include <wchar.h>
 #ifndef WIN32
 #include <sys/time.h>
@@ -32,6 +33,41 @@ bool gTStrict = false;
 bool gDebugSim = false;
 double gRealTimeFactor = 0.0;
 uint32_t gSleepTime = 0;
+uint32_t gEnsembleSize = 0;
+uint32_t gLockStepWidth = 1;
+// Set by the ensemble_constant keyword, to give each ensemble member its own
+// value of a constant, and show the results of every member.
+bool gEnsembleConstant = false;
+uint32_t gEnsembleConstantIndex = 0;
+double gEnsembleConstantFirst = 0.0, gEnsembleConstantStep = 0.0;
+bool gResultBlocks = false;
+bool gSelectedOutputs = false;
+iface::cellml_services::CompilerBackend gCompilerBackend =
+  iface::cellml_services::AUTOMATIC_COMPILER;
+uint32_t gOptimisationLevel = 3;
+uint32_t gRunThreads = 0;
+std::vector<uint32_t> gSensitivities;
+std::vector<uint32_t> gTableStates;
+std::vector<double> gTableMinima, gTableMaxima;
+double gTableTolerance = 0.0;
+std::wstring gResultFile;
+iface::cellml_services::CellMLIntegrationService* gCIS;
+// Set by the checkpoint keyword. The run is paused at the first result at or
+// after gCheckpointVOI, and gPausedForCheckpoint is set (guarded by
+// gFinishedMutex) once it has been asked to pause.
+bool gCheckpoint = false, gPausedForCheckpoint = false;
+double gCheckpointVOI = 0.0;
+// Set by the shared_copy keyword, to check that a second copy of the model
+// loaded from gModelURL shares the model compiled from the first.
+bool gSharedCopy = false;
+std::wstring gModelURL;
+// Set by the compile_batch keyword, to compile the model in one batch with
+// the models at gBatchURLs, gBatchJobs at a time.
+uint32_t gBatchJobs = 0;
+std::vector<std::wstring> gBatchURLs;
+
+// The number of records read from each column of a result file at a time.
+#define RESULT_FILE_SLICE 100
 
 
 #ifdef WIN32
@@ -59,12 +95,16 @@ static int gettimeofday(struct timeval* tv, struct timezone* tz)
 #endif
 
 class TestProgressObserver
-  : public iface::cellml_services::IntegrationProgressObserver
+  : public iface::cellml_services::ResultBlockObserver
 {
 public:
+  // A quiet observer only reports failures, for runs which are checked some
+  // other way.
   TestProgressObserver(iface::cellml_services::CellMLCompiledModel* aCCM,
-                       iface::cellml_services::CellMLIntegrationRun* aRun)
-    : mRefcount(1), mFirstResult(true), mRun(aRun)
+                       iface::cellml_services::CellMLIntegrationRun* aRun,
+                       bool aIsQuiet = false)
+    : mRefcount(1), mFirstResult(true), mRun(aRun), mOutputCount(0),
+      mIsQuiet(aIsQuiet)
   {
     mCCM = aCCM;
     mCI = mCCM->codeInformation();
@@ -72,6 +112,7 @@ public:
     ObjRef<iface::cellml_services::ComputationTargetIterator> cti =
       mCI->iterateTargets();
     bool first = true;
+    std::vector<ObjRef<iface::cellml_services::ComputationTarget> > outputs;
 
     while (true)
     {
@@ -86,11 +127,24 @@ public:
       {
         ObjRef<iface::cellml_api::CellMLVariable> source = ct->variable();
 	std::wstring n = source->name();
-        printf(first ? "\"%S\"" : ",\"%S\"", n.c_str());
+        if (!mIsQuiet)
+          printf(first ? "\"%S\"" : ",\"%S\"", n.c_str());
         first = false;
+        outputs.push_back(ct);
       }
     }
-    printf("\n");
+    if (!mIsQuiet)
+      printf("\n");
+
+    // Only record what is printed, in the order it is printed in.
+    if (gSelectedOutputs)
+    {
+      std::vector<iface::cellml_services::ComputationTarget*> outputTargets;
+      for (uint32_t i = 0; i < outputs.size(); i++)
+        outputTargets.push_back(outputs[i]);
+      aRun->setOutputVariables(outputTargets);
+      mOutputCount = outputs.size();
+    }
   }
 
   ~TestProgressObserver()
@@ -145,6 +199,9 @@ public:
       return
         static_cast< ::iface::cellml_services::IntegrationProgressObserver*>
         (this);
+    else if (gResultBlocks && iface == "cellml_services::ResultBlockObserver")
+      return
+        static_cast< ::iface::cellml_services::ResultBlockObserver*>(this);
     return NULL;
   }
 
@@ -153,12 +210,17 @@ public:
     std::vector<std::string> ret;
     ret.push_back("XPCOM::IObject");
     ret.push_back("cellml_services::IntegrationProgressObserver");
+    if (gResultBlocks)
+      ret.push_back("cellml_services::ResultBlockObserver");
     return ret;
   }
 
   void computedConstants(const std::vector<double>& values)
     throw (std::exception&)
   {
+    if (mIsQuiet)
+      return;
+
     ObjRef<iface::cellml_services::ComputationTargetIterator> cti =
       mCI->iterateTargets();
     while (true)
@@ -178,16 +240,35 @@ public:
 
   void results(const std::vector<double>& values)
     throw (std::exception&)
+  {
+    if (!values.empty())
+      printResults(&values[0], values.size());
+  }
+
+  void resultBlock(iface::cellml_services::ResultBlock* block)
+    throw (std::exception&)
+  {
+    // Read the results in place, as a language binding wrapping the block
+    // would.
+    printResults(reinterpret_cast<const double*>(block->address()),
+                 block->length());
+  }
+
+  void printResults(const double* values, uint32_t count)
   {
     uint32_t aic = mCI->algebraicIndexCount();
     uint32_t ric = mCI->rateIndexCount();
     uint32_t recsize = 2 * ric + aic + 1;
+    if (gSelectedOutputs)
+      recsize = 1 + mOutputCount;
+    uint32_t sensitivityOffset = recsize;
+    recsize += ric * gSensitivities.size();
 
-    if (recsize == 1)
+    if (recsize == 1 || mIsQuiet)
       return;
 
     uint32_t i;
-    for (i = 0; i < values.size(); i += recsize)
+    for (i = 0; i < count; i += recsize)
     {
       if (gRealTimeFactor != 0.0)
       {
@@ -217,6 +298,7 @@ public:
       }
 
       bool first = true;
+      uint32_t output = 0;
       ObjRef<iface::cellml_services::ComputationTargetIterator> cti =
         mCI->iterateTargets();
       while (true)
@@ -246,20 +328,69 @@ public:
         default:
           continue;
         }
+        if (gSelectedOutputs)
+          varOff = 1 + output++;
 
         printf(first ? "\"%g\"" : ",\"%g\"", values[i + varOff]);
         // if (et == iface::cellml_services::STATE_VARIABLE)
         //   printf("(\"%g\")", values[i + varOff + ric]);
         first = false;
       }
+      for (uint32_t j = sensitivityOffset; j < recsize; j++)
+        printf(",\"%g\"", values[i + j]);
       puts("");
+
+      // The run only gets as far as its next step before it pauses.
+      if (gCheckpoint && gEnsembleSize == 0 && values[i] >= gCheckpointVOI)
+      {
+        CDALock l(gFinishedMutex);
+        if (!gPausedForCheckpoint)
+        {
+          mRun->pause();
+          gPausedForCheckpoint = true;
+        }
+      }
+    }
+  }
+
+  // Prints the results written to the result file, reading a slice of each
+  // column at a time as a viewer of a long run would.
+  void printResultFile()
+  {
+    ObjRef<iface::cellml_services::ResultFile> file;
+    try
+    {
+      file = already_AddRefd<iface::cellml_services::ResultFile>
+        (gCIS->openResultFile(gResultFile));
+    }
+    catch (iface::cellml_api::CellMLException&)
+    {
+      printf("# Couldn't read the result file.\n");
+      return;
+    }
+    uint32_t columns = file->columnCount(), records = file->recordCount();
+    for (uint32_t first = 0; first < records; first += RESULT_FILE_SLICE)
+    {
+      std::vector<double> values;
+      for (uint32_t c = 0; c < columns; c++)
+      {
+        std::vector<double> column =
+          file->readColumn(c, first, RESULT_FILE_SLICE);
+        values.resize(column.size() * columns);
+        for (uint32_t i = 0; i < column.size(); i++)
+          values[i * columns + c] = column[i];
+      }
+      printResults(&values[0], values.size());
     }
   }
 
   void done()
     throw (std::exception&)
   {
-    printf("# Run completed.\n");
+    if (gResultFile != L"")
+      printResultFile();
+    if (!mIsQuiet)
+      printf("# Run completed.\n");
     CDALock l(gFinishedMutex);
     gFinished = true;
   }
@@ -267,6 +398,8 @@ public:
   void failed(const std::string& errmsg)
     throw (std::exception&)
   {
+    if (gResultFile != L"")
+      printResultFile();
     printf("# Integration failed (%s)\n", errmsg.c_str());
     CDALock l(gFinishedMutex);
     gFinished = true;
@@ -278,6 +411,162 @@ private:
   bool mFirstResult;
   struct timeval mFirstTime;
   iface::cellml_services::CellMLIntegrationRun* mRun;
+  uint32_t mOutputCount;
+  bool mIsQuiet;
+};
+
+// Runs the model as an ensemble, printing the results of the first member the
+// same way as a normal run. If aAllMembers is set, the results of every member
+// are kept instead, and printed one member after another once the run is done.
+class TestEnsembleObserver
+  : public iface::cellml_services::EnsembleProgressObserver
+{
+public:
+  TestEnsembleObserver(iface::cellml_services::IntegrationProgressObserver*
+                       aFirstMemberObserver, uint32_t aMemberCount,
+                       bool aAllMembers = false)
+    : mRefcount(1), mFirstMemberObserver(aFirstMemberObserver),
+      mAllMembers(aAllMembers)
+  {
+    if (mAllMembers)
+    {
+      mConstants.resize(aMemberCount);
+      mResults.resize(aMemberCount);
+      mFailures.resize(aMemberCount);
+    }
+  }
+
+  void add_ref()
+    throw(std::exception&)
+  {
+#if defined(__GCC_HAVE_SYNC_COMPARE_AND_SWAP_4)
+    __sync_fetch_and_add(&mRefcount, 1);
+#elif defined(WIN32)
+    InterlockedIncrement((volatile long int*)&mRefcount);
+#else
+    mRefcount++;
+#endif
+  }
+
+  void release_ref()
+    throw(std::exception&)
+  {
+#if defined(__GCC_HAVE_SYNC_COMPARE_AND_SWAP_4)
+    if (__sync_sub_and_fetch(&mRefcount, 1) == 0)
+      delete this;
+#elif defined(WIN32)
+    if (InterlockedDecrement((volatile long int*)&mRefcount) == 0)
+      delete this;
+#else
+    mRefcount--;
+    if (mRefcount == 0)
+      delete this;
+#endif
+  }
+
+  std::string objid()
+    throw (std::exception&)
+  {
+    return "singletonTestEnsembleObserver";
+  }
+
+  void* query_interface(const std::string& iface)
+    throw (std::exception&)
+  {
+    add_ref();
+    if (iface == "XPCOM::IObject")
+      return static_cast< ::iface::XPCOM::IObject* >(this);
+    else if (iface == "cellml_services::EnsembleProgressObserver")
+      return
+        static_cast< ::iface::cellml_services::EnsembleProgressObserver*>
+        (this);
+    release_ref();
+    return NULL;
+  }
+
+  std::vector<std::string> supported_interfaces() throw()
+  {
+    std::vector<std::string> ret;
+    ret.push_back("XPCOM::IObject");
+    ret.push_back("cellml_services::EnsembleProgressObserver");
+    return ret;
+  }
+
+  void computedConstants(uint32_t member, const std::vector<double>& values)
+    throw (std::exception&)
+  {
+    if (mAllMembers)
+    {
+      CDALock l(mMembersMutex);
+      mConstants[member] = values;
+    }
+    else if (member == 0)
+      mFirstMemberObserver->computedConstants(values);
+  }
+
+  void results(uint32_t member, const std::vector<double>& values)
+    throw (std::exception&)
+  {
+    if (mAllMembers)
+    {
+      CDALock l(mMembersMutex);
+      mResults[member].insert(mResults[member].end(), values.begin(),
+                              values.end());
+    }
+    else if (member == 0)
+      mFirstMemberObserver->results(values);
+  }
+
+  void memberDone(uint32_t member)
+    throw (std::exception&)
+  {
+    if (!mAllMembers && member == 0)
+      printf("# Run completed.\n");
+  }
+
+  void memberFailed(uint32_t member, const std::string& errmsg)
+    throw (std::exception&)
+  {
+    if (mAllMembers)
+    {
+      CDALock l(mMembersMutex);
+      mFailures[member] = errmsg;
+    }
+    else if (member == 0)
+      printf("# Integration failed (%s)\n", errmsg.c_str());
+  }
+
+  void done()
+    throw (std::exception&)
+  {
+    if (mAllMembers)
+    {
+      CDALock l(mMembersMutex);
+      for (uint32_t i = 0; i < mResults.size(); i++)
+      {
+        printf("# Member %u\n", i);
+        if (!mConstants[i].empty())
+          mFirstMemberObserver->computedConstants(mConstants[i]);
+        mFirstMemberObserver->results(mResults[i]);
+        if (mFailures[i] != "")
+          printf("# Integration failed (%s)\n", mFailures[i].c_str());
+        else
+          printf("# Run completed.\n");
+      }
+    }
+
+    CDALock l(gFinishedMutex);
+    gFinished = true;
+  }
+
+private:
+  uint32_t mRefcount;
+  ObjRef<iface::cellml_services::IntegrationProgressObserver>
+    mFirstMemberObserver;
+  bool mAllMembers;
+  CDAMutex mMembersMutex;
+  std::vector<std::vector<double> > mConstants, mResults;
+  std::vector<std::string> mFailures;
 };
 
 void ProcessInitialKeywords(int argc, char** argv)
@@ -303,6 +592,120 @@ void ProcessInitialKeywords(int argc, char** argv)
       else
         printf("# Warning: debug command given unrecognised value - true and false accepted.\n");
     }
+    else if (!strcasecmp(command, "ensemble"))
+      gEnsembleSize = strtoul(value, NULL, 10);
+    else if (!strcasecmp(command, "lock_step"))
+      gLockStepWidth = strtoul(value, NULL, 10);
+    else if (!strcasecmp(command, "ensemble_constant"))
+    {
+      char* end;
+      gEnsembleConstantIndex = strtoul(value, &end, 10);
+      if (*end == ',')
+        gEnsembleConstantFirst = strtod(end + 1, &end);
+      if (*end == ',')
+        gEnsembleConstantStep = strtod(end + 1, &end);
+      gEnsembleConstant = (*end == 0);
+      if (!gEnsembleConstant)
+        printf("# Warning: Expected index,first,step. "
+               "ensemble_constant ignored.\n");
+    }
+    else if (!strcasecmp(command, "result_blocks"))
+      gResultBlocks = !strcasecmp(value, "true");
+    else if (!strcasecmp(command, "shared_copy"))
+      gSharedCopy = !strcasecmp(value, "true");
+    else if (!strcasecmp(command, "compile_batch"))
+    {
+      gBatchURLs.clear();
+      char* end;
+      gBatchJobs = strtoul(value, &end, 10);
+      while (*end == ',')
+      {
+        char* url = end + 1;
+        end = strchr(url, ',');
+        if (end == NULL)
+          end = url + strlen(url);
+        std::string url8(url, end);
+        std::vector<wchar_t> wurl(url8.size() + 1, 0);
+        mbstowcs(&wurl[0], url8.c_str(), url8.size());
+        gBatchURLs.push_back(&wurl[0]);
+      }
+      if (*end != 0 || gBatchJobs == 0)
+      {
+        printf("# Warning: Expected jobs,url,url,... "
+               "compile_batch ignored.\n");
+        gBatchJobs = 0;
+      }
+    }
+    else if (!strcasecmp(command, "selected_outputs"))
+      gSelectedOutputs = !strcasecmp(value, "true");
+    else if (!strcasecmp(command, "compiler"))
+    {
+      if (!strcasecmp(value, "automatic"))
+        gCompilerBackend = iface::cellml_services::AUTOMATIC_COMPILER;
+      else if (!strcasecmp(value, "in_process"))
+        gCompilerBackend = iface::cellml_services::IN_PROCESS_COMPILER;
+      else if (!strcasecmp(value, "external"))
+        gCompilerBackend = iface::cellml_services::EXTERNAL_COMPILER;
+      else if (!strcasecmp(value, "tiered"))
+        gCompilerBackend = iface::cellml_services::TIERED_COMPILER;
+      else if (!strcasecmp(value, "interpreter"))
+        gCompilerBackend = iface::cellml_services::INTERPRETER;
+      else
+        printf("# Warning: compiler command given unrecognised value - "
+               "automatic, in_process, external, tiered and interpreter "
+               "accepted.\n");
+    }
+    else if (!strcasecmp(command, "optimisation"))
+      gOptimisationLevel = strtoul(value, NULL, 10);
+    else if (!strcasecmp(command, "run_threads"))
+      gRunThreads = strtoul(value, NULL, 10);
+    else if (!strcasecmp(command, "sensitivities"))
+    {
+      gSensitivities.clear();
+      char* end = value;
+      while (*end)
+      {
+        gSensitivities.push_back(strtoul(value, &end, 10));
+        if (end == value)
+        {
+          printf("# Warning: sensitivities command given invalid constant "
+                 "index.\n");
+          gSensitivities.clear();
+          break;
+        }
+        if (*end == ',')
+          end++;
+        value = end;
+      }
+    }
+    else if (!strcasecmp(command, "lookup_tables"))
+    {
+      gTableStates.clear();
+      gTableMinima.clear();
+      gTableMaxima.clear();
+      char* end;
+      gTableTolerance = strtod(value, &end);
+      while (*end == ',')
+      {
+        unsigned long state;
+        double minimum, maximum;
+        int length = 0;
+        if (sscanf(end + 1, "%lu:%lf:%lf%n", &state, &minimum, &maximum,
+                   &length) != 3 || length == 0)
+          break;
+        gTableStates.push_back(state);
+        gTableMinima.push_back(minimum);
+        gTableMaxima.push_back(maximum);
+        end += 1 + length;
+      }
+      if (*end || gTableStates.empty())
+      {
+        printf("# Warning: lookup_tables command given invalid tables.\n");
+        gTableStates.clear();
+        gTableMinima.clear();
+        gTableMaxima.clear();
+      }
+    }
   }
 }
 
@@ -351,6 +754,8 @@ ProcessKeywords(int argc, char** argv,
         ist = iface::cellml_services::ADAMS_MOULTON_1_12;
       else if (!strcasecmp(value, "BDF15SIMP"))
         ist = iface::cellml_services::BDF_IMPLICIT_1_5_SOLVE;
+      else if (!strcasecmp(value, "RUSH_LARSEN"))
+        ist = iface::cellml_services::RUSH_LARSEN;
       else if (!strcasecmp(value, "IDA"))
         continue;
       else
@@ -366,6 +771,28 @@ ProcessKeywords(int argc, char** argv,
       else
         osr->stepType(ist);
     }
+    else if (!strcasecmp(command, "linear_solver"))
+    {
+      iface::cellml_services::LinearSolverType lst;
+      if (!strcasecmp(value, "AUTO"))
+        lst = iface::cellml_services::AUTOMATIC_LINEAR_SOLVER;
+      else if (!strcasecmp(value, "DENSE"))
+        lst = iface::cellml_services::DENSE_LINEAR_SOLVER;
+      else if (!strcasecmp(value, "BANDED"))
+        lst = iface::cellml_services::BANDED_LINEAR_SOLVER;
+      else if (!strcasecmp(value, "KRYLOV"))
+        lst = iface::cellml_services::KRYLOV_LINEAR_SOLVER;
+      else
+      {
+        printf("# Warning: Unsupported linear_solver value %s (ignored)\n",
+               value);
+        continue;
+      }
+
+      DECLARE_QUERY_INTERFACE_OBJREF(osr, run, cellml_services::ODESolverRun);
+      if (osr != NULL)
+        osr->linearSolver(lst);
+    }
     else if (!strcasecmp(command, "step_size_control"))
     {
       double epsAbs, epsRel, scalVar, scalRate, maxStep;
@@ -420,6 +847,40 @@ ProcessKeywords(int argc, char** argv,
       }
       run->setStepSizeControl(epsAbs, epsRel, scalVar, scalRate, maxStep);
     }
+    else if (!strcasecmp(command, "result_flush"))
+    {
+      uint32_t bufferSize, maxLatency, maxPoints;
+      bufferSize = strtoul(value, &value, 10);
+      if (*value != ',')
+      {
+        printf("# Warning: Expected ',' after buffer size. "
+               "result_flush ignored.\n");
+        continue;
+      }
+      value++;
+      maxLatency = strtoul(value, &value, 10);
+      if (*value != ',')
+      {
+        printf("# Warning: Expected ',' after maximum latency. "
+               "result_flush ignored.\n");
+        continue;
+      }
+      value++;
+      maxPoints = strtoul(value, &value, 10);
+      run->setResultFlushPolicy(bufferSize, maxLatency, maxPoints);
+    }
+    else if (!strcasecmp(command, "result_file"))
+    {
+      char* comma = strchr(value, ',');
+      if (comma == NULL)
+      {
+        printf("# Warning: Expected ',' after file name. "
+               "result_file ignored.\n");
+        continue;
+      }
+      gResultFile = std::wstring(value, comma);
+      run->setResultFile(gResultFile, strtoul(comma + 1, NULL, 10));
+    }
     else if (!strcasecmp(command, "range"))
     {
       double start, stop, density;
@@ -445,6 +906,28 @@ ProcessKeywords(int argc, char** argv,
       gStop = stop;
       gDensity = density;
     }
+    else if (!strcasecmp(command, "steady_state"))
+    {
+      double tolerance, period;
+      tolerance = strtod(value, &value);
+      if (*value != ',')
+      {
+        printf("# Warning: Expected ',' after tolerance. "
+               "steady_state ignored.\n");
+        continue;
+      }
+      value++;
+      period = strtod(value, &value);
+      if (*value != ',')
+      {
+        printf("# Warning: Expected ',' after period. "
+               "steady_state ignored.\n");
+        continue;
+      }
+      value++;
+      run->setSteadyStateDetection(tolerance, period,
+                                   !strcasecmp(value, "true"));
+    }
     else if (!strcasecmp(command, "tabulation"))
     {
       double tabstepsize;
@@ -462,6 +945,28 @@ ProcessKeywords(int argc, char** argv,
       gTabStep = tabstepsize;
       gTStrict = tstrict;
     }
+    else if (!strcasecmp(command, "tabulation_interpolation"))
+    {
+      run->setTabulationInterpolation(!strcasecmp(value, "true"));
+    }
+    else if (!strcasecmp(command, "override_constant"))
+    {
+      char* end;
+      uint32_t index = strtoul(value, &end, 10);
+      if (*end != ',')
+      {
+        printf("# Warning: Expected ',' after constant index. "
+               "override_constant ignored.\n");
+        continue;
+      }
+      run->setOverride(iface::cellml_services::CONSTANT, index,
+                       strtod(end + 1, NULL));
+    }
+    else if (!strcasecmp(command, "checkpoint"))
+    {
+      gCheckpoint = true;
+      gCheckpointVOI = strtod(value, NULL);
+    }
     // A special undocumented debugging command...
     else if (!strcasecmp(command, "sleep_time"))
     {
@@ -471,7 +976,17 @@ ProcessKeywords(int argc, char** argv,
     {
       gRealTimeFactor = strtod(value, NULL);
     }
-    else if (!strcasecmp(command, "debug"))
+    else if (!strcasecmp(command, "debug") ||
+             !strcasecmp(command, "ensemble") ||
+             !strcasecmp(command, "lock_step") ||
+             !strcasecmp(command, "ensemble_constant") ||
+             !strcasecmp(command, "result_blocks") ||
+             !strcasecmp(command, "shared_copy") ||
+             !strcasecmp(command, "compile_batch") ||
+             !strcasecmp(command, "selected_outputs") ||
+             !strcasecmp(command, "compiler") ||
+             !strcasecmp(command, "optimisation") ||
+             !strcasecmp(command, "run_threads"))
       ; // ProcessInitialKeywords
     else
       printf("# Warning: Unrecognised command %s. Ignored.\n",
@@ -479,6 +994,119 @@ ProcessKeywords(int argc, char** argv,
   }
 }
 
+// Waits for a run to finish. If the observer pauses it for the checkpoint
+// keyword, a checkpoint is taken while it is paused, and returned once the
+// run has finished.
+already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+WaitForRun(iface::cellml_services::CellMLIntegrationRun* run)
+{
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> paused;
+  while (1)
+  {
+    bool isPaused;
+    {
+      CDALock l(gFinishedMutex);
+      if (gFinished) break;
+      isPaused = gPausedForCheckpoint;
+    }
+    // The run may not have got as far as pausing yet.
+    if (isPaused && paused == NULL)
+    {
+      try
+      {
+        paused = already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+          (run->checkpoint());
+        run->resume();
+        continue;
+      }
+      catch (iface::cellml_api::CellMLException&)
+      {
+      }
+    }
+    sleep(1);
+  }
+
+  if (paused != NULL)
+    paused->add_ref();
+  return paused.getPointer();
+}
+
+// Resumes a second run from a checkpoint of the first taken part way
+// through, recreated from its values as a saved checkpoint would be, and
+// checks that it finishes where the first did. Only problems are reported,
+// so that the output is the same as that of a run without checkpoints.
+void
+CheckResumedRun(iface::cellml_services::CellMLCompiledModel* ccm,
+                iface::cellml_services::CellMLIntegrationRun* run,
+                iface::cellml_services::CellMLIntegrationRun* resumed,
+                iface::cellml_services::IntegrationCheckpoint* paused,
+                int argc, char** argv)
+{
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> finished;
+  try
+  {
+    finished = already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+      (run->checkpoint());
+  }
+  catch (iface::cellml_api::CellMLException&)
+  {
+    printf("# Couldn't take a checkpoint of the finished run.\n");
+    return;
+  }
+
+  try
+  {
+    resumed->resumeFrom(NULL);
+    printf("# Resumed a run from a null checkpoint.\n");
+  }
+  catch (iface::cellml_api::CellMLException&)
+  {
+  }
+
+  std::vector<double> states = paused->states(), rates = paused->rates(),
+    overrideValues = paused->constantOverrideValues();
+  std::vector<uint32_t> overrideIndices = paused->constantOverrideIndices();
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> saved =
+    gCIS->createCheckpoint(ccm, paused->variableOfIntegration(),
+                           paused->stepSize(), states, rates,
+                           overrideIndices, overrideValues);
+
+  ObjRef<TestProgressObserver> tpo = already_AddRefd<TestProgressObserver>
+    (new TestProgressObserver(ccm, resumed, true));
+  resumed->setProgressObserver(tpo);
+  ProcessKeywords(argc, argv, resumed);
+  resumed->resumeFrom(saved);
+  {
+    CDALock l(gFinishedMutex);
+    gFinished = false;
+  }
+  resumed->start();
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> unused =
+    WaitForRun(resumed);
+
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> end;
+  try
+  {
+    end = already_AddRefd<iface::cellml_services::IntegrationCheckpoint>
+      (resumed->checkpoint());
+  }
+  catch (iface::cellml_api::CellMLException&)
+  {
+    printf("# Couldn't take a checkpoint of the resumed run.\n");
+    return;
+  }
+
+  // The resumed run starts a new solve, so only agrees to within the solver
+  // tolerances.
+  std::vector<double> expected = finished->states(), actual = end->states();
+  bool isSame = actual.size() == expected.size() &&
+    end->variableOfIntegration() == finished->variableOfIntegration();
+  for (uint32_t i = 0; isSame && i < actual.size(); i++)
+    isSame = fabs(actual[i] - expected[i]) <= 1E-3 * (1.0 + fabs(expected[i]));
+  if (!isSame)
+    printf("# The resumed run finished at a different state.\n");
+}
+
 bool
 PeekForIDA(int argc, char** argv)
 {
@@ -529,13 +1157,13 @@ IDAMain(iface::cellml_services::CellMLIntegrationService* cis,
 
   cir->start();
 
-  while (1)
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> paused =
+    WaitForRun(cir);
+  if (paused != NULL)
   {
-    {
-      CDALock l(gFinishedMutex);
-      if (gFinished) break;
-    }
-    sleep(1);
+    ObjRef<iface::cellml_services::DAESolverRun> resumed =
+      cis->createDAEIntegrationRun(ccm);
+    CheckResumedRun(ccm, cir, resumed, paused, argc, argv);
   }
 
   if (gSleepTime)
@@ -544,6 +1172,170 @@ IDAMain(iface::cellml_services::CellMLIntegrationService* cis,
   return 0;
 }
 
+iface::cellml_services::ODESolverCompiledModel*
+CompileODEModel(iface::cellml_services::CellMLIntegrationService* cis,
+                iface::cellml_api::Model* mod)
+{
+  if (!gSensitivities.empty())
+    return cis->compileModelODESensitivities(mod, gSensitivities);
+  if (!gTableStates.empty())
+    return cis->compileModelODELookupTables(mod, gTableStates, gTableMinima,
+                                            gTableMaxima, gTableTolerance);
+  return gDebugSim ? cis->compileDebugModelODE(mod) : cis->compileModelODE(mod);
+}
+
+// Loads a second copy of the model and compiles it, checking that it gets
+// the model already compiled from the first copy, and that the compiled
+// model outlives the reference got for the first copy. Only problems are
+// reported, so that the output is the same as that of a normal run. Returns
+// the compiled model, or NULL if the check failed.
+iface::cellml_services::ODESolverCompiledModel*
+CompileSharedCopy(iface::cellml_services::CellMLIntegrationService* cis,
+                  ObjRef<iface::cellml_services::ODESolverCompiledModel>& ccm)
+{
+  ObjRef<iface::cellml_api::CellMLBootstrap> cb = CreateCellMLBootstrap();
+  ObjRef<iface::cellml_api::DOMModelLoader> ml = cb->modelLoader();
+  ObjRef<iface::cellml_api::Model> copy;
+  ObjRef<iface::cellml_services::ODESolverCompiledModel> shared, again;
+  try
+  {
+    copy = already_AddRefd<iface::cellml_api::Model>
+      (ml->loadFromURL(gModelURL));
+    shared = already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+      (CompileODEModel(cis, copy));
+  }
+  catch (...)
+  {
+    printf("# Couldn't load and compile a second copy of the model.\n");
+    return NULL;
+  }
+  if (shared.getPointer() != ccm.getPointer())
+  {
+    printf("# The second copy of the model was compiled again.\n");
+    return NULL;
+  }
+
+  // Only the second copy's reference is left, which must keep the compiled
+  // model, and its entry in the cache, alive.
+  ccm = NULL;
+  try
+  {
+    again = already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+      (CompileODEModel(cis, copy));
+  }
+  catch (...)
+  {
+    printf("# Couldn't compile the second copy of the model again.\n");
+    return NULL;
+  }
+  if (again.getPointer() != shared.getPointer())
+  {
+    printf("# The compiled model didn't outlive the first copy's "
+           "reference.\n");
+    return NULL;
+  }
+  ObjRef<iface::cellml_api::Model> original = shared->model();
+  ObjRef<iface::cellml_services::CodeInformation> ci =
+    shared->codeInformation();
+  if (original == NULL || ci == NULL)
+  {
+    printf("# The shared compiled model lost its model.\n");
+    return NULL;
+  }
+
+  return shared.returnNewReference();
+}
+
+// Runs a compiled model to the end without showing its results, although a
+// failure is still reported.
+void
+RunQuietly(iface::cellml_services::CellMLIntegrationService* cis,
+           iface::cellml_services::ODESolverCompiledModel* ccm)
+{
+  ObjRef<iface::cellml_services::ODESolverRun> run =
+    already_AddRefd<iface::cellml_services::ODESolverRun>
+    (cis->createODEIntegrationRun(ccm));
+  ObjRef<TestProgressObserver> tpo = already_AddRefd<TestProgressObserver>
+    (new TestProgressObserver(ccm, run, true));
+  run->setProgressObserver(tpo);
+  {
+    CDALock l(gFinishedMutex);
+    gFinished = false;
+  }
+  run->start();
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> unused =
+    WaitForRun(run);
+
+  CDALock l(gFinishedMutex);
+  gFinished = false;
+}
+
+// Compiles the model with compileModelsODE, in a batch which also holds the
+// models at gBatchURLs and then the model again. The repeated model must get
+// the same compiled model, and each of the others is run. Only problems are
+// reported, so that the output is the same as that of a normal run. Returns
+// the compiled model, or NULL if the check failed.
+iface::cellml_services::ODESolverCompiledModel*
+CompileModelBatch(iface::cellml_services::CellMLIntegrationService* cis,
+                  iface::cellml_api::Model* mod)
+{
+  ObjRef<iface::cellml_api::CellMLBootstrap> cb = CreateCellMLBootstrap();
+  ObjRef<iface::cellml_api::DOMModelLoader> ml = cb->modelLoader();
+  std::vector<ObjRef<iface::cellml_api::Model> > others;
+  std::vector<iface::cellml_api::Model*> models;
+  models.push_back(mod);
+  for (uint32_t i = 0; i < gBatchURLs.size(); i++)
+  {
+    try
+    {
+      others.push_back(already_AddRefd<iface::cellml_api::Model>
+                       (ml->loadFromURL(gBatchURLs[i])));
+    }
+    catch (...)
+    {
+      printf("# Couldn't load %S.\n", gBatchURLs[i].c_str());
+      return NULL;
+    }
+    models.push_back(others.back());
+  }
+  models.push_back(mod);
+
+  std::vector<iface::cellml_services::ODESolverCompiledModel*> results =
+    cis->compileModelsODE(models, gBatchJobs);
+  std::vector<ObjRef<iface::cellml_services::ODESolverCompiledModel> >
+    compiled;
+  for (uint32_t i = 0; i < results.size(); i++)
+    compiled.push_back
+      (already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+       (results[i]));
+
+  if (compiled.front() == NULL)
+  {
+    std::wstring err = cis->lastError();
+    printf("Caught a CellMLException while compiling model: %S\n",
+           err.c_str());
+    return NULL;
+  }
+  if (compiled.back().getPointer() != compiled.front().getPointer())
+  {
+    printf("# The repeated model was compiled separately.\n");
+    return NULL;
+  }
+  for (uint32_t i = 0; i < gBatchURLs.size(); i++)
+  {
+    if (compiled[i + 1] == NULL)
+    {
+      std::wstring err = cis->lastError();
+      printf("# Couldn't compile %S: %S\n", gBatchURLs[i].c_str(),
+             err.c_str());
+      return NULL;
+    }
+    RunQuietly(cis, compiled[i + 1]);
+  }
+
+  return compiled.front().returnNewReference();
+}
+
 int
 ODEMain(iface::cellml_services::CellMLIntegrationService* cis,
         iface::cellml_api::Model* mod, int argc, char** argv)
@@ -552,7 +1344,16 @@ ODEMain(iface::cellml_services::CellMLIntegrationService* cis,
   try
   {
     printf("# Compiling model...\n");
-    ccm = gDebugSim ? cis->compileDebugModelODE(mod) : cis->compileModelODE(mod);
+    if (gBatchJobs != 0)
+    {
+      ccm = already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+        (CompileModelBatch(cis, mod));
+      if (ccm == NULL)
+        return -1;
+    }
+    else
+      ccm = already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+        (CompileODEModel(cis, mod));
   }
   catch (iface::cellml_api::CellMLException& ce)
   {
@@ -566,12 +1367,43 @@ ODEMain(iface::cellml_services::CellMLIntegrationService* cis,
     return -1;
   }
 
-  printf("# Creating run...\n");
-  ObjRef<iface::cellml_services::ODESolverRun> cir =
-    cis->createODEIntegrationRun(ccm);
+  if (gSharedCopy)
+  {
+    ccm = already_AddRefd<iface::cellml_services::ODESolverCompiledModel>
+      (CompileSharedCopy(cis, ccm));
+    if (ccm == NULL)
+      return -1;
+  }
 
-  ObjRef<TestProgressObserver> tpo = already_AddRefd<TestProgressObserver>(new TestProgressObserver(ccm, cir));
-  cir->setProgressObserver(tpo);
+  printf("# Creating run...\n");
+  ObjRef<iface::cellml_services::ODESolverRun> cir;
+  if (gEnsembleSize != 0)
+  {
+    ObjRef<iface::cellml_services::ODESolverEnsembleRun> cer =
+      cis->createODEEnsembleRun(ccm);
+    std::vector<uint32_t> constantIndices, noIndices;
+    std::vector<double> values;
+    if (gEnsembleConstant)
+    {
+      constantIndices.push_back(gEnsembleConstantIndex);
+      for (uint32_t i = 0; i < gEnsembleSize; i++)
+        values.push_back(gEnsembleConstantFirst + i * gEnsembleConstantStep);
+    }
+    cer->setEnsemble(gEnsembleSize, constantIndices, noIndices, values);
+    cer->lockStepWidth(gLockStepWidth);
+
+    ObjRef<TestProgressObserver> tpo = already_AddRefd<TestProgressObserver>(new TestProgressObserver(ccm, cer));
+    ObjRef<TestEnsembleObserver> teo = already_AddRefd<TestEnsembleObserver>
+      (new TestEnsembleObserver(tpo, gEnsembleSize, gEnsembleConstant));
+    cer->setEnsembleObserver(teo);
+    cir = cer;
+  }
+  else
+  {
+    cir = cis->createODEIntegrationRun(ccm);
+    ObjRef<TestProgressObserver> tpo = already_AddRefd<TestProgressObserver>(new TestProgressObserver(ccm, cir));
+    cir->setProgressObserver(tpo);
+  }
 
   ProcessKeywords(argc, argv, cir);
 
@@ -581,13 +1413,13 @@ ODEMain(iface::cellml_services::CellMLIntegrationService* cis,
 
   cir->start();
 
-  while (1)
+  ObjRef<iface::cellml_services::IntegrationCheckpoint> paused =
+    WaitForRun(cir);
+  if (paused != NULL)
   {
-    {
-      CDALock l(gFinishedMutex);
-      if (gFinished) break;
-    }
-    sleep(1);
+    ObjRef<iface::cellml_services::ODESolverRun> resumed =
+      cis->createODEIntegrationRun(ccm);
+    CheckResumedRun(ccm, cir, resumed, paused, argc, argv);
   }
 
   if (gSleepTime)
@@ -605,7 +1437,8 @@ main(int argc, char** argv)
     printf("Usage: RunCellML modelURL (options)*\n"
            "Available options:\n"
            "  step_type RK2|RK4|RKF45|RKCK|RKPD|"
-           "RK2IMP|RK2SIMP|RK4IMP|BSIMP|GEAR1|GEAR2|AM_1_12|BDF15SIMP|IDA\n"
+           "RK2IMP|RK2SIMP|RK4IMP|BSIMP|GEAR1|GEAR2|AM_1_12|BDF15SIMP|\n"
+           "    RUSH_LARSEN|IDA\n"
            "    => Sets the stepping algorithm to use:\n"
            "      RK2     = 2nd order Runge-Kutta.\n"
            "      RK4     = 4th order Runge-Kutta.\n"
@@ -620,6 +1453,13 @@ main(int argc, char** argv)
            "      GEAR2   = Implict Gear method (M=2).\n"
            "    AM_1_12   = Adams-Moulton (1-12)\n"
            "  BDF15SIMP   = BDF(1-5) with non-linear solve.\n"
+           "  RUSH_LARSEN = Rush-Larsen, stepping by max_step.\n"
+           "  linear_solver AUTO|DENSE|BANDED|KRYLOV\n"
+           "    => Sets the linear solver used by BDF15SIMP:\n"
+           "      AUTO    = Banded if the Jacobian is narrow enough, else dense.\n"
+           "      DENSE   = Dense Gaussian elimination.\n"
+           "      BANDED  = Banded Gaussian elimination, after reordering states.\n"
+           "      KRYLOV  = GMRES with a block diagonal preconditioner.\n"
            "  step_size_control absolute_epsilon,relative_epsilon[,variable_weight[,max_step]]\n"
            "    => Sets the step-size control parameters.\n"
            "      absolute_epsilon: A floating point absolute error tolerance value.\n"
@@ -636,11 +1476,73 @@ main(int argc, char** argv)
            "    => Sets the interval in the bound variable for guaranteed values in other variables,\n"
            "       and whether to only tabulate values at points that are thus guaranteed.\n"
            "       step_size: A floating point tabulation step size.\n"
+           "  tabulation_interpolation true|false\n"
+           "    => Specifies whether to interpolate the values at tabulation points,\n"
+           "       rather than stopping the solver at each of them.\n"
+           "  override_constant index,value\n"
+           "    => Overrides the value of the constant with the given index.\n"
+           "  checkpoint point\n"
+           "    => Pauses the run at point to take a checkpoint, then checks that\n"
+           "       a second run resumed from it finishes at the same state.\n"
+           "  steady_state tolerance,period,true|false\n"
+           "    => Stops the run once the model is steady, and whether to only show\n"
+           "       the final state.\n"
+           "       tolerance: How close to steady the model must be, or 0 to never stop.\n"
+           "       period: The period of a periodic model, or 0 to test the rates.\n"
+           "  result_flush buffer_size,max_latency,max_points\n"
+           "    => Sets when results are sent by the integrator.\n"
+           "       buffer_size: The most values to hold.\n"
+           "       max_latency: The most milliseconds to hold a result, or 0 for no limit.\n"
+           "       max_points: The most results to hold, or 0 for no limit.\n"
            "  real_time_factor number\n"
            "    => Slows the simulation so that number real seconds elapse for \n"
            "       each unit of time in the simulation.\n"
            "  debug true|false\n"
            "    => Specifies whether or not to use debug mode.\n"
+           "  ensemble number\n"
+           "    => Integrates number identical copies of the model at the same time,\n"
+           "       and shows the results of the first (not supported with IDA).\n"
+           "  lock_step number\n"
+           "    => Integrates groups of up to number ensemble members in lock step.\n"
+           "  ensemble_constant index,first,step\n"
+           "    => Gives ensemble member m the value first + m * step for the\n"
+           "       constant with the given index, and shows the results of every\n"
+           "       member, one after another.\n"
+           "  compile_batch jobs,url,url,...\n"
+           "    => Compiles the model with compileModelsODE, jobs at a time, in a\n"
+           "       batch with the models at the given URLs and the model again,\n"
+           "       and runs each of the other models without showing them (not\n"
+           "       supported with IDA, debug, sensitivities, lookup_tables or\n"
+           "       result_file).\n"
+           "  shared_copy true|false\n"
+           "    => Checks that a second copy of the model, loaded separately, gets\n"
+           "       the same compiled model, which outlives the first copy's\n"
+           "       reference (not supported with IDA).\n"
+           "  result_blocks true|false\n"
+           "    => Specifies whether to receive results in shared blocks, rather\n"
+           "       than as a copy.\n"
+           "  result_file name,chunk_records\n"
+           "    => Writes the results to a result file with chunk_records\n"
+           "       records in each chunk, and shows them by reading it back.\n"
+           "  selected_outputs true|false\n"
+           "    => Specifies whether to only record the variables which are shown,\n"
+           "       rather than every variable.\n"
+           "  compiler automatic|in_process|external|tiered|interpreter\n"
+           "    => Specifies how to compile the model code. tiered interprets\n"
+           "       the model until it has been compiled in the background, and\n"
+           "       interpreter only interprets it.\n"
+           "  optimisation level\n"
+           "    => Sets how much to optimise the model code, from 0 to 3.\n"
+           "  run_threads number\n"
+           "    => Integrates runs on a pool of number shared threads, rather\n"
+           "       than a thread each.\n"
+           "  sensitivities index,index,...\n"
+           "    => Integrates the sensitivities of the states to the constants\n"
+           "       with the given indices, and shows them after the other values.\n"
+           "  lookup_tables tolerance,state:min:max,...\n"
+           "    => Computes the rates with lookup tables for the expensive\n"
+           "       functions of the states with the given indices, each between\n"
+           "       min and max, accurate to the given relative tolerance.\n"
           );
     return -1;
   }
@@ -653,6 +1555,7 @@ main(int argc, char** argv)
   memset(URL, 0, (l + 1) * sizeof(wchar_t));
   const char* mbrurl = argv[1];
   mbsrtowcs(URL, &mbrurl, l, NULL);
+  gModelURL = URL;
 
   ObjRef<iface::cellml_api::CellMLBootstrap> cb =
     CreateCellMLBootstrap();
@@ -680,6 +1583,10 @@ main(int argc, char** argv)
   printf("# Creating integration service...\n");
   ObjRef<iface::cellml_services::CellMLIntegrationService> cis =
     CreateIntegrationService();
+  gCIS = cis;
+  cis->compilerBackend(gCompilerBackend);
+  cis->optimisationLevel(gOptimisationLevel);
+  cis->maxRunThreads(gRunThreads);
 
   int ret;
 
@@ -0,0 +1,100 @@
+// Measures the cost of the check for pause / stop commands which integration
+// runs make after every step, comparing polling a command pipe (as CIS used to
+// do) with reading an atomic command word (as it does now).
+#include "Utilities.hxx"
+#ifdef WIN32
+#include <windows.h>
+#else
+#include <sys/time.h>
+#include <sys/select.h>
+#include <unistd.h>
+#endif
+#include <stdio.h>
+#include <stdlib.h>
+
+void usage()
+{
+  puts("Usage: TimeControlCheck numberOfChecks");
+}
+
+static int64_t
+MicrosNow()
+{
+#ifdef WIN32
+  FILETIME ft;
+  GetSystemTimeAsFileTime(&ft);
+  return ((static_cast<int64_t>(ft.dwHighDateTime) << 32) +
+          ft.dwLowDateTime) / 10;
+#else
+  struct timeval tv;
+  gettimeofday(&tv, NULL);
+  return static_cast<int64_t>(tv.tv_sec) * 1000000 + tv.tv_usec;
+#endif
+}
+
+static void
+Report(const char* aName, uint32_t aChecks, int64_t aMicros)
+{
+  printf("%s: total time = %ld micros, %.2f nanos per check\n", aName,
+         static_cast<long>(aMicros), aMicros * 1000.0 / aChecks);
+}
+
+int main(int argc, char** argv)
+{
+  if (argc < 2)
+  {
+    usage();
+    return 1;
+  }
+
+  uint32_t numChecks = strtoul(argv[1], NULL, 10);
+  if (numChecks == 0)
+  {
+    usage();
+    return 1;
+  }
+
+  // Nothing is ever sent, so every check takes the path taken by a running
+  // integration.
+  uint32_t commandsSeen = 0;
+#ifdef WIN32
+  HANDLE semaphore = CreateSemaphore(NULL, 0, 0x7FFFFFFF, NULL);
+  int64_t start = MicrosNow();
+  for (uint32_t i = 0; i < numChecks; i++)
+    if (WaitForSingleObject(semaphore, 0) == WAIT_OBJECT_0)
+      commandsSeen++;
+  Report("Semaphore poll", numChecks, MicrosNow() - start);
+  CloseHandle(semaphore);
+#else
+  int pipes[2];
+  if (pipe(pipes) != 0)
+  {
+    perror("pipe");
+    return 1;
+  }
+  int64_t start = MicrosNow();
+  for (uint32_t i = 0; i < numChecks; i++)
+  {
+    fd_set pipeset;
+    FD_ZERO(&pipeset);
+    FD_SET(pipes[0], &pipeset);
+    struct timeval to;
+    to.tv_sec = 0;
+    to.tv_usec = 0;
+    if (select(pipes[0] + 1, &pipeset, NULL, NULL, &to) != 0)
+      commandsSeen++;
+  }
+  Report("Pipe select", numChecks, MicrosNow() - start);
+  close(pipes[0]);
+  close(pipes[1]);
+#endif
+
+  CDA_AtomicWord command;
+  start = MicrosNow();
+  for (uint32_t i = 0; i < numChecks; i++)
+    if (command.load() != 0)
+      commandsSeen++;
+  Report("Atomic command word", numChecks, MicrosNow() - start);
+
+  return commandsSeen == 0 ? 0 : 1;
+}
@@ -440,6 +440,7 @@ public:
 #endif
   }
 private:
+  friend class CDACondition;
 #ifdef WIN32
   CRITICAL_SECTION mMutex;
 #else
@@ -447,6 +448,64 @@ private:
 #endif
 };
 
+// A wrapper for a condition variable, used together with a CDAMutex...
+class CDACondition
+{
+public:
+  CDACondition()
+  {
+#ifdef WIN32
+    InitializeConditionVariable(&mCondition);
+#else
+    pthread_cond_init(&mCondition, NULL);
+#endif
+  }
+
+  ~CDACondition()
+  {
+#ifndef WIN32
+    pthread_cond_destroy(&mCondition);
+#endif
+  }
+
+  // Atomically releases m (which must be locked) and waits to be signalled.
+  // m is locked again on return. Spurious wakeups can happen, so callers must
+  // check their condition in a loop.
+  void Wait(CDAMutex& m)
+  {
+#ifdef WIN32
+    SleepConditionVariableCS(&mCondition, &m.mMutex, INFINITE);
+#else
+    pthread_cond_wait(&mCondition, &m.mMutex);
+#endif
+  }
+
+  void Signal()
+  {
+#ifdef WIN32
+    WakeConditionVariable(&mCondition);
+#else
+    pthread_cond_signal(&mCondition);
+#endif
+  }
+
+  void Broadcast()
+  {
+#ifdef WIN32
+    WakeAllConditionVariable(&mCondition);
+#else
+    pthread_cond_broadcast(&mCondition);
+#endif
+  }
+
+private:
+#ifdef WIN32
+  CONDITION_VARIABLE mCondition;
+#else
+  pthread_cond_t mCondition;
+#endif
+};
+
 // A class to provide a scoped lock...
 class CDALock
 {
@@ -899,6 +958,52 @@ private:
   uint32_t mRefcount;
 };
 
+// A word which can be read and written by several threads at once without
+// locking, for flags which are checked far more often than they change.
+class CDA_AtomicWord
+{
+public:
+  CDA_AtomicWord(uint32_t aValue = 0)
+    : mValue(aValue)
+  {
+  }
+
+  uint32_t load()
+  {
+#if defined(__ATOMIC_ACQUIRE)
+    return __atomic_load_n(&mValue, __ATOMIC_ACQUIRE);
+#elif defined(__GCC_HAVE_SYNC_COMPARE_AND_SWAP_4)
+    return __sync_fetch_and_add(&mValue, 0);
+#elif defined(WIN32)
+    return InterlockedCompareExchange((volatile long int*)&mValue, 0, 0);
+#else
+    CDALock l(mMutex);
+    return mValue;
+#endif
+  }
+
+  void store(uint32_t aValue)
+  {
+#if defined(__ATOMIC_RELEASE)
+    __atomic_store_n(&mValue, aValue, __ATOMIC_RELEASE);
+#elif defined(__GCC_HAVE_SYNC_COMPARE_AND_SWAP_4)
+    __sync_synchronize();
+    __sync_lock_test_and_set(&mValue, aValue);
+#elif defined(WIN32)
+    InterlockedExchange((volatile long int*)&mValue, aValue);
+#else
+    CDALock l(mMutex);
+    mValue = aValue;
+#endif
+  }
+
+private:
+#if !(defined(WIN32) || defined(__GCC_HAVE_SYNC_COMPARE_AND_SWAP_4))
+  CDAMutex mMutex;
+#endif
+  volatile uint32_t mValue;
+};
+
 #define CDA_IMPL_ID \
   private: \
     CDA_ID _cda_id; \